@@ -1,13 +1,14 @@
-from flask import Flask, render_template
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flasgger import Swagger
 import os
 from .config import Config
+from .replicas import RoutingSession
 from werkzeug.utils import secure_filename # Import secure_filename
 
-# Initialize db and migrate globally
-db = SQLAlchemy()
+# Initialize db and migrate globally (the session routes reads to replicas when configured)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 
 def create_app():
@@ -20,9 +21,38 @@ def create_app():
     db.init_app(app)
     migrate.init_app(app, db)
 
+    # Send read-only requests to read replicas (DATABASE_REPLICA_URLS)
+    from app import replicas
+    replicas.init_app(app, db)
+
+    # Log statements slower than SLOW_QUERY_THRESHOLD_MS with their plans (SLOW_QUERY_LOG)
+    from app import slowlog
+    slowlog.init_app(app, db)
+
+    # Opt-in cProfile of requests (PROFILE_TOKEN header, PROFILE_SAMPLE_RATE) and tracemalloc
+    from app import profiling, memory
+    profiling.init_app(app)
+    memory.init_app(app)
+
     # Swagger for API documentation
     Swagger(app)
 
+    # Reject uploads and edits early when the server or client is over its limits
+    from app import admission
+    admission.init_app(app)
+
+    # Negotiated response compression and precompressed static files
+    from app import compression
+    compression.init_app(app)
+
+    # Read-only edge mode: serve the active snapshot instead of the database and upload storage
+    if app.config['SNAPSHOT_MODE']:
+        from app import snapshot
+        snapshot.init_app(app)
+        from app.commands import register_commands
+        register_commands(app)
+        return app
+
     # Ensure upload folders exist
     try:
         os.makedirs(app.config['UPLOAD_FOLDER_IMAGES'], exist_ok=True)
@@ -33,15 +63,43 @@ def create_app():
     # Register blueprints
     from app.routes.defect_routes import bp as defect_bp
     from app.routes.file_routes import bp as file_bp # Import file_bp
+    from app.routes.admin_routes import bp as admin_bp
+    from app.routes.stats_routes import bp as stats_bp
+    from app.routes.change_routes import bp as change_bp
+    from app.routes.upload_routes import bp as upload_bp
     app.register_blueprint(defect_bp)
     app.register_blueprint(file_bp) # Register file_bp
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(change_bp)
+    app.register_blueprint(upload_bp)
+
+    # Change events for `GET /defect/changes`, shared by the worker processes
+    from app import changes
+    changes.init_app(app)
+
+    # Semantic search index, re-embedding defects as change events commit
+    from app import semantic
+    semantic.init_app(app)
+
+    # Queue changed defects for the related-defects batch job
+    from app import related
+    related.init_app(app)
+
+    # Discard staged uploads of requests that never committed
+    from app import staging
+    staging.init_app(app)
+
+    # CLI commands (`flask files ...`)
+    from app.commands import register_commands
+    register_commands(app)
 
     _ensure_upload_folders(app)
 
-    # Home route - Render index.html dynamically
+    # Home route - serve the frontend's index.html (precompressed if built)
     @app.route('/')
     def index():
-        return render_template('index.html')
+        return compression.send_precompressed(current_app.config['FRONTEND_BUILD_DIR'], 'index.html')
 
     return app
 
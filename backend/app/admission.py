@@ -0,0 +1,230 @@
+"""
+Admission control for the upload and edit routes.
+
+Uploads and edits can hold a request thread (the whole worker with gunicorn's
+default sync workers) for the whole request timeout, so they are admitted in
+``before_request`` - before the body is parsed - and rejected immediately
+when the server is busy:
+
+* Every client has a token bucket (``ADMISSION_RATE`` tokens per second, at
+  most ``ADMISSION_BURST``); each limited request costs one token. An empty
+  bucket is answered with ``429`` and a ``Retry-After`` of the time until the
+  next token.
+* All limited routes together may occupy at most ``ADMISSION_WRITE_SLOTS``
+  request threads, and each route at most its entry in
+  ``ADMISSION_ROUTE_LIMITS``. gunicorn runs ``2 * CPUs + 1`` workers of
+  ``GUNICORN_THREADS`` threads each (four by default), so the default of
+  ``GUNICORN_THREADS`` slots per CPU keeps about half of them free for search
+  and file requests. A full route or slot pool is answered with ``503`` and
+  ``Retry-After: ADMISSION_RETRY_AFTER``.
+
+Limits hold across gunicorn worker processes: slots are ``flock``-ed files
+(released by the kernel if a worker dies) and buckets live in a small SQLite
+file, both under ``ADMISSION_STATE_DIR``. Where ``fcntl`` is unavailable
+(Windows development servers) slots fall back to per-process semaphores.
+
+Admission control is off by default. Buckets are keyed by the client
+address, which behind a reverse proxy is the proxy's own: enable it
+together with ``ADMISSION_CLIENT_HEADER`` (e.g. ``X-Forwarded-For``, as set
+by the proxy) or all clients share one bucket. Only the routes in
+``ADMISSION_ROUTE_LIMITS`` are limited; reads, including those the ASGI
+deployment answers natively (``app/asgi.py``), are never admitted or
+rejected here.
+"""
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_local_semaphores = {}
+_local_semaphores_lock = threading.Lock()
+
+
+class SlotPool:
+    """
+    A cross-process counting semaphore made of ``size`` lock files.
+
+    Args:
+        directory (str): Where the lock files are kept.
+        name (str): The pool name, used as the lock file prefix.
+        size (int): The number of slots.
+    """
+
+    def __init__(self, directory, name, size):
+        self.directory = directory
+        self.name = name
+        self.size = size
+
+    def try_acquire(self):
+        """
+        Takes a free slot without waiting.
+
+        Returns:
+            The slot handle to pass to ``release``, or None if all slots are taken.
+        """
+        if fcntl is None:
+            with _local_semaphores_lock:
+                semaphore = _local_semaphores.setdefault(
+                    (self.name, self.size), threading.BoundedSemaphore(self.size))
+            return semaphore if semaphore.acquire(blocking=False) else None
+
+        # Start at a random slot so concurrent requests do not all probe slot 0 first.
+        start = random.randrange(self.size)
+        for i in range(self.size):
+            path = os.path.join(self.directory, f"{self.name}.{(start + i) % self.size}.lock")
+            # A fresh descriptor per attempt: flock() locks are per open file,
+            # so a shared descriptor would let two threads hold the same slot.
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @staticmethod
+    def release(slot):
+        if fcntl is None:
+            slot.release()
+        else:
+            os.close(slot)  # closing the descriptor drops the lock
+
+
+class TokenBuckets:
+    """
+    Per-client token buckets shared by all worker processes through SQLite.
+
+    Args:
+        path (str): The SQLite database file.
+        rate (float): Tokens added per second.
+        burst (int): Bucket capacity.
+    """
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def take(self, client):
+        """
+        Takes one token from ``client``'s bucket.
+
+        Returns:
+            float: 0 if the request is admitted, otherwise the seconds until a token is available.
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE client = ?', (client,)).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            if tokens < 1:
+                connection.execute('ROLLBACK')
+                return (1 - tokens) / self.rate
+            connection.execute('INSERT OR REPLACE INTO bucket (client, tokens, updated) VALUES (?, ?, ?)',
+                               (client, tokens - 1, now))
+            # Buckets idle long enough to be full again carry no information.
+            if random.random() < 0.01:
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - self.burst / self.rate,))
+            connection.execute('COMMIT')
+            return 0
+        finally:
+            connection.close()
+
+
+def _reject(message, code, retry_after):
+    response = jsonify({'status': 'error', 'message': message})
+    response.status_code = code
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def client_key():
+    """Returns the address requests are rate limited by (see ``ADMISSION_CLIENT_HEADER``)."""
+    header = current_app.config['ADMISSION_CLIENT_HEADER']
+    if header and request.headers.get(header):
+        # e.g. X-Forwarded-For: client, proxy1, proxy2
+        return request.headers[header].split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+
+def _admit():
+    """``before_request`` hook rejecting limited requests the server has no room for."""
+    state = current_app.extensions['admission']
+    route_pool = state['routes'].get(request.endpoint)
+    if route_pool is None:
+        return None
+
+    client = client_key()
+    try:
+        wait = state['buckets'].take(client)
+    except sqlite3.Error as e:
+        # Rate limiting is best effort; never fail a request because of it.
+        logger.error(f"Admission token bucket unavailable: {e}")
+        wait = 0
+    if wait:
+        logger.info(f"Rate limited {client} on {request.endpoint}")
+        return _reject('Too many requests, please retry later', 429, wait)
+
+    retry_after = current_app.config['ADMISSION_RETRY_AFTER']
+    write_slot = state['writes'].try_acquire()
+    if write_slot is None:
+        logger.info(f"Rejected {request.endpoint}: all write slots busy")
+        return _reject('Server busy, please retry later', 503, retry_after)
+    route_slot = route_pool.try_acquire()
+    if route_slot is None:
+        SlotPool.release(write_slot)
+        logger.info(f"Rejected {request.endpoint}: route concurrency limit reached")
+        return _reject('Too many concurrent requests for this operation, please retry later', 503, retry_after)
+
+    g.admission_slots = (write_slot, route_slot)
+    return None
+
+
+def _release(exception=None):
+    """``teardown_request`` hook returning the request's slots."""
+    for slot in g.pop('admission_slots', ()):
+        SlotPool.release(slot)
+
+
+def init_app(app):
+    """Registers admission control for the routes in ``ADMISSION_ROUTE_LIMITS``."""
+    config = app.config
+    if not config['ADMISSION_CONTROL']:
+        return
+
+    if not config['ADMISSION_CLIENT_HEADER']:
+        logger.warning('ADMISSION_CONTROL is on without ADMISSION_CLIENT_HEADER: clients are rate limited by '
+                       'their remote address, so behind a reverse proxy they all share one token bucket')
+
+    directory = config['ADMISSION_STATE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    app.extensions['admission'] = {
+        'writes': SlotPool(directory, 'writes', config['ADMISSION_WRITE_SLOTS']),
+        'routes': {endpoint: SlotPool(directory, endpoint, limit)
+                   for endpoint, limit in config['ADMISSION_ROUTE_LIMITS'].items()},
+        'buckets': TokenBuckets(os.path.join(directory, 'buckets.db'),
+                                config['ADMISSION_RATE'], config['ADMISSION_BURST']),
+    }
+    app.before_request(_admit)
+    app.teardown_request(_release)
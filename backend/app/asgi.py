@@ -0,0 +1,284 @@
+"""
+ASGI application for high-concurrency reads (``asgi.py``).
+
+Under an ASGI server (``uvicorn asgi:app``) the read paths that are mostly
+I/O wait run on the event loop, so a waiting client costs a coroutine
+rather than a worker thread or process:
+
+* ``GET``/``HEAD`` ``/images/<name>`` and ``/pdfs/<name>`` on local storage:
+  ``HEAD`` and ``If-None-Match`` are answered from the stored file metadata
+  (``app/filemeta.py``) when there is some; otherwise werkzeug's
+  ``send_file`` answers conditional and range requests exactly like the
+  sync route. The file is read in ``ASGI_CHUNK_SIZE`` chunks on the
+  default thread pool, so the loop never blocks on disk.
+* ``GET /defect/search`` (keyword mode) and ``GET /defect/<id>``: the statements and JSON
+  of ``defect_routes`` (``search_statement``, ``defect_statement``,
+  ``defect_json``) run on an async engine. Its driver is derived from
+  ``SQLALCHEMY_DATABASE_URI`` (aiosqlite, asyncpg or aiomysql, see
+  ``ASYNC_DRIVERS``), or it comes from ``ASGI_DATABASE_URL``, e.g. to read
+  from a replica.
+
+Everything else goes to the Flask app through a2wsgi's ``WSGIMiddleware``,
+on a pool of ``ASGI_WSGI_THREADS`` threads. That includes writes, admin and
+stats routes, the change stream, file routes on S3, packed or X-Accel
+storage, and every route in ``SNAPSHOT_MODE``. Those requests get all of
+the app's hooks (admission, replicas, compression). The native handlers
+apply the same response compression; they read from one database and do
+not take part in replica routing. They also bypass admission control,
+which only limits the write routes in ``ADMISSION_ROUTE_LIMITS``; put a
+rate limit in the proxy in front of them if reads need one.
+
+Requires ``a2wsgi``, an async driver for the database and an ASGI server.
+``benchmarks/bench_asgi.py`` compares concurrent reads against the sync
+deployment.
+"""
+import asyncio
+import logging
+import re
+from urllib.parse import parse_qsl
+
+from sqlalchemy.engine import make_url
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_accept_header
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper
+
+from app import create_app, db, filemeta
+from app.compression import compress_body
+from app.routes.defect_routes import (search_statement, defect_statement, defect_json, related_statement,
+                                      related_json)
+from app.storage import LocalStorage, get_storage
+
+try:
+    from a2wsgi import WSGIMiddleware
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+except ImportError:  # pragma: no cover - only needed for the ASGI deployment
+    WSGIMiddleware = None
+
+logger = logging.getLogger(__name__)
+
+# Sync dialect -> async driver used for the native read handlers
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+_FILE_ROUTE = re.compile(r'^/(images|pdfs)/([^/]+)$')
+_DEFECT_ROUTE = re.compile(r'^/defect/(\d+)$')
+
+
+def async_database_url(url):
+    """
+    Maps a sync SQLAlchemy URL to the same database through an async driver.
+
+    Raises:
+        ValueError: If the dialect has no async driver in ``ASYNC_DRIVERS``.
+    """
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for {dialect!r}; set ASGI_DATABASE_URL")
+    return url.set(drivername=ASYNC_DRIVERS[dialect])
+
+
+def _query_args(scope):
+    """Parses the query string like ``request.args``: UTF-8, and the first value of a repeated key wins."""
+    args = {}
+    for key, value in parse_qsl(scope['query_string'].decode('utf-8', 'replace'), keep_blank_values=True,
+                                encoding='utf-8', errors='replace'):
+        args.setdefault(key, value)
+    return args
+
+
+def _environ(scope):
+    """Builds the WSGI environ werkzeug needs to evaluate conditional and range headers."""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+class AsgiApp:
+    """
+    Routes the hot read paths to async handlers and everything else to the Flask app.
+
+    Args:
+        flask_app (Flask): The app from ``create_app``.
+    """
+
+    def __init__(self, flask_app):
+        if WSGIMiddleware is None:
+            raise RuntimeError('The ASGI deployment requires a2wsgi and greenlet (SQLAlchemy asyncio)')
+        self.flask_app = flask_app
+        config = flask_app.config
+        self.config = config
+        self.chunk_size = config['ASGI_CHUNK_SIZE']
+        self.wsgi = WSGIMiddleware(flask_app, workers=config['ASGI_WSGI_THREADS'])
+        self.native = not config['SNAPSHOT_MODE']
+
+        self.file_storages = {}
+        self.engine = None
+        self.session_factory = None
+        if not self.native:
+            return
+
+        with flask_app.app_context():
+            for prefix, folder in (('images', config['UPLOAD_FOLDER_IMAGES']), ('pdfs', config['UPLOAD_FOLDER_PDFS'])):
+                storage = get_storage(folder)
+                # Redirecting drivers (S3, X-Accel) send no bytes themselves; packed images need the WSGI path.
+                if type(storage) is LocalStorage and not storage.accel_prefix:
+                    self.file_storages[prefix] = storage
+            url = config['ASGI_DATABASE_URL'] or async_database_url(db.engine.url)
+        # SQLite's async pool is not sized
+        options = {} if make_url(url).get_backend_name() == 'sqlite' else {'pool_size': config['ASGI_DB_POOL_SIZE']}
+        self.engine = create_async_engine(url, **options)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and self.native and scope['method'] in ('GET', 'HEAD'):
+            path = scope['path']
+            match = _FILE_ROUTE.match(path)
+            if match and match.group(1) in self.file_storages:
+                return await self.serve_file(scope, receive, send, match.group(1), match.group(2))
+            if scope['method'] == 'GET':
+                if path == '/defect/search' and _query_args(scope).get('mode', 'keyword') == 'keyword':
+                    return await self.search_defect(scope, send)
+                match = _DEFECT_ROUTE.match(path)
+                if match:
+                    return await self.get_defect(scope, send, int(match.group(1)))
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send_response(self, send, status, headers, body=b''):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_not_found(self, scope, send):
+        response = NotFound().get_response(_environ(scope))
+        await self._send_response(send, response.status_code, response.headers.items(), response.get_data())
+
+    async def _send_json(self, scope, send, data):
+        body = self.flask_app.json.dumps(data).encode()
+        headers = Headers({'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'})
+        if self.config['COMPRESS_RESPONSES']:
+            accept = dict(scope['headers']).get(b'accept-encoding', b'').decode('latin-1')
+            body, encoding = compress_body(body, parse_accept_header(accept), self.config)
+            if encoding:
+                headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(len(body))
+        await self._send_response(send, 200, headers.items(), body)
+
+    def _resolve(self, storage, name):
+        # The layout is read from the app config
+        with self.flask_app.app_context():
+            return storage.path(name)
+
+    async def _file_metadata(self, kind, name):
+        cache = filemeta.get_cache(self.flask_app)
+        hit, meta = cache.get((kind, name))
+        if not hit:
+            async with self.session_factory() as session:
+                row = (await session.execute(filemeta.metadata_statement(kind, name))).first()
+            meta = dict(row._mapping) if row else None
+            cache.put((kind, name), meta)
+        return meta
+
+    async def serve_file(self, scope, receive, send, kind, name):
+        """Async counterpart of ``file_routes.serve_image``/``serve_pdf`` for local storage."""
+        meta = await self._file_metadata(kind, name)
+        if meta:
+            if_none_match = dict(scope['headers']).get(b'if-none-match')
+            response = filemeta.shortcut_response(Response, meta, scope['method'],
+                                                  if_none_match.decode('latin-1') if if_none_match else None)
+            if response is not None:
+                return await self._send_response(send, response.status_code, response.headers.items())
+
+        path = await asyncio.to_thread(self._resolve, self.file_storages[kind], name)
+        if path is None:
+            return await self._send_not_found(scope, send)
+
+        environ = _environ(scope)
+        environ['wsgi.file_wrapper'] = lambda file, buffer_size=self.chunk_size: FileWrapper(file, self.chunk_size)
+        response = await asyncio.to_thread(send_file, path, environ,
+                                           max_age=self.config.get('SEND_FILE_MAX_AGE_DEFAULT'))
+        if meta and response.status_code == 200:
+            response.set_etag(meta['sha256'])
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for key, value in response.headers.items()]})
+            if scope['method'] == 'HEAD' or response.status_code == 304:
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            chunks = iter(response.response)
+            while not disconnected.is_set():
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            await asyncio.to_thread(response.close)
+
+    async def search_defect(self, scope, send):
+        """Async counterpart of ``defect_routes.search_defect``."""
+        args = _query_args(scope)
+        async with self.session_factory() as session:
+            defects = (await session.execute(search_statement(args.get('query', '').lower()))).scalars().all()
+            data = [defect_json(defect) for defect in defects]
+        await self._send_json(scope, send, data)
+
+    async def get_defect(self, scope, send, defect_id):
+        """Async counterpart of ``defect_routes.get_defect``."""
+        async with self.session_factory() as session:
+            defect = (await session.execute(defect_statement(defect_id))).scalar_one_or_none()
+            data = defect_json(defect) if defect is not None else None
+            if data is not None and self.config['RELATED_DEFECTS']:
+                rows = await session.execute(related_statement(defect_id, self.config['RELATED_IN_DEFECT']))
+                data['related'] = related_json(rows.all())
+        if data is None:
+            return await self._send_not_found(scope, send)
+        await self._send_json(scope, send, data)
+
+
+def create_asgi_app():
+    """Creates the Flask app and wraps it for an ASGI server."""
+    return AsgiApp(create_app())
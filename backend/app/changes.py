@@ -0,0 +1,271 @@
+"""
+Change stream for open browsers, delivered as Server-Sent Events.
+
+Mutating routes call ``publish`` with compact change events (``defect.created``,
+``defect.updated``, ``defect.deleted``, ``mode.changed``, ``mode.deleted``)
+carrying only ids. Once the transaction commits, the events are appended to
+an SQLite event log (``CHANGES_LOG_PATH``) shared by all worker processes on
+the host. Each worker runs one thread that tails the log every
+``CHANGES_POLL_INTERVAL`` seconds while it has open streams and hands new
+events to them; clients then refetch only the defects that changed.
+
+The log doubles as the replay buffer: a reconnecting ``EventSource`` sends
+``Last-Event-ID`` and receives the events it missed. When those have already
+been pruned (``CHANGES_KEEP``) or a slow client's queue overflows, the
+stream sends a ``reset`` event and the client falls back to a full refetch.
+
+Streams occupy a request thread, so they end after
+``CHANGES_STREAM_MAX_SECONDS`` (browsers reconnect transparently) and each
+worker serves at most ``CHANGES_MAX_STREAMS`` of them. Streaming needs
+threaded workers (``GUNICORN_THREADS`` in ``gunicorn_config.py``, four by
+default); with sync workers (``GUNICORN_THREADS=1``) no streams are served,
+a warning is logged at startup and clients fall back to refetching.
+"""
+import json
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app import db
+from app.staging import call_after_commit
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ('defect.created', 'defect.updated', 'defect.deleted', 'mode.changed', 'mode.deleted')
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+_PENDING_KEY = 'changes_pending'
+
+
+class EventLog:
+    """
+    Append-only event log shared by the worker processes through SQLite.
+
+    Event ids are never reused (``AUTOINCREMENT``), so they are safe to use as
+    ``Last-Event-ID`` across pruning.
+
+    Args:
+        path (str): The SQLite database file.
+        keep (int): Approximate number of events retained for replay.
+    """
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS event '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, payload TEXT NOT NULL)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=2.0, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def append(self, events):
+        """Appends a list of event dicts in one transaction."""
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT INTO event (created, payload) VALUES (?, ?)',
+                                   [(now, json.dumps(change, separators=(',', ':'))) for change in events])
+            if random.random() < 0.01:
+                connection.execute('DELETE FROM event WHERE id <= (SELECT MAX(id) FROM event) - ?', (self.keep,))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def since(self, last_id, limit=500):
+        """Returns up to ``limit`` ``(id, payload)`` pairs after ``last_id``, oldest first."""
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT id, payload FROM event WHERE id > ? ORDER BY id LIMIT ?',
+                                      (last_id, limit)).fetchall()
+        finally:
+            connection.close()
+
+    def bounds(self):
+        """Returns the oldest and latest retained event ids (None, None if the log is empty)."""
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT MIN(id), MAX(id) FROM event').fetchone()
+        finally:
+            connection.close()
+
+
+class Subscription:
+    """One open stream's queue of ``(id, payload)`` pairs."""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeHub:
+    """
+    Per-process fan-out from the event log to the open streams.
+
+    Args:
+        log (EventLog): The shared event log.
+        poll_interval (float): Seconds between reads of the log while streams are open.
+        max_streams (int): Open streams allowed in this process.
+    """
+
+    def __init__(self, log, poll_interval, max_streams):
+        self.log = log
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._thread = None
+
+    def subscribe(self):
+        """
+        Opens a subscription to events appended from now on.
+
+        Returns:
+            Subscription: The subscription, or None if this process serves ``max_streams`` already.
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                return None
+            if not self._subscribers:
+                # Nobody was listening, so the tail position is stale.
+                self._last_id = self.log.bounds()[1] or 0
+            subscription = Subscription()
+            self._subscribers.add(subscription)
+            # Started lazily so it runs in the worker process, not in the gunicorn master.
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='change-hub', daemon=True)
+                self._thread.start()
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                subscribers = list(self._subscribers)
+                last_id = self._last_id
+            if not subscribers:
+                continue
+            try:
+                events = self.log.since(last_id)
+            except sqlite3.Error as e:
+                logger.error(f"Change log unavailable: {e}")
+                continue
+            if not events:
+                continue
+            for subscriber in subscribers:
+                for change in events:
+                    subscriber.deliver(change)
+            with self._lock:
+                self._last_id = max(self._last_id, events[-1][0])
+
+    def stream_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def publish(event_type, defect, **fields):
+    """
+    Queues a change event; it is published once the current session commits.
+
+    Args:
+        event_type (str): One of ``EVENT_TYPES``.
+        defect (Defect | int): The defect that changed, or its id. A new defect
+            may be passed before its id is assigned.
+        **fields: Further ids, e.g. ``mode_id``.
+    """
+    if 'changes' not in current_app.extensions and not current_app.extensions.get('change_listeners'):
+        return
+    pending = db.session.info.get(_PENDING_KEY)
+    if pending is None:
+        pending = db.session.info[_PENDING_KEY] = []
+        call_after_commit(_deliver_pending, current_app._get_current_object(), pending)
+    pending.append((event_type, defect, fields))
+
+
+def add_listener(app, listener):
+    """
+    Registers ``listener(events)`` to be called with each committed batch of change events.
+
+    Listeners run in the committing request after the events are logged, and
+    also when ``CHANGE_STREAM`` is disabled; they should hand slow work off.
+    """
+    app.extensions.setdefault('change_listeners', []).append(listener)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_pending(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _defect_id(defect):
+    if isinstance(defect, int):
+        return defect
+    # The identity is kept on the instance, so this emits no SQL after the commit.
+    identity = inspect(defect).identity
+    return identity[0] if identity else None
+
+
+def _deliver_pending(app, pending):
+    events = [dict(type=event_type, defect_id=_defect_id(defect), **fields) for event_type, defect, fields in pending]
+    hub = app.extensions.get('changes')
+    if hub is not None:
+        try:
+            hub.log.append(events)
+        except sqlite3.Error as e:
+            # The write itself committed; open streams will miss these events.
+            logger.error(f"Error publishing {len(pending)} change events: {e}")
+    for listener in app.extensions.get('change_listeners', ()):
+        try:
+            listener(events)
+        except Exception as e:
+            logger.error(f"Error in change listener {listener!r}: {e}")
+
+
+def format_event(data, event_id=None, event=None):
+    """Formats one Server-Sent Events message; ``data`` is an already serialized string."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def get_hub():
+    """Returns the app's change hub, or None if the change stream is disabled."""
+    return current_app.extensions.get('changes')
+
+
+def init_app(app):
+    """Creates the event log and this process's hub when ``CHANGE_STREAM`` is enabled."""
+    config = app.config
+    if not config['CHANGE_STREAM']:
+        return
+    if config['CHANGES_MAX_STREAMS'] < 1:
+        logger.warning('CHANGE_STREAM is on but CHANGES_MAX_STREAMS is 0 (sync workers, GUNICORN_THREADS=1): '
+                       'GET /defect/changes answers 503; set GUNICORN_THREADS above 1 to serve streams')
+    log = EventLog(config['CHANGES_LOG_PATH'], config['CHANGES_KEEP'])
+    app.extensions['changes'] = ChangeHub(log, config['CHANGES_POLL_INTERVAL'], config['CHANGES_MAX_STREAMS'])
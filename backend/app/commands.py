@@ -0,0 +1,326 @@
+"""
+Command line tools, available as ``flask files|defects|assets|snapshot|stats|search <command>``.
+"""
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app.models import DefectMode, PDFFile
+from app import maintenance, compression, snapshot, static_export, stats, uploads, semantic, related, filemeta, tiles, imaging
+from app.layout import LAYOUTS
+from app.storage import get_storage
+
+files_cli = AppGroup('files', help='Maintenance commands for uploaded files.')
+defects_cli = AppGroup('defects', help='Maintenance commands for defect records.')
+assets_cli = AppGroup('assets', help='Build steps for the frontend assets.')
+snapshot_cli = AppGroup('snapshot', help='Read-only library snapshots for edge sites.')
+stats_cli = AppGroup('stats', help='Rollup tables behind the /defect/stats endpoints.')
+search_cli = AppGroup('search', help='Semantic index behind /defect/search?mode=semantic.')
+
+
+def register_commands(app):
+    """Attaches the CLI command groups to the application."""
+    app.cli.add_command(files_cli)
+    app.cli.add_command(defects_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(snapshot_cli)
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(search_cli)
+
+
+def _upload_targets():
+    """Pairs each upload folder with the columns that reference its files."""
+    return [
+        (current_app.config['UPLOAD_FOLDER_IMAGES'], DefectMode.image_filename, DefectMode.id),
+        (current_app.config['UPLOAD_FOLDER_PDFS'], PDFFile.filename, PDFFile.id),
+    ]
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def _echo_report(title, report, dry_run):
+    verb = 'would remove' if dry_run else 'removed'
+    count = report['orphaned'] if dry_run else report['removed']
+    click.echo(f"{title}: {report['folder']}")
+    click.echo(f"  scanned {report['scanned']}, orphaned {report['orphaned']} "
+               f"({_format_bytes(report['orphaned_bytes'])}), {verb} {count}, "
+               f"skipped {report['skipped_recent']} recent, {report['errors']} errors")
+    for name in report['samples']:
+        click.echo(f"    {name}")
+
+
+@files_cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='Report orphaned files without deleting them.')
+@click.option('--batch-size', type=int, default=None, help='Directory entries checked per query.')
+@click.option('--grace-seconds', type=int, default=None, help='Ignore files younger than this.')
+@click.option('--check-missing', is_flag=True, help='Also report rows whose file is missing.')
+def gc_command(dry_run, batch_size, grace_seconds, check_missing):
+    """Delete uploaded files and image tiles that no defect, mode or PDF row references, and abandoned chunked uploads."""
+    batch_size = batch_size or current_app.config['FILE_GC_BATCH_SIZE']
+    grace_seconds = current_app.config['FILE_GC_GRACE_SECONDS'] if grace_seconds is None else grace_seconds
+
+    total = 0
+    for folder, column, id_column in _upload_targets():
+        report = maintenance.collect_orphans(folder, column, batch_size, grace_seconds, dry_run)
+        _echo_report('Orphaned files', report, dry_run)
+        total += report['orphaned_bytes']
+
+        report = maintenance.collect_stale_staging(folder, batch_size, grace_seconds, dry_run)
+        _echo_report('Stale staged uploads', report, dry_run)
+        total += report['orphaned_bytes']
+
+        if check_missing:
+            missing = maintenance.find_missing_files(folder, column, id_column, batch_size)
+            click.echo(f"Rows with missing files: {missing['missing']} of {missing['checked']} checked")
+            for row_id in missing['samples']:
+                click.echo(f"    id {row_id}")
+
+    # Tile pyramids belong to the image their names start with.
+    report = maintenance.collect_orphans(current_app.config['UPLOAD_FOLDER_TILES'], DefectMode.image_filename,
+                                         batch_size, grace_seconds, dry_run, owner=tiles.image_of)
+    _echo_report('Orphaned image tiles', report, dry_run)
+    total += report['orphaned_bytes']
+
+    report = maintenance.collect_upload_sessions(uploads.sessions_folder(current_app.config),
+                                                 current_app.config['UPLOAD_SESSION_TTL_HOURS'] * 3600, dry_run)
+    _echo_report('Abandoned chunked uploads', report, dry_run)
+    total += report['orphaned_bytes']
+
+    older_than = datetime.utcnow() - timedelta(days=current_app.config['UPLOAD_IDEMPOTENCY_TTL_DAYS'])
+    keys = maintenance.prune_idempotency_keys(older_than, dry_run)
+    click.echo(f"Expired upload idempotency keys: {'would remove' if dry_run else 'removed'} {keys}")
+
+    click.echo(f"{'Reclaimable' if dry_run else 'Reclaimed'}: {_format_bytes(total)}")
+
+
+@files_cli.command('metadata')
+@click.option('--refresh', is_flag=True, help='Recompute the metadata of every file, not only missing ones.')
+@click.option('--batch-size', type=int, default=None, help='Rows updated per transaction.')
+def files_metadata_command(refresh, batch_size):
+    """Record size, SHA-256, MIME type, dimensions and page counts of stored files."""
+    report = filemeta.backfill(batch_size or current_app.config['FILE_GC_BATCH_SIZE'], refresh)
+    click.echo(f"Recorded the metadata of {report['images']} images and {report['pdfs']} PDFs")
+    for name in report['missing']:
+        click.echo(f"  missing from storage: {name}")
+
+
+@files_cli.command('tiles')
+@click.option('--refresh', is_flag=True, help='Rebuild existing pyramids too.')
+@click.option('--batch-size', type=int, default=None, help='Image rows read per query.')
+def files_tiles_command(refresh, batch_size):
+    """Build the deep-zoom tile pyramids of large images stored without one."""
+    if not tiles.tiling_enabled(current_app.config):
+        raise click.ClickException('Tile pyramids need IMAGE_TILES enabled and Pillow installed.')
+    report = tiles.backfill(batch_size or current_app.config['FILE_GC_BATCH_SIZE'], refresh)
+    click.echo(f"Stored {report['tiles']} tiles of {report['images']} images")
+
+
+@files_cli.command('resume')
+@click.option('--grace-seconds', type=int, default=None, help='Leave jobs younger than this to their worker.')
+@click.option('--batch-size', type=int, default=None, help='Jobs read per query.')
+def files_resume_command(grace_seconds, batch_size):
+    """Run image normalization and tiling jobs that a restarted or recycled worker never finished."""
+    grace_seconds = current_app.config['FILE_GC_GRACE_SECONDS'] if grace_seconds is None else grace_seconds
+    report = imaging.resume_jobs(grace_seconds, batch_size or current_app.config['FILE_GC_BATCH_SIZE'])
+    for kind, count in report.items():
+        click.echo(f"Ran {count} {kind} jobs")
+
+
+@files_cli.command('migrate-layout')
+@click.option('--layout', type=click.Choice(LAYOUTS), default=None,
+              help='Target layout (defaults to UPLOAD_LAYOUT).')
+@click.option('--batch-size', type=int, default=None, help='Files moved per batch.')
+@click.option('--pause', type=float, default=0.0, help='Seconds to sleep between batches.')
+@click.option('--dry-run', is_flag=True, help='Count the files that would be moved.')
+def migrate_layout_command(layout, batch_size, pause, dry_run):
+    """Move uploaded files into the flat or sharded directory layout."""
+    if current_app.config['STORAGE_BACKEND'] != 'local':
+        raise click.ClickException('Upload layouts only apply to STORAGE_BACKEND = local.')
+    layout = layout or current_app.config['UPLOAD_LAYOUT']
+    batch_size = batch_size or current_app.config['FILE_GC_BATCH_SIZE']
+    if layout != current_app.config['UPLOAD_LAYOUT'] or not current_app.config['UPLOAD_LAYOUT_FALLBACK']:
+        click.echo('Warning: UPLOAD_LAYOUT should match the target layout and UPLOAD_LAYOUT_FALLBACK '
+                   'should stay enabled while files are being moved.')
+
+    folders = [folder for folder, _, _ in _upload_targets()]
+    folders.append(current_app.config['UPLOAD_FOLDER_ORIGINALS'])
+    folders.append(current_app.config['UPLOAD_FOLDER_TILES'])
+    for folder in folders:
+        report = maintenance.migrate_layout(folder, layout, batch_size, pause, dry_run)
+        verb = 'would move' if dry_run else 'moved'
+        click.echo(f"{report['folder']}: scanned {report['scanned']}, {verb} {report['moved']}, "
+                   f"{report['errors']} errors")
+
+
+@files_cli.command('compact-packs')
+@click.option('--min-garbage', type=float, default=0.3, show_default=True,
+              help='Rewrite segments with at least this share of deleted bytes.')
+@click.option('--pack-loose', is_flag=True, help='Also move small loose images into segments.')
+@click.option('--batch-size', type=int, default=None, help='Blobs moved per index query.')
+@click.option('--dry-run', is_flag=True, help='Report what would be compacted.')
+def compact_packs_command(min_garbage, pack_loose, batch_size, dry_run):
+    """Reclaim space in the image segment files (IMAGE_PACKS)."""
+    storage = get_storage(current_app.config['UPLOAD_FOLDER_IMAGES'])
+    if not hasattr(storage, 'compact'):
+        raise click.ClickException('Image packs are not enabled (IMAGE_PACKS, STORAGE_BACKEND = local).')
+
+    report = storage.compact(min_garbage, pack_loose, batch_size or current_app.config['FILE_GC_BATCH_SIZE'],
+                             dry_run)
+    verb = 'would rewrite' if dry_run else 'rewrote'
+    click.echo(f"{report['segments']} segments, {verb} {report['compacted']} "
+               f"({_format_bytes(report['reclaimed_bytes'])} reclaimable), moved {report['moved']} blobs")
+    if pack_loose:
+        click.echo(f"{'Would pack' if dry_run else 'Packed'} {report['packed_loose']} loose images")
+
+
+@defects_cli.command('purge')
+@click.option('--older-than-days', type=float, default=None,
+              help='Purge defects deleted longer ago than this (defaults to SOFT_DELETE_RETENTION_DAYS).')
+@click.option('--batch-size', type=int, default=None, help='Defects purged per transaction.')
+@click.option('--dry-run', is_flag=True, help='Count what would be purged.')
+def purge_command(older_than_days, batch_size, dry_run):
+    """Permanently remove deleted defects and their files (run periodically, e.g. from cron)."""
+    days = current_app.config['SOFT_DELETE_RETENTION_DAYS'] if older_than_days is None else older_than_days
+    batch_size = batch_size or current_app.config['FILE_GC_BATCH_SIZE']
+    report = maintenance.purge_deleted_defects(datetime.utcnow() - timedelta(days=days), batch_size, dry_run)
+    if dry_run:
+        click.echo(f"Would purge {report['defects']} defects deleted more than {days:g} days ago "
+                   f"and {report['files']} files")
+    else:
+        click.echo(f"Purged {report['defects']} defects, {report['modes']} modes, {report['pdfs']} PDFs; "
+                   f"removed {report['files']} files, {report['errors']} errors")
+
+
+@assets_cli.command('precompress')
+@click.argument('directories', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('--min-size', type=int, default=None, help='Skip files smaller than this (bytes).')
+def precompress_command(directories, min_size):
+    """Write .br/.gz siblings for the frontend build (run after every build)."""
+    directories = directories or (current_app.config['FRONTEND_BUILD_DIR'],)
+    min_size = current_app.config['COMPRESS_MIN_SIZE'] if min_size is None else min_size
+    if compression.brotli is None:
+        click.echo('brotli is not installed; writing .gz siblings only.')
+
+    for directory in directories:
+        report = compression.precompress_tree(directory, current_app.config['PRECOMPRESS_EXTENSIONS'], min_size)
+        click.echo(f"{directory}: {report['compressed']} files ({_format_bytes(report['bytes_in'])}) -> "
+                   f"gz {_format_bytes(report['bytes_out']['.gz'])}, br {_format_bytes(report['bytes_out']['.br'])}; "
+                   f"{report['skipped']} below minimum size")
+
+
+@defects_cli.command('related')
+@click.option('--full', is_flag=True, help='Recompute every defect, not only those changed since the last run.')
+@click.option('--block-size', type=int, default=None, help='Defects scored per matrix product.')
+def related_command(full, block_size):
+    """Precompute the related defects shown on the defect view."""
+    config = current_app.config
+    report = related.compute_related(full, config['RELATED_TOP_K'], config['RELATED_TEXT_WEIGHT'],
+                                     config['RELATED_IMAGE_WEIGHT'], block_size or config['RELATED_BLOCK_SIZE'],
+                                     config['FILE_GC_BATCH_SIZE'])
+    click.echo(f"{'Full' if report['full'] else 'Incremental'} run over {report['defects']} defects: "
+               f"recomputed {report['recomputed']}, updated {report['merged']} other lists, "
+               f"wrote {report['rows']} rows, removed {report['removed']} stale rows")
+
+
+@snapshot_cli.command('build')
+@click.option('--output', type=click.Path(file_okay=False), default=None,
+              help='Snapshot root directory (defaults to SNAPSHOT_DIR).')
+@click.option('--no-activate', is_flag=True, help='Build without making the snapshot current.')
+@click.option('--keep', type=int, default=None, help='Snapshots to keep (defaults to SNAPSHOT_KEEP).')
+@click.option('--batch-size', type=int, default=None, help='Defects loaded per query.')
+def snapshot_build_command(output, no_activate, keep, batch_size):
+    """Compile the library into a read-only snapshot (SQLite index + blob pack)."""
+    root = output or current_app.config['SNAPSHOT_DIR']
+    os.makedirs(root, exist_ok=True)
+    report = snapshot.build_snapshot(root, batch_size or current_app.config['FILE_GC_BATCH_SIZE'])
+    click.echo(f"Built snapshot {report['name']}: {report['defects']} defects, {report['blobs']} files "
+               f"({_format_bytes(report['pack_bytes'])})")
+    for name in report['missing']:
+        click.echo(f"  missing from storage: {name}")
+
+    if not no_activate:
+        snapshot.activate_snapshot(root, report['name'])
+        click.echo(f"Activated {report['name']}")
+    keep = current_app.config['SNAPSHOT_KEEP'] if keep is None else keep
+    for name in snapshot.prune_snapshots(root, keep):
+        click.echo(f"Removed old snapshot {name}")
+
+
+@snapshot_cli.command('activate')
+@click.argument('name')
+@click.option('--root', type=click.Path(file_okay=False), default=None,
+              help='Snapshot root directory (defaults to SNAPSHOT_DIR).')
+def snapshot_activate_command(name, root):
+    """Atomically switch the served snapshot to NAME (e.g. after copying it to an edge site)."""
+    root = root or current_app.config['SNAPSHOT_DIR']
+    try:
+        snapshot.activate_snapshot(root, name)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Activated {name}")
+
+
+@snapshot_cli.command('list')
+@click.option('--root', type=click.Path(file_okay=False), default=None,
+              help='Snapshot root directory (defaults to SNAPSHOT_DIR).')
+def snapshot_list_command(root):
+    """List the snapshots in the snapshot root."""
+    root = root or current_app.config['SNAPSHOT_DIR']
+    current = snapshot.current_snapshot_name(root)
+    for name in snapshot.list_snapshots(root):
+        click.echo(f"{'*' if name == current else ' '} {name}")
+
+
+@snapshot_cli.command('export-static')
+@click.option('--output', type=click.Path(file_okay=False), default=None,
+              help='Export directory (defaults to STATIC_EXPORT_DIR).')
+@click.option('--with-files', is_flag=True, help='Copy the images and PDFs into the export.')
+@click.option('--files-url', default=None,
+              help='Base URL of the images and PDFs when they are not copied (defaults to the API paths).')
+@click.option('--batch-size', type=int, default=None, help='Defects loaded per query.')
+def snapshot_export_static_command(output, with_files, files_url, batch_size):
+    """Export a sharded JSON search index for the static frontend in docs/."""
+    output = output or current_app.config['STATIC_EXPORT_DIR']
+    try:
+        report = static_export.export_static(output, with_files, files_url,
+                                             batch_size or current_app.config['FILE_GC_BATCH_SIZE'])
+    except FileExistsError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Exported {report['searchable']} of {report['defects']} defects to {output}: "
+               f"{report['trigrams']} trigrams in {report['shards']} shards, {report['files']} files "
+               f"({_format_bytes(report['bytes'])})")
+    for name in report['missing']:
+        click.echo(f"  missing from storage: {name}")
+
+
+@stats_cli.command('rebuild')
+@click.option('--batch-size', type=int, default=None, help='Defects sized per transaction.')
+def stats_rebuild_command(batch_size):
+    """Recompute the statistics rollups from the defect tables and storage."""
+    report = stats.rebuild(batch_size or current_app.config['FILE_GC_BATCH_SIZE'])
+    click.echo(f"Rebuilt statistics: {report['defects']} defects, {report['days']} days of activity")
+
+
+@search_cli.command('build')
+@click.option('--dimensions', type=int, default=None, help='Topics (defaults to SEMANTIC_DIMENSIONS).')
+@click.option('--batch-size', type=int, default=None, help='Defects loaded per query.')
+def search_build_command(dimensions, batch_size):
+    """Fit a new semantic index over all live defects and activate it."""
+    config = current_app.config
+    try:
+        report = semantic.build_index(config['SEMANTIC_INDEX_DIR'], dimensions or config['SEMANTIC_DIMENSIONS'],
+                                      config['SEMANTIC_MAX_TERMS'], batch_size or config['FILE_GC_BATCH_SIZE'],
+                                      config['SEMANTIC_KEEP'])
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Built semantic index {report['name']}: {report['defects']} defects, "
+               f"{report['terms']} terms, {report['dimensions']} dimensions")
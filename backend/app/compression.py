@@ -0,0 +1,193 @@
+"""
+HTTP compression.
+
+Two mechanisms are provided:
+
+* JSON (and other configured) responses larger than ``COMPRESS_MIN_SIZE``
+  are compressed on the fly with Brotli or gzip, whichever the client
+  prefers, at ``COMPRESS_LEVEL_BROTLI`` / ``COMPRESS_LEVEL_GZIP``.
+* Static frontend files are never compressed per request. Instead
+  ``flask assets precompress`` writes ``.br`` and ``.gz`` siblings at build
+  time and ``send_precompressed`` picks the best one the client accepts.
+
+Brotli is optional; without the ``brotli`` package only gzip is produced,
+although existing ``.br`` siblings are still served.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+
+from flask import abort, current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - Brotli is optional
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Content-Encoding -> precompressed file suffix, in order of preference
+PRECOMPRESSED_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _compress(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_LEVEL_BROTLI'])
+    return gzip.compress(data, compresslevel=config['COMPRESS_LEVEL_GZIP'])
+
+
+def choose_encoding(accept_encodings, available):
+    """
+    Picks the content coding the client prefers among ``available``.
+
+    Args:
+        accept_encodings: The request's parsed ``Accept-Encoding`` header.
+        available (iterable[str]): Codings the server can produce, in order of preference.
+
+    Returns:
+        str: The chosen coding, or None if the client accepts none of them.
+    """
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_response(response):
+    """``after_request`` hook that compresses large textual responses."""
+    config = current_app.config
+    if (not config['COMPRESS_RESPONSES']
+            or response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data, encoding = compress_body(response.get_data(), request.accept_encodings, config)
+    if encoding is None:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compress_body(data, accept_encodings, config):
+    """
+    Compresses a response body for a client, if it is large enough.
+
+    Args:
+        data (bytes): The body.
+        accept_encodings: The request's parsed ``Accept-Encoding`` header.
+        config: The app config.
+
+    Returns:
+        tuple: The (possibly compressed) body and its content coding, or None if unchanged.
+    """
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return data, None
+    encoding = choose_encoding(accept_encodings, ('br', 'gzip') if brotli else ('gzip',))
+    if encoding is None:
+        return data, None
+    return _compress(data, encoding, config), encoding
+
+
+def send_precompressed(directory, filename):
+    """
+    Sends a static file, preferring a precompressed ``.br``/``.gz`` sibling.
+
+    Args:
+        directory (str): The directory the file is served from.
+        filename (str): The path of the file relative to ``directory``.
+
+    Returns:
+        Response: The (possibly encoded) file response.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    available = [encoding for encoding, suffix in PRECOMPRESSED_SUFFIXES if os.path.isfile(path + suffix)]
+    encoding = choose_encoding(request.accept_encodings, available) if available else None
+
+    if encoding is None:
+        response = send_from_directory(directory, filename)
+    else:
+        suffix = dict(PRECOMPRESSED_SUFFIXES)[encoding]
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def precompress_tree(root, extensions, min_size=0, gzip_level=9, brotli_level=11):
+    """
+    Writes ``.gz`` (and, if available, ``.br``) siblings for static files.
+
+    Siblings that are not smaller than the original are not kept, and
+    up-to-date siblings are left alone, so the command is cheap to re-run
+    after every build.
+
+    Args:
+        root (str): The directory to process recursively.
+        extensions (iterable[str]): File extensions to compress, without the dot.
+        min_size (int): Files smaller than this are skipped.
+        gzip_level (int): gzip compression level.
+        brotli_level (int): Brotli quality.
+
+    Returns:
+        dict: Counts of files compressed and skipped, and bytes written per suffix.
+    """
+    extensions = {ext.lower() for ext in extensions}
+    report = {'compressed': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': {'.gz': 0, '.br': 0}}
+    encoders = [('.gz', lambda data: gzip.compress(data, compresslevel=gzip_level, mtime=0))]
+    if brotli:
+        encoders.append(('.br', lambda data: brotli.compress(data, quality=brotli_level)))
+
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.rsplit('.', 1)[-1].lower() not in extensions:
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if stat.st_size < min_size:
+                report['skipped'] += 1
+                continue
+
+            with open(path, 'rb') as f:
+                data = f.read()
+            for suffix, encode in encoders:
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= stat.st_mtime:
+                    continue
+                encoded = encode(data)
+                if len(encoded) >= len(data):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(encoded)
+                os.replace(target + '.tmp', target)
+                report['bytes_out'][suffix] += len(encoded)
+            report['compressed'] += 1
+            report['bytes_in'] += len(data)
+
+    return report
+
+
+def init_app(app):
+    """Registers the compression hook and precompressed static file serving."""
+    app.after_request(compress_response)
+
+    if app.static_folder:
+        def static(filename):
+            return send_precompressed(app.static_folder, filename)
+        app.view_functions['static'] = static
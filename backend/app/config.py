@@ -1,11 +1,210 @@
 import os
+import tempfile
 
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY", "defaultsecretkey")
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///defects.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Optional read replicas (comma-separated URLs), registered as binds replica_1, replica_2, ...
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    SQLALCHEMY_BINDS = {f'replica_{i}': url for i, url in enumerate(DATABASE_REPLICA_URLS, 1)}
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 10))
+    REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+    # How long a client keeps reading from the primary after it wrote
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     UPLOAD_FOLDER_IMAGES = os.path.join(BASE_DIR, 'static', 'images')
     UPLOAD_FOLDER_PDFS = os.path.join(BASE_DIR, 'static', 'pdfs')
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
\ No newline at end of file
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+
+    # Upload folder layout: 'flat' or 'sharded' (<folder>/ab/cd/<name>). Existing folders are flat:
+    # to switch, set 'sharded' with the fallback on, run `flask files migrate-layout`, then turn
+    # the fallback off again (it costs a second lookup for every missing file).
+    UPLOAD_LAYOUT = os.environ.get('UPLOAD_LAYOUT', 'flat')
+    UPLOAD_LAYOUT_FALLBACK = os.environ.get('UPLOAD_LAYOUT_FALLBACK', 'false').lower() in ('1', 'true', 'yes')
+
+    # Where uploaded files are kept: 'local' (the upload folders) or 's3' (requires boto3)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    # s3: answer file routes with a redirect to a presigned URL instead of proxying the bytes
+    STORAGE_REDIRECTS = os.environ.get('STORAGE_REDIRECTS', 'true').lower() in ('1', 'true', 'yes')
+    STORAGE_SIGNED_URL_EXPIRES = int(os.environ.get('STORAGE_SIGNED_URL_EXPIRES', 300))
+    # local: internal nginx location mapped to the static folder, e.g. '/_uploads' (enables X-Accel-Redirect)
+    STORAGE_LOCAL_ACCEL_PREFIX = os.environ.get('STORAGE_LOCAL_ACCEL_PREFIX', '')
+    # local: keep images up to IMAGE_PACK_MAX_BLOB bytes in append-only segment files
+    IMAGE_PACKS = os.environ.get('IMAGE_PACKS', 'false').lower() in ('1', 'true', 'yes')
+    IMAGE_PACK_MAX_BLOB = int(os.environ.get('IMAGE_PACK_MAX_BLOB', 1024 * 1024))
+    IMAGE_PACK_SEGMENT_SIZE = int(os.environ.get('IMAGE_PACK_SEGMENT_SIZE', 256 * 1024 * 1024))
+    STORAGE_S3_BUCKET = os.environ.get('STORAGE_S3_BUCKET', 'wdl-uploads')
+    STORAGE_S3_PREFIX = os.environ.get('STORAGE_S3_PREFIX', '')
+    STORAGE_S3_ENDPOINT_URL = os.environ.get('STORAGE_S3_ENDPOINT_URL', '')  # e.g. http://minio:9000
+    STORAGE_S3_PUBLIC_URL = os.environ.get('STORAGE_S3_PUBLIC_URL', '')  # endpoint browsers use, if different
+    STORAGE_S3_REGION = os.environ.get('STORAGE_S3_REGION', '')
+    STORAGE_S3_ACCESS_KEY = os.environ.get('STORAGE_S3_ACCESS_KEY', '')
+    STORAGE_S3_SECRET_KEY = os.environ.get('STORAGE_S3_SECRET_KEY', '')
+    STORAGE_S3_ADDRESSING_STYLE = os.environ.get('STORAGE_S3_ADDRESSING_STYLE', 'auto')  # 'path' for MinIO
+
+    # Threads used to write several uploaded files of one request concurrently
+    UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+
+    # Resumable chunked uploads (see app/uploads.py): largest chunk per PUT, files per session,
+    # hours before `flask files gc` drops an idle session, and days finalize Idempotency-Keys are kept
+    UPLOAD_CHUNK_MAX = int(os.environ.get('UPLOAD_CHUNK_MAX', 8 * 1024 * 1024))
+    UPLOAD_SESSION_MAX_FILES = int(os.environ.get('UPLOAD_SESSION_MAX_FILES', 100))
+    UPLOAD_SESSION_TTL_HOURS = float(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24))
+    UPLOAD_IDEMPOTENCY_TTL_DAYS = float(os.environ.get('UPLOAD_IDEMPOTENCY_TTL_DAYS', 7))
+
+    # Admission control for the upload and edit routes (see app/admission.py). Off by default:
+    # behind a reverse proxy, set ADMISSION_CLIENT_HEADER too, or every client shares one bucket.
+    ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'false').lower() in ('1', 'true', 'yes')
+    ADMISSION_STATE_DIR = os.environ.get('ADMISSION_STATE_DIR', os.path.join(tempfile.gettempdir(), 'wdl-admission'))
+    # Threads per gunicorn worker (see gunicorn_config.py); 1 means sync workers
+    SERVER_THREADS = max(1, int(os.environ.get('GUNICORN_THREADS', 4)))
+    # Request threads the limited routes may occupy in total; the rest stay reserved for reads
+    ADMISSION_WRITE_SLOTS = int(os.environ.get('ADMISSION_WRITE_SLOTS', (os.cpu_count() or 1) * SERVER_THREADS))
+    ADMISSION_UPLOAD_CONCURRENCY = int(os.environ.get('ADMISSION_UPLOAD_CONCURRENCY', 2))
+    ADMISSION_EDIT_CONCURRENCY = int(os.environ.get('ADMISSION_EDIT_CONCURRENCY', 4))
+    ADMISSION_ROUTE_LIMITS = {
+        'defect_routes.upload_defect': ADMISSION_UPLOAD_CONCURRENCY,
+        'defect_routes.update_defect_details': ADMISSION_UPLOAD_CONCURRENCY,
+        'defect_routes.bulk_update_defects': ADMISSION_UPLOAD_CONCURRENCY,
+        'upload_routes.finalize_upload': ADMISSION_UPLOAD_CONCURRENCY,
+        'defect_routes.edit_defect': ADMISSION_EDIT_CONCURRENCY,
+        'defect_routes.edit_defect_mode': ADMISSION_EDIT_CONCURRENCY,
+        'defect_routes.bulk_delete': ADMISSION_EDIT_CONCURRENCY,
+    }
+    # Per-client token bucket: sustained requests per second and burst size
+    ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE', 0.5))
+    ADMISSION_BURST = int(os.environ.get('ADMISSION_BURST', 10))
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+    # Header holding the client address when behind a proxy, e.g. 'X-Forwarded-For'
+    ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER', '')
+
+    # Deleted defects can be restored until `flask defects purge` removes them after this many days
+    SOFT_DELETE_RETENTION_DAYS = float(os.environ.get('SOFT_DELETE_RETENTION_DAYS', 7))
+    # Most defect plus mode ids accepted by one bulk delete request
+    BULK_DELETE_MAX_IDS = int(os.environ.get('BULK_DELETE_MAX_IDS', 1000))
+    # Orphaned upload collection (`flask files gc`)
+    FILE_GC_BATCH_SIZE = int(os.environ.get('FILE_GC_BATCH_SIZE', 500))
+    FILE_GC_GRACE_SECONDS = int(os.environ.get('FILE_GC_GRACE_SECONDS', 3600))
+
+    # Upload-time image normalization (requires Pillow)
+    IMAGE_NORMALIZE = os.environ.get('IMAGE_NORMALIZE', 'false').lower() in ('1', 'true', 'yes')
+    IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 2048))
+    IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'WEBP').upper()
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 80))
+    IMAGE_KEEP_ORIGINAL = os.environ.get('IMAGE_KEEP_ORIGINAL', 'false').lower() in ('1', 'true', 'yes')
+    IMAGE_NORMALIZE_WORKERS = int(os.environ.get('IMAGE_NORMALIZE_WORKERS', 2))
+    UPLOAD_FOLDER_ORIGINALS = os.path.join(BASE_DIR, 'static', 'originals')
+
+    # Response compression
+    COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL_GZIP = int(os.environ.get('COMPRESS_LEVEL_GZIP', 6))
+    COMPRESS_LEVEL_BROTLI = int(os.environ.get('COMPRESS_LEVEL_BROTLI', 5))
+    COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/plain'}
+
+    # Read-only edge snapshots (`flask snapshot build`). With SNAPSHOT_MODE the app serves
+    # the active snapshot in SNAPSHOT_DIR instead of the database and upload storage.
+    SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(BASE_DIR), 'snapshots'))
+    SNAPSHOT_MODE = os.environ.get('SNAPSHOT_MODE', 'false').lower() in ('1', 'true', 'yes')
+    SNAPSHOT_RELOAD_INTERVAL = float(os.environ.get('SNAPSHOT_RELOAD_INTERVAL', 2))
+    SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 3))
+
+    # Opt-in slow-query log with captured query plans (`GET /admin/slow-queries`)
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'false').lower() in ('1', 'true', 'yes')
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+    SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() in ('1', 'true', 'yes')
+    SLOW_QUERY_LOG_PATH = os.environ.get('SLOW_QUERY_LOG_PATH', os.path.join(tempfile.gettempdir(), 'wdl-slow-queries.db'))
+    SLOW_QUERY_KEEP = int(os.environ.get('SLOW_QUERY_KEEP', 5000))
+    # Requests per second (and burst) each client may make to the report endpoint
+    SLOW_QUERY_REPORT_RATE = float(os.environ.get('SLOW_QUERY_REPORT_RATE', 0.2))
+    SLOW_QUERY_REPORT_BURST = int(os.environ.get('SLOW_QUERY_REPORT_BURST', 5))
+
+    # Defect statistics (`/defect/stats`): rollup tables updated after every write
+    STATS_ROLLUPS = os.environ.get('STATS_ROLLUPS', 'true').lower() in ('1', 'true', 'yes')
+    STATS_MAX_LIMIT = int(os.environ.get('STATS_MAX_LIMIT', 100))
+
+    # Server-Sent Events change stream (`GET /defect/changes`), fanned out across workers
+    # through a shared SQLite event log
+    CHANGE_STREAM = os.environ.get('CHANGE_STREAM', 'true').lower() in ('1', 'true', 'yes')
+    CHANGES_LOG_PATH = os.environ.get('CHANGES_LOG_PATH', os.path.join(tempfile.gettempdir(), 'wdl-changes.db'))
+    CHANGES_KEEP = int(os.environ.get('CHANGES_KEEP', 10000))
+    CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.25))
+    CHANGES_HEARTBEAT = float(os.environ.get('CHANGES_HEARTBEAT', 15))
+    CHANGES_RETRY_MS = int(os.environ.get('CHANGES_RETRY_MS', 3000))
+    # Streams per worker process. Each holds a request thread, so the default leaves a
+    # quarter of them for other requests (3 of the default 4), and none of a sync worker
+    CHANGES_MAX_STREAMS = int(os.environ.get('CHANGES_MAX_STREAMS', SERVER_THREADS * 3 // 4))
+    CHANGES_STREAM_MAX_SECONDS = float(os.environ.get('CHANGES_STREAM_MAX_SECONDS', 300))
+
+    # ASGI deployment (`uvicorn asgi:app`): native async reads, the rest on WSGI threads
+    ASGI_DATABASE_URL = os.environ.get('ASGI_DATABASE_URL')  # default: DATABASE_URL with its async driver
+    ASGI_DB_POOL_SIZE = int(os.environ.get('ASGI_DB_POOL_SIZE', 20))
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+    ASGI_CHUNK_SIZE = int(os.environ.get('ASGI_CHUNK_SIZE', 256 * 1024))
+
+    # Opt-in request profiling: requests sent with `X-Profile: <PROFILE_TOKEN>`, and a sampled
+    # fraction of PROFILE_ENDPOINTS (all if empty) slower than PROFILE_SAMPLE_MIN_MS.
+    # The /admin/profiles and /admin/memory routes require the same header.
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_SAMPLE_MIN_MS = float(os.environ.get('PROFILE_SAMPLE_MIN_MS', 1000))
+    PROFILE_ENDPOINTS = {e for e in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if e}
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'wdl-profiles'))
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+
+    # Worker memory: gunicorn recycles a worker whose RSS exceeds WORKER_MAX_RSS_MB (0 disables);
+    # TRACEMALLOC_FRAMES > 0 traces allocations in every worker from boot
+    WORKER_MAX_RSS_MB = int(os.environ.get('WORKER_MAX_RSS_MB', 1024))
+    TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 0))
+
+    # Semantic search (`/defect/search?mode=semantic`, see app/semantic.py): `flask search build` fits
+    # the index in SEMANTIC_INDEX_DIR; writes update it in place until the next build. Fewer
+    # SEMANTIC_DIMENSIONS generalize more (e.g. tens for a library of a few hundred defects)
+    SEMANTIC_SEARCH = os.environ.get('SEMANTIC_SEARCH', 'true').lower() in ('1', 'true', 'yes')
+    SEMANTIC_INDEX_DIR = os.environ.get('SEMANTIC_INDEX_DIR', os.path.join(os.path.dirname(BASE_DIR), 'search-index'))
+    SEMANTIC_DIMENSIONS = int(os.environ.get('SEMANTIC_DIMENSIONS', 128))
+    SEMANTIC_MAX_TERMS = int(os.environ.get('SEMANTIC_MAX_TERMS', 50000))
+    SEMANTIC_DEFAULT_LIMIT = int(os.environ.get('SEMANTIC_DEFAULT_LIMIT', 20))
+    SEMANTIC_MAX_LIMIT = int(os.environ.get('SEMANTIC_MAX_LIMIT', 100))
+    SEMANTIC_MIN_SCORE = float(os.environ.get('SEMANTIC_MIN_SCORE', 0.1))
+    SEMANTIC_RELOAD_INTERVAL = float(os.environ.get('SEMANTIC_RELOAD_INTERVAL', 2))
+    SEMANTIC_KEEP = int(os.environ.get('SEMANTIC_KEEP', 2))
+
+    # Related defects (`flask defects related`, see app/related.py): neighbours kept per defect and
+    # shown by GET /defect/<id>, similarity weights, and where image features are cached
+    RELATED_DEFECTS = os.environ.get('RELATED_DEFECTS', 'true').lower() in ('1', 'true', 'yes')
+    RELATED_TOP_K = int(os.environ.get('RELATED_TOP_K', 10))
+    RELATED_IN_DEFECT = int(os.environ.get('RELATED_IN_DEFECT', 5))
+    RELATED_TEXT_WEIGHT = float(os.environ.get('RELATED_TEXT_WEIGHT', 0.7))
+    RELATED_IMAGE_WEIGHT = float(os.environ.get('RELATED_IMAGE_WEIGHT', 0.3))
+    RELATED_BLOCK_SIZE = int(os.environ.get('RELATED_BLOCK_SIZE', 256))
+    RELATED_DIR = os.environ.get('RELATED_DIR', os.path.join(os.path.dirname(BASE_DIR), 'related-features'))
+
+    # Static search index for the backend-less frontend in docs/ (`flask snapshot export-static`,
+    # app/static_export.py); docs/index.html searches it in the browser when it is present.
+    STATIC_EXPORT_DIR = os.environ.get('STATIC_EXPORT_DIR',
+                                       os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)), 'docs', 'search'))
+
+    # Stored image/PDF metadata (app/filemeta.py): per-process cache of the lookups that answer
+    # HEAD and If-None-Match on /images and /pdfs without touching storage
+    FILE_METADATA_CACHE_SIZE = int(os.environ.get('FILE_METADATA_CACHE_SIZE', 10000))
+    FILE_METADATA_CACHE_TTL = float(os.environ.get('FILE_METADATA_CACHE_TTL', 60))
+
+    # Deep-zoom tile pyramids of images larger than IMAGE_TILE_MIN_DIMENSION (app/tiles.py, requires
+    # Pillow), served from /images/<name>/tiles. Each gunicorn worker starts IMAGE_TILE_WORKERS
+    # processes of its own on first use, so mind workers * IMAGE_TILE_WORKERS before enabling it.
+    IMAGE_TILES = os.environ.get('IMAGE_TILES', 'false').lower() in ('1', 'true', 'yes')
+    IMAGE_TILE_MIN_DIMENSION = int(os.environ.get('IMAGE_TILE_MIN_DIMENSION', 2048))
+    IMAGE_TILE_SIZE = int(os.environ.get('IMAGE_TILE_SIZE', 256))
+    IMAGE_TILE_OVERLAP = int(os.environ.get('IMAGE_TILE_OVERLAP', 1))
+    IMAGE_TILE_FORMAT = os.environ.get('IMAGE_TILE_FORMAT', 'JPEG').upper()
+    IMAGE_TILE_QUALITY = int(os.environ.get('IMAGE_TILE_QUALITY', 85))
+    IMAGE_TILE_WORKERS = int(os.environ.get('IMAGE_TILE_WORKERS', 2))
+    UPLOAD_FOLDER_TILES = os.path.join(BASE_DIR, 'static', 'tiles')
+
+    # Frontend served at "/" and the file types `flask assets precompress` handles
+    FRONTEND_BUILD_DIR = os.environ.get('FRONTEND_BUILD_DIR', os.path.join(BASE_DIR, 'templates'))
+    PRECOMPRESS_EXTENSIONS = {'html', 'js', 'css', 'json', 'svg', 'txt', 'map', 'ico'}
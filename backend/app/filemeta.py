@@ -0,0 +1,320 @@
+"""
+Stored metadata of uploaded images and PDFs.
+
+Every staged upload is inspected on the upload pool (see ``app/staging.py``)
+and its byte size, SHA-256, MIME type and either pixel dimensions (images)
+or page count (PDFs) are stored on its ``DefectMode``/``PDFFile`` row:
+
+* ``GET /defect/<id>`` returns them (``image`` per mode, ``pdf`` per
+  defect), so a client can lay out a page before downloading any file.
+* ``/images/<name>`` and ``/pdfs/<name>`` answer ``HEAD`` and
+  ``If-None-Match`` requests from them without touching the storage; the
+  SHA-256 is the ETag. Lookups by filename are kept for
+  ``FILE_METADATA_CACHE_TTL`` seconds in a per-process LRU cache of
+  ``FILE_METADATA_CACHE_SIZE`` entries. Files without stored metadata are
+  served from storage as before.
+
+Image normalization (``app/imaging.py``) stores the metadata of the
+re-encoded file. ``flask files metadata`` backfills rows uploaded before
+metadata was recorded.
+
+Dimensions need Pillow, an optional dependency; without it they are left
+empty. Page counts come from counting the page objects of the PDF,
+including those in compressed object streams. This is a best-effort count
+that needs no PDF library, and it is empty if no page object is found or
+the object streams inflate to more than ``PDF_MAX_INFLATED_BYTES``.
+"""
+import hashlib
+import logging
+import mimetypes
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import select, update
+from werkzeug.http import parse_etags
+
+from app import db
+from app.models import DefectMode, PDFFile
+from app.storage import get_storage
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('images', 'pdfs')
+
+_PAGE = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+_STREAM = re.compile(rb'stream\r?\n')
+# Object streams inflated per PDF at most: a small upload can inflate to gigabytes
+PDF_MAX_INFLATED_BYTES = 16 * 1024 * 1024
+
+
+def pdf_page_count(data):
+    """
+    Counts the pages of a PDF.
+
+    Args:
+        data (bytes): The PDF.
+
+    Returns:
+        int: The number of page objects, or None if none was found or the
+        object streams inflate to more than ``PDF_MAX_INFLATED_BYTES``.
+    """
+    pages = len(_PAGE.findall(data))
+    view = memoryview(data)
+    budget = PDF_MAX_INFLATED_BYTES
+    for match in _STREAM.finditer(data):
+        # The stream's dictionary, from its "N 0 obj" header on
+        header = data[max(0, match.start() - 512):match.start()]
+        header = header[header.rfind(b'obj') + 3:]
+        if b'/ObjStm' not in header or b'/FlateDecode' not in header:
+            continue
+        try:
+            inflated = zlib.decompressobj().decompress(view[match.end():], budget + 1)
+        except zlib.error:
+            continue
+        budget -= len(inflated)
+        if budget < 0:
+            return None
+        pages += len(_PAGE.findall(inflated))
+    return pages or None
+
+
+def inspect(file, filename):
+    """
+    Returns the MIME type, pixel dimensions (images) and page count (PDFs) of a file.
+
+    Only the header of an image is decoded; a PDF is read whole.
+
+    Args:
+        file: Path or binary file object, positioned at the start.
+        filename (str): The file's name, for its type.
+
+    Returns:
+        dict: ``mimetype``, ``width``, ``height`` and ``pages`` (None where not applicable).
+    """
+    meta = {'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            'width': None, 'height': None, 'pages': None}
+    if meta['mimetype'] == 'application/pdf':
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                data = f.read()
+        else:
+            data = file.read()
+        meta['pages'] = pdf_page_count(data)
+    elif meta['mimetype'].startswith('image/') and Image is not None:
+        try:
+            with Image.open(file) as image:
+                meta['width'], meta['height'] = image.size
+                meta['mimetype'] = Image.MIME.get(image.format, meta['mimetype'])
+        except Exception as e:
+            logger.warning(f"Cannot read the dimensions of {filename}: {e}")
+    return meta
+
+
+def describe(file, filename):
+    """
+    Returns the full metadata of a seekable binary file: ``size`` and ``sha256`` plus ``inspect``'s.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = file.read(1024 * 1024)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return dict(inspect(file, filename), size=size, sha256=digest.hexdigest())
+
+
+def image_columns(meta, filename=None):
+    """Returns the ``DefectMode`` column values of an image's metadata (a dict or ``StagedFile``), or of no image."""
+    if meta is None:
+        return {'image_filename': None, 'image_size': None, 'image_sha256': None,
+                'image_mimetype': None, 'image_width': None, 'image_height': None}
+    meta = meta if isinstance(meta, dict) else meta._asdict()
+    return {'image_filename': filename or meta['filename'], 'image_size': meta['size'],
+            'image_sha256': meta['sha256'], 'image_mimetype': meta['mimetype'],
+            'image_width': meta['width'], 'image_height': meta['height']}
+
+
+def pdf_columns(meta, filename=None):
+    """Returns the ``PDFFile`` column values of a PDF's metadata (a dict or ``StagedFile``)."""
+    meta = meta if isinstance(meta, dict) else meta._asdict()
+    return {'filename': filename or meta['filename'], 'size': meta['size'], 'sha256': meta['sha256'],
+            'mimetype': meta['mimetype'], 'page_count': meta['pages']}
+
+
+def image_json(mode):
+    """Serializes a mode's image metadata, or None if there is no image or it was not recorded."""
+    if not mode.image_filename or mode.image_sha256 is None:
+        return None
+    return {'size': mode.image_size, 'sha256': mode.image_sha256, 'mimetype': mode.image_mimetype,
+            'width': mode.image_width, 'height': mode.image_height}
+
+
+def pdf_json(pdf):
+    """Serializes a PDF's metadata, or None if there is no PDF or it was not recorded."""
+    if pdf is None or pdf.sha256 is None:
+        return None
+    return {'size': pdf.size, 'sha256': pdf.sha256, 'mimetype': pdf.mimetype, 'pages': pdf.page_count}
+
+
+def metadata_statement(kind, filename):
+    """Builds the SELECT of the size, SHA-256 and MIME type recorded for a served file."""
+    if kind == 'images':
+        return (select(DefectMode.image_size.label('size'), DefectMode.image_sha256.label('sha256'),
+                       DefectMode.image_mimetype.label('mimetype'))
+                .where(DefectMode.image_filename == filename, DefectMode.image_sha256.isnot(None))
+                .limit(1))
+    return (select(PDFFile.size, PDFFile.sha256, PDFFile.mimetype)
+            .where(PDFFile.filename == filename, PDFFile.sha256.isnot(None))
+            .limit(1))
+
+
+class MetadataCache:
+    """
+    Thread-safe LRU cache of served files' metadata by ``(kind, filename)``.
+
+    Misses are cached too, so files without metadata cost one query per ``ttl``.
+
+    Args:
+        size (int): Entries kept.
+        ttl (float): Seconds an entry is used.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns ``(True, metadata)`` for a fresh entry (metadata may be None), else ``(False, None)``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def put(self, key, meta):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, meta)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def get_cache(app):
+    """Returns the app's metadata cache."""
+    cache = app.extensions.get('file_metadata')
+    if cache is None:
+        cache = app.extensions['file_metadata'] = MetadataCache(app.config['FILE_METADATA_CACHE_SIZE'],
+                                                                app.config['FILE_METADATA_CACHE_TTL'])
+    return cache
+
+
+def lookup(kind, filename):
+    """
+    Returns the recorded ``size``, ``sha256`` and ``mimetype`` of a served file, or None.
+
+    Args:
+        kind (str): ``'images'`` or ``'pdfs'``.
+        filename (str): The stored name.
+    """
+    cache = get_cache(current_app)
+    hit, meta = cache.get((kind, filename))
+    if not hit:
+        row = db.session.execute(metadata_statement(kind, filename)).first()
+        meta = dict(row._mapping) if row else None
+        cache.put((kind, filename), meta)
+    return meta
+
+
+def forget(kind, filename):
+    """Drops a file from this process's cache, e.g. after it was re-encoded under the same name."""
+    get_cache(current_app).forget((kind, filename))
+
+
+def shortcut_response(response_class, meta, method, if_none_match):
+    """
+    Builds the response to a HEAD or conditional request from a file's recorded metadata.
+
+    Args:
+        response_class: The response class to instantiate.
+        meta (dict): The file's ``lookup`` result.
+        method (str): The request method.
+        if_none_match (str): The ``If-None-Match`` header, or None.
+
+    Returns:
+        Response: A 304 if the ETag matches, the headers of a 200 for HEAD,
+        or None if the body has to be sent.
+    """
+    if if_none_match and parse_etags(if_none_match).contains_weak(meta['sha256']):
+        response = response_class(status=304)
+    elif method == 'HEAD':
+        response = response_class(mimetype=meta['mimetype'])
+        response.content_length = meta['size']
+    else:
+        return None
+    response.set_etag(meta['sha256'])
+    return response
+
+
+def backfill(batch_size=500, refresh=False):
+    """
+    Records the metadata of stored images and PDFs whose rows have none.
+
+    Rows are read in id order, ``batch_size`` at a time, and each batch is
+    committed on its own, so an interrupted run resumes where it stopped.
+
+    Args:
+        batch_size (int): Rows per transaction.
+        refresh (bool): Recompute the metadata of every row.
+
+    Returns:
+        dict: Numbers of images and PDFs updated and the names of files missing from storage.
+    """
+    config = current_app.config
+    report = {'images': 0, 'pdfs': 0, 'missing': []}
+    targets = (
+        ('images', DefectMode, DefectMode.image_filename, DefectMode.image_sha256, image_columns),
+        ('pdfs', PDFFile, PDFFile.filename, PDFFile.sha256, pdf_columns),
+    )
+    for kind, model, filename_column, sha_column, columns in targets:
+        storage = get_storage(config['UPLOAD_FOLDER_IMAGES' if kind == 'images' else 'UPLOAD_FOLDER_PDFS'])
+        last_id = 0
+        while True:
+            stmt = select(model.id, filename_column).where(model.id > last_id, filename_column.isnot(None))
+            if not refresh:
+                stmt = stmt.where(sha_column.is_(None))
+            rows = db.session.execute(stmt.order_by(model.id).limit(batch_size)).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for row_id, filename in rows:
+                try:
+                    with storage.open(filename) as f:
+                        meta = describe(f, filename)
+                except FileNotFoundError:
+                    report['missing'].append(f"{kind}/{filename}")
+                    continue
+                values = columns(meta, filename)
+                db.session.execute(update(model).where(model.id == row_id, filename_column == filename)
+                                   .values(values))
+                report[kind] += 1
+            db.session.commit()
+    return report
@@ -0,0 +1,355 @@
+"""
+Upload-time image normalization.
+
+When ``IMAGE_NORMALIZE`` is enabled, every image accepted by the upload and
+edit routes is re-encoded after its transaction commits: EXIF and other
+metadata are dropped, the longest side is capped at ``IMAGE_MAX_DIMENSION``
+and the result is written as ``IMAGE_FORMAT`` at ``IMAGE_QUALITY``. The work
+runs on a small thread pool, so the request returns as soon as the original
+upload is committed; the mode row is switched to the re-encoded file once it
+is ready.
+
+Each job is recorded in ``image_job`` in the upload's transaction and removed
+when it finishes, so jobs lost with a restarted or recycled worker stay
+listed; ``flask files resume`` runs them.
+
+Images large enough for a deep-zoom tile pyramid (see ``app/tiles.py``) are
+queued for tiling after their commit; tiling jobs are recorded in
+``image_job`` as well. Images that are normalized are tiled by their
+normalization job instead, from the original before it is replaced, so their
+pyramid keeps the full resolution the re-encoded copy is capped below.
+
+Pillow is an optional dependency. Without it normalization is skipped and
+uploads are stored as-is.
+"""
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, select, update
+
+from app import db, stats, changes, filemeta, tiles
+from app.models import DefectMode, ImageJob
+from app.staging import stage_files, staging_folder, call_after_commit
+from app.storage import get_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Output format -> file extension
+FORMAT_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+# image_job kinds
+JOB_NORMALIZE = 'normalize'
+JOB_TILES = 'tiles'
+
+_executor = None
+
+
+def _get_executor(max_workers):
+    """Creates the normalization pool lazily so it is not shared across forked workers."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-normalize')
+    return _executor
+
+
+def normalization_enabled(config):
+    """Returns True if uploaded images should be re-encoded."""
+    return bool(config.get('IMAGE_NORMALIZE')) and Image is not None
+
+
+def normalized_filename(filename, image_format):
+    """
+    Returns the name the re-encoded copy of ``filename`` is stored under.
+
+    Args:
+        filename (str): The stored name of the uploaded image.
+        image_format (str): The Pillow output format, e.g. ``'WEBP'``.
+
+    Returns:
+        str: The filename with its extension replaced by the output format's.
+    """
+    return f"{os.path.splitext(filename)[0]}.{FORMAT_EXTENSIONS[image_format]}"
+
+
+def normalize_image(src, dest_path, max_dimension, image_format, quality):
+    """
+    Re-encodes an image without metadata and with capped dimensions.
+
+    The EXIF orientation is applied to the pixels before the metadata is
+    discarded, so rotated camera photos keep displaying upright.
+
+    Args:
+        src: Path or binary file object of the image to read.
+        dest_path (str): Path to write the re-encoded image to. It is written atomically.
+        max_dimension (int): Maximum width or height in pixels.
+        image_format (str): The Pillow output format.
+        quality (int): Encoder quality (ignored by lossless formats).
+
+    Returns:
+        tuple[int, int]: The width and height of the image before it was capped.
+    """
+    with Image.open(src) as img:
+        img = ImageOps.exif_transpose(img)
+        size = img.size
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            # Palette images keep their transparency in img.info, not in a band.
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        if image_format == 'JPEG' and img.mode == 'RGBA':
+            img = img.convert('RGB')
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        tmp_path = f"{dest_path}.tmp"
+        # No exif/icc/pnginfo arguments are passed, so no metadata is written.
+        img.save(tmp_path, format=image_format, quality=quality, optimize=True)
+    os.replace(tmp_path, dest_path)
+    return size
+
+
+def _scratch_path(folder, filename):
+    """Returns a private path in the folder's staging area for intermediate files."""
+    staging = staging_folder(folder)
+    os.makedirs(staging, exist_ok=True)
+    return os.path.join(staging, f"{uuid.uuid4().hex}_{filename}")
+
+
+def _keep_original(config, storage, filename):
+    """Copies a stored image into the originals storage."""
+    scratch = _scratch_path(config['UPLOAD_FOLDER_IMAGES'], filename)
+    with storage.open(filename) as src, open(scratch, 'wb') as out:
+        shutil.copyfileobj(src, out)
+    get_storage(config['UPLOAD_FOLDER_ORIGINALS']).put_file(scratch, filename)
+
+
+def _normalize_stored_image(app, filename):
+    """Worker job: re-encodes a committed image and points its mode row at the new file."""
+    with app.app_context():
+        config = app.config
+        folder = config['UPLOAD_FOLDER_IMAGES']
+        image_format = config['IMAGE_FORMAT']
+        storage = get_storage(folder)
+        new_filename = normalized_filename(filename, image_format)
+        scratch = _scratch_path(folder, new_filename)
+
+        try:
+            with storage.open(filename) as src:
+                original_size = normalize_image(src, scratch, config['IMAGE_MAX_DIMENSION'],
+                                                image_format, config['IMAGE_QUALITY'])
+            with open(scratch, 'rb') as f:
+                columns = filemeta.image_columns(filemeta.describe(f, new_filename), new_filename)
+            if new_filename == filename:
+                # Re-encoding in place overwrites the original, so copy it aside first.
+                if config['IMAGE_KEEP_ORIGINAL']:
+                    _keep_original(config, storage, filename)
+                _tile_original(config, filename, new_filename, original_size)
+                storage.put_file(scratch, new_filename)
+                _record_metadata(filename, columns)
+                stats.refresh_image_owners(new_filename)
+                return
+            storage.put_file(scratch, new_filename)
+        except FileNotFoundError:
+            # The image was deleted before the job ran.
+            return
+        except Exception as e:
+            logger.error(f"Error normalizing image {filename}: {e}")
+            return
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+        try:
+            result = db.session.execute(
+                update(DefectMode)
+                .where(DefectMode.image_filename == filename)
+                .values(columns)
+            )
+            # The image URL changed, so open pages refetch these modes.
+            owners = db.session.execute(
+                select(DefectMode.id, DefectMode.defect_id).where(DefectMode.image_filename == new_filename))
+            for mode_id, defect_id in owners:
+                changes.publish('mode.changed', defect_id, mode_id=mode_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error switching mode image {filename} to {new_filename}: {e}")
+            storage.delete(new_filename)
+            return
+
+        if result.rowcount == 0 and not _is_referenced(new_filename):
+            # The mode was deleted or given another image in the meantime. A resumed
+            # job whose first run switched the mode already goes on to tile and retire
+            # the original, in case the first run stopped before.
+            storage.delete(new_filename)
+            return
+        stats.refresh_image_owners(new_filename)
+        _tile_original(config, filename, new_filename, original_size)
+
+        try:
+            if config['IMAGE_KEEP_ORIGINAL']:
+                _keep_original(config, storage, filename)
+            storage.delete(filename)
+        except Exception as e:
+            logger.error(f"Error retiring original image {filename}: {e}")
+
+
+def _is_referenced(filename):
+    referenced = db.session.execute(
+        select(DefectMode.id).where(DefectMode.image_filename == filename).limit(1)).first() is not None
+    db.session.rollback()
+    return referenced
+
+
+def _record_metadata(filename, columns):
+    """Stores the metadata of an image re-encoded under its own name."""
+    try:
+        db.session.execute(update(DefectMode).where(DefectMode.image_filename == filename).values(columns))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error recording the metadata of image {filename}: {e}")
+    filemeta.forget('images', filename)
+
+
+def _tile_original(config, filename, new_filename, size):
+    """Builds the pyramid of a normalized image from its original, if the original is large enough."""
+    if not (tiles.tiling_enabled(config) and tiles.needs_pyramid(config, *size)):
+        return
+    try:
+        count = tiles.build_stored_pyramid(new_filename, source=filename)
+        if count:
+            logger.info(f"Stored {count} tiles of image {new_filename}")
+    except Exception as e:
+        logger.error(f"Error tiling image {new_filename}: {e}")
+
+
+def finish_job(kind, filename):
+    """Removes the ``image_job`` rows of a finished job."""
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(delete(ImageJob).where(ImageJob.kind == kind, ImageJob.filename == filename))
+    except Exception as e:
+        logger.error(f"Error removing the {kind} job of image {filename}: {e}")
+
+
+def _run_job(app, kind, filename, job):
+    """Worker job: runs ``job(app, filename)`` and removes its row, whatever the outcome."""
+    try:
+        job(app, filename)
+    finally:
+        with app.app_context():
+            finish_job(kind, filename)
+
+
+def _submit_normalization(app, filename):
+    _get_executor(app.config['IMAGE_NORMALIZE_WORKERS']).submit(
+        _run_job, app, JOB_NORMALIZE, filename, _normalize_stored_image)
+
+
+def _submit_tiles(app, filename):
+    tiles.submit(app, _run_job, app, JOB_TILES, filename, tiles.build_job)
+
+
+# image_job kind -> job(app, filename)
+_JOBS = {JOB_NORMALIZE: _normalize_stored_image, JOB_TILES: tiles.build_job}
+
+
+def resume_jobs(grace_seconds=3600, batch_size=500):
+    """
+    Runs the image jobs that were queued but never finished, e.g. because their worker was recycled.
+
+    Jobs run one at a time in this process. Jobs younger than
+    ``grace_seconds`` are left alone: a live worker may still be on them.
+
+    Args:
+        grace_seconds (int): Minimum job age.
+        batch_size (int): Rows read per query.
+
+    Returns:
+        dict: Numbers of jobs run per kind.
+    """
+    app = current_app._get_current_object()
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    report = {kind: 0 for kind in _JOBS}
+    last_id = 0
+    while True:
+        rows = db.session.execute(select(ImageJob.id, ImageJob.kind, ImageJob.filename)
+                                  .where(ImageJob.id > last_id, ImageJob.created_at < cutoff)
+                                  .order_by(ImageJob.id).limit(batch_size)).all()
+        db.session.rollback()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for row in rows:
+            job = _JOBS.get(row.kind)
+            if job is None:
+                logger.warning(f"Skipping image job {row.id} of unknown kind {row.kind}")
+                continue
+            _run_job(app, row.kind, row.filename, job)
+            report[row.kind] += 1
+    return report
+
+
+def stage_images(files, upload_folder, allowed_extensions=None):
+    """
+    Stages uploaded images concurrently and, if enabled, queues their normalization.
+
+    Args:
+        files (list): The uploaded images; falsy entries are allowed.
+        upload_folder (str): The image upload folder.
+        allowed_extensions (set): If given, each image's magic bytes must match one of these types.
+
+    Returns:
+        list[StagedFile]: One entry per element of ``files`` (None for empty entries).
+    """
+    staged = stage_files(files, upload_folder, allowed_extensions)
+    queue_normalization(staged)
+    return staged
+
+
+def queue_normalization(staged):
+    """
+    Queues the normalization of staged images for after the current session commits, if enabled.
+
+    Images that are not normalized are queued for tiling instead, if they
+    are large enough; normalized ones are tiled by their normalization job.
+
+    Args:
+        staged (list[StagedFile]): The staged images; None entries are skipped.
+    """
+    app = current_app._get_current_object()
+    normalize = normalization_enabled(app.config)
+    tile = tiles.tiling_enabled(app.config)
+    for staged_file in staged:
+        if not staged_file:
+            continue
+        if normalize:
+            # Committed with the upload, so a job lost with its worker can be resumed.
+            db.session.add(ImageJob(kind=JOB_NORMALIZE, filename=staged_file.filename))
+            call_after_commit(_submit_normalization, app, staged_file.filename)
+        elif tile and tiles.needs_pyramid(app.config, staged_file.width, staged_file.height):
+            db.session.add(ImageJob(kind=JOB_TILES, filename=staged_file.filename))
+            call_after_commit(_submit_tiles, app, staged_file.filename)
+
+
+def stage_image(file, upload_folder, allowed_extensions=None):
+    """
+    Stages an uploaded image and, if enabled, queues its normalization.
+
+    Args:
+        file: The uploaded image.
+        upload_folder (str): The image upload folder.
+        allowed_extensions (set): If given, the image's magic bytes must match one of these types.
+
+    Returns:
+        str: The stored filename, or None if no file was given.
+    """
+    return stage_images([file], upload_folder, allowed_extensions)[0].filename if file else None
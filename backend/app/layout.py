@@ -0,0 +1,130 @@
+"""
+On-disk layout of the upload folders.
+
+With ``UPLOAD_LAYOUT = 'sharded'`` a stored file named ``name`` lives at
+``<upload folder>/ab/cd/name``, where ``abcd`` are the first hex digits of
+the MD5 of the name. This keeps every directory small (at most 65,536 leaf
+directories, each holding a tiny fraction of the files) so lookups, backups
+and listings stay fast. The ``'flat'`` layout stores files directly in the
+upload folder, which is how all files were stored originally.
+
+The default is ``'flat'``, so existing upload folders keep working as they
+are. To switch an installation to the sharded layout:
+
+1. set ``UPLOAD_LAYOUT = 'sharded'`` and ``UPLOAD_LAYOUT_FALLBACK = True``
+   and restart; lookups now also check the other layout, so every file
+   stays reachable;
+2. run ``flask files migrate-layout``, which moves the files while the
+   application keeps serving them;
+3. turn ``UPLOAD_LAYOUT_FALLBACK`` off again, as it costs a second lookup
+   for every file that is missing.
+"""
+import hashlib
+import os
+
+from flask import current_app
+
+LAYOUTS = ('flat', 'sharded')
+
+
+def shard_dirs(filename):
+    """
+    Returns the two fan-out directory names for a stored filename.
+
+    Args:
+        filename (str): The stored filename.
+
+    Returns:
+        tuple[str, str]: e.g. ``('3f', 'a9')``.
+    """
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return digest[0:2], digest[2:4]
+
+
+def storage_path(upload_folder, filename, layout=None):
+    """
+    Computes where a file is written under the given (or configured) layout.
+
+    Args:
+        upload_folder (str): The upload folder the file belongs to.
+        filename (str): The stored filename.
+        layout (str): ``'flat'`` or ``'sharded'``; defaults to ``UPLOAD_LAYOUT``.
+
+    Returns:
+        str: The absolute path of the file.
+    """
+    layout = layout or current_app.config['UPLOAD_LAYOUT']
+    if layout == 'sharded':
+        return os.path.join(upload_folder, *shard_dirs(filename), filename)
+    return os.path.join(upload_folder, filename)
+
+
+def resolve_path(upload_folder, filename):
+    """
+    Finds an existing stored file, honouring the migration fallback.
+
+    Args:
+        upload_folder (str): The upload folder the file belongs to.
+        filename (str): The stored filename.
+
+    Returns:
+        str: The path of the file, or None if it does not exist.
+    """
+    primary = storage_path(upload_folder, filename)
+    if os.path.isfile(primary):
+        return primary
+    if not current_app.config['UPLOAD_LAYOUT_FALLBACK']:
+        return None
+
+    other = storage_path(upload_folder, filename,
+                         'flat' if current_app.config['UPLOAD_LAYOUT'] == 'sharded' else 'sharded')
+    if os.path.isfile(other):
+        return other
+    # The migration may have moved the file between the two checks.
+    if os.path.isfile(primary):
+        return primary
+    return None
+
+
+def ensure_parent(path):
+    """Creates the directory a stored file is about to be written into."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+def scan_batches(folder, batch_size, recursive=True):
+    """
+    Walks a folder with ``os.scandir`` and yields its regular files in batches.
+
+    Subdirectories (the shard directories of the sharded layout) are listed
+    one at a time, so only a single directory handle is open at once.
+
+    Args:
+        folder (str): The folder to scan. Hidden entries (such as the staging area) are skipped.
+        batch_size (int): The maximum number of entries per batch.
+        recursive (bool): Descend into subdirectories.
+
+    Yields:
+        list[os.DirEntry]: Up to ``batch_size`` file entries.
+    """
+    if not os.path.isdir(folder):
+        return
+
+    batch = []
+    pending_dirs = [folder]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending_dirs.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,371 @@
+"""
+Maintenance routines for the upload folders and deleted defects.
+
+These are run from the ``flask files`` and ``flask defects`` CLI groups (see
+``app/commands.py``) and are written to work in bounded memory regardless of how many files the
+upload folders hold.
+"""
+import logging
+import os
+import shutil
+import time
+
+from flask import current_app
+from sqlalchemy import delete, func, select
+
+from app import db, tiles
+from app.models import Defect, DefectMode, PDFFile, UploadIdempotencyKey
+from app.layout import storage_path, ensure_parent, scan_batches
+from app.staging import STAGING_DIRNAME
+from app.uploads import session_mtime
+from app.storage import get_storage, StoredObject
+
+logger = logging.getLogger(__name__)
+
+
+def _new_report(folder):
+    return {'folder': folder, 'scanned': 0, 'orphaned': 0, 'orphaned_bytes': 0,
+            'removed': 0, 'skipped_recent': 0, 'errors': 0, 'samples': []}
+
+
+def _remove(obj, delete, report, dry_run, sample_limit):
+    report['orphaned'] += 1
+    report['orphaned_bytes'] += obj.size
+    if len(report['samples']) < sample_limit:
+        report['samples'].append(obj.name)
+    if dry_run:
+        return
+    try:
+        delete(obj.name)
+        report['removed'] += 1
+    except Exception as e:
+        report['errors'] += 1
+        logger.error(f"Error deleting orphaned file {obj.name}: {e}")
+
+
+def collect_orphans(folder, column, batch_size=500, grace_seconds=3600, dry_run=True, sample_limit=20, owner=None):
+    """
+    Removes files stored for ``folder`` that no database row references.
+
+    The folder's storage driver is listed, so this works for every
+    ``STORAGE_BACKEND``. Files are compared against ``column`` one batch at a time, so memory use
+    is bounded by ``batch_size`` rather than by the number of files or rows.
+    Files modified within ``grace_seconds`` are never removed, which protects
+    uploads whose transaction has not committed yet.
+
+    Args:
+        folder (str): The upload folder to clean.
+        column: The model column holding stored filenames (e.g. ``DefectMode.image_filename``).
+        batch_size (int): Number of directory entries checked per query.
+        grace_seconds (int): Minimum file age before it may be collected.
+        dry_run (bool): Only report what would be removed.
+        sample_limit (int): Maximum number of orphaned filenames kept in the report.
+        owner: For files derived from another stored file (e.g. image tiles),
+            a function returning the name ``column`` holds for a stored name.
+
+    Returns:
+        dict: A report with counts, reclaimable bytes and sample filenames.
+    """
+    report = _new_report(folder)
+    owner = owner or (lambda name: name)
+    cutoff = time.time() - grace_seconds
+    storage = get_storage(folder)
+
+    for batch in storage.iter_objects(batch_size):
+        report['scanned'] += len(batch)
+        names = list({owner(obj.name) for obj in batch})
+        referenced = set(db.session.execute(select(column).where(column.in_(names))).scalars())
+
+        for obj in batch:
+            if owner(obj.name) in referenced:
+                continue
+            if obj.mtime > cutoff:
+                report['skipped_recent'] += 1
+                continue
+            _remove(obj, storage.delete, report, dry_run, sample_limit)
+
+        # Release the identity map and the read transaction between batches.
+        db.session.rollback()
+
+    return report
+
+
+def collect_stale_staging(folder, batch_size=500, grace_seconds=3600, dry_run=True, sample_limit=20):
+    """
+    Removes staged uploads that were never promoted (e.g. after a worker crash).
+
+    Args:
+        folder (str): The upload folder whose staging area should be cleaned.
+        batch_size (int): Number of directory entries handled per batch.
+        grace_seconds (int): Minimum file age before it may be collected.
+        dry_run (bool): Only report what would be removed.
+        sample_limit (int): Maximum number of filenames kept in the report.
+
+    Returns:
+        dict: A report with counts, reclaimable bytes and sample filenames.
+    """
+    staging = os.path.join(folder, STAGING_DIRNAME)
+    report = _new_report(staging)
+    cutoff = time.time() - grace_seconds
+
+    def delete(name):
+        os.remove(os.path.join(staging, name))
+
+    for batch in scan_batches(staging, batch_size, recursive=False):
+        report['scanned'] += len(batch)
+        for entry in batch:
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime > cutoff:
+                report['skipped_recent'] += 1
+                continue
+            _remove(StoredObject(entry.name, stat.st_size, stat.st_mtime), delete, report, dry_run, sample_limit)
+
+    return report
+
+
+def collect_upload_sessions(root, ttl_seconds, dry_run=True, sample_limit=20):
+    """
+    Removes resumable upload sessions that received no chunk for ``ttl_seconds``.
+
+    Args:
+        root (str): The sessions folder (``uploads.sessions_folder``).
+        ttl_seconds (float): Idle time after which a session is abandoned.
+        dry_run (bool): Only report what would be removed.
+        sample_limit (int): Maximum number of session ids kept in the report.
+
+    Returns:
+        dict: A report with counts, reclaimable bytes and sample session ids.
+    """
+    report = _new_report(root)
+    cutoff = time.time() - ttl_seconds
+    if not os.path.isdir(root):
+        return report
+
+    with os.scandir(root) as entries:
+        sessions = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    for directory in sessions:
+        report['scanned'] += 1
+        try:
+            if session_mtime(directory) > cutoff:
+                report['skipped_recent'] += 1
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+        except FileNotFoundError:
+            continue  # finalized meanwhile
+        _remove(StoredObject(os.path.basename(directory), size, 0),
+                lambda name: shutil.rmtree(os.path.join(root, name)), report, dry_run, sample_limit)
+    return report
+
+
+def prune_idempotency_keys(older_than, dry_run=True):
+    """
+    Deletes finalize Idempotency-Keys created before ``older_than``; a retry after that creates a new defect.
+
+    Returns:
+        int: The number of keys (that would be) deleted.
+    """
+    condition = UploadIdempotencyKey.created_at < older_than
+    if dry_run:
+        return db.session.execute(select(func.count()).select_from(UploadIdempotencyKey).where(condition)).scalar()
+    count = db.session.execute(delete(UploadIdempotencyKey).where(condition)).rowcount
+    db.session.commit()
+    return count
+
+
+def find_missing_files(folder, column, id_column, batch_size=500, sample_limit=20):
+    """
+    Reports rows whose stored filename no longer exists in storage.
+
+    Rows are streamed with ``yield_per`` so the whole table is never loaded.
+    Nothing is modified; the report is meant for manual follow-up.
+
+    Args:
+        folder (str): The upload folder the filenames live in.
+        column: The model column holding stored filenames.
+        id_column: The primary key column of the same model.
+        batch_size (int): Number of rows fetched per round trip.
+        sample_limit (int): Maximum number of row ids kept in the report.
+
+    Returns:
+        dict: The number of rows checked, the number missing and sample ids.
+    """
+    report = {'folder': folder, 'checked': 0, 'missing': 0, 'samples': []}
+    stmt = (select(id_column, column)
+            .where(column.isnot(None))
+            .execution_options(yield_per=batch_size))
+
+    storage = get_storage(folder)
+    for row_id, filename in db.session.execute(stmt):
+        report['checked'] += 1
+        if not storage.exists(filename):
+            report['missing'] += 1
+            if len(report['samples']) < sample_limit:
+                report['samples'].append(row_id)
+
+    db.session.rollback()
+    return report
+
+
+def migrate_layout(folder, layout, batch_size=500, pause_seconds=0.0, dry_run=False):
+    """
+    Moves locally stored files into ``layout`` while the application keeps running.
+
+    Files are moved with ``os.replace`` one batch at a time, optionally
+    sleeping between batches to limit I/O pressure. Lookups keep working
+    throughout because ``resolve_path`` checks both layouts while
+    ``UPLOAD_LAYOUT_FALLBACK`` is enabled, and the command can be interrupted
+    and re-run at any point.
+
+    Args:
+        folder (str): The upload folder to migrate.
+        layout (str): The target layout, ``flat`` or ``sharded``.
+        batch_size (int): Number of files moved per batch.
+        pause_seconds (float): Time to sleep between batches.
+        dry_run (bool): Only count the files that would be moved.
+
+    Returns:
+        dict: The number of files scanned, moved and failed.
+    """
+    report = {'folder': folder, 'scanned': 0, 'moved': 0, 'errors': 0}
+
+    # Flat files only live at the top level, so a flat -> sharded migration
+    # never needs to list the shard directories.
+    for batch in scan_batches(folder, batch_size, recursive=(layout == 'flat')):
+        report['scanned'] += len(batch)
+        for entry in batch:
+            target = storage_path(folder, entry.name, layout)
+            if target == entry.path:
+                continue
+            if dry_run:
+                report['moved'] += 1
+                continue
+            try:
+                ensure_parent(target)
+                os.replace(entry.path, target)
+                report['moved'] += 1
+            except OSError as e:
+                report['errors'] += 1
+                logger.error(f"Error moving {entry.path} to {target}: {e}")
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    return report
+
+
+def delete_returning(model, columns, *conditions):
+    """
+    Deletes the rows of ``model`` matching ``conditions`` with one set-based statement.
+
+    Uses ``DELETE ... RETURNING`` where the database supports it; elsewhere the
+    rows are read with ``SELECT ... FOR UPDATE`` first, so the result still
+    matches what was deleted. Does not commit.
+
+    Returns:
+        list: ``columns`` of each deleted row.
+    """
+    if db.session.get_bind().dialect.delete_returning:
+        return db.session.execute(
+            delete(model).where(*conditions).returning(*columns)
+            .execution_options(synchronize_session=False)).all()
+    rows = db.session.execute(select(*columns).where(*conditions).with_for_update()).all()
+    if rows:
+        db.session.execute(delete(model).where(*conditions).execution_options(synchronize_session=False))
+    return rows
+
+
+def delete_defects(defect_ids, deleted_before=None):
+    """
+    Permanently deletes defects with their modes and PDF, without committing.
+
+    Args:
+        defect_ids (list[int]): The defects to delete.
+        deleted_before (datetime): If given, only defects soft-deleted before this time are deleted
+            (their modes and PDFs are deleted regardless, so roll back if ids are missing).
+
+    Returns:
+        dict: ``defect_ids`` actually deleted, ``modes`` and ``pdfs`` counts, and
+        ``files``: upload folder -> names of the files that are no longer referenced.
+    """
+    config = current_app.config
+    modes = delete_returning(DefectMode, (DefectMode.image_filename,), DefectMode.defect_id.in_(defect_ids))
+    pdfs = delete_returning(PDFFile, (PDFFile.filename,), PDFFile.defect_id.in_(defect_ids))
+    conditions = [Defect.id.in_(defect_ids)]
+    if deleted_before is not None:
+        conditions.append(Defect.deleted_at < deleted_before)
+    defects = delete_returning(Defect, (Defect.id,), *conditions)
+    return {
+        'defect_ids': [row.id for row in defects],
+        'modes': len(modes),
+        'pdfs': len(pdfs),
+        'files': {
+            config['UPLOAD_FOLDER_IMAGES']: [row.image_filename for row in modes if row.image_filename],
+            config['UPLOAD_FOLDER_PDFS']: [row.filename for row in pdfs],
+        },
+    }
+
+
+def purge_deleted_defects(deleted_before, batch_size=500, dry_run=True):
+    """
+    Permanently removes defects that were soft-deleted before ``deleted_before``.
+
+    Each batch deletes its modes, PDFs and defects with one set-based
+    ``DELETE`` per table in one transaction, collecting the file names as it
+    goes (``delete_defects``). If a defect of the batch is restored in the
+    meantime, the batch is rolled back and retried. Files are removed after
+    the commit, one ``delete_many`` call per upload folder.
+
+    Args:
+        deleted_before (datetime): Purge defects deleted before this time (UTC).
+        batch_size (int): Defects purged per transaction.
+        dry_run (bool): Only count what would be purged.
+
+    Returns:
+        dict: Counts of purged defects, modes, PDFs and files, and file errors.
+    """
+    report = {'defects': 0, 'modes': 0, 'pdfs': 0, 'files': 0, 'errors': 0}
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            select(Defect.id)
+            .where(Defect.deleted_at < deleted_before, Defect.id > last_id)
+            .order_by(Defect.id).limit(batch_size)
+            .with_for_update()
+        ).scalars().all()
+        if not ids:
+            db.session.rollback()
+            break
+
+        if dry_run:
+            report['defects'] += len(ids)
+            report['files'] += db.session.execute(
+                select(func.count(DefectMode.id))
+                .where(DefectMode.defect_id.in_(ids), DefectMode.image_filename.isnot(None))).scalar()
+            report['files'] += db.session.execute(
+                select(func.count(PDFFile.id)).where(PDFFile.defect_id.in_(ids))).scalar()
+            db.session.rollback()
+            last_id = ids[-1]
+            continue
+
+        result = delete_defects(ids, deleted_before)
+        if len(result['defect_ids']) != len(ids):
+            db.session.rollback()
+            logger.info(f"Defects restored during purge, retrying batch after id {last_id}")
+            continue
+        db.session.commit()
+        last_id = ids[-1]
+        report['defects'] += len(ids)
+        report['modes'] += result['modes']
+        report['pdfs'] += result['pdfs']
+
+        for folder, names in result['files'].items():
+            if not names:
+                continue
+            try:
+                get_storage(folder).delete_many(names)
+                if folder == current_app.config['UPLOAD_FOLDER_IMAGES'] and tiles.tiling_enabled(current_app.config):
+                    tiles.delete_pyramids(names)
+                report['files'] += len(names)
+            except Exception as e:
+                report['errors'] += len(names)
+                logger.error(f"Error deleting {len(names)} files of purged defects from {folder}: {e}")
+    return report
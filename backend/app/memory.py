@@ -0,0 +1,155 @@
+"""
+Worker memory: RSS-based recycling and tracemalloc snapshots.
+
+* gunicorn calls ``recycle_if_over_limit`` after every request (the
+  ``post_request`` hook in ``gunicorn_config.py``). Once a worker's resident
+  set exceeds ``WORKER_MAX_RSS_MB`` it stops accepting connections, finishes
+  its in-flight requests and exits, and the master starts a fresh one - long
+  before the OOM killer would pick a victim mid-request.
+* ``tracemalloc`` is off by default, as tracing slows every allocation.
+  ``POST /admin/memory/tracemalloc`` starts it in the worker that handles the
+  request (``TRACEMALLOC_FRAMES`` > 0 starts it in every worker at boot), and
+  ``GET /admin/memory`` reports the RSS plus, while tracing, the top
+  allocation sites and their growth since that worker's previous snapshot.
+  Requests land on any worker, so every answer names its ``pid``.
+
+The RSS comes from ``/proc``, else ``psutil`` if it is installed, else
+``getrusage``. Where none is available (Windows without psutil) the RSS is
+unknown and workers are not recycled.
+"""
+import logging
+import os
+import threading
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover - optional
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEYS = ('lineno', 'filename', 'traceback')
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_snapshot_lock = threading.Lock()
+_last_snapshot = None
+
+
+def current_rss():
+    """
+    Returns this process's resident set size in bytes, or None if it cannot be read.
+
+    Reads ``/proc/self/statm``; elsewhere asks ``psutil``, or falls back to
+    the peak RSS from ``getrusage``, which never decreases.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def recycle_if_over_limit(worker, limit_mb=None):
+    """
+    Asks a gunicorn worker to exit gracefully once its RSS exceeds the limit.
+
+    Args:
+        worker: The gunicorn worker (``post_request`` hook argument).
+        limit_mb (int): The limit; defaults to ``Config.WORKER_MAX_RSS_MB``. 0 disables recycling.
+
+    Returns:
+        bool: True if the worker was asked to exit.
+    """
+    if limit_mb is None:
+        from app.config import Config
+        limit_mb = Config.WORKER_MAX_RSS_MB
+    if not limit_mb or not worker.alive:
+        return False
+    rss = current_rss()
+    if rss is None or rss <= limit_mb * 1024 * 1024:
+        return False
+    worker.log.warning(f"Worker {worker.pid} RSS {rss / 2**20:.0f} MiB exceeds {limit_mb} MiB; recycling")
+    # The worker finishes its in-flight requests, then the master replaces it.
+    worker.alive = False
+    return True
+
+
+def start_tracing(frames):
+    """Starts tracemalloc in this process; returns False if it was already tracing."""
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracing():
+    """Stops tracemalloc in this process and forgets its last snapshot."""
+    global _last_snapshot
+    with _snapshot_lock:
+        _last_snapshot = None
+    tracemalloc.stop()
+
+
+def _site(stat, key):
+    frame = stat.traceback[0]
+    site = {'file': frame.filename, 'line': frame.lineno if key != 'filename' else None}
+    if key == 'traceback':
+        site['traceback'] = [f"{f.filename}:{f.lineno}" for f in stat.traceback]
+    return site
+
+
+def memory_report(limit=20, key='lineno'):
+    """
+    Reports this process's memory use.
+
+    Args:
+        limit (int): Allocation sites to include.
+        key (str): How allocations are grouped, one of ``SNAPSHOT_KEYS``.
+
+    Returns:
+        dict: pid and RSS; while tracing also traced totals, the top sites and
+        the growth since the previous report of this process.
+    """
+    global _last_snapshot
+    report = {'pid': os.getpid(), 'rss_bytes': current_rss(), 'tracing': tracemalloc.is_tracing()}
+    if not report['tracing']:
+        return report
+
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+    with _snapshot_lock:
+        previous, _last_snapshot = _last_snapshot, snapshot
+
+    report.update(traced_bytes=current, traced_peak_bytes=peak, top=[
+        dict(_site(stat, key), size_bytes=stat.size, count=stat.count)
+        for stat in snapshot.statistics(key)[:limit]
+    ])
+    if previous is not None:
+        report['growth'] = [
+            dict(_site(stat, key), size_diff_bytes=stat.size_diff, count_diff=stat.count_diff)
+            for stat in snapshot.compare_to(previous, key)[:limit]
+        ]
+    return report
+
+
+def init_app(app):
+    """Starts tracemalloc at boot when ``TRACEMALLOC_FRAMES`` is set."""
+    frames = app.config['TRACEMALLOC_FRAMES']
+    if frames:
+        start_tracing(frames)
@@ -4,28 +4,93 @@ from datetime import datetime
 class Defect(db.Model):
     """Model representing a wafer defect entry."""
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Routes call it the title; the column keeps its original name.
+    title = db.Column('name', db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Set when the defect is deleted; the row is purged once the retention window has passed
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
     modes = db.relationship('DefectMode', backref='defect', cascade='all, delete-orphan')
     pdf = db.relationship('PDFFile', backref='defect', uselist=False, cascade='all, delete-orphan')
 
 class DefectMode(db.Model):
     """Model representing a specific mode of a wafer defect."""
     id = db.Column(db.Integer, primary_key=True)
+    defect_id = db.Column(db.Integer, db.ForeignKey('defect.id'), nullable=False, index=True)
     mode = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
-    image_filename = db.Column(db.String(255), nullable=True)  # Store filename, not path
-    pdf_filename = db.Column(db.String(255), nullable=True)    # Store filename
-    created_at = db.Column(DateTime, nullable=False, default=datetime.utcnow)
+    image_filename = db.Column(db.String(255), nullable=True, index=True)  # Store filename, not path
+    # Recorded at upload (see app/filemeta.py); NULL until `flask files metadata` for older rows
+    image_size = db.Column(db.BigInteger, nullable=True)
+    image_sha256 = db.Column(db.String(64), nullable=True)
+    image_mimetype = db.Column(db.String(100), nullable=True)
+    image_width = db.Column(db.Integer, nullable=True)
+    image_height = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
-        return f'<Defect {self.title}>'
-        
+        return f'<DefectMode {self.mode}>'
+
 class PDFFile(db.Model):
     """Model representing the PDF file associated with a defect."""
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(255), nullable=False)
-    defect_id = db.Column(db.Integer, db.ForeignKey('defect.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    defect_id = db.Column(db.Integer, db.ForeignKey('defect.id'), nullable=False, index=True)
+    # Recorded at upload (see app/filemeta.py); NULL until `flask files metadata` for older rows
+    size = db.Column(db.BigInteger, nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    page_count = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DefectActivityDaily(db.Model):
+    """Rollup: defects and modes created, edited and deleted per day (UTC)."""
+    __tablename__ = 'defect_activity_daily'
+    day = db.Column(db.Date, primary_key=True)
+    defects_created = db.Column(db.Integer, nullable=False, default=0)
+    modes_created = db.Column(db.Integer, nullable=False, default=0)
+    defects_edited = db.Column(db.Integer, nullable=False, default=0)
+    defects_deleted = db.Column(db.Integer, nullable=False, default=0)
+
+class DefectRollup(db.Model):
+    """Rollup: per-defect mode count, edit count and stored bytes."""
+    __tablename__ = 'defect_rollup'
+    defect_id = db.Column(db.Integer, primary_key=True)  # no FK: rows are removed after the defect
+    mode_count = db.Column(db.Integer, nullable=False, default=0)
+    edit_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    image_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    pdf_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0, index=True)
+    last_edited_at = db.Column(db.DateTime, nullable=True)
+
+class UploadIdempotencyKey(db.Model):
+    """Finalized chunked uploads by client idempotency key, so a retried finalize returns the first result."""
+    __tablename__ = 'upload_idempotency_key'
+    key = db.Column(db.String(128), primary_key=True)
+    upload_id = db.Column(db.String(32), nullable=False)
+    defect_id = db.Column(db.Integer, nullable=False)  # no FK: the key outlives a purged defect
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class RelatedDefect(db.Model):
+    """Precomputed nearest neighbours of each defect (`flask defects related`), rank 0 first."""
+    __tablename__ = 'related_defect'
+    defect_id = db.Column(db.Integer, primary_key=True)  # no FK: rows are removed after the defect
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    related_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+class RelatedQueue(db.Model):
+    """Defects changed since the last `flask defects related` run; an id may be queued repeatedly."""
+    __tablename__ = 'related_queue'
+    id = db.Column(db.Integer, primary_key=True)
+    defect_id = db.Column(db.Integer, nullable=False)
+
+class ImageJob(db.Model):
+    """Image post-processing committed with its upload and not finished yet (see app/imaging.py)."""
+    __tablename__ = 'image_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
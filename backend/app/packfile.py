@@ -0,0 +1,145 @@
+"""
+Pack files: many blobs appended to one large file and read back through mmap.
+
+``PackWriter`` appends blobs and reports where each one landed;
+``PackReader`` maps a pack read-only and hands out zero-copy ``memoryview``
+slices; ``blob_response`` turns such a slice into a cacheable HTTP response
+with ETag and single-range support, copying only the bytes it sends. The index that maps names to
+``(offset, length)`` is kept by the caller.
+"""
+import hashlib
+import mmap
+import os
+
+from flask import current_app, request
+from werkzeug.datastructures import ContentRange
+
+# Slices handed to the WSGI server per iteration
+RESPONSE_CHUNK_SIZE = 256 * 1024
+
+
+class PackWriter:
+    """
+    Appends blobs to a pack file.
+
+    Args:
+        path (str): The pack file; created if missing, appended to otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.offset = self.file.tell()
+
+    def append(self, src):
+        """
+        Copies a readable binary file object to the end of the pack.
+
+        Args:
+            src: The file object to copy from.
+
+        Returns:
+            tuple[int, int, str]: The blob's offset, length and SHA-256 hex digest.
+        """
+        offset = self.offset
+        digest = hashlib.sha256()
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            self.file.write(chunk)
+            self.offset += len(chunk)
+        return offset, self.offset - offset, digest.hexdigest()
+
+    def close(self):
+        """Flushes the pack to disk and closes it."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PackReader:
+    """
+    Maps a pack file read-only.
+
+    Slices stay valid for as long as they are referenced, even after the
+    reader itself is dropped, so a pack can be swapped out while responses
+    are still streaming from it.
+
+    Args:
+        path (str): The pack file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # mmap cannot map an empty file.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def view(self, offset, length):
+        """Returns a zero-copy view of ``length`` bytes at ``offset``."""
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise ValueError(f"Slice {offset}+{length} is outside {self.path} ({self.size} bytes)")
+        if not length:
+            return memoryview(b'')
+        return memoryview(self._map)[offset:offset + length]
+
+
+def _iter_chunks(view):
+    # WSGI servers only accept bytes, so each chunk is copied out of the mapping as it is sent.
+    for start in range(0, len(view), RESPONSE_CHUNK_SIZE):
+        yield view[start:start + RESPONSE_CHUNK_SIZE].tobytes()
+
+
+def blob_response(view, mimetype, etag=None, max_age=31536000):
+    """
+    Builds a response streaming a pack slice.
+
+    Stored filenames are unique, so blobs never change and are marked
+    immutable. ``If-None-Match`` and single ``Range`` requests are honoured
+    without touching the bytes that are not sent.
+
+    Args:
+        view (memoryview): The blob, as returned by ``PackReader.view``.
+        mimetype (str): The blob's content type.
+        etag (str): Strong ETag for conditional requests (e.g. the blob's hash).
+        max_age (int): ``Cache-Control`` max-age in seconds.
+
+    Returns:
+        Response: A 200, 206, 304 or 416 response.
+    """
+    response = current_app.response_class(mimetype=mimetype, direct_passthrough=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    response.accept_ranges = 'bytes'
+    if etag:
+        response.set_etag(etag)
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            return response
+
+    length = len(view)
+    # Blobs never change, so only an If-Range naming another entity forces a full response.
+    if request.range is not None and request.if_range.etag in (None, etag):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            response.status_code = 416
+            response.content_range = ContentRange('bytes', None, None, length)
+            return response
+        start, stop = byte_range
+        view = view[start:stop]
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, length)
+
+    response.response = _iter_chunks(view)
+    response.content_length = len(view)
+    return response
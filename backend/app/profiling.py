@@ -0,0 +1,195 @@
+"""
+Opt-in per-request profiling.
+
+A request is run under ``cProfile`` when either:
+
+* it carries ``X-Profile: <PROFILE_TOKEN>`` (disabled while the token is
+  unset); its response then names the stored profile in ``X-Profile-Id``, or
+* it is picked by sampling (``PROFILE_SAMPLE_RATE``, a fraction of all
+  requests, optionally limited to the endpoints in ``PROFILE_ENDPOINTS``);
+  a sampled profile is only kept when the request took at least
+  ``PROFILE_SAMPLE_MIN_MS``, so the occasional slow call is caught without
+  storing thousands of fast ones.
+
+Profiles are written in ``pstats`` format to ``PROFILE_DIR`` (shared by the
+worker processes, newest ``PROFILE_KEEP`` kept) with a JSON sidecar holding
+the endpoint, path, status and duration. ``GET /admin/profiles`` lists them
+and ``GET /admin/profiles/<id>`` downloads one, for ``snakeviz`` or
+``python -m pstats``, or as text with ``?format=text``. Those routes, like
+the memory routes, also require the ``X-Profile`` header (``token_required``)
+and are never profiled themselves.
+"""
+import cProfile
+import functools
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+
+from flask import abort, current_app, g, request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+_PROFILE_ID = re.compile(r'^[0-9]+-[0-9]+-[0-9a-f]+$')
+
+
+def token_matches(config):
+    """Returns whether the request carries ``X-Profile: <PROFILE_TOKEN>``; always False while the token is unset."""
+    token = config['PROFILE_TOKEN']
+    supplied = request.headers.get(PROFILE_HEADER)
+    return bool(token and supplied and hmac.compare_digest(supplied.encode(), token.encode()))
+
+
+def token_required(view):
+    """
+    Route decorator for the profiling and memory routes.
+
+    Requests without a matching ``X-Profile`` header get the same ``404`` as
+    an unknown URL, so the routes do not exist while ``PROFILE_TOKEN`` is
+    unset. The routes are not profiled: reading profiles should not create,
+    and rotate out, new ones.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not token_matches(current_app.config):
+            abort(404)
+        return view(*args, **kwargs)
+    wrapper.profile_exempt = True
+    return wrapper
+
+
+def _sampled(config):
+    rate = config['PROFILE_SAMPLE_RATE']
+    if not rate or random.random() >= rate:
+        return False
+    endpoints = config['PROFILE_ENDPOINTS']
+    return not endpoints or request.endpoint in endpoints
+
+
+def _start():
+    """``before_request`` hook starting the profiler for requested or sampled requests."""
+    config = current_app.config
+    if getattr(current_app.view_functions.get(request.endpoint), 'profile_exempt', False):
+        return
+    trigger = 'header' if token_matches(config) else 'sample' if _sampled(config) else None
+    if trigger is None:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler is active in this process (e.g. a concurrent request on Python 3.12+).
+        logger.warning(f"Not profiling {request.path}: {e}")
+        return
+    g.profile = (profiler, trigger, time.perf_counter())
+    if trigger == 'header':
+        g.profile_id = new_profile_id()
+
+
+def _tag_response(response):
+    """``after_request`` hook naming the profile of a header-triggered request."""
+    if 'profile' in g:
+        g.profile_status = response.status_code
+        if 'profile_id' in g:
+            response.headers[PROFILE_ID_HEADER] = g.profile_id
+    return response
+
+
+def _finish(exception=None):
+    """``teardown_request`` hook stopping the profiler and storing the profile."""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    profiler, trigger, start = profile
+    profiler.disable()
+    duration_ms = (time.perf_counter() - start) * 1000
+    config = current_app.config
+    if trigger == 'sample' and duration_ms < config['PROFILE_SAMPLE_MIN_MS']:
+        return
+    try:
+        save_profile(config['PROFILE_DIR'], g.pop('profile_id', None) or new_profile_id(), profiler, {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': g.pop('profile_status', 500),
+            'duration_ms': round(duration_ms, 1),
+            'trigger': trigger,
+            'pid': os.getpid(),
+            'created': time.time(),
+        }, config['PROFILE_KEEP'])
+    except OSError as e:
+        logger.error(f"Error storing profile of {request.path}: {e}")
+
+
+def new_profile_id():
+    """Returns a new profile id; ids sort by creation time."""
+    return f"{int(time.time() * 1000)}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def save_profile(directory, profile_id, profiler, metadata, keep):
+    """Writes a profile and its metadata, then drops the oldest beyond ``keep``."""
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, f'{profile_id}.prof'))
+    with open(os.path.join(directory, f'{profile_id}.json'), 'w') as f:
+        json.dump(dict(metadata, id=profile_id), f)
+
+    ids = sorted((name[:-5] for name in os.listdir(directory) if name.endswith('.json')),
+                 key=lambda i: int(i.split('-')[0]))
+    for old in ids[:-keep] if keep else []:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, old + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory, limit=None):
+    """Returns the metadata of the stored profiles, newest first."""
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith('.json')]
+    except FileNotFoundError:
+        return []
+    names.sort(key=lambda name: int(name.split('-')[0]), reverse=True)
+    result = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(directory, name)) as f:
+                result.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # pruned by another worker meanwhile
+    return result
+
+
+def profile_path(directory, profile_id):
+    """Returns the ``.prof`` path of a stored profile, or None if the id is invalid or unknown."""
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(directory, f'{profile_id}.prof')
+    return path if os.path.isfile(path) else None
+
+
+def profile_text(path, sort='cumulative', limit=50):
+    """Renders a stored profile as ``pstats`` text, top ``limit`` functions by ``sort``."""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def init_app(app):
+    """Registers the profiling hooks when a token or a sample rate is configured."""
+    config = app.config
+    if not config['PROFILE_TOKEN'] and not config['PROFILE_SAMPLE_RATE']:
+        return
+    app.before_request(_start)
+    app.after_request(_tag_response)
+    app.teardown_request(_finish)
@@ -0,0 +1,253 @@
+"""
+Precomputed "related defects".
+
+``flask defects related`` (run periodically, e.g. from cron) stores the
+``RELATED_TOP_K`` nearest neighbours of every live defect in
+``related_defect``, so ``GET /defect/<id>`` and ``GET /defect/<id>/related``
+read them with one primary-key range scan instead of comparing the defect
+with the whole library per request.
+
+Similarity is a weighted sum of two cosines:
+
+* text: the defect's vector in the semantic index (``app/semantic.py``),
+  built from its title, mode names and descriptions; build that index first;
+* images: each mode image shrunk to an 8x8 grayscale thumbnail, mean-centred
+  and normalized, averaged over the defect's images. These features are
+  cached by defect id in ``RELATED_DIR`` and only recomputed for defects
+  that changed.
+
+The two feature vectors are concatenated, scaled by the square roots of
+``RELATED_TEXT_WEIGHT`` and ``RELATED_IMAGE_WEIGHT``, so one dot product
+gives the weighted sum. Scores are computed with NumPy for
+``RELATED_BLOCK_SIZE`` defects at a time against all others, which bounds
+memory by block size times library size.
+
+Committed change events queue the touched defect ids in ``related_queue``.
+A run recomputes the full lists of the queued defects, then merges their new
+scores into every other list, dropping entries of deleted defects; only rows
+that change are rewritten. A list that lost an entry is only refilled from
+the queued defects, so it may run short until the next ``--full`` run, which
+also removes every row whose defect or related defect is no longer live
+(e.g. lists of defects purged while no change listener was running).
+"""
+import logging
+import os
+import uuid
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+
+from app import db, changes, semantic
+from app.models import Defect, DefectMode, RelatedDefect, RelatedQueue
+from app.storage import get_storage
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+FEATURES_FILENAME = 'image_features.npz'
+THUMBNAIL_SIZE = 8
+IMAGE_DIMENSIONS = THUMBNAIL_SIZE * THUMBNAIL_SIZE
+
+
+def image_feature(file):
+    """Returns the normalized, mean-centred 8x8 grayscale thumbnail of an image file."""
+    with Image.open(file) as image:
+        # Lets JPEG decode at a fraction of the full size
+        image.draft('L', (THUMBNAIL_SIZE * 8, THUMBNAIL_SIZE * 8))
+        thumbnail = image.convert('L').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX)
+        pixels = np.asarray(thumbnail, np.float32).ravel()
+    pixels = pixels - pixels.mean()
+    norm = np.linalg.norm(pixels)
+    return pixels / norm if norm else pixels
+
+
+def _load_cache(directory):
+    try:
+        with np.load(os.path.join(directory, FEATURES_FILENAME)) as cache:
+            return cache['features'], cache['known']
+    except FileNotFoundError:
+        return np.zeros((0, IMAGE_DIMENSIONS), np.float32), np.zeros(0, bool)
+
+
+def _save_cache(directory, features, known):
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{uuid.uuid4().hex}.npz")
+    np.savez(tmp_path, features=features, known=known)
+    os.replace(tmp_path, os.path.join(directory, FEATURES_FILENAME))
+
+
+def _image_features(ids, stale, directory, batch_size):
+    """Returns the image features of ``ids``, computing those that are ``stale`` or not cached."""
+    features, known = _load_cache(directory)
+    size = int(ids[-1]) + 1 if len(ids) else 0
+    if size > len(known):
+        features = np.concatenate([features, np.zeros((size - len(known), IMAGE_DIMENSIONS), np.float32)])
+        known = np.concatenate([known, np.zeros(size - len(known), bool)])
+
+    missing = sorted(set(ids[~known[ids]].tolist()) | (stale & set(ids.tolist())))
+    if missing and Image is None:
+        logger.warning('Pillow is not installed; related defects ignore images')
+    elif missing:
+        storage = get_storage(current_app.config['UPLOAD_FOLDER_IMAGES'])
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            sums = {defect_id: np.zeros(IMAGE_DIMENSIONS, np.float32) for defect_id in batch}
+            for defect_id, filename in db.session.execute(
+                    select(DefectMode.defect_id, DefectMode.image_filename)
+                    .where(DefectMode.defect_id.in_(batch), DefectMode.image_filename.isnot(None))):
+                try:
+                    with storage.open(filename) as f:
+                        sums[defect_id] += image_feature(f)
+                except Exception as e:
+                    logger.warning(f"Skipping image {filename} of defect {defect_id}: {e}")
+            db.session.rollback()
+            for defect_id, total in sums.items():
+                norm = np.linalg.norm(total)
+                features[defect_id] = total / norm if norm else total
+                known[defect_id] = True
+        _save_cache(directory, features, known)
+    return features[ids]
+
+
+def _text_features(ids, index_root):
+    """Returns the semantic index vectors of ``ids`` (zeros if no index was built)."""
+    path = semantic.active_path(index_root)
+    if path is None:
+        logger.warning('No semantic index (flask search build); related defects ignore text')
+        return np.zeros((len(ids), 0), np.float32)
+    vectors = semantic.SemanticIndex(path).vectors
+    result = np.zeros((len(ids), vectors.shape[1]), np.float32)
+    inside = ids < len(vectors)
+    result[inside] = vectors[ids[inside]]
+    return result
+
+
+def _top_k(scores, k):
+    """Returns the column indexes and scores of each row's ``k`` highest scores, best first."""
+    k = min(k, scores.shape[1])
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, columns, 1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(columns, order, 1), np.take_along_axis(top, order, 1)
+
+
+def _write_lists(lists):
+    """Replaces the stored lists of ``{defect_id: [(related_id, score), ...]}`` in one transaction."""
+    if not lists:
+        return 0
+    rows = [{'defect_id': defect_id, 'rank': rank, 'related_id': related_id, 'score': score}
+            for defect_id, neighbours in lists.items() for rank, (related_id, score) in enumerate(neighbours)]
+    with db.engine.begin() as connection:
+        connection.execute(delete(RelatedDefect).where(RelatedDefect.defect_id.in_(list(lists))))
+        if rows:
+            connection.execute(insert(RelatedDefect), rows)
+    return len(rows)
+
+
+def compute_related(full=False, top_k=10, text_weight=0.7, image_weight=0.3, block_size=256, batch_size=500):
+    """
+    Recomputes the related defects of the queued defects (or of all with ``full``).
+
+    Args:
+        full (bool): Recompute every list; implied while ``related_defect`` is empty.
+        top_k (int): Neighbours kept per defect.
+        text_weight (float): Weight of the text similarity.
+        image_weight (float): Weight of the image similarity.
+        block_size (int): Defects scored per matrix product.
+        batch_size (int): Defects whose images are read per query.
+
+    Returns:
+        dict: Numbers of live defects, recomputed defects, other lists updated, rows written
+        and stale rows removed.
+    """
+    config = current_app.config
+    report = {'full': full, 'defects': 0, 'recomputed': 0, 'merged': 0, 'rows': 0, 'removed': 0}
+    last_queued = db.session.scalar(select(func.max(RelatedQueue.id))) or 0
+    if not full and db.session.scalar(select(RelatedDefect.defect_id).limit(1)) is None:
+        report['full'] = full = True
+    live = np.array(db.session.scalars(select(Defect.id).where(Defect.deleted_at.is_(None))
+                                       .order_by(Defect.id)).all(), np.int64)
+    queued = set(db.session.scalars(select(RelatedQueue.defect_id).where(RelatedQueue.id <= last_queued)
+                                    .distinct()).all())
+    db.session.rollback()
+    touched = set(live.tolist()) if full else queued
+    report['defects'] = len(live)
+
+    features = np.hstack([
+        np.sqrt(text_weight) * _text_features(live, config['SEMANTIC_INDEX_DIR']),
+        np.sqrt(image_weight) * _image_features(live, touched, config['RELATED_DIR'], batch_size),
+    ]).astype(np.float32)
+    touched_positions = np.flatnonzero(np.isin(live, list(touched)))
+
+    # Full lists of the touched defects against the whole library
+    lists = {defect_id: [] for defect_id in touched - set(live.tolist())}  # deleted: drop their lists
+    for start in range(0, len(touched_positions), block_size):
+        block = touched_positions[start:start + block_size]
+        scores = features[block] @ features.T
+        scores[np.arange(len(block)), block] = -np.inf
+        if len(live) > 1:
+            columns, top = _top_k(scores, top_k)
+            for row, position in enumerate(block):
+                lists[int(live[position])] = [(int(live[c]), float(s)) for c, s in zip(columns[row], top[row]) if s > 0]
+        else:
+            lists[int(live[block[0]])] = []
+        report['rows'] += _write_lists(lists)
+        lists = {}
+    report['rows'] += _write_lists(lists)
+    report['recomputed'] = len(touched)
+
+    # Everybody else: merge in the new scores of the touched defects
+    if not full and touched:
+        others = np.flatnonzero(~np.isin(live, list(touched)))
+        touched_ids = live[touched_positions]
+        for start in range(0, len(others), block_size):
+            block = others[start:start + block_size]
+            block_ids = [int(i) for i in live[block]]
+            current = {defect_id: [] for defect_id in block_ids}
+            for row in db.session.execute(select(RelatedDefect.defect_id, RelatedDefect.related_id, RelatedDefect.score)
+                                          .where(RelatedDefect.defect_id.in_(block_ids))
+                                          .order_by(RelatedDefect.defect_id, RelatedDefect.rank)):
+                current[row.defect_id].append((row.related_id, row.score))
+            db.session.rollback()
+            scores = features[block] @ features[touched_positions].T if len(touched_positions) else None
+
+            changed = {}
+            for row, defect_id in enumerate(block_ids):
+                kept = [(related_id, score) for related_id, score in current[defect_id] if related_id not in touched]
+                candidates = list(kept)
+                if scores is not None:
+                    best = np.argsort(-scores[row])[:top_k]
+                    candidates += [(int(touched_ids[c]), float(scores[row, c])) for c in best if scores[row, c] > 0]
+                merged = sorted(candidates, key=lambda pair: -pair[1])[:top_k]
+                if merged != current[defect_id]:
+                    changed[defect_id] = merged
+            report['rows'] += _write_lists(changed)
+            report['merged'] += len(changed)
+
+    with db.engine.begin() as connection:
+        if full:
+            # Rows of defects that are gone, whether or not their deletion was queued
+            live_ids = select(Defect.id).where(Defect.deleted_at.is_(None))
+            report['removed'] = connection.execute(delete(RelatedDefect).where(
+                RelatedDefect.defect_id.not_in(live_ids) | RelatedDefect.related_id.not_in(live_ids))).rowcount
+        connection.execute(delete(RelatedQueue).where(RelatedQueue.id <= last_queued))
+    return report
+
+
+def _enqueue(events):
+    """Change listener queuing the touched defects for the next run."""
+    defect_ids = sorted({event['defect_id'] for event in events if event.get('defect_id') is not None})
+    if defect_ids:
+        with db.engine.begin() as connection:
+            connection.execute(insert(RelatedQueue), [{'defect_id': defect_id} for defect_id in defect_ids])
+
+
+def init_app(app):
+    """Queues changed defects for ``flask defects related`` when ``RELATED_DEFECTS`` is enabled."""
+    if app.config['RELATED_DEFECTS']:
+        changes.add_listener(app, _enqueue)
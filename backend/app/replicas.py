@@ -0,0 +1,247 @@
+"""
+Read/write routing between the primary database and read replicas.
+
+Replicas are configured with ``DATABASE_REPLICA_URLS`` and registered as the
+Flask-SQLAlchemy binds ``replica_1``, ``replica_2``, ... (see ``Config``).
+When at least one is configured:
+
+* ``GET``/``HEAD``/``OPTIONS`` requests run their plain ``SELECT`` statements
+  on a randomly chosen healthy replica. Everything else - mutating requests,
+  flushes, DML, ``SELECT ... FOR UPDATE``, CLI commands and background jobs -
+  uses the primary.
+* Once a session has written, the rest of its transaction reads from the
+  primary, and a committed write sets a short-lived cookie
+  (``REPLICA_STICKY_SECONDS``) that keeps the client's following requests on
+  the primary so users read their own writes.
+* Replicas are checked at most every ``REPLICA_CHECK_INTERVAL`` seconds per
+  worker. A replica that cannot be reached, drops a connection or lags more
+  than ``REPLICA_MAX_LAG_SECONDS`` is skipped until a later check passes;
+  with no healthy replica, reads fall back to the primary. Lag, health and
+  routing counters are reported by ``GET /admin/replicas``.
+"""
+import logging
+import random
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = 'replica_'
+STICKY_COOKIE = 'wdl_primary_until'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_REPLICA_KEY = 'replica_bind'
+_WROTE_KEY = 'replica_wrote'
+
+# Dialect name -> query returning the replica's lag in seconds (NULL if unknown)
+LAG_QUERIES = {
+    'postgresql': (
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+    ),
+}
+
+
+class RoutingSession(Session):
+    """Session that sends read-only statements to the replica chosen for the request."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        replica = self.info.get(_REPLICA_KEY)
+        if (replica is None
+                or bind is not None
+                or self._flushing
+                or self.info.get(_WROTE_KEY)
+                or not getattr(clause, 'is_select', False)
+                or getattr(clause, '_for_update_arg', None) is not None
+                or engine is not self._db.engines.get(None)):
+            return engine
+        return self._db.engines[replica]
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_flush(session, flush_context):
+    session.info[_WROTE_KEY] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[_WROTE_KEY] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_after_write(session):
+    if session.info.pop(_WROTE_KEY, False) and has_request_context():
+        g.replica_sticky = True
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_write(session):
+    session.info.pop(_WROTE_KEY, None)
+
+
+def measure_lag(connection):
+    """
+    Returns a replica's replication lag in seconds.
+
+    Args:
+        connection: An open connection to the replica.
+
+    Returns:
+        float: The lag, or None if the dialect does not report it (the
+        connection is still exercised, so an unreachable replica raises).
+    """
+    dialect = connection.dialect.name
+    if dialect == 'mysql' or dialect == 'mariadb':
+        row = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+        if row is None:
+            return None
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return float(lag) if lag is not None else None
+
+    query = LAG_QUERIES.get(dialect)
+    if query is None:
+        connection.execute(text('SELECT 1'))
+        return None
+    lag = connection.execute(text(query)).scalar()
+    return float(lag) if lag is not None else None
+
+
+class ReplicaPool:
+    """
+    Per-process health and lag bookkeeping for the configured replicas.
+
+    Args:
+        names (list[str]): The replica bind keys.
+        max_lag (float): Replicas lagging more than this many seconds are skipped.
+        check_interval (float): Minimum time between health checks.
+    """
+
+    def __init__(self, names, max_lag, check_interval):
+        self.names = list(names)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.status = {name: {'healthy': False, 'lag_seconds': None, 'checked_at': None,
+                              'error': None, 'requests': 0} for name in self.names}
+        self.primary_fallbacks = 0
+        self.sticky_reads = 0
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def check(self, name, engine):
+        """Measures one replica's lag and updates its health."""
+        status = self.status[name]
+        try:
+            with engine.connect() as connection:
+                lag = measure_lag(connection)
+            healthy = lag is None or lag <= self.max_lag
+            error = None if healthy else f"lag {lag:.1f}s exceeds {self.max_lag}s"
+        except Exception as e:
+            lag, healthy, error = None, False, str(e)
+
+        if healthy != status['healthy']:
+            log = logger.info if healthy else logger.warning
+            log(f"Read replica {name} is {'healthy' if healthy else 'unhealthy'}"
+                f"{'' if healthy else f': {error}'}")
+        status.update(healthy=healthy, lag_seconds=lag, checked_at=time.time(), error=error)
+
+    def refresh(self, engines, force=False):
+        """Re-checks every replica if the check interval has passed (or ``force``)."""
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        # Only one thread checks; the others keep using the previous results.
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            for name in self.names:
+                self.check(name, engines[name])
+        finally:
+            self._lock.release()
+
+    def choose(self, engines):
+        """Returns a healthy replica's bind key, or None to read from the primary."""
+        self.refresh(engines)
+        healthy = [name for name in self.names if self.status[name]['healthy']]
+        if not healthy:
+            self.primary_fallbacks += 1
+            return None
+        name = random.choice(healthy)
+        self.status[name]['requests'] += 1
+        return name
+
+    def mark_failed(self, name, error):
+        """Takes a replica out of rotation until its next successful check."""
+        status = self.status[name]
+        if status['healthy']:
+            logger.warning(f"Read replica {name} failed: {error}")
+        status.update(healthy=False, error=str(error))
+
+    def snapshot(self):
+        """Returns the current health, lag and routing counters."""
+        return {
+            'replicas': [dict(self.status[name], name=name) for name in self.names],
+            'primary_fallbacks': self.primary_fallbacks,
+            'sticky_reads': self.sticky_reads,
+            'max_lag_seconds': self.max_lag,
+        }
+
+
+def get_pool():
+    """Returns the replica pool of the current app, or None if no replicas are configured."""
+    return current_app.extensions.get('replicas')
+
+
+def _choose_replica():
+    """``before_request`` hook routing read-only requests to a replica."""
+    if request.method not in READ_METHODS:
+        return
+    pool = current_app.extensions['replicas']
+    try:
+        sticky_until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        sticky_until = 0
+    if sticky_until > time.time():
+        pool.sticky_reads += 1
+        return
+
+    from app import db
+    name = pool.choose(db.engines)
+    if name is not None:
+        db.session.info[_REPLICA_KEY] = name
+
+
+def _set_sticky_cookie(response):
+    """``after_request`` hook keeping a client on the primary after it wrote."""
+    if g.pop('replica_sticky', False):
+        seconds = current_app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def init_app(app, db):
+    """Sets up replica routing if ``SQLALCHEMY_BINDS`` contains replica binds."""
+    with app.app_context():
+        engines = db.engines
+    names = sorted(key for key in engines if key and key.startswith(REPLICA_BIND_PREFIX))
+    if not names:
+        return
+
+    pool = ReplicaPool(names, app.config['REPLICA_MAX_LAG_SECONDS'], app.config['REPLICA_CHECK_INTERVAL'])
+    app.extensions['replicas'] = pool
+
+    for name in names:
+        def handle_error(context, name=name):
+            if context.is_disconnect:
+                pool.mark_failed(name, context.original_exception)
+        event.listen(engines[name], 'handle_error', handle_error)
+
+    app.before_request(_choose_replica)
+    app.after_request(_set_sticky_cookie)
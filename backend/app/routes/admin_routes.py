@@ -0,0 +1,232 @@
+import math
+import os
+import time
+from flask import Blueprint, request, current_app, send_file
+from app.models import db
+from app.replicas import get_pool
+from app.admission import client_key
+from app import slowlog, profiling, memory
+from app.routes.defect_routes import success, error
+
+# Operational endpoints (health and metrics)
+bp = Blueprint('admin_routes', __name__)
+
+@bp.route('/admin/replicas', methods=['GET'])
+def replica_status():
+    """
+    Report read replica health, replication lag and routing counters.
+    ---
+    responses:
+      200:
+        description: Per-replica health and lag (counters are per worker process)
+    """
+    pool = get_pool()
+    if pool is None:
+        return success('No read replicas configured', {'replicas': []})
+
+    # Check now so the reported lag is current rather than up to REPLICA_CHECK_INTERVAL old.
+    pool.refresh(db.engines, force=True)
+    return success('Replica status retrieved successfully', pool.snapshot())
+
+
+@bp.route('/admin/slow-queries', methods=['GET'])
+def slow_queries():
+    """
+    List the slowest statements, aggregated by normalized SQL (requires SLOW_QUERY_LOG).
+    ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 20
+      - name: since
+        in: query
+        type: integer
+        required: false
+        description: Only include executions from the last this many seconds
+      - name: order
+        in: query
+        type: string
+        enum: [total, count, max, avg]
+        default: total
+    responses:
+      200:
+        description: Statements with count, total/avg/max duration, routes, and the plan (and tables it reads in full) of the slowest execution
+      404:
+        description: Slow-query logging is disabled
+      429:
+        description: Rate limited; see Retry-After
+    """
+    log = slowlog.get_log()
+    if log is None:
+        return error('Slow-query logging is disabled (SLOW_QUERY_LOG)', 404)
+
+    wait = current_app.extensions['slowlog_report_buckets'].take(client_key())
+    if wait:
+        response, code = error('Too many requests, please retry later', 429)
+        response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+        return response, code
+
+    order = request.args.get('order', 'total')
+    if order not in ('total', 'count', 'max', 'avg'):
+        return error('order must be one of total, count, max, avg')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    since = request.args.get('since', type=int)
+    statements = log.top(limit, time.time() - since if since else None, order)
+    return success('Slow queries retrieved successfully', {
+        'threshold_ms': current_app.config['SLOW_QUERY_THRESHOLD_MS'],
+        'statements': statements,
+    })
+
+
+@bp.route('/admin/slow-queries', methods=['DELETE'])
+def clear_slow_queries():
+    """
+    Clear the slow-query log, e.g. after deploying an index.
+    ---
+    responses:
+      200:
+        description: Log cleared
+      404:
+        description: Slow-query logging is disabled
+    """
+    log = slowlog.get_log()
+    if log is None:
+        return error('Slow-query logging is disabled (SLOW_QUERY_LOG)', 404)
+    log.clear()
+    return success('Slow-query log cleared')
+
+
+@bp.route('/admin/profiles', methods=['GET'])
+@profiling.token_required
+def list_profiles():
+    """
+    List stored request profiles, newest first (see PROFILE_TOKEN and PROFILE_SAMPLE_RATE).
+    ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 50
+    responses:
+      200:
+        description: Profiles with endpoint, path, status, duration, trigger (header or sample) and worker pid
+      404:
+        description: No X-Profile header matching PROFILE_TOKEN (or no token configured)
+    """
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+    return success('Profiles retrieved successfully',
+                   profiling.list_profiles(current_app.config['PROFILE_DIR'], limit))
+
+
+@bp.route('/admin/profiles/<profile_id>', methods=['GET'])
+@profiling.token_required
+def download_profile(profile_id):
+    """
+    Download a stored request profile in pstats format, or as text.
+    ---
+    parameters:
+      - name: profile_id
+        in: path
+        type: string
+        required: true
+      - name: format
+        in: query
+        type: string
+        enum: [pstats, text]
+        default: pstats
+      - name: sort
+        in: query
+        type: string
+        enum: [cumulative, tottime, calls]
+        default: cumulative
+      - name: limit
+        in: query
+        type: integer
+        default: 50
+        description: Functions listed in the text format
+    responses:
+      200:
+        description: The profile (open with snakeviz or python -m pstats), or its top functions as text
+      404:
+        description: Profile not found, or no X-Profile header matching PROFILE_TOKEN
+    """
+    path = profiling.profile_path(current_app.config['PROFILE_DIR'], profile_id)
+    if path is None:
+        return error('Profile not found', 404)
+    if request.args.get('format') == 'text':
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in profiling.SORT_KEYS:
+            return error(f"sort must be one of {', '.join(profiling.SORT_KEYS)}")
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        return current_app.response_class(profiling.profile_text(path, sort, limit), mimetype='text/plain')
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
+
+@bp.route('/admin/memory', methods=['GET'])
+@profiling.token_required
+def memory_report():
+    """
+    Report the memory of the worker handling this request; with tracemalloc running, its top allocation sites.
+    ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 20
+      - name: key
+        in: query
+        type: string
+        enum: [lineno, filename, traceback]
+        default: lineno
+    responses:
+      200:
+        description: pid and RSS; while tracing also the top allocation sites and their growth since this worker's previous report
+      404:
+        description: No X-Profile header matching PROFILE_TOKEN (or no token configured)
+    """
+    key = request.args.get('key', 'lineno')
+    if key not in memory.SNAPSHOT_KEYS:
+        return error(f"key must be one of {', '.join(memory.SNAPSHOT_KEYS)}")
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    return success('Memory report retrieved successfully', memory.memory_report(limit, key))
+
+
+@bp.route('/admin/memory/tracemalloc', methods=['POST'])
+@profiling.token_required
+def start_tracemalloc():
+    """
+    Start tracemalloc in the worker handling this request.
+    ---
+    parameters:
+      - name: frames
+        in: query
+        type: integer
+        default: 1
+        description: Stack frames kept per allocation (more is slower)
+    responses:
+      200:
+        description: Tracing started (or was already running) in the reported pid
+      404:
+        description: No X-Profile header matching PROFILE_TOKEN (or no token configured)
+    """
+    frames = max(1, min(request.args.get('frames', 1, type=int), 50))
+    started = memory.start_tracing(frames)
+    return success('Tracing started' if started else 'Tracing was already running', {'pid': os.getpid()})
+
+
+@bp.route('/admin/memory/tracemalloc', methods=['DELETE'])
+@profiling.token_required
+def stop_tracemalloc():
+    """
+    Stop tracemalloc in the worker handling this request.
+    ---
+    responses:
+      200:
+        description: Tracing stopped in the reported pid
+      404:
+        description: No X-Profile header matching PROFILE_TOKEN (or no token configured)
+    """
+    memory.stop_tracing()
+    return success('Tracing stopped', {'pid': os.getpid()})
@@ -0,0 +1,117 @@
+import queue
+import time
+from flask import Blueprint, Response, request, current_app
+from app import changes
+from app.routes.defect_routes import error
+
+# Server-Sent Events stream of defect changes, published by app/changes.py
+bp = Blueprint('change_routes', __name__)
+
+def _last_event_id():
+    """Helper to read the id to resume after from Last-Event-ID (set by EventSource on reconnect) or ?since=."""
+    value = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+@bp.route('/defect/changes', methods=['GET'])
+def change_stream():
+    """
+    Stream defect changes as Server-Sent Events.
+    Each message's data is a JSON object with a type (defect.created, defect.updated, defect.deleted,
+    mode.changed or mode.deleted), the defect_id and, for mode events, the mode_id. Restored defects
+    are reported as defect.created. A "reset" event means changes were missed and the client should
+    refetch. The stream ends after CHANGES_STREAM_MAX_SECONDS; EventSource reconnects and resumes.
+    ---
+    parameters:
+      - name: Last-Event-ID
+        in: header
+        type: integer
+        required: false
+        description: Resume after this event (sent automatically by EventSource)
+      - name: since
+        in: query
+        type: integer
+        required: false
+        description: Resume after this event id, for clients that cannot set headers
+    responses:
+      200:
+        description: text/event-stream of change events
+      404:
+        description: The change stream is disabled
+      503:
+        description: This worker serves its maximum number of streams; retry after Retry-After seconds
+    """
+    hub = changes.get_hub()
+    if hub is None:
+        return error('The change stream is disabled', 404)
+
+    config = current_app.config
+    subscription = hub.subscribe()
+    if subscription is None:
+        response, code = error('Too many open change streams, please retry later', 503)
+        response.headers['Retry-After'] = str(max(1, config['CHANGES_RETRY_MS'] // 1000))
+        return response, code
+
+    # Subscribed before reading the log, so nothing falls between the replay and the live events.
+    last_id = _last_event_id()
+    try:
+        oldest_id, latest_id = hub.log.bounds()
+        replay = []
+        missed = False
+        if last_id is not None and last_id != (latest_id or 0):
+            # Pruned events, or an id from a log that has since been recreated
+            if latest_id is None or last_id > latest_id or oldest_id > last_id + 1:
+                missed = True
+            else:
+                replay = hub.log.since(last_id, limit=config['CHANGES_KEEP'])
+    except Exception:
+        hub.unsubscribe(subscription)
+        raise
+
+    heartbeat = config['CHANGES_HEARTBEAT']
+    deadline = time.monotonic() + config['CHANGES_STREAM_MAX_SECONDS']
+    retry_ms = config['CHANGES_RETRY_MS']
+
+    def generate():
+        sent_id = last_id or 0
+        try:
+            yield f"retry: {retry_ms}\n\n"
+            if missed:
+                yield changes.format_event('{}', latest_id or 0, 'reset')
+                sent_id = latest_id or 0
+            elif last_id is None:
+                # Gives the client a position to resume from, even if nothing changes before it reconnects.
+                yield changes.format_event('{}', latest_id or 0, 'ready')
+                sent_id = latest_id or 0
+            for event_id, payload in replay:
+                yield changes.format_event(payload, event_id)
+                sent_id = event_id
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event_id, payload = subscription.queue.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if subscription.overflowed:
+                    # This client fell too far behind; let it refetch rather than replay.
+                    yield changes.format_event('{}', event_id, 'reset')
+                    return
+                if event_id <= sent_id:
+                    continue
+                yield changes.format_event(payload, event_id)
+                sent_id = event_id
+        finally:
+            hub.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keeps nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,10 +1,14 @@
-from flask import Blueprint, request, jsonify, current_app
-from app.models import db, Defect, DefectMode, PDFFile
+from flask import Blueprint, request, jsonify, current_app, abort
+from app.models import db, Defect, DefectMode, PDFFile, RelatedDefect
+from app.staging import stage_files, schedule_delete, InvalidUpload
+from app.imaging import stage_images
+from app import stats, changes, maintenance, semantic, filemeta
 import os
 import json
 import logging
-from werkzeug.utils import secure_filename # Import secure_filename
-from sqlalchemy import DateTime
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, insert
+from sqlalchemy.orm import selectinload
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -41,21 +45,136 @@ def strip_or_none(s):
     """Helper to strip whitespace from a string or return None if empty."""
     return s.strip() if s is not None else None
 
-def save_file(file, upload_folder):
-    """Helper function to save uploaded files and return the filename.
-    Handles filename security and ensures the upload folder exists.
-    """
-    if file:
-        filename = secure_filename(file.filename)  # Sanitize the filename
-        os.makedirs(upload_folder, exist_ok=True)  # Ensure the folder exists
-        filepath = os.path.join(upload_folder, filename)
-        try:
-            file.save(filepath)
-            return filename
-        except Exception as e:
-            print(f"Error saving file: {e}") # Log the error
-            return None # IMPORTANT:  Return None on error!
-    return None  # important:  return None if no file
+def _validate_mode_entry(mode_info, label):
+    """Helper returning a validation message for the shape of one JSON mode entry, or None."""
+    if not isinstance(mode_info, dict):
+        return f'Invalid mode entry {label}'
+    if mode_info.get('id') is not None and (not isinstance(mode_info['id'], int) or isinstance(mode_info['id'], bool)):
+        return f'Mode ids must be integers {label}'
+    if any(mode_info.get(key) is not None and not isinstance(mode_info[key], str) for key in ('mode', 'description')):
+        return f'Mode name and description must be strings {label}'
+    return None
+
+def _validate_mode_fields(mode_name, description, label):
+    """Helper returning a validation message for a mode's name and description, or None."""
+    if not mode_name or len(mode_name) < 2:
+        return f'Defect mode name must be at least 2 characters long {label}'
+    if not description or len(description) < 5:
+        return f'Description must be at least 5 characters long {label}'
+    return None
+
+def search_statement(query):
+    """Helper building the search SELECT; shared with the async read handlers in app/asgi.py."""
+    pattern = f'%{query}%'
+    # distinct() avoids duplicates when a defect has several matching modes
+    return (select(Defect).join(DefectMode)
+            .where(Defect.deleted_at.is_(None))
+            .where(Defect.title.ilike(pattern) | DefectMode.mode.ilike(pattern) | DefectMode.description.ilike(pattern))
+            .distinct()
+            .options(selectinload(Defect.modes), selectinload(Defect.pdf)))
+
+def defect_statement(defect_id):
+    """Helper building the SELECT of one live defect with its modes and PDF; shared with app/asgi.py."""
+    return (select(Defect)
+            .where(Defect.id == defect_id, Defect.deleted_at.is_(None))
+            .options(selectinload(Defect.modes), selectinload(Defect.pdf)))
+
+def defect_json(defect):
+    """Helper to serialize a defect loaded by search_statement or defect_statement."""
+    return {
+        'id': defect.id,
+        'name': defect.title,
+        'pdf_url': f"/pdfs/{defect.pdf.filename}" if defect.pdf else None,
+        'pdf': filemeta.pdf_json(defect.pdf),
+        'modes': [{
+            'id': mode.id,
+            'mode': mode.mode,
+            'description': mode.description,
+            'image_url': f"/images/{mode.image_filename}" if mode.image_filename else None,
+            'image': filemeta.image_json(mode)
+        } for mode in defect.modes]
+    }
+
+def related_statement(defect_id, limit):
+    """Helper building the SELECT of a defect's precomputed related defects, best first; shared with app/asgi.py."""
+    return (select(RelatedDefect.related_id, RelatedDefect.score, Defect.title)
+            .join(Defect, Defect.id == RelatedDefect.related_id)
+            .where(RelatedDefect.defect_id == defect_id, Defect.deleted_at.is_(None))
+            .order_by(RelatedDefect.rank)
+            .limit(limit))
+
+def related_json(rows):
+    """Helper to serialize the rows of related_statement."""
+    return [{'id': row.related_id, 'name': row.title, 'score': round(row.score, 4)} for row in rows]
+
+def validate_new_defect(name, modes, descriptions):
+    """Helper returning a validation message for a new defect's name, modes and descriptions, or None."""
+    if not name or len(name) < 3:
+        return 'Defect name must be at least 3 characters long'
+    if not modes or not isinstance(modes, list) or len(modes) == 0:
+        return 'At least one defect mode is required'
+    if len(modes) != len(descriptions):
+        return 'Number of defect modes and descriptions must match'
+    return None
+
+def create_defect(name, modes, descriptions, staged_images, staged_pdf):
+    """Helper adding a new defect with its modes and PDF (StagedFiles) to the session; shared with the chunked uploads."""
+    new_defect = Defect(title=name)
+    db.session.add(new_defect)
+    for i in range(len(modes)):
+        new_mode = DefectMode(mode=modes[i], description=descriptions[i], defect=new_defect,
+                              **filemeta.image_columns(staged_images[i]))
+        db.session.add(new_mode)
+
+    pdf = PDFFile(defect=new_defect, **filemeta.pdf_columns(staged_pdf))
+    db.session.add(pdf)
+
+    stats.record(new_defect, created=True, modes_added=len(modes))
+    changes.publish('defect.created', new_defect)
+    return new_defect
+
+def _live_defect_or_404(defect_id):
+    """Helper to fetch a defect that has not been deleted, or abort with 404."""
+    return Defect.query.filter(Defect.id == defect_id, Defect.deleted_at.is_(None)).first_or_404()
+
+def _live_mode_or_404(mode_id):
+    """Helper to fetch a mode whose defect has not been deleted, or abort with 404."""
+    return DefectMode.query.join(Defect).filter(DefectMode.id == mode_id, Defect.deleted_at.is_(None)).first_or_404()
+
+def _load_modes(defect_ids, mode_ids):
+    """Helper to fetch the current values of modes belonging to the given defects in one query."""
+    if not mode_ids:
+        return {}
+    rows = db.session.execute(
+        select(DefectMode.id, DefectMode.defect_id, DefectMode.mode, DefectMode.description, DefectMode.image_filename)
+        .where(DefectMode.id.in_(mode_ids), DefectMode.defect_id.in_(defect_ids))
+    )
+    return {row.id: row for row in rows}
+
+def _mode_changes(row, mode_name, description, staged_image=None):
+    """Helper to diff a mode row against new values; schedules removal of a replaced image."""
+    changes = {}
+    if mode_name != row.mode:
+        changes['mode'] = mode_name
+    if description != row.description:
+        changes['description'] = description
+    if staged_image:
+        if row.image_filename:
+            schedule_delete(current_app.config['UPLOAD_FOLDER_IMAGES'], row.image_filename)
+        changes.update(filemeta.image_columns(staged_image))
+    return changes
+
+def _touch_defects(defect_ids):
+    """Helper bumping updated_at of defects whose modes or PDF changed, so `flask stats rebuild` sees the edit."""
+    if defect_ids:
+        db.session.execute(update(Defect).where(Defect.id.in_(list(defect_ids))).values(updated_at=datetime.utcnow()))
+
+def _apply_mode_changes(mode_updates, mode_inserts):
+    """Helper to write mode changes as one executemany UPDATE and one INSERT."""
+    if mode_updates:
+        db.session.execute(update(DefectMode), mode_updates)
+    if mode_inserts:
+        db.session.execute(insert(DefectMode), mode_inserts)
 
 
 
@@ -108,14 +227,9 @@ def upload_defect():
         pdf_file = request.files.get('pdf')
 
         # === VALIDATIONS ===
-        if not name or len(name) < 3:
-            return error('Defect name must be at least 3 characters long')
-
-        if not modes or not isinstance(modes, list) or len(modes) == 0:
-            return error('At least one defect mode is required')
-
-        if len(modes) != len(descriptions):
-            return error('Number of defect modes and descriptions must match')
+        message = validate_new_defect(name, modes, descriptions)
+        if message:
+            return error(message)
 
         if not pdf_file:
             return error('A PDF file is required')
@@ -130,7 +244,9 @@ def upload_defect():
         elif not is_allowed_file(pdf_file.filename, ALLOWED_PDF_EXTENSIONS):
             return error('Only PDF files are allowed')
 
-
+        # Ensure the number of images matches the number of modes (if provided)
+        if len(images) > len(modes):
+            return error('Number of images exceeds the number of defect modes')
 
         for i, image in enumerate(images):
             if image:
@@ -143,29 +259,22 @@ def upload_defect():
                 elif not is_allowed_file(image.filename, ALLOWED_IMAGE_EXTENSIONS):
                     return error(f'Image for mode {modes[i]} must be a JPG or PNG file')
 
-        # Ensure the number of images matches the number of modes (if provided)
-        if len(images) > len(modes):
-            return error('Number of images exceeds the number of defect modes')
-
         # === PROCESSING ===
-        new_defect = Defect(title=name)
-        db.session.add(new_defect)
-        db.session.flush()
-
-        for i in range(len(modes)):
-            img_filename = save_file(images[i], current_app.config['UPLOAD_FOLDER_IMAGES']) if i < len(images) and images[i] else None
-            new_mode = DefectMode(mode=modes[i], description=descriptions[i], image_filename=img_filename, defect=new_defect)
-            db.session.add(new_mode)
-
-        pdf_filename = save_file(pdf_file, current_app.config['UPLOAD_FOLDER_PDFS'])
-        pdf = PDFFile(filename=pdf_filename, defect=new_defect)
-        db.session.add(pdf)
+        # Validate content, hash and write every file on the upload pool first;
+        # rows are only created once all of them have landed.
+        mode_images = [images[i] if i < len(images) else None for i in range(len(modes))]
+        staged_images = stage_images(mode_images, current_app.config['UPLOAD_FOLDER_IMAGES'], ALLOWED_IMAGE_EXTENSIONS)
+        staged_pdf = stage_files([pdf_file], current_app.config['UPLOAD_FOLDER_PDFS'], ALLOWED_PDF_EXTENSIONS)[0]
 
+        create_defect(name, modes, descriptions, staged_images, staged_pdf)
         db.session.commit()
         return success('Defect uploaded successfully')
 
     except json.JSONDecodeError:
         return error('Invalid JSON format for defect_modes')
+    except InvalidUpload as e:
+        db.session.rollback()
+        return error(str(e))
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error uploading defect: {e}")
@@ -177,39 +286,62 @@ def upload_defect():
 def search_defect():
     """
     Search for defects by name, mode, or description.
+    mode=semantic ranks defects by meaning rather than by substring (see app/semantic.py), best first,
+    each with its score.
     ---
     parameters:
       - name: query
         in: query
         type: string
         required: false
+      - name: mode
+        in: query
+        type: string
+        enum: [keyword, semantic]
+        default: keyword
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Semantic mode only; number of results (defaults to SEMANTIC_DEFAULT_LIMIT)
     responses:
       200:
         description: List of matching defects
+      503:
+        description: Semantic search is disabled or its index has not been built
     """
+    mode = request.args.get('mode', 'keyword')
+    if mode == 'semantic':
+        return _semantic_search(request.args.get('query', ''))
+    if mode != 'keyword':
+        return error('mode must be keyword or semantic')
     query = request.args.get('query', '').lower()
-    defects = Defect.query.join(DefectMode).filter(
-        (Defect.title.ilike(f'%{query}%')) |
-        (DefectMode.mode.ilike(f'%{query}%')) |
-        (DefectMode.description.ilike(f'%{query}%'))
-    ).distinct(Defect.id).all() # Use distinct to avoid duplicates if a defect has multiple matching modes
-
-    result = []
-    for defect in defects:
-        defect_data = {
-            'id': defect.id,
-            'name': defect.title,
-            'pdf_url': f"/pdfs/{defect.pdf.filename}" if defect.pdf else None,
-            'modes': [{
-                'id': mode.id,
-                'mode': mode.mode,
-                'description': mode.description,
-                'image_url': f"/images/{mode.image_filename}" if mode.image_filename else None
-            } for mode in defect.modes]
-        }
-        result.append(defect_data)
-
-    return jsonify(result), 200
+    # Modes and PDFs are loaded in two IN queries rather than one query per defect
+    defects = db.session.execute(search_statement(query)).scalars().all()
+    return jsonify([defect_json(defect) for defect in defects]), 200
+
+
+def _semantic_search(query):
+    """Helper answering /defect/search?mode=semantic from the semantic index."""
+    index = semantic.get_index()
+    if index is None:
+        return error('Semantic search index is not available (flask search build)', 503)
+    config = current_app.config
+    limit = max(1, min(request.args.get('limit', config['SEMANTIC_DEFAULT_LIMIT'], type=int),
+                       config['SEMANTIC_MAX_LIMIT']))
+    ranked = index.search(query, limit, config['SEMANTIC_MIN_SCORE'])
+    if not ranked:
+        return jsonify([]), 200
+    return jsonify(_scored_defects_json(dict(ranked))), 200
+
+def _scored_defects_json(scores):
+    """Helper to serialize the live defects among {defect_id: score}, best first, each with its score."""
+    defects = db.session.execute(
+        select(Defect).where(Defect.id.in_(scores), Defect.deleted_at.is_(None))
+        .options(selectinload(Defect.modes), selectinload(Defect.pdf))
+    ).scalars().all()
+    defects.sort(key=lambda defect: -scores[defect.id])
+    return [dict(defect_json(defect), score=round(scores[defect.id], 4)) for defect in defects]
 
 
 @bp.route('/defect/<int:defect_id>', methods=['GET'])
@@ -228,25 +360,53 @@ def get_defect(defect_id):
       404:
         description: Defect not found
     """
-    defect = Defect.query.get_or_404(defect_id)
-    defect_data = {
-        'id': defect.id,
-        'name': defect.title,
-        'pdf_url': f"/pdfs/{defect.pdf.filename}" if defect.pdf else None,
-        'modes': [{
-            'id': mode.id,
-            'mode': mode.mode,
-            'description': mode.description,
-            'image_url': f"/images/{mode.image_filename}" if mode.image_filename else None
-        } for mode in defect.modes]
-    }
-    return jsonify(defect_data), 200
+    defect = db.session.execute(defect_statement(defect_id)).scalar_one_or_none()
+    if defect is None:
+        abort(404)
+    data = defect_json(defect)
+    if current_app.config['RELATED_DEFECTS']:
+        data['related'] = related_json(db.session.execute(
+            related_statement(defect_id, current_app.config['RELATED_IN_DEFECT'])).all())
+    return jsonify(data), 200
+
+
+@bp.route('/defect/<int:defect_id>/related', methods=['GET'])
+def get_related_defects(defect_id):
+    """
+    Get the defects most similar to a defect in text and images, best first, each with its score.
+    Precomputed by `flask defects related`; defects changed since its last run are not reflected yet.
+    ---
+    parameters:
+      - name: defect_id
+        in: path
+        type: integer
+        required: true
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Number of defects (at most RELATED_TOP_K)
+    responses:
+      200:
+        description: The related defects
+      404:
+        description: Defect not found, or related defects are disabled
+    """
+    if not current_app.config['RELATED_DEFECTS']:
+        abort(404)
+    _live_defect_or_404(defect_id)
+    limit = max(1, min(request.args.get('limit', current_app.config['RELATED_TOP_K'], type=int),
+                       current_app.config['RELATED_TOP_K']))
+    rows = db.session.execute(related_statement(defect_id, limit)).all()
+    return jsonify(_scored_defects_json({row.related_id: row.score for row in rows})), 200
 
 
 @bp.route('/defect/<int:defect_id>', methods=['DELETE'])
 def delete_defect(defect_id):
     """
     Delete an entire defect, including its modes and PDF.
+    The defect is only marked as deleted; it can be restored until
+    `flask defects purge` removes it and its files after SOFT_DELETE_RETENTION_DAYS.
     ---
     parameters:
       - name: defect_id
@@ -260,25 +420,84 @@ def delete_defect(defect_id):
         description: Defect not found
     """
     try:
-        defect = Defect.query.get_or_404(defect_id)
+        now = datetime.utcnow()
+        result = db.session.execute(
+            update(Defect)
+            .where(Defect.id == defect_id, Defect.deleted_at.is_(None))
+            .values(deleted_at=now)
+        )
+        if result.rowcount == 0:
+            db.session.rollback()
+            return error('Defect not found', 404)
+        stats.record(defect_id, deleted=True)
+        changes.publish('defect.deleted', defect_id)
+        db.session.commit()
+        restorable_until = now + timedelta(days=current_app.config['SOFT_DELETE_RETENTION_DAYS'])
+        return success('Defect deleted successfully', {'restorable_until': restorable_until.isoformat()})
 
-        for mode in defect.modes:
-            if mode.image_filename:
-                delete_file(current_app.config['UPLOAD_FOLDER_IMAGES'], mode.image_filename)
-            db.session.delete(mode) # Delete the defect mode
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error deleting defect {defect_id}: {e}")
+        return error('Error deleting defect', 500)
 
-        if defect.pdf:
-            delete_file(current_app.config['UPLOAD_FOLDER_PDFS'], defect.pdf.filename)
-            db.session.delete(defect.pdf)
 
-        db.session.delete(defect)
+@bp.route('/defect/<int:defect_id>/restore', methods=['POST'])
+def restore_defect(defect_id):
+    """
+    Restore a deleted defect that has not been purged yet.
+    ---
+    parameters:
+      - name: defect_id
+        in: path
+        type: integer
+        required: true
+    responses:
+      200:
+        description: Defect restored successfully
+      404:
+        description: No deleted defect with this id
+    """
+    try:
+        result = db.session.execute(
+            update(Defect)
+            .where(Defect.id == defect_id, Defect.deleted_at.isnot(None))
+            .values(deleted_at=None)
+        )
+        if result.rowcount == 0:
+            db.session.rollback()
+            return error('No deleted defect with this id', 404)
+        stats.record(defect_id, edited=False)
+        changes.publish('defect.created', defect_id)
         db.session.commit()
-        return success('Defect deleted successfully')
+        return success('Defect restored successfully')
 
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error deleting defect {defect_id}: {e}")
-        return error('Error deleting defect', 500)
+        logger.error(f"Error restoring defect {defect_id}: {e}")
+        return error('Error restoring defect', 500)
+
+
+@bp.route('/defect/deleted', methods=['GET'])
+def list_deleted_defects():
+    """
+    List deleted defects that can still be restored, most recently deleted first.
+    ---
+    responses:
+      200:
+        description: Deleted defects with the time they will be purged after
+    """
+    retention = timedelta(days=current_app.config['SOFT_DELETE_RETENTION_DAYS'])
+    rows = db.session.execute(
+        select(Defect.id, Defect.title, Defect.deleted_at)
+        .where(Defect.deleted_at.isnot(None))
+        .order_by(Defect.deleted_at.desc())
+    )
+    return success('Deleted defects retrieved successfully', [{
+        'id': row.id,
+        'name': row.title,
+        'deleted_at': row.deleted_at.isoformat(),
+        'purge_after': (row.deleted_at + retention).isoformat(),
+    } for row in rows])
 
 
 @bp.route('/defect/mode/<int:mode_id>', methods=['DELETE'])
@@ -297,17 +516,21 @@ def delete_defect_mode(mode_id):
       404:
         description: Defect mode not found
     """
+    mode = _live_mode_or_404(mode_id)
     try:
-        mode = DefectMode.query.get_or_404(mode_id)
 
         if mode.image_filename:
-            delete_file(current_app.config['UPLOAD_FOLDER_IMAGES'], mode.image_filename)
+            schedule_delete(current_app.config['UPLOAD_FOLDER_IMAGES'], mode.image_filename)
 
+        _touch_defects([mode.defect_id])
+        stats.record(mode.defect_id)
+        changes.publish('mode.deleted', mode.defect_id, mode_id=mode_id)
         db.session.delete(mode)
         db.session.commit()
         return success('Defect mode deleted successfully')
 
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error deleting defect mode {mode_id}: {e}")
         return error('Error deleting defect mode', 500)
 
@@ -339,8 +562,8 @@ def edit_defect(defect_id):
       404:
         description: Defect not found
     """
+    defect = _live_defect_or_404(defect_id)
     try:
-        defect = Defect.query.get_or_404(defect_id)
         updated = False
 
         # Update defect name if provided
@@ -366,21 +589,27 @@ def edit_defect(defect_id):
 
             # Delete old PDF if exists
             if defect.pdf and defect.pdf.filename:
-                delete_file(current_app.config['UPLOAD_FOLDER_PDFS'], defect.pdf.filename)
+                schedule_delete(current_app.config['UPLOAD_FOLDER_PDFS'], defect.pdf.filename)
                 db.session.delete(defect.pdf)
 
             # Save new PDF
-            pdf_filename = save_file(pdf_file, current_app.config['UPLOAD_FOLDER_PDFS'])
-            new_pdf = PDFFile(filename=pdf_filename, defect=defect)
+            staged_pdf = stage_files([pdf_file], current_app.config['UPLOAD_FOLDER_PDFS'], ALLOWED_PDF_EXTENSIONS)[0]
+            new_pdf = PDFFile(defect=defect, **filemeta.pdf_columns(staged_pdf))
             db.session.add(new_pdf)
             updated = True
 
         if updated:
+            _touch_defects([defect_id])
+            stats.record(defect_id)
+            changes.publish('defect.updated', defect_id)
             db.session.commit()
             return success('Defect updated successfully')
         else:
             return success('No changes were made')
 
+    except InvalidUpload as e:
+        db.session.rollback()
+        return error(str(e))
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error updating defect {defect_id}: {e}")
@@ -418,8 +647,8 @@ def edit_defect_mode(mode_id):
       404:
         description: Defect mode not found
     """
+    mode = _live_mode_or_404(mode_id)
     try:
-        mode = DefectMode.query.get_or_404(mode_id)
         updated = False
 
         new_mode = strip_or_none(request.form.get('mode'))
@@ -448,21 +677,27 @@ def edit_defect_mode(mode_id):
             if not is_allowed_file(new_image.filename, ALLOWED_IMAGE_EXTENSIONS):
                 return error('Image must be a JPG or PNG file')
 
-            # Delete old image if exists
+            # Delete old image once the new one is committed
             if mode.image_filename:
-                old_path = os.path.join(current_app.config['UPLOAD_FOLDER_IMAGES'], mode.image_filename)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-            image_filename = save_file(new_image, current_app.config['UPLOAD_FOLDER_IMAGES'])
-            mode.image_filename = image_filename
+                schedule_delete(current_app.config['UPLOAD_FOLDER_IMAGES'], mode.image_filename)
+            staged_image = stage_images([new_image], current_app.config['UPLOAD_FOLDER_IMAGES'],
+                                        ALLOWED_IMAGE_EXTENSIONS)[0]
+            for column, value in filemeta.image_columns(staged_image).items():
+                setattr(mode, column, value)
             updated = True
 
         if updated:
+            _touch_defects([mode.defect_id])
+            stats.record(mode.defect_id)
+            changes.publish('mode.changed', mode.defect_id, mode_id=mode_id)
             db.session.commit()
             return success('Defect mode updated successfully')
         else:
             return success('No changes were made to this mode')
 
+    except InvalidUpload as e:
+        db.session.rollback()
+        return error(str(e))
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error updating defect mode {mode_id}: {e}")
@@ -506,8 +741,8 @@ def update_defect_details(defect_id):
       500:
         description: Internal server error
     """
+    defect = _live_defect_or_404(defect_id)
     try:
-        defect = Defect.query.get_or_404(defect_id)
         name = strip_or_none(request.form.get('defect_name'))
         modes_data = json.loads(request.form.get('defect_modes_json', '[]'))
         pdf_file = request.files.get('pdf')
@@ -531,10 +766,10 @@ def update_defect_details(defect_id):
             if not is_allowed_file(pdf_file.filename, ALLOWED_PDF_EXTENSIONS):
                 return error('Only PDF files are allowed')
             if defect.pdf and defect.pdf.filename:
-                delete_file(current_app.config['UPLOAD_FOLDER_PDFS'], defect.pdf.filename)
+                schedule_delete(current_app.config['UPLOAD_FOLDER_PDFS'], defect.pdf.filename)
                 db.session.delete(defect.pdf)
-            pdf_filename = save_file(pdf_file, current_app.config['UPLOAD_FOLDER_PDFS'])
-            new_pdf = PDFFile(filename=pdf_filename, defect=defect)
+            staged_pdf = stage_files([pdf_file], current_app.config['UPLOAD_FOLDER_PDFS'], ALLOWED_PDF_EXTENSIONS)[0]
+            new_pdf = PDFFile(defect=defect, **filemeta.pdf_columns(staged_pdf))
             db.session.add(new_pdf)
             updated = True
 
@@ -542,88 +777,69 @@ def update_defect_details(defect_id):
         if not isinstance(modes_data, list) or len(modes_data) == 0:
             return error('At least one defect mode is required')
 
-        existing_mode_ids = {mode.id for mode in defect.modes}
-        updated_mode_ids = set()
-
+        # Validate every entry and resolve its image upload before touching the database
+        entries = []
+        existing_seen = 0
         for mode_info in modes_data:
+            message = _validate_mode_entry(mode_info, 'in defect_modes_json')
+            if message:
+                return error(message)
             mode_id = mode_info.get('id')
             mode_name = strip_or_none(mode_info.get('mode'))
             description = strip_or_none(mode_info.get('description'))
-            new_image = mode_info.get('new_image') # This would likely be a filename or base64 string if sent this way
-
-            if not mode_name or len(mode_name) < 2:
-                return error(f'Defect mode name must be at least 2 characters long for mode with id {mode_id}')
-            if not description or len(description) < 5:
-                return error(f'Description must be at least 5 characters long for mode with id {mode_id}')
+            new_image = mode_info.get('new_image') # Name of the multipart field carrying the image
+
+            message = _validate_mode_fields(mode_name, description, f'for mode with id {mode_id}')
+            if message:
+                return error(message)
+
+            if not mode_id and not isinstance(new_image, str):
+                # New modes may also send their image as new_image_<n>, n = existing modes before it
+                new_image = f'new_image_{existing_seen}'
+            image_file = request.files.get(new_image) if isinstance(new_image, str) else None
+            if image_file:
+                label = f'mode {mode_name}' if mode_id else f'new mode {mode_name}'
+                image_file.seek(0, os.SEEK_END)
+                image_size = image_file.tell()
+                image_file.seek(0)
+                if image_size > current_app.config['MAX_CONTENT_LENGTH']:
+                    return error(f'Image file too large for {label}. Max size:{current_app.config["MAX_CONTENT_LENGTH"]}', 413)
+                if not is_allowed_file(image_file.filename, ALLOWED_IMAGE_EXTENSIONS):
+                    return error(f'Invalid image file for {label}')
 
             if mode_id:
-                # Existing mode, update it
-                existing_mode = DefectMode.query.get(mode_id)
-                if not existing_mode or existing_mode.defect_id != defect.id:
-                    return error(f'Defect mode with id {mode_id} not found for this defect', 400)
-
-                if mode_name != existing_mode.mode:
-                    existing_mode.mode = mode_name
-                    updated = True
-                if description != existing_mode.description:
-                    existing_mode.description = description
-                    updated = True
-
-                # Handle new image upload for existing mode
-                if new_image and isinstance(new_image, str): # Assuming frontend sends filename of newly uploaded image
-                    uploaded_file = request.files.get(new_image)
-                    if uploaded_file :
-                        #check size
-                        uploaded_file.seek(0, os.SEEK_END)
-                        image_size = uploaded_file.tell()
-                        uploaded_file.seek(0)
-                        if image_size > current_app.config['MAX_CONTENT_LENGTH']:
-                            return error(f'Image file too large for mode {mode_name}. Max size:{current_app.config["MAX_CONTENT_LENGTH"]}',413)
-                        elif  is_allowed_file(uploaded_file.filename, ALLOWED_IMAGE_EXTENSIONS):
-                            if existing_mode.image_filename:
-                                delete_file(current_app.config['UPLOAD_FOLDER_IMAGES'], existing_mode.image_filename)
-                            image_filename = save_file(uploaded_file, current_app.config['UPLOAD_FOLDER_IMAGES'])
-                            existing_mode.image_filename = image_filename
-                            updated = True
-                        else:
-                            return error(f'Invalid image file for mode {mode_name}')
-
-
-
-                    elif uploaded_file:
-                        return error(f'Invalid image file for mode {mode_name}')
-
-                updated_mode_ids.add(mode_id)
+                existing_seen += 1
+            entries.append((mode_id, mode_name, description, image_file))
+
+        # Load every referenced mode of this defect in a single query
+        current_modes = _load_modes([defect.id], [entry[0] for entry in entries if entry[0]])
+        for mode_id, _, _, _ in entries:
+            if mode_id and mode_id not in current_modes:
+                return error(f'Defect mode with id {mode_id} not found for this defect', 400)
+
+        # Write all new images concurrently
+        staged_images = stage_images([entry[3] for entry in entries], current_app.config['UPLOAD_FOLDER_IMAGES'],
+                                     ALLOWED_IMAGE_EXTENSIONS)
 
+        mode_updates, mode_inserts = [], []
+        for (mode_id, mode_name, description, _), staged in zip(entries, staged_images):
+            if mode_id:
+                row = current_modes[mode_id]
+                values = _mode_changes(row, mode_name, description, staged)
+                if values:
+                    mode_updates.append({'id': mode_id, **values})
             else:
-                # New mode, create it
-                image_file = request.files.get(f'new_image_{len(updated_mode_ids)}') # Assuming frontend sends new images with unique keys
-                image_filename = None
-                if image_file:
-                    #check size
-                    image_file.seek(0, os.SEEK_END)
-                    image_size = image_file.tell()
-                    image_file.seek(0)
-                    if image_size > current_app.config['MAX_CONTENT_LENGTH']:
-                        return error(f'Image file too large for new mode {mode_name}. Max size:{current_app.config["MAX_CONTENT_LENGTH"]}',413)
-                    elif is_allowed_file(image_file.filename, ALLOWED_IMAGE_EXTENSIONS):
-                        image_filename = save_file(image_file, current_app.config['UPLOAD_FOLDER_IMAGES'])
-                    else:
-                        return error(f'Invalid image file for new mode {mode_name}')
-
-                elif image_file:
-                    return error(f'Invalid image file for new mode {mode_name}')
-
-                new_mode = DefectMode(mode=mode_name, description=description, image_filename=image_filename, defect=defect)
-                db.session.add(new_mode)
-                updated = True
-
-        # Check if all existing modes are still present (no accidental deletions through this update)
-        if updated_mode_ids != existing_mode_ids:
-            # Handle cases where modes might have been intended for deletion (frontend should use DELETE /defect/mode/:id for that)
-            pass # Or you could implement logic to handle implicit deletions here if required
+                mode_inserts.append({'defect_id': defect.id, 'mode': mode_name,
+                                     'description': description, **filemeta.image_columns(staged)})
+
+        _apply_mode_changes(mode_updates, mode_inserts)
+        if mode_updates or mode_inserts:
+            updated = True
 
         if updated:
+            _touch_defects([defect_id])
+            stats.record(defect_id, modes_added=len(mode_inserts))
+            changes.publish('defect.updated', defect_id)
             db.session.commit()
             return success('Defect details updated successfully')
         else:
@@ -631,7 +847,259 @@ def update_defect_details(defect_id):
 
     except json.JSONDecodeError:
         return error('Invalid JSON format for defect_modes_json')
+    except InvalidUpload as e:
+        db.session.rollback()
+        return error(str(e))
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error updating defect {defect_id}: {e}")
-        return error(f'Database error: {str(e)}', 500)
\ No newline at end of file
+        return error(f'Database error: {str(e)}', 500)
+
+
+@bp.route('/defect/bulk', methods=['PATCH'])
+def bulk_update_defects():
+    """
+    Update names and modes of many defects in one transaction.
+    Either every change is applied or, on any validation error, none is.
+    ---
+    consumes:
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            defects:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                  name:
+                    type: string
+                  modes:
+                    type: array
+                    description: Modes with an id are updated, modes without one are created
+                    items:
+                      type: object
+                      properties:
+                        id:
+                          type: integer
+                        mode:
+                          type: string
+                        description:
+                          type: string
+    responses:
+      200:
+        description: Defects updated successfully
+      400:
+        description: Validation error
+      404:
+        description: One of the defects was not found
+    """
+    payload = request.get_json(silent=True)
+    defects_data = payload.get('defects') if isinstance(payload, dict) else None
+    if not isinstance(defects_data, list) or len(defects_data) == 0:
+        return error('A non-empty "defects" list is required')
+
+    try:
+        defect_ids = [item.get('id') for item in defects_data if isinstance(item, dict)]
+        if len(defect_ids) != len(defects_data) or not all(isinstance(i, int) for i in defect_ids):
+            return error('Every entry needs an integer "id"')
+        if len(set(defect_ids)) != len(defect_ids):
+            return error('Each defect may only appear once')
+        for item in defects_data:
+            modes = item.get('modes') or []
+            if not isinstance(modes, list):
+                return error(f'"modes" must be a list for defect {item["id"]}')
+            for mode_info in modes:
+                message = _validate_mode_entry(mode_info, f'for defect {item["id"]}')
+                if message:
+                    return error(message)
+
+        # One query for the defects and one for all referenced modes
+        titles = dict(db.session.execute(select(Defect.id, Defect.title).where(Defect.id.in_(defect_ids), Defect.deleted_at.is_(None))).all())
+        missing = [i for i in defect_ids if i not in titles]
+        if missing:
+            return error(f'Defect with id {missing[0]} not found', 404)
+
+        mode_ids = [mode['id'] for item in defects_data for mode in item.get('modes') or [] if mode.get('id')]
+        current_modes = _load_modes(defect_ids, mode_ids)
+
+        defect_updates, mode_updates, mode_inserts = [], [], []
+        for item in defects_data:
+            defect_id = item['id']
+            if 'name' in item:
+                name = strip_or_none(item.get('name'))
+                if not name or len(name) < 3:
+                    return error(f'Defect name must be at least 3 characters long for defect {defect_id}')
+                if name != titles[defect_id]:
+                    defect_updates.append({'id': defect_id, 'title': name})
+
+            for mode_info in item.get('modes') or []:
+                mode_id = mode_info.get('id')
+                mode_name = strip_or_none(mode_info.get('mode'))
+                description = strip_or_none(mode_info.get('description'))
+
+                message = _validate_mode_fields(mode_name, description, f'for mode with id {mode_id} of defect {defect_id}')
+                if message:
+                    return error(message)
+
+                if mode_id:
+                    row = current_modes.get(mode_id)
+                    if row is None or row.defect_id != defect_id:
+                        return error(f'Defect mode with id {mode_id} not found for defect {defect_id}', 400)
+                    values = _mode_changes(row, mode_name, description)
+                    if values:
+                        mode_updates.append({'id': mode_id, **values})
+                else:
+                    mode_inserts.append({'defect_id': defect_id, 'mode': mode_name, 'description': description})
+
+        if defect_updates:
+            db.session.execute(update(Defect), defect_updates)
+        _apply_mode_changes(mode_updates, mode_inserts)
+
+        changed = {entry['id']: 0 for entry in defect_updates}
+        changed.update((current_modes[entry['id']].defect_id, 0) for entry in mode_updates)
+        for entry in mode_inserts:
+            changed[entry['defect_id']] = changed.get(entry['defect_id'], 0) + 1
+        _touch_defects(changed)
+        for changed_id, modes_added in changed.items():
+            stats.record(changed_id, modes_added=modes_added)
+            changes.publish('defect.updated', changed_id)
+        db.session.commit()
+
+        return success('Defects updated successfully', {
+            'defects_updated': len(defect_updates),
+            'modes_updated': len(mode_updates),
+            'modes_created': len(mode_inserts),
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error bulk updating defects: {e}")
+        return error(f'Database error: {str(e)}', 500)
+
+
+def _id_list(payload, key):
+    """Helper to read an optional list of integer ids from a JSON body; returns None if malformed."""
+    ids = payload.get(key, [])
+    if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return None
+    return list(dict.fromkeys(ids))
+
+
+@bp.route('/defect/bulk/delete', methods=['POST'])
+def bulk_delete():
+    """
+    Delete many defects and modes in one transaction.
+    Defects are soft-deleted (restorable until purged) unless purge is true.
+    Ids that do not exist, or whose defect is already deleted, are reported as not found;
+    with purge, already deleted defects are purged too.
+    ---
+    consumes:
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            defect_ids:
+              type: array
+              items:
+                type: integer
+            mode_ids:
+              type: array
+              items:
+                type: integer
+            purge:
+              type: boolean
+              description: Permanently delete the defects and their files now
+    responses:
+      200:
+        description: Counts of deleted defects, modes and files, and the ids that were not found
+      400:
+        description: Validation error
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return error('A JSON object with "defect_ids" and/or "mode_ids" is required')
+    defect_ids, mode_ids = _id_list(payload, 'defect_ids'), _id_list(payload, 'mode_ids')
+    if defect_ids is None or mode_ids is None:
+        return error('"defect_ids" and "mode_ids" must be lists of integers')
+    if not defect_ids and not mode_ids:
+        return error('Nothing to delete')
+    if len(defect_ids) + len(mode_ids) > current_app.config['BULK_DELETE_MAX_IDS']:
+        return error(f"At most {current_app.config['BULK_DELETE_MAX_IDS']} ids can be deleted per request")
+    purge = payload.get('purge') is True
+
+    try:
+        images_folder = current_app.config['UPLOAD_FOLDER_IMAGES']
+        touched = set()
+
+        # One DELETE for the modes (only those of defects that are not deleted),
+        # returning the image names to remove after the commit.
+        deleted_modes = []
+        if mode_ids:
+            live_defects = select(Defect.id).where(Defect.deleted_at.is_(None))
+            deleted_modes = maintenance.delete_returning(
+                DefectMode, (DefectMode.id, DefectMode.defect_id, DefectMode.image_filename),
+                DefectMode.id.in_(mode_ids), DefectMode.defect_id.in_(live_defects))
+            for row in deleted_modes:
+                schedule_delete(images_folder, row.image_filename)
+                touched.add(row.defect_id)
+
+        # Defects that were live until this request. Purging also removes defects
+        # that were already soft-deleted; those were counted and announced back then.
+        newly_deleted, deleted_defects = [], []
+        if defect_ids:
+            newly_deleted = db.session.execute(
+                select(Defect.id).where(Defect.id.in_(defect_ids), Defect.deleted_at.is_(None)).with_for_update()
+            ).scalars().all()
+        if defect_ids and purge:
+            result = maintenance.delete_defects(defect_ids)
+            deleted_defects = result['defect_ids']
+            for folder, names in result['files'].items():
+                for name in names:
+                    schedule_delete(folder, name)
+        elif newly_deleted:
+            now = datetime.utcnow()
+            db.session.execute(update(Defect).where(Defect.id.in_(newly_deleted)).values(deleted_at=now))
+            deleted_defects = newly_deleted
+
+        for defect_id in newly_deleted:
+            stats.record(defect_id, deleted=True)
+            changes.publish('defect.deleted', defect_id)
+        edited_defects = touched - set(deleted_defects)
+        _touch_defects(edited_defects)
+        for defect_id in edited_defects:
+            stats.record(defect_id)
+        for row in deleted_modes:
+            if row.defect_id not in deleted_defects:
+                changes.publish('mode.deleted', row.defect_id, mode_id=row.id)
+        db.session.commit()
+
+        found_modes = {row.id for row in deleted_modes}
+        data = {
+            'defects_deleted': len(deleted_defects),
+            'modes_deleted': len(deleted_modes),
+            'purged': purge,
+            'not_found': {
+                'defect_ids': sorted(set(defect_ids) - set(deleted_defects)),
+                'mode_ids': [i for i in mode_ids if i not in found_modes],
+            },
+        }
+        if deleted_defects and not purge:
+            retention = timedelta(days=current_app.config['SOFT_DELETE_RETENTION_DAYS'])
+            data['restorable_until'] = (now + retention).isoformat()
+        return success('Bulk delete completed', data)
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error bulk deleting: {e}")
+        return error(f'Database error: {str(e)}', 500)
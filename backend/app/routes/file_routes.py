@@ -1,11 +1,26 @@
-from flask import Blueprint, send_from_directory, abort, current_app
-import os
+from flask import Blueprint, abort, current_app, request
+from app import filemeta, tiles
+from app.storage import get_storage
+from app.compression import send_precompressed
 
 bp = Blueprint('file_routes', __name__)
 
 @bp.route("/")
 def index():
-    return send_from_directory("static", "index.html")  # Assuming HTML is in static/
+    return send_precompressed(current_app.config['FRONTEND_BUILD_DIR'], 'index.html')
+
+def _send(kind, upload_folder, filename):
+    """Helper answering HEAD and If-None-Match from the stored metadata; anything else goes to storage."""
+    meta = filemeta.lookup(kind, filename)
+    if meta:
+        response = filemeta.shortcut_response(current_app.response_class, meta, request.method,
+                                              request.headers.get('If-None-Match'))
+        if response is not None:
+            return response
+    response = get_storage(upload_folder).send(filename)
+    if meta and response.status_code == 200:
+        response.set_etag(meta['sha256'])
+    return response
 
 @bp.route('/images/<filename>', methods=['GET'])
 def serve_image(filename):
@@ -26,16 +41,81 @@ def serve_image(filename):
           image/jpeg: {}
           image/png: {}
           image/jpg: {}
+      302:
+        description: Redirect to a short-lived signed URL (S3 storage with STORAGE_REDIRECTS)
+      304:
+        description: Not modified (the ETag is the image's SHA-256)
       404:
         description: Image not found
     """
-    img_path = current_app.config['UPLOAD_FOLDER_IMAGES']
-    file_path = os.path.join(img_path, filename)
+    return _send('images', current_app.config['UPLOAD_FOLDER_IMAGES'], filename)
 
-    if not os.path.isfile(file_path): 
-        abort(404, description="Image not found")
+@bp.route('/images/<filename>/tiles', methods=['GET'])
+def serve_image_tiles(filename):
+    """
+    Serve the Deep Zoom (DZI) descriptor of a large image's tile pyramid.
+    ---
+    parameters:
+      - name: filename
+        in: path
+        required: true
+        description: Image filename
+        schema:
+          type: string
+    responses:
+      200:
+        description: DZI descriptor; its Url attribute is the base URL of the tiles
+        content:
+          application/xml: {}
+      404:
+        description: The image has no tile pyramid (yet); use the whole image
+    """
+    descriptor = tiles.lookup(filename)
+    if descriptor is None:
+        abort(404)
+    return current_app.response_class(descriptor['xml'], mimetype='application/xml')
 
-    return send_from_directory(current_app.config['UPLOAD_FOLDER_IMAGES'], filename)
+@bp.route('/images/<filename>/tiles/<int:level>/<tile>', methods=['GET'])
+def serve_image_tile(filename, level, tile):
+    """
+    Serve one tile of a large image's pyramid.
+    ---
+    parameters:
+      - name: filename
+        in: path
+        required: true
+        description: Image filename
+        schema:
+          type: string
+      - name: level
+        in: path
+        required: true
+        description: Pyramid level; the highest is the full-size image, each one below halves it
+        schema:
+          type: integer
+      - name: tile
+        in: path
+        required: true
+        description: Tile column and row as <x>_<y>, optionally followed by the descriptor's format extension
+        schema:
+          type: string
+    responses:
+      200:
+        description: Tile image
+        content:
+          image/jpeg: {}
+          image/png: {}
+          image/webp: {}
+      302:
+        description: Redirect to a short-lived signed URL (S3 storage with STORAGE_REDIRECTS)
+      404:
+        description: No pyramid, or no such tile in it
+    """
+    descriptor = tiles.lookup(filename)
+    name = tiles.tile_for(descriptor, filename, level, tile) if descriptor else None
+    if name is None:
+        abort(404)
+    return get_storage(current_app.config['UPLOAD_FOLDER_TILES']).send(name)
 
 @bp.route('/pdfs/<filename>', methods=['GET'])
 def serve_pdf(filename):
@@ -54,13 +134,11 @@ def serve_pdf(filename):
         description: PDF file
         content: 
           application/pdf: {}
+      302:
+        description: Redirect to a short-lived signed URL (S3 storage with STORAGE_REDIRECTS)
+      304:
+        description: Not modified (the ETag is the PDF's SHA-256)
       404: 
         description: PDF not found
     """
-    pdf_path = current_app.config['UPLOAD_FOLDER_PDFS']
-    file_path = os.path.join(pdf_path, filename)
-
-    if not os.path.isfile(file_path): 
-        abort(404, description="PDF not found")
-
-    return send_from_directory(pdf_path, filename)
+    return _send('pdfs', current_app.config['UPLOAD_FOLDER_PDFS'], filename)
@@ -0,0 +1,106 @@
+from flask import Blueprint, request, abort, current_app
+from app.snapshot import current_snapshot
+from app.packfile import blob_response
+from app.compression import send_precompressed
+
+# Read-only routes served from a compiled snapshot (SNAPSHOT_DIR mode)
+bp = Blueprint('snapshot_routes', __name__)
+
+def _json_response(body, snapshot):
+    """Helper to send a precomputed JSON body."""
+    response = current_app.response_class(body, mimetype='application/json')
+    response.headers['X-Snapshot'] = snapshot.name
+    return response
+
+def _serve_blob(kind, filename):
+    """Helper to send an image or PDF straight from the snapshot's pack."""
+    blob = current_snapshot().blob(kind, filename)
+    if blob is None:
+        abort(404)
+    view, mimetype, sha256 = blob
+    return blob_response(view, mimetype, etag=sha256)
+
+@bp.route("/")
+def index():
+    return send_precompressed(current_app.config['FRONTEND_BUILD_DIR'], 'index.html')
+
+@bp.route('/defect/search', methods=['GET'])
+def search_defect():
+    """
+    Search for defects by name, mode, or description (snapshot mode).
+    ---
+    parameters:
+      - name: query
+        in: query
+        type: string
+        required: false
+    responses:
+      200:
+        description: List of matching defects
+    """
+    snapshot = current_snapshot()
+    return _json_response(snapshot.search_json(request.args.get('query', '')), snapshot)
+
+@bp.route('/defect/<int:defect_id>', methods=['GET'])
+def get_defect(defect_id):
+    """
+    Get complete information for a specific defect (snapshot mode).
+    ---
+    parameters:
+      - name: defect_id
+        in: path
+        type: integer
+        required: true
+    responses:
+      200:
+        description: Complete information for the requested defect
+      404:
+        description: Defect not found
+    """
+    snapshot = current_snapshot()
+    body = snapshot.defect_json(defect_id)
+    if body is None:
+        abort(404)
+    return _json_response(body, snapshot)
+
+@bp.route('/images/<filename>', methods=['GET'])
+def serve_image(filename):
+    """
+    Serve an image from the snapshot pack.
+    ---
+    parameters:
+      - name: filename
+        in: path
+        required: true
+        schema:
+          type: string
+    responses:
+      200:
+        description: Image file
+      304:
+        description: Not modified
+      404:
+        description: Image not found
+    """
+    return _serve_blob('images', filename)
+
+@bp.route('/pdfs/<filename>', methods=['GET'])
+def serve_pdf(filename):
+    """
+    Serve a PDF from the snapshot pack (supports Range requests).
+    ---
+    parameters:
+      - name: filename
+        in: path
+        required: true
+        schema:
+          type: string
+    responses:
+      200:
+        description: PDF file
+      206:
+        description: Partial content
+      404:
+        description: PDF not found
+    """
+    return _serve_blob('pdfs', filename)
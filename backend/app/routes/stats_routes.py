@@ -0,0 +1,112 @@
+from datetime import date
+from flask import Blueprint, request, current_app
+from app import stats
+from app.routes.defect_routes import success, error
+
+# Library statistics, read from the rollup tables maintained by app/stats.py
+bp = Blueprint('stats_routes', __name__)
+
+def _limit():
+    """Helper to read the ?limit= parameter, capped at STATS_MAX_LIMIT."""
+    limit = request.args.get('limit', 10, type=int)
+    return max(1, min(limit, current_app.config['STATS_MAX_LIMIT']))
+
+def _day_arg(name):
+    """Helper to parse an optional YYYY-MM-DD query parameter; raises ValueError if malformed."""
+    value = request.args.get(name)
+    return date.fromisoformat(value) if value else None
+
+
+@bp.route('/defect/stats', methods=['GET'])
+def stats_summary():
+    """
+    Library totals: defects, modes, edits and stored bytes.
+    ---
+    responses:
+      200:
+        description: Totals over all defects
+    """
+    return success('Statistics retrieved successfully', stats.summary())
+
+
+@bp.route('/defect/stats/activity', methods=['GET'])
+def stats_activity():
+    """
+    Defects created, modes created, defects edited and defects deleted per day, week or month.
+    ---
+    parameters:
+      - name: bucket
+        in: query
+        type: string
+        enum: [day, week, month]
+        default: week
+      - name: since
+        in: query
+        type: string
+        format: date
+        required: false
+      - name: until
+        in: query
+        type: string
+        format: date
+        required: false
+    responses:
+      200:
+        description: One entry per bucket with activity, oldest first (weeks start on Monday)
+      400:
+        description: Invalid bucket or date
+    """
+    bucket = request.args.get('bucket', 'week')
+    if bucket not in stats.BUCKETS:
+        return error(f"bucket must be one of {', '.join(stats.BUCKETS)}")
+    try:
+        since, until = _day_arg('since'), _day_arg('until')
+    except ValueError:
+        return error('since and until must be dates in YYYY-MM-DD format')
+    return success('Activity retrieved successfully', stats.activity(bucket, since, until))
+
+
+@bp.route('/defect/stats/modes', methods=['GET'])
+def stats_modes():
+    """
+    Distribution of the number of modes per defect.
+    ---
+    responses:
+      200:
+        description: Number of defects per mode count, and the average
+    """
+    return success('Mode statistics retrieved successfully', stats.modes_per_defect())
+
+
+@bp.route('/defect/stats/edits', methods=['GET'])
+def stats_edits():
+    """
+    The most edited defects.
+    ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 10
+    responses:
+      200:
+        description: Defects with their edit count, most edited first
+    """
+    return success('Edit statistics retrieved successfully', stats.most_edited(_limit()))
+
+
+@bp.route('/defect/stats/storage', methods=['GET'])
+def stats_storage():
+    """
+    The defects whose images and PDF take the most storage.
+    ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 10
+    responses:
+      200:
+        description: Defects with image, PDF and total bytes, largest first
+    """
+    return success('Storage statistics retrieved successfully', stats.largest(_limit()))
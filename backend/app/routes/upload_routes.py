@@ -0,0 +1,376 @@
+import re
+import logging
+from flask import Blueprint, request, jsonify, current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app.models import db, UploadIdempotencyKey
+from app.staging import stage_local_file, call_after_commit, InvalidUpload
+from app.imaging import queue_normalization
+from app import uploads
+from app.routes.defect_routes import (success, error, is_allowed_file, strip_or_none, validate_new_defect,
+                                      create_defect, ALLOWED_IMAGE_EXTENSIONS, ALLOWED_PDF_EXTENSIONS)
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Resumable chunked uploads, see app/uploads.py
+bp = Blueprint('upload_routes', __name__)
+
+_SHA256 = re.compile(r'^[0-9a-fA-F]{64}$')
+
+def _sessions_folder():
+    """Helper returning the upload sessions folder of the current app."""
+    return uploads.sessions_folder(current_app.config)
+
+def _session_json(session):
+    """Helper to serialize an upload session with the bytes received per file."""
+    return {
+        'upload_id': session['id'],
+        'files': [{
+            'index': index,
+            'filename': declared['filename'],
+            'size': declared['size'],
+            'received': received,
+            'complete': received == declared['size'],
+        } for index, (declared, received) in enumerate(zip(session['files'], session['received']))]
+    }
+
+def _validate_declared_file(declared, index):
+    """Helper returning a validation message for one file of a new upload session, or None."""
+    if not isinstance(declared, dict):
+        return f'File {index} must be an object with filename and size'
+    filename = declared.get('filename')
+    if not isinstance(filename, str) or not filename.strip():
+        return f'File {index} needs a filename'
+    if not is_allowed_file(filename, ALLOWED_IMAGE_EXTENSIONS | ALLOWED_PDF_EXTENSIONS):
+        return f'File {index} must be a JPG, PNG or PDF file'
+    size = declared.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        return f'File {index} needs a positive size'
+    if size > current_app.config['MAX_CONTENT_LENGTH']:
+        return f"File {index} is too large. Maximum allowed size is {current_app.config['MAX_CONTENT_LENGTH']} bytes"
+    sha256 = declared.get('sha256')
+    if sha256 is not None and (not isinstance(sha256, str) or not _SHA256.match(sha256)):
+        return f'File {index} sha256 must be 64 hex characters'
+    return None
+
+def _replay(key_row, upload_id):
+    """Helper answering a finalize whose Idempotency-Key was already used."""
+    if key_row.upload_id != upload_id:
+        return error('Idempotency-Key was already used for another upload', 422)
+    response, code = success('Defect uploaded successfully', {'upload_id': upload_id, 'defect_id': key_row.defect_id})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, code
+
+def _stored_key(key):
+    """Helper loading an idempotency key from the database, bypassing the session's identity map."""
+    return db.session.execute(
+        select(UploadIdempotencyKey).where(UploadIdempotencyKey.key == key).execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+@bp.route('/admin/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start a resumable upload by declaring its files.
+    Send each file's bytes with PUT /admin/uploads/{upload_id}/files/{index}, then create the defect
+    with POST /admin/uploads/{upload_id}/finalize.
+    ---
+    consumes:
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            files:
+              type: array
+              items:
+                type: object
+                properties:
+                  filename:
+                    type: string
+                  size:
+                    type: integer
+                  sha256:
+                    type: string
+                    description: Optional SHA-256 of the whole file, checked at finalize
+    responses:
+      200:
+        description: The upload id and its files
+      400:
+        description: Invalid file list
+    """
+    payload = request.get_json(silent=True)
+    files = payload.get('files') if isinstance(payload, dict) else None
+    if not isinstance(files, list) or not files:
+        return error('files must be a non-empty list')
+    if len(files) > current_app.config['UPLOAD_SESSION_MAX_FILES']:
+        return error(f"At most {current_app.config['UPLOAD_SESSION_MAX_FILES']} files per upload")
+    for index, declared in enumerate(files):
+        message = _validate_declared_file(declared, index)
+        if message:
+            return error(message)
+
+    try:
+        session = uploads.create_session(_sessions_folder(), [{
+            'filename': declared['filename'].strip(),
+            'size': declared['size'],
+            'sha256': declared['sha256'].lower() if declared.get('sha256') else None,
+        } for declared in files])
+    except OSError as e:
+        logger.error(f"Error creating upload session: {e}")
+        return error(f'Upload failed: {str(e)}', 500)
+    return success('Upload started', _session_json(session))
+
+
+@bp.route('/admin/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """
+    Report how many bytes of each file have been received, to resume an interrupted upload.
+    ---
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: The files with their received bytes
+      404:
+        description: Unknown, expired or finalized upload
+    """
+    try:
+        session = uploads.session_status(_sessions_folder(), upload_id)
+    except uploads.SessionNotFound:
+        return error('Upload not found', 404)
+    return success('Upload status retrieved successfully', _session_json(session))
+
+
+@bp.route('/admin/uploads/<upload_id>/files/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """
+    Write a chunk of a declared file.
+    A chunk may start anywhere up to the bytes received so far; resending a chunk is harmless.
+    ---
+    consumes:
+      - application/octet-stream
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+      - name: index
+        in: path
+        type: integer
+        required: true
+      - name: offset
+        in: query
+        type: integer
+        required: true
+      - name: X-Chunk-SHA256
+        in: header
+        type: string
+        required: true
+        description: SHA-256 of the chunk, hex encoded
+    responses:
+      200:
+        description: Bytes of the file received so far
+      400:
+        description: Checksum mismatch or chunk past the declared size
+      404:
+        description: Unknown upload or file
+      409:
+        description: The chunk starts past the received bytes; data.received is where to resume
+      413:
+        description: Chunk larger than UPLOAD_CHUNK_MAX
+    """
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return error('offset must be a non-negative integer')
+    sha256 = request.headers.get('X-Chunk-SHA256', '')
+    if not _SHA256.match(sha256):
+        return error('X-Chunk-SHA256 header with the chunk\'s hex SHA-256 is required')
+    chunk_max = current_app.config['UPLOAD_CHUNK_MAX']
+    if request.content_length is not None and request.content_length > chunk_max:
+        return error(f'Chunk is too large. Maximum allowed size is {chunk_max} bytes', 413)
+    data = request.get_data(cache=False)
+    if not data:
+        return error('Chunk is empty')
+    if len(data) > chunk_max:
+        return error(f'Chunk is too large. Maximum allowed size is {chunk_max} bytes', 413)
+
+    try:
+        received = uploads.write_chunk(_sessions_folder(), upload_id, index, offset, data, sha256)
+    except uploads.SessionNotFound:
+        return error('Upload or file not found', 404)
+    except uploads.OffsetConflict as e:
+        return jsonify({'status': 'error', 'message': str(e), 'data': {'received': e.received}}), 409
+    except uploads.InvalidChunk as e:
+        return error(str(e))
+    return success('Chunk received', {'index': index, 'received': received})
+
+
+@bp.route('/admin/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """
+    Abandon an upload and delete the bytes received.
+    ---
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: Upload deleted
+      404:
+        description: Unknown, expired or finalized upload
+    """
+    try:
+        with uploads.session_lock(_sessions_folder(), upload_id):
+            uploads.remove_session(_sessions_folder(), upload_id)
+    except uploads.SessionNotFound:
+        return error('Upload not found', 404)
+    return success('Upload deleted')
+
+
+@bp.route('/admin/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """
+    Create the defect from a completed upload.
+    Retrying with the same Idempotency-Key returns the first result (with Idempotent-Replayed: true)
+    instead of creating another defect.
+    ---
+    consumes:
+      - application/json
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+      - name: Idempotency-Key
+        in: header
+        type: string
+        required: true
+        description: Client-chosen key, unique per defect (at most 128 characters)
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            defect_name:
+              type: string
+            defect_modes:
+              type: array
+              items:
+                type: string
+            descriptions:
+              type: array
+              items:
+                type: string
+            pdf:
+              type: integer
+              description: Index of the PDF among the upload's files
+            images:
+              type: array
+              description: Per mode, the index of its image or null
+              items:
+                type: integer
+    responses:
+      200:
+        description: Defect uploaded successfully; data holds the defect_id
+      400:
+        description: Invalid defect or file references
+      404:
+        description: Unknown, expired or already finalized upload
+      409:
+        description: Files not complete, or a file failed its sha256 and must be uploaded again
+      422:
+        description: The Idempotency-Key was used for another upload
+    """
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if not key or len(key) > 128:
+        return error('An Idempotency-Key header of at most 128 characters is required')
+    key_row = db.session.get(UploadIdempotencyKey, key)
+    if key_row is not None:
+        return _replay(key_row, upload_id)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return error('Request body must be a JSON object')
+    name = strip_or_none(payload.get('defect_name'))
+    modes = payload.get('defect_modes')
+    descriptions = payload.get('descriptions') or []
+    message = validate_new_defect(name, modes, descriptions)
+    if message:
+        return error(message)
+    pdf_index = payload.get('pdf')
+    images = payload.get('images') or []
+    if not isinstance(images, list) or len(images) > len(modes):
+        return error('Number of images exceeds the number of defect modes')
+    images = images + [None] * (len(modes) - len(images))
+    referenced = [pdf_index] + [index for index in images if index is not None]
+    if not all(isinstance(index, int) and not isinstance(index, bool) for index in referenced):
+        return error('pdf and images must be file indexes')
+    if len(set(referenced)) != len(referenced):
+        return error('A file can only be used once')
+
+    root = _sessions_folder()
+    try:
+        with uploads.session_lock(root, upload_id) as session:
+            # A concurrent finalize with the same key may have committed while we waited for the lock.
+            key_row = _stored_key(key)
+            if key_row is not None:
+                return _replay(key_row, upload_id)
+
+            files = session['files']
+            if not all(0 <= index < len(files) for index in referenced):
+                return error('File index out of range')
+            if not is_allowed_file(files[pdf_index]['filename'], ALLOWED_PDF_EXTENSIONS):
+                return error('Only PDF files are allowed')
+            for i, index in enumerate(images):
+                if index is not None and not is_allowed_file(files[index]['filename'], ALLOWED_IMAGE_EXTENSIONS):
+                    return error(f'Image for mode {modes[i]} must be a JPG or PNG file')
+            incomplete = [index for index in referenced if session['received'][index] != files[index]['size']]
+            if incomplete:
+                return error(f'Files {incomplete} are not completely uploaded', 409)
+
+            # Link the parts into staging; they are promoted when the defect commits.
+            staged = {}
+            for index in referenced:
+                allowed = ALLOWED_PDF_EXTENSIONS if index == pdf_index else ALLOWED_IMAGE_EXTENSIONS
+                staged[index] = stage_local_file(uploads.part_path(root, upload_id, index), files[index]['filename'],
+                                                 current_app.config['UPLOAD_FOLDER_PDFS' if index == pdf_index
+                                                                    else 'UPLOAD_FOLDER_IMAGES'], allowed)
+                if files[index]['sha256'] and staged[index].sha256 != files[index]['sha256']:
+                    db.session.rollback()
+                    uploads.reset_part(root, upload_id, index)
+                    return error(f'File {index} does not match its sha256; upload it again', 409)
+            staged_images = [staged[index] if index is not None else None for index in images]
+            queue_normalization(staged_images)
+
+            defect = create_defect(name, modes, descriptions, staged_images, staged[pdf_index])
+            db.session.flush()
+            db.session.add(UploadIdempotencyKey(key=key, upload_id=upload_id, defect_id=defect.id))
+            call_after_commit(uploads.remove_session, root, upload_id)
+            db.session.commit()
+            return success('Defect uploaded successfully', {'upload_id': upload_id, 'defect_id': defect.id})
+
+    except (uploads.SessionNotFound, IntegrityError):
+        # Finalized meanwhile: a retry that waited for the lock, or lost the race to commit the same key
+        db.session.rollback()
+        key_row = _stored_key(key)
+        if key_row is not None:
+            return _replay(key_row, upload_id)
+        return error('Upload not found', 404)
+    except InvalidUpload as e:
+        db.session.rollback()
+        return error(str(e))
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error finalizing upload {upload_id}: {e}")
+        return error(f'Upload failed: {str(e)}', 500)
@@ -0,0 +1,286 @@
+"""
+Append-only segment storage for small uploaded images.
+
+With ``IMAGE_PACKS`` enabled (local storage only), images up to
+``IMAGE_PACK_MAX_BLOB`` bytes are not kept as individual files. Instead they
+are appended to segment files ``<images folder>/.packs/segment-NNNNNN.pack``
+of up to ``IMAGE_PACK_SEGMENT_SIZE`` bytes, and an index in
+``.packs/index.db`` maps each name to ``(segment, offset, length)``. Millions
+of images then occupy a few hundred large files, which keeps backups, rsync
+and the inode cache happy. Larger images, and images uploaded before packs
+were enabled, stay loose files handled by the regular local driver.
+
+Segments are only ever appended to. Deleting or replacing an image just
+drops or repoints its index row; ``flask files compact-packs`` later copies
+the live blobs out of segments that are mostly garbage and removes them.
+Readers map segments with ``mmap`` and slice them per request.
+
+Writers in all worker processes serialize on ``.packs/write.lock``.
+"""
+import io
+import logging
+import mimetypes
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from app.packfile import PackWriter, PackReader, blob_response
+from app.storage import StoredObject
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PACKS_DIRNAME = '.packs'
+INDEX_FILENAME = 'index.db'
+LOCK_FILENAME = 'write.lock'
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.pack$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blob (
+    name TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    created REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS blob_segment ON blob (segment);
+"""
+
+
+class PackedStorage:
+    """
+    Storage driver keeping small files in append-only segments.
+
+    Args:
+        root (str): The upload folder.
+        loose: The driver for files that are not packed (a ``LocalStorage`` on ``root``).
+        max_blob (int): Files larger than this stay loose.
+        segment_size (int): A new segment is started once the active one reaches this size.
+    """
+
+    def __init__(self, root, loose, max_blob, segment_size):
+        self.root = root
+        self.loose = loose
+        self.max_blob = max_blob
+        self.segment_size = segment_size
+        self.packs = os.path.join(root, PACKS_DIRNAME)
+        os.makedirs(self.packs, exist_ok=True)
+        self._local = threading.local()
+        self._readers = {}
+        self._write_lock = threading.Lock()
+        self._db().executescript(SCHEMA)
+
+    # -- index and segments ---------------------------------------------------
+
+    def _db(self):
+        """Returns this thread's connection to the index."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(os.path.join(self.packs, INDEX_FILENAME), timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def segment_path(self, segment):
+        return os.path.join(self.packs, f"segment-{segment:06d}.pack")
+
+    def segments(self):
+        """Returns the numbers of the existing segment files, ascending."""
+        numbers = []
+        for name in os.listdir(self.packs):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _lookup(self, name):
+        return self._db().execute('SELECT segment, offset, length, sha256 FROM blob WHERE name = ?',
+                                  (name,)).fetchone()
+
+    def _view(self, segment, offset, length):
+        """Returns a slice of a segment, remapping it if it has grown since it was mapped."""
+        reader = self._readers.get(segment)
+        if reader is None or offset + length > reader.size:
+            reader = self._readers[segment] = PackReader(self.segment_path(segment))
+        return reader.view(offset, length)
+
+    @contextmanager
+    def _locked(self):
+        """Serializes segment appends across threads and worker processes."""
+        with self._write_lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(os.path.join(self.packs, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _append(self, src, name, expected_location=None):
+        """
+        Appends a blob to the active segment and points ``name`` at it.
+
+        With ``expected_location`` (``(segment, offset)``), the index row is
+        only repointed if it still refers to that location; compaction uses
+        this so a concurrent delete or replacement wins.
+
+        Returns:
+            bool: Whether the index now points at the appended blob.
+        """
+        with self._locked():
+            segments = self.segments()
+            segment = segments[-1] if segments else 1
+            if os.path.exists(self.segment_path(segment)) and \
+                    os.path.getsize(self.segment_path(segment)) >= self.segment_size:
+                segment += 1
+            # The blob is on disk before the index refers to it; a crash in
+            # between only leaves garbage for compaction.
+            with PackWriter(self.segment_path(segment)) as pack:
+                offset, length, sha256 = pack.append(src)
+
+            if expected_location is None:
+                self._db().execute('INSERT OR REPLACE INTO blob VALUES (?, ?, ?, ?, ?, ?)',
+                                   (name, segment, offset, length, sha256, time.time()))
+                return True
+            cursor = self._db().execute(
+                'UPDATE blob SET segment = ?, offset = ? WHERE name = ? AND segment = ? AND offset = ?',
+                (segment, offset, name) + tuple(expected_location))
+            return cursor.rowcount == 1
+
+    # -- storage driver interface ---------------------------------------------
+
+    def exists(self, name):
+        return self._lookup(name) is not None or self.loose.exists(name)
+
+    def open(self, name):
+        row = self._lookup(name)
+        if row is None:
+            return self.loose.open(name)
+        segment, offset, length, _ = row
+        return io.BytesIO(self._view(segment, offset, length).tobytes())
+
+    def size(self, name):
+        row = self._lookup(name)
+        return self.loose.size(name) if row is None else row[2]
+
+    def put_file(self, local_path, name):
+        """Packs a local file if it is small enough, otherwise stores it loose."""
+        if os.path.getsize(local_path) > self.max_blob:
+            self.loose.put_file(local_path, name)
+            return
+        with open(local_path, 'rb') as src:
+            self._append(src, name)
+        os.remove(local_path)
+        # A loose file of the same name (e.g. re-encoded in place) is superseded.
+        self.loose.delete(name)
+
+    def delete(self, name):
+        self._db().execute('DELETE FROM blob WHERE name = ?', (name,))
+        self.loose.delete(name)
+
+    def delete_many(self, names):
+        names = list(names)
+        with self._db() as connection:
+            connection.execute('BEGIN')
+            connection.executemany('DELETE FROM blob WHERE name = ?', [(name,) for name in names])
+        self.loose.delete_many(names)
+
+    def iter_objects(self, batch_size):
+        """Yields packed blobs, then loose files, in batches of ``StoredObject``."""
+        last = ''
+        while True:
+            rows = self._db().execute('SELECT name, length, created FROM blob WHERE name > ? '
+                                      'ORDER BY name LIMIT ?', (last, batch_size)).fetchall()
+            if not rows:
+                break
+            yield [StoredObject(*row) for row in rows]
+            last = rows[-1][0]
+        yield from self.loose.iter_objects(batch_size)
+
+    def send(self, name):
+        row = self._lookup(name)
+        if row is None:
+            return self.loose.send(name)
+        segment, offset, length, sha256 = row
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        return blob_response(self._view(segment, offset, length), mimetype, etag=sha256)
+
+    # -- maintenance ----------------------------------------------------------
+
+    def compact(self, min_garbage=0.3, pack_loose=False, batch_size=500, dry_run=False):
+        """
+        Reclaims space held by deleted and replaced blobs.
+
+        Every segment except the active one whose share of unreferenced bytes
+        is at least ``min_garbage`` has its live blobs appended to the active
+        segment and is then deleted. Readers that still map a removed segment
+        keep working; they switch to the new location on their next lookup.
+
+        Args:
+            min_garbage (float): Garbage ratio (0-1) from which a segment is rewritten.
+            pack_loose (bool): Also move loose files no larger than ``max_blob`` into segments.
+            batch_size (int): Blobs moved per index query.
+            dry_run (bool): Only report what would be done.
+
+        Returns:
+            dict: Segments examined and rewritten, blobs moved, bytes reclaimed, loose files packed.
+        """
+        report = {'segments': 0, 'compacted': 0, 'moved': 0, 'reclaimed_bytes': 0, 'packed_loose': 0}
+        live = dict((segment, total) for segment, total in
+                    self._db().execute('SELECT segment, SUM(length) FROM blob GROUP BY segment'))
+        segments = self.segments()
+        report['segments'] = len(segments)
+
+        for segment in segments[:-1]:
+            size = os.path.getsize(self.segment_path(segment))
+            garbage = size - live.get(segment, 0)
+            if not size or garbage / size < min_garbage:
+                continue
+            report['compacted'] += 1
+            report['reclaimed_bytes'] += garbage
+            if dry_run:
+                continue
+
+            while True:
+                rows = self._db().execute('SELECT name, offset, length FROM blob WHERE segment = ? LIMIT ?',
+                                          (segment, batch_size)).fetchall()
+                if not rows:
+                    break
+                for name, offset, length in rows:
+                    src = io.BytesIO(self._view(segment, offset, length).tobytes())
+                    self._append(src, name, expected_location=(segment, offset))
+                    report['moved'] += 1
+
+            with self._locked():
+                if self._db().execute('SELECT 1 FROM blob WHERE segment = ? LIMIT 1', (segment,)).fetchone():
+                    continue
+                self._readers.pop(segment, None)
+                os.remove(self.segment_path(segment))
+
+        if pack_loose:
+            for batch in self.loose.iter_objects(batch_size):
+                for obj in batch:
+                    if obj.size > self.max_blob or self._lookup(obj.name) is not None:
+                        continue
+                    report['packed_loose'] += 1
+                    if dry_run:
+                        continue
+                    try:
+                        with self.loose.open(obj.name) as src:
+                            self._append(src, obj.name)
+                        self.loose.delete(obj.name)
+                    except FileNotFoundError:
+                        pass
+
+        return report
@@ -0,0 +1,388 @@
+"""
+Semantic search over defect titles, mode names and descriptions.
+
+Keyword search only finds the words typed, while the same failure is written
+up as a "void", a "pinhole" or a "pit". ``flask search build`` fits a latent
+semantic index over the library:
+
+* every live defect is one document (its title plus its modes' names and
+  descriptions), weighted with sublinear TF-IDF;
+* a randomized truncated SVD of the document-term matrix yields
+  ``SEMANTIC_DIMENSIONS`` topics. Words used in similar contexts end up close
+  together, so a query for "pinhole" also ranks defects described as voids;
+* each defect's L2-normalized topic vector is row ``defect_id`` of
+  ``vectors.npy``; unused and deleted ids are zero rows.
+
+``/defect/search?mode=semantic`` folds the query into the same space and
+scores every defect with one matrix-vector product against the
+memory-mapped vectors, so the worker processes share a single copy through
+the page cache.
+
+Writes keep the index current without a rebuild: committed change events
+(``changes.add_listener``) re-embed the touched defects on a background
+thread with the vocabulary and topics of the last build. Words first seen
+since then are ignored until the next ``flask search build``, which should
+run periodically (e.g. nightly). Builds go to a new directory under
+``SEMANTIC_INDEX_DIR`` that replacing ``CURRENT`` activates, as for
+snapshots; builds and updates serialize on an ``flock``.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from app import db, changes
+from app.models import Defect
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILENAME = 'CURRENT'
+LOCK_FILENAME = 'lock'
+VOCAB_FILENAME = 'vocab.json'
+IDF_FILENAME = 'idf.npy'
+COMPONENTS_FILENAME = 'components.npy'
+VECTORS_FILENAME = 'vectors.npy'
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it', 'its',
+    'of', 'on', 'or', 'that', 'the', 'to', 'was', 'were', 'which', 'with',
+))
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Splits text into lower-cased terms, without stopwords and single characters."""
+    return [token for token in _TOKEN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def defect_text(defect):
+    """Returns the text a defect is indexed by; its modes must be loaded."""
+    return ' '.join([defect.title] + [f"{mode.mode} {mode.description}" for mode in defect.modes])
+
+
+def _weights(token_lists, vocab, idf):
+    """Sublinear TF-IDF rows, L2-normalized, as a COO matrix ``(rows, cols, values)``."""
+    rows, cols, values = [], [], []
+    for row, tokens in enumerate(token_lists):
+        counts = Counter(vocab[token] for token in tokens if token in vocab)
+        if not counts:
+            continue
+        columns = np.fromiter(counts.keys(), np.int64, len(counts))
+        weights = (1 + np.log(np.fromiter(counts.values(), np.float32, len(counts)))) * idf[columns]
+        rows.append(np.full(len(columns), row, np.int64))
+        cols.append(columns)
+        values.append((weights / np.linalg.norm(weights)).astype(np.float32))
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+def _sparse_dot(rows, cols, values, n_rows, dense, block=65536):
+    """Multiplies a COO matrix by a dense one, ``block`` non-zeros at a time to bound memory."""
+    out = np.zeros((n_rows, dense.shape[1]), np.float32)
+    for start in range(0, len(values), block):
+        part = slice(start, start + block)
+        np.add.at(out, rows[part], values[part, None] * dense[cols[part]])
+    return out
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def _topics(rows, cols, values, n_docs, n_terms, dimensions, power_iterations=2, seed=0):
+    """
+    Computes the top right singular vectors of a sparse document-term matrix.
+
+    Randomized range finder (Halko et al.) with a few power iterations, so
+    only products with thin dense matrices are needed.
+
+    Returns:
+        numpy.ndarray: ``(n_terms, k)`` float32, ``k = min(dimensions, n_docs, n_terms)``.
+    """
+    k = min(dimensions, n_docs, n_terms)
+    rank = min(k + 10, n_docs, n_terms)
+    rng = np.random.default_rng(seed)
+    basis, _ = np.linalg.qr(_sparse_dot(rows, cols, values, n_docs,
+                                        rng.standard_normal((n_terms, rank), dtype=np.float32)))
+    for _ in range(power_iterations):
+        term_basis, _ = np.linalg.qr(_sparse_dot(cols, rows, values, n_terms, basis))
+        basis, _ = np.linalg.qr(_sparse_dot(rows, cols, values, n_docs, term_basis))
+    # Q^T A, computed as (A^T Q)^T
+    projected = _sparse_dot(cols, rows, values, n_terms, basis).T
+    _, _, vt = np.linalg.svd(projected, full_matrices=False)
+    return np.ascontiguousarray(vt[:k].T, dtype=np.float32)
+
+
+class SemanticIndex:
+    """
+    An index directory: vocabulary, IDF, topics and the memory-mapped defect vectors.
+
+    Args:
+        path (str): The index directory.
+        writable (bool): Map the vectors read-write (updates hold the writer lock).
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, VOCAB_FILENAME)) as f:
+            self.vocab = {term: i for i, term in enumerate(json.load(f))}
+        self.idf = np.load(os.path.join(path, IDF_FILENAME), mmap_mode='r')
+        self.components = np.load(os.path.join(path, COMPONENTS_FILENAME), mmap_mode='r')
+        self.vectors_path = os.path.join(path, VECTORS_FILENAME)
+        self.vectors_inode = os.stat(self.vectors_path).st_ino
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+' if writable else 'r')
+
+    def embed(self, texts):
+        """Returns the normalized topic vectors of ``texts``; all-zero for texts without known words."""
+        rows, cols, values = _weights([tokenize(text) for text in texts], self.vocab, self.idf)
+        return _normalize(_sparse_dot(rows, cols, values, len(texts), self.components))
+
+    def search(self, query, limit, min_score=0.0):
+        """
+        Ranks the defects by cosine similarity to ``query``.
+
+        Returns:
+            list[tuple[int, float]]: Up to ``limit`` ``(defect_id, score)`` pairs above ``min_score``, best first.
+        """
+        vector = self.embed([query])[0]
+        if not vector.any() or not len(self.vectors):
+            return []
+        scores = self.vectors @ vector
+        limit = min(limit, len(scores))
+        top = np.argpartition(scores, -limit)[-limit:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > min_score]
+
+
+class IndexManager:
+    """
+    Tracks the active index of ``SEMANTIC_INDEX_DIR`` and reopens it after a build or a resize.
+
+    Args:
+        root (str): The index root.
+        reload_interval (float): Minimum time between checks for a newer index.
+    """
+
+    def __init__(self, root, reload_interval):
+        self.root = root
+        self.reload_interval = reload_interval
+        self._index = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the active ``SemanticIndex``, or None if no index was built."""
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=self._index is None):
+            try:
+                self._next_check = now + self.reload_interval
+                path = active_path(self.root)
+                index = self._index
+                try:
+                    if path and (index is None or index.path != path
+                                 or index.vectors_inode != os.stat(os.path.join(path, VECTORS_FILENAME)).st_ino):
+                        self._index = SemanticIndex(path)
+                except (OSError, ValueError) as e:
+                    # Keep serving the previous index if the new one is unreadable.
+                    logger.error(f"Error opening semantic index {path}: {e}")
+            finally:
+                self._lock.release()
+        return self._index
+
+
+def active_path(root):
+    """Returns the directory of the active index, or None if none was built."""
+    try:
+        with open(os.path.join(root, CURRENT_FILENAME)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(root, name) if name else None
+
+
+@contextmanager
+def _writer_lock(root):
+    os.makedirs(root, exist_ok=True)
+    fd = os.open(os.path.join(root, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _activate(root, name):
+    tmp_path = os.path.join(root, f".{CURRENT_FILENAME}.{uuid.uuid4().hex}")
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILENAME))
+
+
+def _live_defects(defect_ids=None, batch_size=500):
+    stmt = (select(Defect).where(Defect.deleted_at.is_(None)).order_by(Defect.id)
+            .options(selectinload(Defect.modes)).execution_options(yield_per=batch_size))
+    if defect_ids is not None:
+        stmt = stmt.where(Defect.id.in_(defect_ids))
+    return db.session.scalars(stmt)
+
+
+def build_index(root, dimensions=128, max_terms=50000, batch_size=500, keep=2):
+    """
+    Fits a new index over all live defects and makes it the active one.
+
+    Holds the writer lock throughout, so incremental updates wait for the
+    build instead of being applied to the index it replaces.
+
+    Args:
+        root (str): The index root (``SEMANTIC_INDEX_DIR``).
+        dimensions (int): Number of topics.
+        max_terms (int): Vocabulary size; the terms in most defects are kept.
+        batch_size (int): Defects loaded per query.
+        keep (int): Index directories to keep, including the new one.
+
+    Returns:
+        dict: The index name and its numbers of defects, terms and dimensions.
+
+    Raises:
+        ValueError: If there is nothing to index.
+    """
+    with _writer_lock(root):
+        ids, token_lists = [], []
+        for defect in _live_defects(batch_size=batch_size):
+            ids.append(defect.id)
+            token_lists.append(tokenize(defect_text(defect)))
+        db.session.rollback()
+
+        document_frequency = Counter(term for tokens in token_lists for term in set(tokens))
+        if not document_frequency:
+            raise ValueError('No defects with indexable text')
+        terms = sorted(document_frequency, key=lambda term: (-document_frequency[term], term))[:max_terms]
+        vocab = {term: i for i, term in enumerate(terms)}
+        frequencies = np.array([document_frequency[term] for term in terms], np.float32)
+        idf = (np.log((1 + len(ids)) / (1 + frequencies)) + 1).astype(np.float32)
+
+        rows, cols, values = _weights(token_lists, vocab, idf)
+        components = _topics(rows, cols, values, len(ids), len(terms), dimensions)
+        vectors = np.zeros((max(ids) + 1, components.shape[1]), np.float32)
+        vectors[ids] = _normalize(_sparse_dot(rows, cols, values, len(ids), components))
+
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        tmp_dir = os.path.join(root, f".{name}")
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, VOCAB_FILENAME), 'w') as f:
+            json.dump(terms, f)
+        np.save(os.path.join(tmp_dir, IDF_FILENAME), idf)
+        np.save(os.path.join(tmp_dir, COMPONENTS_FILENAME), components)
+        np.save(os.path.join(tmp_dir, VECTORS_FILENAME), vectors)
+        os.rename(tmp_dir, os.path.join(root, name))
+        _activate(root, name)
+
+        names = sorted(entry.name for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith('.'))
+        for old in names[:-keep] if keep > 0 else []:
+            if old != name:
+                # Workers still mapping the files keep them alive until they reload.
+                shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+    return {'name': name, 'defects': len(ids), 'terms': len(terms), 'dimensions': components.shape[1]}
+
+
+def _grow(index, rows):
+    """Replaces the vectors file with a larger copy; readers pick it up on their next reload."""
+    rows = max(rows, 2 * len(index.vectors))
+    tmp_path = f"{index.vectors_path}.{uuid.uuid4().hex}"
+    grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(rows, index.vectors.shape[1]))
+    grown[:len(index.vectors)] = index.vectors
+    grown.flush()
+    del grown
+    os.replace(tmp_path, index.vectors_path)
+    index.vectors = np.load(index.vectors_path, mmap_mode='r+')
+
+
+def update_defects(root, defect_ids):
+    """
+    Re-embeds defects in the active index; deleted and missing ones are cleared.
+
+    Args:
+        root (str): The index root.
+        defect_ids (list[int]): The defects to refresh.
+
+    Returns:
+        int: The number of rows written (0 if no index was built yet).
+    """
+    defect_ids = sorted(set(defect_ids))
+    with _writer_lock(root):
+        path = active_path(root)
+        if path is None or not defect_ids:
+            return 0
+        index = SemanticIndex(path, writable=True)
+        texts = {defect.id: defect_text(defect) for defect in _live_defects(defect_ids)}
+        db.session.rollback()
+        embeddings = index.embed([texts.get(defect_id, '') for defect_id in defect_ids])
+        if defect_ids[-1] >= len(index.vectors):
+            _grow(index, defect_ids[-1] + 1)
+        index.vectors[defect_ids] = embeddings
+        index.vectors.flush()
+    return len(defect_ids)
+
+
+def _refresh(app, defect_ids):
+    with app.app_context():
+        try:
+            update_defects(app.config['SEMANTIC_INDEX_DIR'], defect_ids)
+        except Exception as e:
+            logger.error(f"Error updating the semantic index for defects {defect_ids}: {e}")
+
+
+def _on_changes(app, events):
+    """Change listener queuing the touched defects for re-embedding on this process's index thread."""
+    global _executor
+    defect_ids = [event['defect_id'] for event in events if event.get('defect_id') is not None]
+    if not defect_ids:
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='semantic-index')
+    _executor.submit(_refresh, app, defect_ids)
+
+
+def get_index():
+    """Returns the app's active ``SemanticIndex``, or None if disabled or not built."""
+    manager = current_app.extensions.get('semantic')
+    return manager.get() if manager is not None else None
+
+
+def init_app(app):
+    """Opens the index lazily and keeps it updated on writes when ``SEMANTIC_SEARCH`` is enabled."""
+    config = app.config
+    if not config['SEMANTIC_SEARCH']:
+        return
+    app.extensions['semantic'] = IndexManager(config['SEMANTIC_INDEX_DIR'], config['SEMANTIC_RELOAD_INTERVAL'])
+    changes.add_listener(app, partial(_on_changes, app))
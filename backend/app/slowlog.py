@@ -0,0 +1,299 @@
+"""
+Opt-in slow-query log.
+
+With ``SLOW_QUERY_LOG`` enabled, every statement that any engine (primary
+and replicas) runs for longer than ``SLOW_QUERY_THRESHOLD_MS`` is logged and
+recorded with:
+
+* the route (request endpoint) or ``cli`` outside requests,
+* its bind parameters, redacted to type and length for strings and bytes,
+* its duration, and
+* for ``SELECT`` statements, the query plan (``EXPLAIN QUERY PLAN`` on
+  SQLite, ``EXPLAIN`` elsewhere), captured right after the statement on the
+  same connection so it reflects the same transaction.
+
+Records go to a small SQLite file (``SLOW_QUERY_LOG_PATH``) shared by all
+worker processes and capped at ``SLOW_QUERY_KEEP`` rows. ``GET
+/admin/slow-queries`` aggregates them by normalized statement: literals and
+placeholders become ``?`` and ``IN`` lists collapse, so the same query with
+different arguments is counted once. Each statement lists the tables its
+plan reads in full (``full_scans``), the usual sign of a missing index;
+``tests/test_query_plans.py`` applies the same check to the routes.
+"""
+import hashlib
+import logging
+import random
+import re
+import sqlite3
+import time
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+
+from app.admission import TokenBuckets
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIXES = {'sqlite': 'EXPLAIN QUERY PLAN '}
+MAX_STATEMENT_LENGTH = 4000
+MAX_PLAN_LENGTH = 8000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slow_query (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    statement TEXT NOT NULL,
+    route TEXT NOT NULL,
+    params TEXT,
+    duration_ms REAL NOT NULL,
+    plan TEXT,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slow_query_fingerprint ON slow_query (fingerprint, recorded);
+CREATE INDEX IF NOT EXISTS slow_query_recorded ON slow_query (recorded);
+"""
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"\?|%\(\w+\)s|%s|(?<!:):\w+|\$\d+")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_EXPLAINABLE = re.compile(r"\s*(SELECT|WITH)\b", re.IGNORECASE)
+# Plan lines reading a whole table: SQLite without an index, or building a
+# throw-away one for this query; PostgreSQL sequential scans
+_FULL_SCANS = (
+    re.compile(r"^SCAN (\w+)$"),
+    re.compile(r"^SEARCH (\w+) USING AUTOMATIC "),
+    re.compile(r"\bSeq Scan on (\w+)"),
+)
+
+
+def normalize_statement(statement):
+    """
+    Reduces a statement to its shape, so executions with different arguments group together.
+
+    Returns:
+        str: The statement with literals and placeholders replaced by ``?``,
+        ``IN`` lists collapsed to ``(?...)`` and whitespace collapsed.
+    """
+    normalized = _WHITESPACE.sub(' ', statement).strip()
+    normalized = _LITERALS.sub('?', normalized)
+    normalized = _PLACEHOLDERS.sub('?', normalized)
+    return _IN_LISTS.sub('(?...)', normalized)
+
+
+def _redact_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return repr(value)
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact_parameters(parameters, executemany=False):
+    """Describes bind parameters without their string or binary contents."""
+    if executemany:
+        return f"<{len(parameters)} parameter sets>"
+    if isinstance(parameters, dict):
+        return ', '.join(f"{key}={_redact_value(value)}" for key, value in parameters.items())
+    return ', '.join(_redact_value(value) for value in parameters or ())
+
+
+def explain(dbapi_connection, dialect, statement, parameters):
+    """
+    Captures the plan of a statement on the connection that ran it.
+
+    Runs on a raw DBAPI cursor, so it is not itself timed or recorded. On
+    PostgreSQL it is wrapped in a savepoint: a failing ``EXPLAIN`` would
+    otherwise abort the request's transaction.
+
+    Returns:
+        str: One plan line per row, or None if the plan could not be captured.
+    """
+    savepoint = dialect == 'postgresql'
+    cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(EXPLAIN_PREFIXES.get(dialect, 'EXPLAIN ') + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            logger.debug(f"Could not explain slow query: {e}")
+            return None
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    finally:
+        cursor.close()
+
+    if dialect == 'sqlite':
+        # (id, parent, notused, detail)
+        return '\n'.join(str(row[-1]) for row in rows)
+    return '\n'.join(' | '.join('' if col is None else str(col) for col in row) for row in rows)
+
+
+def full_scans(plan):
+    """
+    Lists the tables a captured plan reads in full.
+
+    Args:
+        plan (str): A plan as returned by ``explain`` (SQLite or PostgreSQL).
+
+    Returns:
+        list[str]: The table names (or aliases) in plan order, each once.
+    """
+    tables = []
+    for line in (plan or '').splitlines():
+        for pattern in _FULL_SCANS:
+            match = pattern.search(line.strip())
+            if match and match.group(1) not in tables:
+                tables.append(match.group(1))
+    return tables
+
+
+class SlowQueryLog:
+    """
+    Slow statements recorded in an SQLite file shared by the worker processes.
+
+    Args:
+        path (str): The SQLite database file.
+        keep (int): Approximate number of records to retain.
+    """
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def add(self, statement, route, params, duration_ms, plan):
+        normalized = normalize_statement(statement)
+        fingerprint = hashlib.sha1(normalized.encode()).hexdigest()[:16]
+        connection = self._connect()
+        try:
+            connection.execute(
+                'INSERT INTO slow_query (fingerprint, statement, route, params, duration_ms, plan, recorded) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (fingerprint, normalized[:MAX_STATEMENT_LENGTH], route, params, duration_ms,
+                 plan[:MAX_PLAN_LENGTH] if plan else None, time.time()))
+            if random.random() < 0.01:
+                connection.execute('DELETE FROM slow_query WHERE id <= '
+                                   '(SELECT MAX(id) FROM slow_query) - ?', (self.keep,))
+        finally:
+            connection.close()
+
+    def top(self, limit=20, since=None, order='total'):
+        """
+        Aggregates the records by normalized statement.
+
+        Args:
+            limit (int): Number of statements to return.
+            since (float): Only consider records from this UNIX time on.
+            order (str): ``total`` (time spent), ``count``, ``max`` or ``avg``.
+
+        Returns:
+            list[dict]: Per statement: count, total/avg/max milliseconds, routes,
+            and the parameters, plan and full-scanned tables of its slowest execution.
+        """
+        order_by = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms', 'avg': 'avg_ms'}[order]
+        connection = self._connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            rows = connection.execute(
+                f'SELECT fingerprint, MIN(statement) AS statement, COUNT(*) AS count, '
+                f'SUM(duration_ms) AS total_ms, AVG(duration_ms) AS avg_ms, MAX(duration_ms) AS max_ms, '
+                f'MAX(recorded) AS last_seen, GROUP_CONCAT(DISTINCT route) AS routes '
+                f'FROM slow_query WHERE recorded >= ? GROUP BY fingerprint ORDER BY {order_by} DESC LIMIT ?',
+                (since or 0, limit)).fetchall()
+            result = []
+            for row in rows:
+                slowest = connection.execute(
+                    'SELECT params, plan FROM slow_query WHERE fingerprint = ? AND recorded >= ? '
+                    'ORDER BY duration_ms DESC LIMIT 1', (row['fingerprint'], since or 0)).fetchone()
+                result.append({
+                    'fingerprint': row['fingerprint'],
+                    'statement': row['statement'],
+                    'count': row['count'],
+                    'total_ms': round(row['total_ms'], 1),
+                    'avg_ms': round(row['avg_ms'], 1),
+                    'max_ms': round(row['max_ms'], 1),
+                    'last_seen': row['last_seen'],
+                    'routes': sorted(row['routes'].split(',')),
+                    'slowest_params': slowest['params'],
+                    'plan': slowest['plan'],
+                    'full_scans': full_scans(slowest['plan']),
+                })
+            return result
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self._connect()
+        try:
+            connection.execute('DELETE FROM slow_query')
+        finally:
+            connection.close()
+
+
+def _route():
+    if has_request_context():
+        return request.endpoint or request.path
+    return 'cli'
+
+
+def _instrument(engine, log, threshold_ms, capture_plans):
+    dialect = engine.dialect.name
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _finish(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_slow_query_start', None)
+        if start is None:
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms < threshold_ms:
+            return
+
+        try:
+            plan = None
+            if capture_plans and not executemany and _EXPLAINABLE.match(statement):
+                plan = explain(conn.connection.dbapi_connection, dialect, statement, parameters)
+            route = _route()
+            params = redact_parameters(parameters, executemany)
+            logger.warning(f"Slow query ({duration_ms:.0f} ms) in {route}: "
+                           f"{normalize_statement(statement)[:500]} [{params}]")
+            log.add(statement, route, params, duration_ms, plan)
+        except Exception as e:
+            # The query itself succeeded; never fail it because of the log.
+            logger.error(f"Error recording slow query: {e}")
+
+
+def get_log():
+    """Returns the app's slow-query log, or None if it is disabled."""
+    return current_app.extensions.get('slowlog')
+
+
+def init_app(app, db):
+    """Instruments every engine when ``SLOW_QUERY_LOG`` is enabled."""
+    config = app.config
+    if not config['SLOW_QUERY_LOG']:
+        return
+
+    log = SlowQueryLog(config['SLOW_QUERY_LOG_PATH'], config['SLOW_QUERY_KEEP'])
+    app.extensions['slowlog'] = log
+    # The report aggregates the whole log, so it is rate limited per client.
+    app.extensions['slowlog_report_buckets'] = TokenBuckets(
+        config['SLOW_QUERY_LOG_PATH'], config['SLOW_QUERY_REPORT_RATE'], config['SLOW_QUERY_REPORT_BURST'])
+    with app.app_context():
+        engines = db.engines
+    for engine in set(engines.values()):
+        _instrument(engine, log, config['SLOW_QUERY_THRESHOLD_MS'], config['SLOW_QUERY_EXPLAIN'])
@@ -0,0 +1,334 @@
+"""
+Read-only edge snapshots of the library.
+
+``flask snapshot build`` compiles the library into a self-contained
+directory that a remote site can serve without the database or the upload
+storage:
+
+* ``library.db`` - a SQLite database holding every defect's precomputed
+  JSON, a lower-cased search text and, where SQLite supports it, an FTS5
+  trigram index over that text (substring search without a table scan);
+  plus the ``blob`` index mapping each image and PDF to its slice of the pack.
+* ``blobs.pack`` - all images and PDFs appended into one file.
+
+Snapshots live side by side under ``SNAPSHOT_DIR``; the ``CURRENT`` file
+names the active one and is replaced atomically by ``flask snapshot build``
+and ``flask snapshot activate``. An app started with ``SNAPSHOT_MODE`` set
+runs in read-only mode (``app/routes/snapshot_routes.py``): it serves
+``/defect/search``, ``/defect/<id>``, ``/images/*`` and ``/pdfs/*`` from the
+active snapshot, with the pack memory-mapped, and picks up a newly
+activated snapshot within ``SNAPSHOT_RELOAD_INTERVAL`` seconds. Requests
+already streaming from the previous snapshot finish undisturbed.
+"""
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from app import db, filemeta
+from app.models import Defect
+from app.packfile import PackWriter, PackReader
+from app.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+DB_FILENAME = 'library.db'
+PACK_FILENAME = 'blobs.pack'
+CURRENT_FILENAME = 'CURRENT'
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE defect (
+    id INTEGER PRIMARY KEY,
+    searchable INTEGER NOT NULL,
+    search_text TEXT NOT NULL,
+    json TEXT NOT NULL
+);
+CREATE TABLE blob (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    mimetype TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (kind, name)
+) WITHOUT ROWID;
+"""
+
+# Trigram queries need at least three characters; shorter ones scan search_text.
+TRIGRAM_MIN_QUERY = 3
+
+
+def _defect_document(defect):
+    """Returns the JSON body of ``GET /defect/<id>`` and the defect's search text."""
+    data = {
+        'id': defect.id,
+        'name': defect.title,
+        'pdf_url': f"/pdfs/{defect.pdf.filename}" if defect.pdf else None,
+        'pdf': filemeta.pdf_json(defect.pdf),
+        'modes': [{
+            'id': mode.id,
+            'mode': mode.mode,
+            'description': mode.description,
+            'image_url': f"/images/{mode.image_filename}" if mode.image_filename else None,
+            'image': filemeta.image_json(mode)
+        } for mode in defect.modes]
+    }
+    parts = [defect.title or '']
+    for mode in defect.modes:
+        parts.extend([mode.mode or '', mode.description or ''])
+    # The live search matches each field separately, so keep a separator
+    # that no query can span.
+    return json.dumps(data, sort_keys=True, separators=(',', ':')), '\n'.join(parts).lower()
+
+
+def _create_search_index(connection):
+    """Builds the FTS5 trigram index if this SQLite supports it; returns its kind."""
+    try:
+        connection.execute("CREATE VIRTUAL TABLE search USING fts5("
+                           "search_text, content='defect', content_rowid='id', tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 trigram index unavailable, snapshot search will scan: {e}")
+        return 'scan'
+    connection.execute("INSERT INTO search(search) VALUES ('rebuild')")
+    return 'trigram'
+
+
+def build_snapshot(root, batch_size=500):
+    """
+    Compiles the library into a new snapshot directory under ``root``.
+
+    Defects are streamed in batches and every referenced image and PDF is
+    copied from storage into the pack exactly once. The snapshot is built in
+    a hidden temporary directory and renamed into place when complete, so a
+    half-built snapshot is never visible.
+
+    Args:
+        root (str): The snapshot root (``SNAPSHOT_DIR``).
+        batch_size (int): Defects loaded per round trip.
+
+    Returns:
+        dict: The snapshot name, counts of defects and blobs, pack size and
+        the names of files that were missing from storage.
+    """
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    tmp_dir = os.path.join(root, f".{name}.tmp")
+    os.makedirs(tmp_dir)
+    report = {'name': name, 'defects': 0, 'blobs': 0, 'pack_bytes': 0, 'missing': []}
+
+    stores = {'images': get_storage(current_app.config['UPLOAD_FOLDER_IMAGES']),
+              'pdfs': get_storage(current_app.config['UPLOAD_FOLDER_PDFS'])}
+
+    connection = sqlite3.connect(os.path.join(tmp_dir, DB_FILENAME))
+    try:
+        connection.executescript(SCHEMA)
+        with PackWriter(os.path.join(tmp_dir, PACK_FILENAME)) as pack:
+            def add_blob(kind, filename):
+                if connection.execute('SELECT 1 FROM blob WHERE kind = ? AND name = ?',
+                                      (kind, filename)).fetchone():
+                    return
+                try:
+                    with stores[kind].open(filename) as src:
+                        offset, length, sha256 = pack.append(src)
+                except FileNotFoundError:
+                    report['missing'].append(f"{kind}/{filename}")
+                    return
+                connection.execute('INSERT INTO blob VALUES (?, ?, ?, ?, ?, ?)',
+                                   (kind, filename, offset, length,
+                                    mimetypes.guess_type(filename)[0] or 'application/octet-stream', sha256))
+                report['blobs'] += 1
+
+            stmt = (select(Defect)
+                    .where(Defect.deleted_at.is_(None))
+                    .options(selectinload(Defect.modes), selectinload(Defect.pdf))
+                    .order_by(Defect.id)
+                    .execution_options(yield_per=batch_size))
+            for defect in db.session.scalars(stmt):
+                document, search_text = _defect_document(defect)
+                # The live search joins the modes, so defects without modes never match.
+                connection.execute('INSERT INTO defect VALUES (?, ?, ?, ?)',
+                                   (defect.id, 1 if defect.modes else 0, search_text, document))
+                for mode in defect.modes:
+                    if mode.image_filename:
+                        add_blob('images', mode.image_filename)
+                if defect.pdf:
+                    add_blob('pdfs', defect.pdf.filename)
+                report['defects'] += 1
+            report['pack_bytes'] = pack.offset
+        db.session.rollback()
+
+        search_index = _create_search_index(connection)
+        connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('name', name), ('built_at', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('search_index', search_index),
+        ])
+        connection.commit()
+        connection.execute('VACUUM')
+    except Exception:
+        connection.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    connection.close()
+
+    os.rename(tmp_dir, os.path.join(root, name))
+    return report
+
+
+def activate_snapshot(root, name):
+    """
+    Makes ``name`` the snapshot served from ``root``.
+
+    The ``CURRENT`` pointer is replaced with a single rename, so readers see
+    either the old or the new snapshot, never a mix.
+
+    Args:
+        root (str): The snapshot root.
+        name (str): A snapshot directory inside ``root``.
+    """
+    if not os.path.isfile(os.path.join(root, name, DB_FILENAME)):
+        raise FileNotFoundError(f"{name} is not a snapshot in {root}")
+    tmp_path = os.path.join(root, f".{CURRENT_FILENAME}.{uuid.uuid4().hex}")
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILENAME))
+
+
+def list_snapshots(root):
+    """Returns the snapshot names under ``root``, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(entry.name for entry in os.scandir(root)
+                  if entry.is_dir() and not entry.name.startswith('.')
+                  and os.path.isfile(os.path.join(entry.path, DB_FILENAME)))
+
+
+def current_snapshot_name(root):
+    """Returns the active snapshot's name, or None if none was activated."""
+    try:
+        with open(os.path.join(root, CURRENT_FILENAME)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def prune_snapshots(root, keep):
+    """Deletes all but the newest ``keep`` snapshots, never the active one."""
+    current = current_snapshot_name(root)
+    removed = []
+    for name in list_snapshots(root)[:-keep] if keep > 0 else list_snapshots(root):
+        if name != current:
+            # Servers still mapping the files keep them alive until they swap.
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            removed.append(name)
+    return removed
+
+
+class Snapshot:
+    """
+    An opened snapshot: a read-only SQLite connection plus the mapped pack.
+
+    Args:
+        path (str): The snapshot directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        # immutable=1: the file never changes, so SQLite skips locking entirely.
+        self.db = sqlite3.connect(f"file:{os.path.join(path, DB_FILENAME)}?mode=ro&immutable=1",
+                                  uri=True, check_same_thread=False)
+        self.pack = PackReader(os.path.join(path, PACK_FILENAME))
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        self.trigram = meta.get('search_index') == 'trigram'
+
+    def defect_json(self, defect_id):
+        row = self.db.execute('SELECT json FROM defect WHERE id = ?', (defect_id,)).fetchone()
+        return row[0] if row else None
+
+    def search_json(self, query):
+        """Returns the JSON array ``/defect/search`` answers for ``query``."""
+        pattern = f"%{query.lower()}%"
+        if self.trigram and len(query) >= TRIGRAM_MIN_QUERY:
+            rows = self.db.execute(
+                'SELECT json FROM defect WHERE searchable AND id IN '
+                '(SELECT rowid FROM search WHERE search_text LIKE ?) ORDER BY id', (pattern,))
+        else:
+            rows = self.db.execute(
+                'SELECT json FROM defect WHERE searchable AND search_text LIKE ? ORDER BY id', (pattern,))
+        return '[' + ','.join(row[0] for row in rows) + ']'
+
+    def blob(self, kind, name):
+        """Returns ``(view, mimetype, sha256)`` for a stored file, or None."""
+        row = self.db.execute('SELECT offset, length, mimetype, sha256 FROM blob WHERE kind = ? AND name = ?',
+                              (kind, name)).fetchone()
+        if row is None:
+            return None
+        offset, length, mimetype, sha256 = row
+        return self.pack.view(offset, length), mimetype, sha256
+
+
+class SnapshotManager:
+    """
+    Tracks the active snapshot of a root directory and swaps it when ``CURRENT`` changes.
+
+    Args:
+        root (str): The snapshot root, or a single snapshot directory.
+        reload_interval (float): Minimum time between checks of ``CURRENT``.
+    """
+
+    def __init__(self, root, reload_interval):
+        self.root = root
+        self.reload_interval = reload_interval
+        self._snapshot = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _active_path(self):
+        if os.path.isfile(os.path.join(self.root, DB_FILENAME)):
+            return self.root
+        name = current_snapshot_name(self.root)
+        return os.path.join(self.root, name) if name else None
+
+    def get(self):
+        """Returns the active ``Snapshot``; raises RuntimeError if none is available."""
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=self._snapshot is None):
+            try:
+                self._next_check = now + self.reload_interval
+                path = self._active_path()
+                if path and (self._snapshot is None or self._snapshot.path != path):
+                    try:
+                        self._snapshot = Snapshot(path)
+                        logger.info(f"Serving snapshot {self._snapshot.name}")
+                    except Exception as e:
+                        # Keep serving the previous snapshot if the new one is unreadable.
+                        logger.error(f"Error opening snapshot {path}: {e}")
+            finally:
+                self._lock.release()
+        if self._snapshot is None:
+            raise RuntimeError(f"No snapshot available in {self.root}")
+        return self._snapshot
+
+
+def current_snapshot():
+    """Returns the snapshot the current app serves."""
+    return current_app.extensions['snapshot'].get()
+
+
+def init_app(app):
+    """Switches the app to read-only snapshot mode."""
+    app.extensions['snapshot'] = SnapshotManager(app.config['SNAPSHOT_DIR'],
+                                                 app.config['SNAPSHOT_RELOAD_INTERVAL'])
+    from app.routes.snapshot_routes import bp as snapshot_bp
+    app.register_blueprint(snapshot_bp)
@@ -0,0 +1,311 @@
+"""
+Transactional file staging for uploads.
+
+Uploaded files are first written to a ``.staging`` directory inside their
+upload folder and are only handed to the folder's storage driver (see
+``app/storage.py``) once the database transaction that references them
+commits. Deletions requested during a transaction are
+deferred the same way, so a rollback never leaves rows pointing at missing
+files or files that no row points at.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.utils import secure_filename
+
+from app import db, filemeta, tiles
+from app.storage import get_storage
+from app.validation import has_valid_signature
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIRNAME = '.staging'
+_PENDING_KEY = 'pending_files'
+
+_upload_pool = None
+
+# What stage_files() reports for every file it wrote, with its metadata (see app/filemeta.py)
+StagedFile = namedtuple('StagedFile', ['filename', 'size', 'sha256', 'mimetype', 'width', 'height', 'pages'])
+
+
+class InvalidUpload(ValueError):
+    """Raised when an uploaded file's content does not match its declared type."""
+
+
+def _pending(session):
+    """Returns the pending promote/delete lists stored on the session."""
+    return session.info.setdefault(_PENDING_KEY, {'promote': [], 'delete': [], 'callbacks': []})
+
+
+def staging_folder(upload_folder):
+    """Returns the staging directory that belongs to an upload folder."""
+    return os.path.join(upload_folder, STAGING_DIRNAME)
+
+
+def unique_filename(original_name):
+    """
+    Builds a collision-free storage name for an uploaded file.
+
+    Args:
+        original_name (str): The client-supplied filename.
+
+    Returns:
+        str: A sanitized filename prefixed with a random UUID.
+    """
+    return f"{uuid.uuid4().hex}_{secure_filename(original_name)}"
+
+
+def stage_file(file, upload_folder, allowed_extensions=None):
+    """
+    Writes an uploaded file to the staging area of ``upload_folder``.
+
+    The file becomes visible under its final name only after the current
+    session commits; if the transaction is rolled back the staged copy is
+    discarded.
+
+    Args:
+        file: The uploaded file object (``werkzeug.datastructures.FileStorage``).
+        upload_folder (str): The folder the file is ultimately stored in.
+        allowed_extensions (set): If given, the file's magic bytes must match one of these types.
+
+    Returns:
+        str: The filename to store on the database row, or None if no file was given.
+
+    Raises:
+        InvalidUpload: If the content does not match the allowed types.
+    """
+    if not file:
+        return None
+    return stage_files([file], upload_folder, allowed_extensions)[0].filename
+
+
+def _write_staged(file, upload_folder, allowed_extensions):
+    """
+    Validates, hashes, writes and inspects one upload into the staging area.
+
+    The stream is read once, and nothing here touches the session, so it is
+    safe to run on worker threads.
+    """
+    stream = file.stream
+    stream.seek(0)
+    if allowed_extensions is not None:
+        head = stream.read(16)
+        stream.seek(0)
+        if not has_valid_signature(file.filename, head, allowed_extensions):
+            raise InvalidUpload(f"{file.filename} is not a valid {'/'.join(sorted(allowed_extensions)).upper()} file")
+
+    filename = unique_filename(file.filename)
+    staging = staging_folder(upload_folder)
+    os.makedirs(staging, exist_ok=True)
+    staged_path = os.path.join(staging, filename)
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(staged_path, 'wb') as out:
+        while True:
+            chunk = stream.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return StagedFile(filename, size, digest.hexdigest(), **filemeta.inspect(staged_path, file.filename)), staged_path
+
+
+def _get_upload_pool(max_workers):
+    """Creates the shared upload I/O pool lazily so it is not shared across forked workers."""
+    global _upload_pool
+    if _upload_pool is None:
+        _upload_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload-io')
+    return _upload_pool
+
+
+def stage_files(files, upload_folder, allowed_extensions=None):
+    """
+    Stages several uploads, processing them concurrently on the upload pool.
+
+    Magic-byte validation, hashing, the disk write and the metadata
+    inspection of each file run on worker threads; the files are registered
+    with the current session from the calling thread. If any file fails, the files that did land are still
+    registered (and so discarded on rollback) before the first error is
+    re-raised.
+
+    Args:
+        files (list): Uploaded file objects; falsy entries are allowed.
+        upload_folder (str): The folder the files are ultimately stored in.
+        allowed_extensions (set): If given, each file's magic bytes must match one of these types.
+
+    Returns:
+        list[StagedFile]: One entry per element of ``files`` (None for empty entries).
+
+    Raises:
+        InvalidUpload: If a file's content does not match the allowed types.
+    """
+    present = [i for i, file in enumerate(files) if file]
+    if len(present) > 1:
+        pool = _get_upload_pool(current_app.config['UPLOAD_WORKERS'])
+        futures = [pool.submit(_write_staged, files[i], upload_folder, allowed_extensions) for i in present]
+    else:
+        futures = None
+
+    results, first_error = [], None
+    for n, i in enumerate(present):
+        try:
+            results.append(futures[n].result() if futures
+                           else _write_staged(files[i], upload_folder, allowed_extensions))
+        except Exception as e:
+            results.append(None)
+            first_error = first_error or e
+
+    staged = [None] * len(files)
+    promote = _pending(db.session)['promote']
+    for i, result in zip(present, results):
+        if result:
+            staged_file, staged_path = result
+            promote.append((staged_path, upload_folder, staged_file.filename))
+            staged[i] = staged_file
+
+    if first_error:
+        raise first_error
+    return staged
+
+
+def stage_local_file(path, original_name, upload_folder, allowed_extensions=None):
+    """
+    Stages a file that is already on local disk, such as an assembled chunked upload.
+
+    The file is hard-linked into the staging area (copied if it is on another
+    filesystem), so the source is left intact when the transaction rolls back.
+
+    Args:
+        path (str): The local file.
+        original_name (str): The client-supplied filename.
+        upload_folder (str): The folder the file is ultimately stored in.
+        allowed_extensions (set): If given, the file's magic bytes must match one of these types.
+
+    Returns:
+        StagedFile: The staged file.
+
+    Raises:
+        InvalidUpload: If the content does not match the allowed types.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        if allowed_extensions is not None and not has_valid_signature(original_name, head, allowed_extensions):
+            raise InvalidUpload(f"{original_name} is not a valid {'/'.join(sorted(allowed_extensions)).upper()} file")
+        f.seek(0)
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+
+    filename = unique_filename(original_name)
+    staging = staging_folder(upload_folder)
+    os.makedirs(staging, exist_ok=True)
+    staged_path = os.path.join(staging, filename)
+    try:
+        os.link(path, staged_path)
+    except OSError:
+        shutil.copyfile(path, staged_path)
+    _pending(db.session)['promote'].append((staged_path, upload_folder, filename))
+    return StagedFile(filename, size, digest.hexdigest(), **filemeta.inspect(staged_path, original_name))
+
+
+def schedule_delete(upload_folder, filename):
+    """
+    Removes a stored file once the current session commits.
+
+    Args:
+        upload_folder (str): The folder containing the file.
+        filename (str): The name of the file to delete.
+    """
+    if filename:
+        _pending(db.session)['delete'].append((upload_folder, filename))
+
+
+def call_after_commit(func, *args):
+    """
+    Runs ``func(*args)`` after the current session commits and its files are promoted.
+
+    The callback is dropped if the transaction is rolled back. It must not use
+    the session that just committed.
+    """
+    _pending(db.session)['callbacks'].append((func, args))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending_files(session):
+    """Promotes staged files and performs deferred deletions after a commit."""
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+
+    for staged_path, upload_folder, filename in pending['promote']:
+        try:
+            get_storage(upload_folder).put_file(staged_path, filename)
+        except Exception as e:
+            logger.error(f"Error promoting staged file {staged_path}: {e}")
+
+    deletes = {}
+    for upload_folder, filename in pending['delete']:
+        deletes.setdefault(upload_folder, []).append(filename)
+    for upload_folder, filenames in deletes.items():
+        try:
+            get_storage(upload_folder).delete_many(filenames)
+            if upload_folder == current_app.config['UPLOAD_FOLDER_IMAGES'] and tiles.tiling_enabled(current_app.config):
+                tiles.delete_pyramids(filenames)
+        except Exception as e:
+            logger.error(f"Error deleting {len(filenames)} files from {upload_folder}: {e}")
+
+    for func, args in pending['callbacks']:
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Error in after-commit callback {func.__name__}: {e}")
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending_files(session, transaction):
+    """Drops staged files when the outermost transaction ends without a commit."""
+    if transaction.parent is not None:
+        return
+    _remove_staged(session.info.pop(_PENDING_KEY, None))
+
+
+def _remove_staged(pending):
+    if not pending:
+        return
+
+    for staged_path, _, _ in pending['promote']:
+        try:
+            os.remove(staged_path)
+        except OSError:
+            pass
+
+
+def discard_pending_files(exception=None):
+    """
+    Drops staged files still pending when the app context ends.
+
+    This covers requests that staged files before their session began a
+    transaction and then bailed out, which no transaction event sees.
+    """
+    _remove_staged(db.session.info.pop(_PENDING_KEY, None))
+
+
+def init_app(app):
+    """Registers the teardown that discards uncommitted staged files."""
+    # Registered after Flask-SQLAlchemy, so it runs before the session is removed.
+    app.teardown_appcontext(discard_pending_files)
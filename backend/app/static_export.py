@@ -0,0 +1,201 @@
+"""
+Static search index for the backend-less frontend.
+
+``flask snapshot export-static`` compiles the library into plain JSON files
+that any static host can serve (by default ``docs/search``, next to the
+GitHub Pages copy of the frontend in ``docs/index.html``), so the page can
+search the library in the browser without the API:
+
+* ``meta.json`` - format version, counts, the list of index shards and the
+  ids of every searchable defect;
+* ``terms/<key>.json`` - the trigram index, sharded by the first
+  ``SHARD_PREFIX`` characters of each trigram (``<key>`` is the hex of their
+  UTF-8, so any character is a safe file name). A shard maps each of its
+  trigrams to the ids of the defects whose search text contains it;
+* ``defects/<n>.json`` - the document store, ``DOCS_PER_SHARD`` consecutive
+  defect ids per file, each with the JSON of ``GET /defect/<id>`` and the
+  lower-cased search text;
+* ``images/`` and ``pdfs/`` - copies of the files, with ``--with-files``.
+
+Id lists are sorted and delta-encoded (each id minus the previous one),
+which keeps them to a few digits per entry.
+
+Search matches the live ``/defect/search``: a case-insensitive substring of
+the title, a mode name or a description, among defects that have modes.
+The browser fetches only the shards of the query's trigrams, intersects
+their id lists and checks the candidates' search text, then fetches the
+document shards of the matches. The search text is padded at the end so
+that every substring shorter than a trigram starts one; such queries read
+the shards starting with them.
+
+The export is written to a temporary sibling directory and swapped in when
+complete, so a host never serves half of one.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from app import db
+from app.models import Defect
+from app.snapshot import _defect_document
+from app.storage import get_storage
+
+FORMAT_VERSION = 1
+META_FILENAME = 'meta.json'
+TRIGRAM = 3
+SHARD_PREFIX = 2
+DOCS_PER_SHARD = 100
+# Never a character of a query typed into the search box
+PADDING = '\n'
+
+
+def trigrams(search_text):
+    """Returns the trigrams of the padded search text, one starting at each character."""
+    padded = search_text + PADDING * (TRIGRAM - 1)
+    return {padded[i:i + TRIGRAM] for i in range(len(search_text))}
+
+
+def shard_filename(key):
+    """Returns the file name of the index shard of trigrams starting with ``key``."""
+    return f"{key.encode('utf-8').hex()}.json"
+
+
+def _deltas(ids):
+    previous = 0
+    deltas = []
+    for defect_id in ids:
+        deltas.append(defect_id - previous)
+        previous = defect_id
+    return deltas
+
+
+def _write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    return os.path.getsize(path)
+
+
+def export_static(output, with_files=False, files_url=None, batch_size=500):
+    """
+    Writes the static search index of the library to ``output``.
+
+    Args:
+        output (str): The export directory; replaced if it holds a previous export.
+        with_files (bool): Copy every referenced image and PDF into the export
+            and link them relative to it.
+        files_url (str): Without ``with_files``, the base URL the file links
+            point at (e.g. a CDN); by default they keep the API's ``/images``
+            and ``/pdfs`` paths.
+        batch_size (int): Defects loaded per round trip.
+
+    Returns:
+        dict: Counts of defects, searchable defects, trigrams, shards, copied
+        files and bytes written, and the names of files missing from storage.
+
+    Raises:
+        FileExistsError: If ``output`` is a non-empty directory that is not an export.
+    """
+    output = os.path.abspath(output)
+    if os.path.isdir(output) and os.listdir(output) and not os.path.exists(os.path.join(output, META_FILENAME)):
+        raise FileExistsError(f"{output} is not empty and holds no static export")
+    parent = os.path.dirname(output)
+    tmp_dir = os.path.join(parent, f".{os.path.basename(output)}-{uuid.uuid4().hex[:8]}.tmp")
+    for subdirectory in ('terms', 'defects'):
+        os.makedirs(os.path.join(tmp_dir, subdirectory))
+    report = {'defects': 0, 'searchable': 0, 'trigrams': 0, 'shards': 0, 'files': 0, 'bytes': 0, 'missing': []}
+
+    stores = {'images': get_storage(current_app.config['UPLOAD_FOLDER_IMAGES']),
+              'pdfs': get_storage(current_app.config['UPLOAD_FOLDER_PDFS'])}
+    links = {}
+
+    def link(kind, filename):
+        if not with_files:
+            return f"{files_url.rstrip('/')}/{kind}/{filename}" if files_url else f"/{kind}/{filename}"
+        if (kind, filename) not in links:
+            path = os.path.join(tmp_dir, kind, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                with stores[kind].open(filename) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            except FileNotFoundError:
+                os.remove(path)
+                report['missing'].append(f"{kind}/{filename}")
+                links[kind, filename] = None
+            else:
+                report['files'] += 1
+                report['bytes'] += os.path.getsize(path)
+                links[kind, filename] = f"{kind}/{filename}"
+        return links[kind, filename]
+
+    postings = {}
+    searchable = []
+    documents, shard_number = {}, None
+
+    def flush_documents():
+        if documents:
+            report['bytes'] += _write_json(os.path.join(tmp_dir, 'defects', f"{shard_number}.json"), documents)
+            documents.clear()
+
+    try:
+        stmt = (select(Defect)
+                .where(Defect.deleted_at.is_(None))
+                .options(selectinload(Defect.modes), selectinload(Defect.pdf))
+                .order_by(Defect.id)
+                .execution_options(yield_per=batch_size))
+        for defect in db.session.scalars(stmt):
+            report['defects'] += 1
+            # The live search joins the modes, so defects without modes never match.
+            if not defect.modes:
+                continue
+            document, search_text = _defect_document(defect)
+            document = json.loads(document)
+            document['pdf_url'] = link('pdfs', defect.pdf.filename) if defect.pdf else None
+            for data, mode in zip(document['modes'], defect.modes):
+                data['image_url'] = link('images', mode.image_filename) if mode.image_filename else None
+
+            if defect.id // DOCS_PER_SHARD != shard_number:
+                flush_documents()
+                shard_number = defect.id // DOCS_PER_SHARD
+            documents[defect.id] = {'defect': document, 'text': search_text}
+            # Defects stream in id order, so every id list comes out sorted.
+            for trigram in trigrams(search_text):
+                postings.setdefault(trigram, []).append(defect.id)
+            searchable.append(defect.id)
+        flush_documents()
+        db.session.rollback()
+
+        shards = {}
+        for trigram, ids in postings.items():
+            shards.setdefault(trigram[:SHARD_PREFIX], {})[trigram] = _deltas(ids)
+        for key, shard in shards.items():
+            report['bytes'] += _write_json(os.path.join(tmp_dir, 'terms', shard_filename(key)), shard)
+        report.update(searchable=len(searchable), trigrams=len(postings), shards=len(shards))
+        report['bytes'] += _write_json(os.path.join(tmp_dir, META_FILENAME), {
+            'version': FORMAT_VERSION,
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'trigram': TRIGRAM,
+            'shard_prefix': SHARD_PREFIX,
+            'docs_per_shard': DOCS_PER_SHARD,
+            'defects': len(searchable),
+            'shards': sorted(shards),
+            'ids': _deltas(searchable),
+        })
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # Two renames: the old export is never mixed with the new one.
+    previous = None
+    if os.path.exists(output):
+        previous = f"{tmp_dir}.old"
+        os.rename(output, previous)
+    os.rename(tmp_dir, output)
+    if previous:
+        shutil.rmtree(previous, ignore_errors=True)
+    return report
@@ -0,0 +1,368 @@
+"""
+Defect statistics: rollup tables kept current on write, and SQL bucketing.
+
+Two rollup tables back the ``/defect/stats`` endpoints, so the endpoints
+never scan the defect tables:
+
+* ``defect_activity_daily`` counts defects created, modes created, defects
+  edited and defects deleted per UTC day. Weekly and monthly series are a
+  ``GROUP BY`` over the daily rows (see ``bucket_expression``).
+* ``defect_rollup`` holds one row per defect with its mode count, edit
+  count and the bytes its images and PDF occupy in storage.
+
+Write routes call ``record`` with the defects they change. Once the
+transaction has committed and its files are promoted, the counters are
+incremented and each touched defect's row is re-derived from its current
+modes and PDF in a short transaction of its own. File sizes come from the
+metadata columns recorded at upload (``app/filemeta.py``); storage is only
+asked for rows whose size is not recorded yet. A failure
+there is logged and never fails the write; ``flask stats rebuild``
+recomputes both tables from the ``created_at``/``updated_at`` timestamps.
+"""
+import logging
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import Date, and_, cast, delete, event, func, insert, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Defect, DefectMode, PDFFile, DefectActivityDaily, DefectRollup
+from app.staging import call_after_commit
+from app.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = ('day', 'week', 'month')
+DAILY_COUNTERS = ('defects_created', 'modes_created', 'defects_edited', 'defects_deleted')
+
+_PENDING_KEY = 'stats_pending'
+
+# created_at and updated_at defaults are taken separately, so a fresh row's differ slightly.
+_EDIT_TOLERANCE = timedelta(seconds=1)
+
+
+def record(defect, created=False, deleted=False, modes_added=0, edited=None):
+    """
+    Notes a change to a defect; the rollups are updated after the session commits.
+
+    Args:
+        defect: The ``Defect`` (a new instance is fine, its id is read after the commit) or its id.
+        created (bool): The defect was created.
+        deleted (bool): The defect was deleted.
+        modes_added (int): Number of modes created for the defect.
+        edited (bool): Count the change as an edit; by default every change that
+            is neither a creation nor a deletion is one.
+    """
+    if not current_app.config['STATS_ROLLUPS']:
+        return
+    pending = db.session.info.get(_PENDING_KEY)
+    if pending is None:
+        pending = db.session.info[_PENDING_KEY] = []
+        call_after_commit(_apply_pending, pending)
+    if edited is None:
+        edited = not (created or deleted)
+    pending.append((defect, created, deleted, modes_added, edited))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_pending(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _defect_id(defect):
+    if isinstance(defect, int):
+        return defect
+    # The identity is kept on the instance, so this emits no SQL after the commit.
+    identity = inspect(defect).identity
+    return identity[0] if identity else None
+
+
+def _apply_pending(pending):
+    """After-commit callback folding one transaction's changes into the rollups."""
+    now = datetime.utcnow()
+    counters = dict.fromkeys(DAILY_COUNTERS, 0)
+    changes = {}
+    for defect, created, deleted, modes_added, edited in pending:
+        defect_id = _defect_id(defect)
+        if defect_id is None:
+            continue
+        change = changes.setdefault(defect_id, {'created': False, 'deleted': False, 'edited': False})
+        change['created'] |= created
+        change['deleted'] |= deleted
+        change['edited'] |= edited
+        counters['modes_created'] += modes_added
+
+    for change in changes.values():
+        if change['deleted']:
+            counters['defects_deleted'] += 1
+        elif change['created']:
+            counters['defects_created'] += 1
+        elif change['edited']:
+            counters['defects_edited'] += 1
+
+    deleted = [defect_id for defect_id, change in changes.items() if change['deleted']]
+    live = [defect_id for defect_id, change in changes.items() if not change['deleted']]
+    with db.engine.begin() as connection:
+        if any(counters.values()):
+            _upsert(connection, DefectActivityDaily.__table__, {'day': now.date()}, increments=counters)
+        if deleted:
+            connection.execute(delete(DefectRollup).where(DefectRollup.defect_id.in_(deleted)))
+        for defect_id, values in _defect_totals(connection, live).items():
+            increments = {}
+            if changes[defect_id]['edited'] and not changes[defect_id]['created']:
+                increments['edit_count'] = 1
+                values['last_edited_at'] = now
+            _upsert(connection, DefectRollup.__table__, {'defect_id': defect_id}, values, increments)
+
+
+def refresh_image_owners(filename):
+    """Re-derives the stored bytes of the defects using an image that was re-encoded or replaced."""
+    if not current_app.config['STATS_ROLLUPS']:
+        return
+    try:
+        defect_ids = db.session.execute(select(DefectMode.defect_id)
+                                        .where(DefectMode.image_filename == filename)).scalars().all()
+        db.session.rollback()
+        _apply_pending([(defect_id, False, False, 0, False) for defect_id in defect_ids])
+    except Exception as e:
+        logger.error(f"Error updating statistics for image {filename}: {e}")
+
+
+def _upsert(connection, table, key, values=None, increments=None):
+    """
+    Updates the row identified by ``key``, inserting it if it does not exist yet.
+
+    ``increments`` are added to the current column values (and used as the
+    initial values of a new row). Works on every dialect; if another worker
+    inserts the row first, the update is retried.
+    """
+    values = values or {}
+    increments = increments or {}
+    condition = and_(*(table.c[name] == value for name, value in key.items()))
+    assignments = dict(values, **{name: table.c[name] + n for name, n in increments.items()})
+    for _ in range(2):
+        if connection.execute(update(table).where(condition).values(assignments)).rowcount:
+            return
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table).values(**key, **values, **increments))
+            return
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Could not upsert {table.name} row {key}")
+
+
+def _file_size(storage, name, size):
+    """Returns the recorded ``size`` of a stored file, asking storage only when it is not recorded."""
+    if size is not None:
+        return size
+    try:
+        return storage.size(name)
+    except FileNotFoundError:
+        return 0
+
+
+def _defect_totals(connection, defect_ids):
+    """
+    Derives the mode count and stored bytes of existing, not deleted defects.
+
+    Returns:
+        dict: Defect id -> ``defect_rollup`` column values (without the edit columns).
+    """
+    if not defect_ids:
+        return {}
+    config = current_app.config
+    images = get_storage(config['UPLOAD_FOLDER_IMAGES'])
+    pdfs = get_storage(config['UPLOAD_FOLDER_PDFS'])
+
+    existing = connection.execute(select(Defect.id).where(Defect.id.in_(defect_ids),
+                                                         Defect.deleted_at.is_(None))).scalars()
+    totals = {defect_id: {'mode_count': 0, 'image_bytes': 0, 'pdf_bytes': 0} for defect_id in existing}
+    modes = connection.execute(select(DefectMode.defect_id, DefectMode.image_filename, DefectMode.image_size)
+                               .where(DefectMode.defect_id.in_(list(totals))))
+    for defect_id, filename, size in modes:
+        totals[defect_id]['mode_count'] += 1
+        if filename:
+            totals[defect_id]['image_bytes'] += _file_size(images, filename, size)
+    pdf_rows = connection.execute(select(PDFFile.defect_id, PDFFile.filename, PDFFile.size)
+                                  .where(PDFFile.defect_id.in_(list(totals))))
+    for defect_id, filename, size in pdf_rows:
+        totals[defect_id]['pdf_bytes'] += _file_size(pdfs, filename, size)
+
+    for values in totals.values():
+        values['total_bytes'] = values['image_bytes'] + values['pdf_bytes']
+    return totals
+
+
+def bucket_expression(column, bucket, dialect):
+    """
+    Truncates a date or timestamp column to the start of its day, ISO week (Monday) or month.
+
+    Args:
+        column: The column or SQL expression to bucket.
+        bucket (str): One of ``BUCKETS``.
+        dialect (str): The database dialect name.
+
+    Returns:
+        A SQL expression usable in ``SELECT`` and ``GROUP BY``. Depending on the
+        dialect it evaluates to a date or an ISO ``YYYY-MM-DD`` string.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket {bucket!r}")
+    if dialect == 'postgresql':
+        return cast(func.date_trunc(bucket, column), Date)
+    if dialect == 'mysql' or dialect == 'mariadb':
+        if bucket == 'week':
+            return func.subdate(func.date(column), func.weekday(column))
+        if bucket == 'month':
+            return func.date_format(column, '%Y-%m-01')
+        return func.date(column)
+    # SQLite: 'weekday 0' moves forward to Sunday, six days back is that week's Monday.
+    if bucket == 'week':
+        return func.date(column, 'weekday 0', '-6 days')
+    if bucket == 'month':
+        return func.strftime('%Y-%m-01', column)
+    return func.date(column)
+
+
+def _as_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def activity(bucket='week', since=None, until=None):
+    """
+    Returns the daily activity counters summed per bucket, oldest first.
+
+    Args:
+        bucket (str): One of ``BUCKETS``.
+        since (date): First day to include.
+        until (date): Last day to include.
+    """
+    table = DefectActivityDaily
+    start = bucket_expression(table.day, bucket, _dialect()).label('bucket')
+    query = (select(start, *(func.sum(getattr(table, name)).label(name) for name in DAILY_COUNTERS))
+             .group_by(start).order_by(start))
+    if since:
+        query = query.where(table.day >= since)
+    if until:
+        query = query.where(table.day <= until)
+    return [dict({name: int(getattr(row, name)) for name in DAILY_COUNTERS}, bucket=_as_date(row.bucket).isoformat())
+            for row in db.session.execute(query)]
+
+
+def summary():
+    """Returns library-wide totals from the per-defect rollup."""
+    row = db.session.execute(select(
+        func.count(DefectRollup.defect_id).label('defects'),
+        func.sum(DefectRollup.mode_count).label('modes'),
+        func.sum(DefectRollup.edit_count).label('edits'),
+        func.sum(DefectRollup.image_bytes).label('image_bytes'),
+        func.sum(DefectRollup.pdf_bytes).label('pdf_bytes'),
+    )).one()
+    return {name: int(getattr(row, name) or 0) for name in ('defects', 'modes', 'edits', 'image_bytes', 'pdf_bytes')}
+
+
+def modes_per_defect():
+    """Returns how many defects have each number of modes, and the mean."""
+    rows = db.session.execute(select(DefectRollup.mode_count, func.count().label('defects'))
+                              .group_by(DefectRollup.mode_count).order_by(DefectRollup.mode_count)).all()
+    defects = sum(row.defects for row in rows)
+    modes = sum(row.mode_count * row.defects for row in rows)
+    return {
+        'histogram': [{'modes': row.mode_count, 'defects': row.defects} for row in rows],
+        'average': round(modes / defects, 2) if defects else 0,
+    }
+
+
+def _top_defects(order_column, limit, *columns):
+    query = (select(DefectRollup.defect_id, Defect.title, *columns)
+             .join(Defect, Defect.id == DefectRollup.defect_id)
+             .order_by(order_column.desc(), DefectRollup.defect_id)
+             .limit(limit))
+    return db.session.execute(query).all()
+
+
+def most_edited(limit=10):
+    """Returns the defects with the most edits, most edited first."""
+    rows = _top_defects(DefectRollup.edit_count, limit, DefectRollup.edit_count, DefectRollup.last_edited_at)
+    return [{'id': row.defect_id, 'name': row.title, 'edit_count': row.edit_count,
+             'last_edited_at': row.last_edited_at.isoformat() if row.last_edited_at else None}
+            for row in rows if row.edit_count]
+
+
+def largest(limit=10):
+    """Returns the defects whose files take the most storage, largest first."""
+    rows = _top_defects(DefectRollup.total_bytes, limit, DefectRollup.image_bytes,
+                        DefectRollup.pdf_bytes, DefectRollup.total_bytes)
+    return [{'id': row.defect_id, 'name': row.title, 'image_bytes': row.image_bytes,
+             'pdf_bytes': row.pdf_bytes, 'total_bytes': row.total_bytes} for row in rows]
+
+
+def rebuild(batch_size=500):
+    """
+    Recomputes both rollup tables from the defect tables and storage.
+
+    Creations come from ``GROUP BY`` over day buckets of ``created_at``.
+    Every edit, including mode and PDF changes, bumps the defect's
+    ``updated_at``, but rows only remember their last update: an edited
+    defect counts one edit, on the day of its last one. Edit counts above
+    one are therefore not recoverable, and modes edited before
+    ``updated_at`` was bumped for them do not count.
+
+    Args:
+        batch_size (int): Defects whose files are sized per transaction.
+
+    Returns:
+        dict: Number of activity days and defects written.
+    """
+    dialect = _dialect()
+    days = {}
+
+    def count(day, counter, n=1):
+        days.setdefault(day, dict.fromkeys(DAILY_COUNTERS, 0))[counter] += n
+
+    for counter, column in (('defects_created', Defect.created_at), ('modes_created', DefectMode.created_at)):
+        day = bucket_expression(column, 'day', dialect)
+        for value, n in db.session.execute(select(day, func.count()).where(column.isnot(None)).group_by(day)):
+            count(_as_date(value), counter, n)
+    db.session.rollback()
+
+    with db.engine.begin() as connection:
+        connection.execute(delete(DefectRollup))
+
+    defects = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(select(Defect.id, Defect.created_at, Defect.updated_at)
+                                      .where(Defect.id > last_id, Defect.deleted_at.is_(None))
+                                      .order_by(Defect.id).limit(batch_size)).all()
+            if not rows:
+                break
+            totals = _defect_totals(connection, [row.id for row in rows])
+            batch = []
+            for row in rows:
+                edited = (row.updated_at is not None and row.created_at is not None
+                          and row.updated_at - row.created_at > _EDIT_TOLERANCE)
+                if edited:
+                    count(row.updated_at.date(), 'defects_edited')
+                batch.append(dict(totals[row.id], defect_id=row.id, edit_count=int(edited),
+                                  last_edited_at=row.updated_at if edited else None))
+            connection.execute(insert(DefectRollup), batch)
+            defects += len(batch)
+            last_id = rows[-1].id
+
+    with db.engine.begin() as connection:
+        connection.execute(delete(DefectActivityDaily))
+        if days:
+            connection.execute(insert(DefectActivityDaily), [dict(counters, day=day) for day, counters in days.items()])
+    return {'days': len(days), 'defects': defects}
@@ -0,0 +1,302 @@
+"""
+Storage backends for uploaded files.
+
+Every upload folder (images, PDFs, kept originals, image tiles) is backed by a storage
+driver chosen with ``STORAGE_BACKEND``:
+
+* ``local`` keeps files in the upload folder itself, in the layout described
+  in ``app/layout.py``. With ``STORAGE_LOCAL_ACCEL_PREFIX`` set, file routes
+  answer with an ``X-Accel-Redirect`` header and nginx sends the bytes. With
+  ``IMAGE_PACKS`` set, small images are appended to segment files instead
+  (see ``app/segments.py``).
+* ``s3`` keeps files in an S3-compatible bucket (AWS S3, MinIO, Ceph RGW, ...)
+  under ``<STORAGE_S3_PREFIX><folder name>/<filename>``. With
+  ``STORAGE_REDIRECTS`` enabled, file routes answer with a redirect to a
+  presigned URL valid for ``STORAGE_SIGNED_URL_EXPIRES`` seconds, so no blob
+  bytes pass through the workers. Requires ``boto3``.
+
+Uploads are still staged in the local ``.staging`` directory of their upload
+folder (see ``app/staging.py``) and handed to the driver after the database
+transaction commits.
+
+Drivers are looked up by upload folder with ``get_storage``, so callers keep
+passing the configured ``UPLOAD_FOLDER_*`` paths around.
+"""
+import io
+import logging
+import mimetypes
+import os
+from collections import namedtuple
+
+from flask import abort, current_app, redirect, send_from_directory, stream_with_context
+
+from app.layout import storage_path, resolve_path, ensure_parent, scan_batches
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover - boto3 is only needed for the s3 backend
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('local', 's3')
+
+# A stored file as reported by the drivers' iter_objects()
+StoredObject = namedtuple('StoredObject', ['name', 'size', 'mtime'])
+
+
+def _guess_mimetype(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """
+    Stores files in a local upload folder.
+
+    Args:
+        root (str): The upload folder.
+        accel_prefix (str): If set, ``send`` delegates the transfer to nginx
+            through ``X-Accel-Redirect: <accel_prefix>/<folder name>/<path>``.
+    """
+
+    def __init__(self, root, accel_prefix=None):
+        self.root = root
+        self.accel_prefix = accel_prefix.rstrip('/') if accel_prefix else None
+
+    def path(self, name):
+        """Returns the path of a stored file, or None if it does not exist."""
+        return resolve_path(self.root, name)
+
+    def exists(self, name):
+        return self.path(name) is not None
+
+    def open(self, name):
+        """Opens a stored file for binary reading; raises FileNotFoundError if missing."""
+        path = self.path(name)
+        if path is None:
+            raise FileNotFoundError(name)
+        return open(path, 'rb')
+
+    def size(self, name):
+        """Returns a stored file's size in bytes; raises FileNotFoundError if missing."""
+        path = self.path(name)
+        if path is None:
+            raise FileNotFoundError(name)
+        return os.path.getsize(path)
+
+    def put_file(self, local_path, name):
+        """Moves a local file (normally a staged upload) into storage under ``name``."""
+        target = storage_path(self.root, name)
+        ensure_parent(target)
+        os.replace(local_path, target)
+
+    def delete(self, name):
+        path = self.path(name)
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def delete_many(self, names):
+        for name in names:
+            self.delete(name)
+
+    def iter_objects(self, batch_size):
+        """Yields the stored files in batches of ``StoredObject``."""
+        for batch in scan_batches(self.root, batch_size):
+            objects = []
+            for entry in batch:
+                stat = entry.stat(follow_symlinks=False)
+                objects.append(StoredObject(entry.name, stat.st_size, stat.st_mtime))
+            yield objects
+
+    def send(self, name):
+        """Builds the response for a file route; aborts with 404 if the file is missing."""
+        path = self.path(name)
+        if path is None:
+            abort(404)
+        relative = os.path.relpath(path, self.root)
+        if not self.accel_prefix:
+            return send_from_directory(self.root, relative)
+
+        response = current_app.response_class(mimetype=_guess_mimetype(name))
+        response.headers['X-Accel-Redirect'] = '/'.join(
+            [self.accel_prefix, os.path.basename(self.root)] + relative.split(os.sep))
+        return response
+
+
+class S3Storage:
+    """
+    Stores files in an S3-compatible bucket.
+
+    Args:
+        client: The boto3 S3 client used for all requests.
+        bucket (str): The bucket name.
+        prefix (str): Key prefix for this upload folder, ending with ``/``.
+        redirects (bool): Answer file routes with a presigned URL redirect
+            instead of streaming the object through the worker.
+        expires (int): Lifetime of presigned URLs in seconds.
+        signing_client: Client used to presign URLs; differs from ``client``
+            when browsers reach the service under another host name.
+    """
+
+    def __init__(self, client, bucket, prefix, redirects=True, expires=300, signing_client=None):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.redirects = redirects
+        self.expires = expires
+        self.signing_client = signing_client or client
+
+    def key(self, name):
+        return f"{self.prefix}{name}"
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        """Returns a stored object's size in bytes; raises FileNotFoundError if missing."""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(name)
+            raise
+        return head['ContentLength']
+
+    def open(self, name):
+        """Downloads a stored object into memory; raises FileNotFoundError if missing."""
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(name)
+        return io.BytesIO(obj['Body'].read())
+
+    def put_file(self, local_path, name):
+        """Uploads a local file (normally a staged upload) and removes the local copy."""
+        self.client.upload_file(local_path, self.bucket, self.key(name),
+                                ExtraArgs={'ContentType': _guess_mimetype(name)})
+        os.remove(local_path)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def delete_many(self, names):
+        """Deletes objects with one request per 1000 keys."""
+        names = list(names)
+        for start in range(0, len(names), 1000):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.key(name)} for name in names[start:start + 1000]],
+                'Quiet': True,
+            })
+            for failure in response.get('Errors', []):
+                logger.error(f"Error deleting {failure['Key']} from {self.bucket}: {failure.get('Message')}")
+
+    def iter_objects(self, batch_size):
+        """Yields the stored objects in batches of ``StoredObject``."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket, Prefix=self.prefix,
+                                   PaginationConfig={'PageSize': batch_size})
+        for page in pages:
+            objects = [StoredObject(obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp())
+                       for obj in page.get('Contents', [])]
+            if objects:
+                yield objects
+
+    def send(self, name):
+        """
+        Builds the response for a file route.
+
+        In redirect mode the object is not looked up first; a missing object
+        is reported by the storage service when the client follows the URL.
+        """
+        if self.redirects:
+            url = self.signing_client.generate_presigned_url(
+                'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=self.expires)
+            response = redirect(url, code=302)
+            # Let browsers reuse the redirect, but never beyond the URL's lifetime.
+            response.headers['Cache-Control'] = f"private, max-age={self.expires // 2}"
+            return response
+
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.NoSuchKey:
+            abort(404)
+        body = obj['Body']
+        response = current_app.response_class(
+            stream_with_context(body.iter_chunks(64 * 1024)),
+            mimetype=obj.get('ContentType') or _guess_mimetype(name))
+        response.content_length = obj['ContentLength']
+        response.call_on_close(body.close)
+        return response
+
+
+def _s3_client(config, endpoint_url):
+    if boto3 is None:
+        raise RuntimeError("STORAGE_BACKEND = 's3' requires the boto3 package")
+    return boto3.client(
+        's3',
+        endpoint_url=endpoint_url or None,
+        region_name=config['STORAGE_S3_REGION'] or None,
+        aws_access_key_id=config['STORAGE_S3_ACCESS_KEY'] or None,
+        aws_secret_access_key=config['STORAGE_S3_SECRET_KEY'] or None,
+        config=BotoConfig(signature_version='s3v4',
+                          s3={'addressing_style': config['STORAGE_S3_ADDRESSING_STYLE']}),
+    )
+
+
+def _create_storage(app, upload_folder):
+    config = app.config
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        local = LocalStorage(upload_folder, config['STORAGE_LOCAL_ACCEL_PREFIX'])
+        if config['IMAGE_PACKS'] and upload_folder == config['UPLOAD_FOLDER_IMAGES']:
+            from app.segments import PackedStorage
+            return PackedStorage(upload_folder, local, config['IMAGE_PACK_MAX_BLOB'],
+                                 config['IMAGE_PACK_SEGMENT_SIZE'])
+        return local
+    if backend != 's3':
+        raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}; expected one of {', '.join(BACKENDS)}")
+
+    # boto3 clients are thread-safe, so all folders of the app share them.
+    clients = app.extensions.get('storage_s3_clients')
+    if clients is None:
+        client = _s3_client(config, config['STORAGE_S3_ENDPOINT_URL'])
+        public_url = config['STORAGE_S3_PUBLIC_URL']
+        clients = app.extensions['storage_s3_clients'] = (
+            client, _s3_client(config, public_url) if public_url else client)
+    client, signing_client = clients
+
+    prefix = f"{config['STORAGE_S3_PREFIX']}{os.path.basename(os.path.normpath(upload_folder))}/"
+    return S3Storage(client, config['STORAGE_S3_BUCKET'], prefix,
+                     redirects=config['STORAGE_REDIRECTS'],
+                     expires=config['STORAGE_SIGNED_URL_EXPIRES'],
+                     signing_client=signing_client)
+
+
+def get_storage(upload_folder):
+    """
+    Returns the storage driver for an upload folder of the current app.
+
+    Args:
+        upload_folder (str): One of the configured ``UPLOAD_FOLDER_*`` paths.
+
+    Returns:
+        LocalStorage | S3Storage: The driver; created on first use and cached on the app.
+    """
+    app = current_app._get_current_object()
+    drivers = app.extensions.setdefault('storage', {})
+    driver = drivers.get(upload_folder)
+    if driver is None:
+        driver = drivers[upload_folder] = _create_storage(app, upload_folder)
+    return driver
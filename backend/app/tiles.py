@@ -0,0 +1,438 @@
+"""
+Deep-zoom tile pyramids of large images.
+
+With ``IMAGE_TILES`` enabled, every committed image whose longer side
+exceeds ``IMAGE_TILE_MIN_DIMENSION`` pixels is cut into a Deep Zoom (DZI)
+pyramid, so a viewer zoomed into a small region of an 8k SEM capture only
+downloads and decodes the tiles it shows:
+
+* level ``max_level`` is the full image, where ``max_level`` is
+  ``ceil(log2(longer side))``; every level below halves the previous one,
+  down to a single pixel at level 0;
+* each level is cut into ``IMAGE_TILE_SIZE`` pixel tiles, extended by
+  ``IMAGE_TILE_OVERLAP`` pixels into their neighbours, and encoded as
+  ``IMAGE_TILE_FORMAT`` at ``IMAGE_TILE_QUALITY``.
+
+``GET /images/<name>/tiles`` returns the pyramid's DZI descriptor (its
+``Url`` attribute points at the tiles, so OpenSeadragon can open it as is)
+and ``GET /images/<name>/tiles/<level>/<x>_<y>`` a tile. The page served at
+``/`` uses them in its image viewer and falls back to the whole image for
+images without a pyramid.
+
+Tiles are stored in ``UPLOAD_FOLDER_TILES`` through the configured storage
+driver, as ``<name>_<level>_<x>_<y>.<ext>`` next to the descriptor
+``<name>.dzi``. The descriptor is written last, so a pyramid is only served
+once it is complete. Decoding, resampling and encoding are CPU-bound and run
+on a pool of ``IMAGE_TILE_WORKERS`` processes; a thread per worker moves the
+image and its tiles between storage and the pool. With image normalization
+enabled, the pyramid is cut from the original upload by the normalization
+job, before the original is re-encoded: normalized images are capped at
+``IMAGE_MAX_DIMENSION``, which would leave nothing to zoom into. Like
+normalization, tiling jobs are recorded in ``image_job`` (see
+``app/imaging.py``), so ``flask files resume`` runs the jobs of a restarted
+or recycled worker.
+
+Every gunicorn worker process starts its own pools on its first job, so a
+server may run up to ``workers * IMAGE_TILE_WORKERS`` tiling processes, each
+holding a decoded image. Tiling is therefore off by default.
+
+Pyramids are deleted with their image, and ``flask files gc`` removes those
+of images no row references. ``flask files tiles`` builds the pyramids of
+images stored before tiling was enabled.
+
+Pillow is an optional dependency. Without it no pyramids are built.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+from flask import current_app
+from sqlalchemy import or_, select
+
+from app import db, filemeta
+from app.models import DefectMode
+from app.storage import get_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+DESCRIPTOR_EXTENSION = '.dzi'
+# Pillow format -> tile file extension
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+_TILE = re.compile(r'^(\d+)_(\d+)(?:\.(\w+))?$')
+_TILE_NAME = re.compile(r'^(.+)_\d+_\d+_\d+\.\w+$')
+
+_threads = None
+_processes = None
+_pools_lock = threading.Lock()
+
+
+def tiling_enabled(config):
+    """Returns True if large images should get a tile pyramid."""
+    return bool(config.get('IMAGE_TILES')) and Image is not None
+
+
+def needs_pyramid(config, width, height):
+    """Returns True if an image of these dimensions is large enough to tile (unknown dimensions are checked later)."""
+    if width is None or height is None:
+        return True
+    return max(width, height) > config['IMAGE_TILE_MIN_DIMENSION']
+
+
+def descriptor_name(filename):
+    """Returns the stored name of an image's DZI descriptor."""
+    return f"{filename}{DESCRIPTOR_EXTENSION}"
+
+
+def tile_name(filename, level, column, row, extension):
+    """Returns the stored name of one tile of an image's pyramid."""
+    return f"{filename}_{level}_{column}_{row}.{extension}"
+
+
+def image_of(name):
+    """Returns the image a stored descriptor or tile belongs to (for ``flask files gc``)."""
+    if name.endswith(DESCRIPTOR_EXTENSION):
+        return name[:-len(DESCRIPTOR_EXTENSION)]
+    match = _TILE_NAME.match(name)
+    return match.group(1) if match else name
+
+
+def max_level(width, height):
+    """Returns the level of the full-size image: ``ceil(log2(longer side))``."""
+    return (max(width, height) - 1).bit_length()
+
+
+def level_size(width, height, level):
+    """Returns the pixel size of a pyramid level."""
+    scale = 2 ** (max_level(width, height) - level)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def tile_box(column, row, level_width, level_height, tile_size, overlap):
+    """Returns the ``(left, top, right, bottom)`` crop of a tile within its level."""
+    left = column * tile_size - (overlap if column else 0)
+    top = row * tile_size - (overlap if row else 0)
+    return (left, top, min((column + 1) * tile_size + overlap, level_width),
+            min((row + 1) * tile_size + overlap, level_height))
+
+
+def grid(width, height, level, tile_size):
+    """Returns the number of tile columns and rows of a level."""
+    level_width, level_height = level_size(width, height, level)
+    return math.ceil(level_width / tile_size), math.ceil(level_height / tile_size)
+
+
+def build_pyramid(src_path, out_dir, filename, tile_size, overlap, image_format, quality):
+    """
+    Cuts every level of an image into tiles; runs on the process pool.
+
+    Each level is resampled from the one above it, so the full image is
+    decoded once.
+
+    Args:
+        src_path (str): The image to tile.
+        out_dir (str): Directory the tiles are written to, under their stored names.
+        filename (str): The image's stored name, for the tile names.
+        tile_size (int): Tile width and height in pixels, without overlap.
+        overlap (int): Pixels each tile extends into its neighbours.
+        image_format (str): The Pillow tile format.
+        quality (int): Encoder quality (ignored by lossless formats).
+
+    Returns:
+        tuple[int, int, list[str]]: The image's width and height and the tile names written.
+    """
+    extension = FORMAT_EXTENSIONS[image_format]
+    names = []
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            # Palette images keep their transparency in img.info, not in a band.
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        if image_format == 'JPEG' and img.mode == 'RGBA':
+            img = img.convert('RGB')
+        width, height = img.size
+        level_image = img
+        for level in range(max_level(width, height), -1, -1):
+            level_width, level_height = level_size(width, height, level)
+            if level_image.size != (level_width, level_height):
+                level_image = level_image.resize((level_width, level_height), Image.Resampling.LANCZOS)
+            columns, rows = grid(width, height, level, tile_size)
+            for column in range(columns):
+                for row in range(rows):
+                    name = tile_name(filename, level, column, row, extension)
+                    tile = level_image.crop(tile_box(column, row, level_width, level_height, tile_size, overlap))
+                    tile.save(os.path.join(out_dir, name), format=image_format, quality=quality)
+                    names.append(name)
+    return width, height, names
+
+
+def descriptor_xml(filename, width, height, tile_size, overlap, extension):
+    """Returns the DZI descriptor of an image's pyramid."""
+    image = ElementTree.Element('Image', {
+        'xmlns': DZI_NAMESPACE,
+        'Url': f"/images/{quote(filename)}/tiles/",
+        'Format': extension,
+        'Overlap': str(overlap),
+        'TileSize': str(tile_size),
+    })
+    ElementTree.SubElement(image, 'Size', {'Width': str(width), 'Height': str(height)})
+    return b'<?xml version="1.0" encoding="UTF-8"?>\n' + ElementTree.tostring(image)
+
+
+def parse_descriptor(data):
+    """Reads a stored descriptor into ``width``, ``height``, ``tile_size``, ``overlap`` and ``format``."""
+    image = ElementTree.fromstring(data)
+    size = image.find(f"{{{DZI_NAMESPACE}}}Size")
+    return {'width': int(size.get('Width')), 'height': int(size.get('Height')),
+            'tile_size': int(image.get('TileSize')), 'overlap': int(image.get('Overlap')),
+            'format': image.get('Format')}
+
+
+def _storage():
+    return get_storage(current_app.config['UPLOAD_FOLDER_TILES'])
+
+
+def _read_descriptor(filename):
+    """Returns the raw descriptor of an image's pyramid, or None if it has none."""
+    try:
+        with _storage().open(descriptor_name(filename)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _get_cache(app):
+    """Returns the app's descriptor cache; entries live as long as file metadata ones."""
+    cache = app.extensions.get('tile_descriptors')
+    if cache is None:
+        cache = app.extensions['tile_descriptors'] = filemeta.MetadataCache(
+            app.config['FILE_METADATA_CACHE_SIZE'], app.config['FILE_METADATA_CACHE_TTL'])
+    return cache
+
+
+def lookup(filename):
+    """
+    Returns the descriptor of an image's pyramid, or None if it has none.
+
+    Args:
+        filename (str): The image's stored name.
+
+    Returns:
+        dict: ``xml`` (the stored descriptor) plus the fields of ``parse_descriptor``.
+    """
+    cache = _get_cache(current_app)
+    hit, descriptor = cache.get(filename)
+    if not hit:
+        data = _read_descriptor(filename)
+        descriptor = dict(parse_descriptor(data), xml=data) if data else None
+        cache.put(filename, descriptor)
+    return descriptor
+
+
+def tile_for(descriptor, filename, level, tile):
+    """
+    Resolves a tile request against a pyramid.
+
+    Args:
+        descriptor (dict): The pyramid's ``lookup`` result.
+        filename (str): The image's stored name.
+        level (int): The pyramid level.
+        tile (str): ``<x>_<y>``, optionally followed by the tile format's extension.
+
+    Returns:
+        str: The tile's stored name, or None if the pyramid has no such tile.
+    """
+    match = _TILE.match(tile)
+    if not match or (match.group(3) and match.group(3) != descriptor['format']):
+        return None
+    column, row = int(match.group(1)), int(match.group(2))
+    width, height = descriptor['width'], descriptor['height']
+    if level > max_level(width, height):
+        return None
+    columns, rows = grid(width, height, level, descriptor['tile_size'])
+    if column >= columns or row >= rows:
+        return None
+    return tile_name(filename, level, column, row, descriptor['format'])
+
+
+def _get_pools(workers):
+    """Creates the pools lazily so they are not shared across forked workers."""
+    global _threads, _processes
+    with _pools_lock:
+        if _processes is None:
+            # Spawned, not forked: the server process runs threads.
+            _processes = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-tiles')
+    return _threads, _processes
+
+
+def _is_referenced(filename):
+    return db.session.execute(
+        select(DefectMode.id).where(DefectMode.image_filename == filename).limit(1)).first() is not None
+
+
+def build_stored_pyramid(filename, source=None):
+    """
+    Builds and stores the pyramid of a stored image, replacing any previous one.
+
+    Args:
+        filename (str): The image's stored name.
+        source (str): The stored image to cut instead, e.g. the original of a normalized image.
+
+    Returns:
+        int: The number of tiles stored; 0 if the image is missing, too small or no longer used.
+    """
+    config = current_app.config
+    image_format = config['IMAGE_TILE_FORMAT']
+    scratch = tempfile.mkdtemp(prefix='wdl-tiles-')
+    try:
+        src_path = os.path.join(scratch, 'source')
+        try:
+            with get_storage(config['UPLOAD_FOLDER_IMAGES']).open(source or filename) as src, \
+                    open(src_path, 'wb') as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        except FileNotFoundError:
+            # The image was deleted before the job ran.
+            return 0
+        with Image.open(src_path) as img:
+            if not needs_pyramid(config, *img.size):
+                return 0
+
+        _, processes = _get_pools(config['IMAGE_TILE_WORKERS'])
+        width, height, names = processes.submit(
+            build_pyramid, src_path, scratch, filename, config['IMAGE_TILE_SIZE'],
+            config['IMAGE_TILE_OVERLAP'], image_format, config['IMAGE_TILE_QUALITY']).result()
+
+        storage = _storage()
+        previous = _read_descriptor(filename)
+        for name in names:
+            storage.put_file(os.path.join(scratch, name), name)
+        descriptor_path = os.path.join(scratch, descriptor_name(filename))
+        with open(descriptor_path, 'wb') as f:
+            f.write(descriptor_xml(filename, width, height, config['IMAGE_TILE_SIZE'],
+                                   config['IMAGE_TILE_OVERLAP'], FORMAT_EXTENSIONS[image_format]))
+        storage.put_file(descriptor_path, descriptor_name(filename))
+        _get_cache(current_app).forget(filename)
+        if previous:
+            # Re-encoded in place with other dimensions or settings: drop tiles the new pyramid lacks.
+            storage.delete_many(sorted(set(_tile_names(filename, parse_descriptor(previous))) - set(names)))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    # The mode may have been deleted or given another image meanwhile.
+    referenced = _is_referenced(filename)
+    db.session.rollback()
+    if not referenced:
+        delete_pyramids([filename])
+        return 0
+    return len(names)
+
+
+def build_job(app, filename):
+    """Worker thread job: builds the pyramid of a committed image."""
+    with app.app_context():
+        try:
+            tiles = build_stored_pyramid(filename)
+            if tiles:
+                logger.info(f"Stored {tiles} tiles of image {filename}")
+        except Exception as e:
+            logger.error(f"Error tiling image {filename}: {e}")
+
+
+def submit(app, job, *args):
+    """Runs ``job(*args)`` on the tiling threads, e.g. ``build_job`` wrapped by its ``image_job`` row."""
+    threads, _ = _get_pools(app.config['IMAGE_TILE_WORKERS'])
+    threads.submit(job, *args)
+
+
+def _tile_names(filename, descriptor):
+    extension = descriptor['format']
+    width, height = descriptor['width'], descriptor['height']
+    for level in range(max_level(width, height) + 1):
+        columns, rows = grid(width, height, level, descriptor['tile_size'])
+        for column in range(columns):
+            for row in range(rows):
+                yield tile_name(filename, level, column, row, extension)
+
+
+def delete_pyramids(filenames):
+    """
+    Deletes the pyramids of images, descriptor first so they stop being served.
+
+    Args:
+        filenames (list[str]): The images' stored names; those without a pyramid are skipped.
+    """
+    storage = _storage()
+    cache = _get_cache(current_app)
+    for filename in filenames:
+        data = _read_descriptor(filename)
+        if data is None:
+            continue
+        storage.delete(descriptor_name(filename))
+        cache.forget(filename)
+        storage.delete_many(list(_tile_names(filename, parse_descriptor(data))))
+
+
+def backfill(batch_size=500, refresh=False):
+    """
+    Builds the missing pyramids of stored images large enough to tile.
+
+    Images are read in mode id order, ``batch_size`` rows per query, and
+    tiled ``IMAGE_TILE_WORKERS`` at a time.
+
+    Args:
+        batch_size (int): Rows read per query.
+        refresh (bool): Rebuild pyramids that already exist.
+
+    Returns:
+        dict: Numbers of images tiled and tiles stored.
+    """
+    app = current_app._get_current_object()
+    threads, _ = _get_pools(app.config['IMAGE_TILE_WORKERS'])
+    min_dimension = app.config['IMAGE_TILE_MIN_DIMENSION']
+    report = {'images': 0, 'tiles': 0}
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(DefectMode.id, DefectMode.image_filename)
+            .where(DefectMode.id > last_id, DefectMode.image_filename.isnot(None),
+                   # Rows without recorded dimensions are checked when tiled.
+                   or_(DefectMode.image_width.is_(None), DefectMode.image_height.is_(None),
+                       DefectMode.image_width > min_dimension, DefectMode.image_height > min_dimension))
+            .order_by(DefectMode.id).limit(batch_size)).all()
+        db.session.rollback()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        filenames = list(dict.fromkeys(filename for _, filename in rows))
+        if not refresh:
+            filenames = [filename for filename in filenames if _read_descriptor(filename) is None]
+        for tiles in threads.map(lambda filename: _backfill_job(app, filename), filenames):
+            if tiles:
+                report['images'] += 1
+                report['tiles'] += tiles
+    return report
+
+
+def _backfill_job(app, filename):
+    with app.app_context():
+        try:
+            return build_stored_pyramid(filename)
+        except Exception as e:
+            logger.error(f"Error tiling image {filename}: {e}")
+            return 0
@@ -0,0 +1,217 @@
+"""
+Resumable chunked uploads.
+
+An unreliable client uploads a defect in steps instead of one multipart body:
+
+1. ``POST /admin/uploads`` declares the files (name, size, optional SHA-256)
+   and returns an upload id.
+2. ``PUT /admin/uploads/<id>/files/<index>?offset=N`` sends a chunk with its
+   SHA-256 in ``X-Chunk-SHA256``. Chunks are written straight into the
+   file's part in the staging area. ``GET /admin/uploads/<id>`` reports how
+   many bytes of every file have arrived, so an interrupted client resumes
+   from there instead of starting over.
+3. ``POST /admin/uploads/<id>/finalize`` with an ``Idempotency-Key`` header
+   creates the defect from the parts, exactly like ``/admin/upload``. The key
+   is stored in the same transaction as the defect, so a retry after a lost
+   response gets the first result rather than a duplicate.
+
+A session is a directory under ``sessions_folder`` (inside the PDF staging
+area): ``manifest.json``, one ``<index>.part`` per file and a lock file. A
+part's size is the number of bytes received. Chunk writes and finalize
+``flock`` the session, so they are serialized across worker processes.
+Finalize hard-links the parts into staging (see ``stage_local_file``), so a
+failed finalize keeps the bytes already received. ``flask files gc`` removes
+sessions idle for ``UPLOAD_SESSION_TTL_HOURS``.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from app.staging import staging_folder
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+SESSIONS_DIRNAME = 'sessions'
+MANIFEST_FILENAME = 'manifest.json'
+LOCK_FILENAME = 'lock'
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class SessionNotFound(LookupError):
+    """Raised for an unknown, expired or already finalized upload session, or an unknown file index."""
+
+
+class InvalidChunk(ValueError):
+    """Raised when a chunk fails its checksum or does not fit the declared file."""
+
+
+class OffsetConflict(ValueError):
+    """Raised when a chunk starts past the bytes received so far; ``received`` is where to resume."""
+
+    def __init__(self, received):
+        super().__init__(f'Expected a chunk at offset {received} or earlier')
+        self.received = received
+
+
+def sessions_folder(config):
+    """Returns the directory holding the upload sessions."""
+    return os.path.join(staging_folder(config['UPLOAD_FOLDER_PDFS']), SESSIONS_DIRNAME)
+
+
+def _session_dir(root, upload_id):
+    if not _UPLOAD_ID.match(upload_id):
+        raise SessionNotFound(upload_id)
+    return os.path.join(root, upload_id)
+
+
+def part_path(root, upload_id, index):
+    """Returns the path of a file's part."""
+    return os.path.join(_session_dir(root, upload_id), f'{index}.part')
+
+
+def create_session(root, files):
+    """
+    Creates an upload session.
+
+    Args:
+        root (str): The sessions folder.
+        files (list[dict]): The declared files, each with ``filename``, ``size`` and ``sha256`` (or None).
+
+    Returns:
+        dict: The session (see ``session_status``).
+    """
+    upload_id = uuid.uuid4().hex
+    directory = os.path.join(root, upload_id)
+    os.makedirs(directory)
+    for index in range(len(files)):
+        open(os.path.join(directory, f'{index}.part'), 'wb').close()
+    manifest = {'id': upload_id, 'created': time.time(), 'files': files}
+    # Written last: a session without a manifest does not exist yet.
+    with open(os.path.join(directory, MANIFEST_FILENAME + '.tmp'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(directory, MANIFEST_FILENAME + '.tmp'), os.path.join(directory, MANIFEST_FILENAME))
+    return _with_received(root, manifest)
+
+
+def _with_received(root, manifest):
+    manifest['received'] = []
+    for index in range(len(manifest['files'])):
+        try:
+            manifest['received'].append(os.path.getsize(part_path(root, manifest['id'], index)))
+        except FileNotFoundError:
+            raise SessionNotFound(manifest['id'])
+    return manifest
+
+
+def _load(root, upload_id):
+    try:
+        with open(os.path.join(_session_dir(root, upload_id), MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise SessionNotFound(upload_id)
+    return _with_received(root, manifest)
+
+
+def session_status(root, upload_id):
+    """
+    Returns a session's manifest with the bytes received per file.
+
+    Returns:
+        dict: ``id``, ``created``, ``files`` (as declared) and ``received`` (bytes per file).
+
+    Raises:
+        SessionNotFound: If the session does not exist.
+    """
+    return _load(root, upload_id)
+
+
+@contextmanager
+def session_lock(root, upload_id):
+    """
+    Holds a session's lock, serializing chunk writes and finalize across processes.
+
+    Yields:
+        dict: The session as of acquiring the lock (see ``session_status``).
+
+    Raises:
+        SessionNotFound: If the session does not exist, or was finalized while waiting for the lock.
+    """
+    directory = _session_dir(root, upload_id)
+    try:
+        fd = os.open(os.path.join(directory, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        raise SessionNotFound(upload_id)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield _load(root, upload_id)
+    finally:
+        os.close(fd)
+
+
+def write_chunk(root, upload_id, index, offset, data, sha256):
+    """
+    Writes a chunk into a file's part.
+
+    A chunk may start anywhere up to the bytes received so far, so a chunk
+    whose response was lost can simply be sent again.
+
+    Args:
+        root (str): The sessions folder.
+        upload_id (str): The session.
+        index (int): The file within the session.
+        offset (int): Where the chunk starts in the file.
+        data (bytes): The chunk.
+        sha256 (str): The chunk's SHA-256, hex encoded.
+
+    Returns:
+        int: The bytes of the file received so far.
+
+    Raises:
+        SessionNotFound: If the session or file does not exist.
+        InvalidChunk: If the checksum does not match or the chunk runs past the declared size.
+        OffsetConflict: If the chunk starts past the bytes received.
+    """
+    if hashlib.sha256(data).hexdigest() != sha256.lower():
+        raise InvalidChunk('Chunk checksum mismatch')
+    with session_lock(root, upload_id) as session:
+        if not 0 <= index < len(session['files']):
+            raise SessionNotFound(f'{upload_id}/{index}')
+        received = session['received'][index]
+        if offset > received:
+            raise OffsetConflict(received)
+        if offset + len(data) > session['files'][index]['size']:
+            raise InvalidChunk('Chunk extends past the declared file size')
+        with open(part_path(root, upload_id, index), 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        return max(received, offset + len(data))
+
+
+def reset_part(root, upload_id, index):
+    """Discards a file's received bytes, e.g. after its full-file checksum failed."""
+    with open(part_path(root, upload_id, index), 'wb'):
+        pass
+
+
+def remove_session(root, upload_id):
+    """Deletes a session and its parts."""
+    shutil.rmtree(_session_dir(root, upload_id), ignore_errors=True)
+
+
+def session_mtime(directory):
+    """Returns the time of a session's last chunk (or its creation), for expiry."""
+    mtimes = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            mtimes.append(entry.stat(follow_symlinks=False).st_mtime)
+    return max(mtimes, default=0)
@@ -1,6 +1,8 @@
 import os
 import uuid
 from werkzeug.utils import secure_filename
+from app.staging import staging_folder
+from app.storage import get_storage
 
 def save_file(file, upload_folder):
     """
@@ -16,16 +18,17 @@ def save_file(file, upload_folder):
     if not file:
         return None
 
-    # Ensure the upload folder exists
-    os.makedirs(upload_folder, exist_ok=True)
+    # Write to the local staging area first, then hand the file to the storage backend
+    staging = staging_folder(upload_folder)
+    os.makedirs(staging, exist_ok=True)
 
     # Generate a unique filename using UUID
     filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
-    filepath = os.path.join(upload_folder, filename)
+    filepath = os.path.join(staging, filename)
 
-    # Save the file to the filesystem
     try:
         file.save(filepath)
+        get_storage(upload_folder).put_file(filepath, filename)
     except Exception as e:
         print(f"Error saving file: {e}")
         return None
@@ -41,7 +44,7 @@ def delete_file(upload_folder, filename):
         filename (str): The name of the file to delete.
     """
     try:
-        os.remove(os.path.join(upload_folder, filename))
-    except OSError as e:
+        get_storage(upload_folder).delete(filename)
+    except Exception as e:
         print(f"Error deleting file: {e}")
         pass  # Ignore errors if the file doesn't exist or can't be deleted
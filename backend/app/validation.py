@@ -26,3 +26,30 @@ def strip_or_none(value):
         str: The stripped string or None.
     """
     return value.strip() if value and isinstance(value, str) else None
+
+# Leading bytes ("magic numbers") of the file types accepted for upload
+FILE_SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'pdf': (b'%PDF-',),
+}
+
+def has_valid_signature(filename, head, allowed_set):
+    """
+    Checks that a file's leading bytes match its (allowed) extension.
+
+    Args:
+        filename (str): The name of the file.
+        head (bytes): The first bytes of the file (at least 8).
+        allowed_set (set): A set of allowed file extensions.
+
+    Returns:
+        bool: True if the extension is allowed and the content matches it, False otherwise.
+    """
+    if not validate_file(filename, allowed_set):
+        return False
+    signatures = FILE_SIGNATURES.get(filename.rsplit('.', 1)[1].lower())
+    if signatures is None:
+        return True  # No known signature for this type; the extension check has to do
+    return any(head.startswith(signature) for signature in signatures)
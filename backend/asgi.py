@@ -0,0 +1,9 @@
+import os
+from app.asgi import create_asgi_app
+
+# Set environment variable for production
+os.environ.setdefault('FLASK_ENV', 'production')
+
+# ASGI entrypoint: `uvicorn asgi:app --workers N`, or
+# `gunicorn asgi:app -k uvicorn.workers.UvicornWorker` (see app/asgi.py)
+app = create_asgi_app()
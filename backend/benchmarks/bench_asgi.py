@@ -0,0 +1,214 @@
+"""
+Benchmark concurrent reads on the sync (gunicorn) and ASGI (uvicorn) deployments.
+
+Seeds a throw-away SQLite database and upload folders, then starts each
+server with a single worker process, so the results are per core:
+
+* ``sync``: ``wsgi:app`` on gunicorn with ``gthread`` workers and
+  ``--threads`` threads, as in ``gunicorn_config.py``;
+* ``asgi``: ``asgi:app`` on uvicorn (see ``app/asgi.py``).
+
+For every ``--connections`` level, that many keep-alive connections
+repeatedly fetch an image, a PDF, a defect and a search for ``--duration``
+seconds. They read bodies at ``--client-kbps`` to model slow links, which is
+where one thread per connection runs out. Run from the ``backend`` folder:
+
+    python -m benchmarks.bench_asgi --connections 10 100 500 --duration 10 --client-kbps 256
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+PDF_HEADER = b'%PDF-1.4\n'
+CHUNK = 16 * 1024
+
+
+def _make_app(root):
+    # Config reads DATABASE_URL at import time, so set it before importing the app.
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(root, 'bench.db')}"
+    os.environ.setdefault('ADMISSION_CONTROL', 'false')
+    os.environ.setdefault('CHANGES_LOG_PATH', os.path.join(root, 'changes.db'))
+    from app import create_app, db
+
+    app = create_app()
+    app.config.update(
+        UPLOAD_FOLDER_IMAGES=os.path.join(root, 'images'),
+        UPLOAD_FOLDER_PDFS=os.path.join(root, 'pdfs'),
+        IMAGE_NORMALIZE=False,
+    )
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _seed(root, defects, image_kb):
+    app = _make_app(root)
+    client = app.test_client()
+    for i in range(defects):
+        response = client.post('/admin/upload', content_type='multipart/form-data', data={
+            'defect_name': f'Benchmark defect {i}',
+            'defect_modes': json.dumps(['mode 0', 'mode 1']),
+            'descriptions': ['benchmark description 0', 'benchmark description 1'],
+            'images': [(io.BytesIO(PNG_HEADER + os.urandom(image_kb * 1024)), 'mode.png')],
+            'pdf': (io.BytesIO(PDF_HEADER + os.urandom(image_kb * 1024)), 'report.pdf'),
+        })
+        if response.status_code != 200:
+            raise RuntimeError(response.get_json())
+    defect = client.get('/defect/1').get_json()
+    return ['/defect/1', '/defect/search?query=mode', defect['modes'][0]['image_url'], defect['pdf_url']]
+
+
+def _serve(kind, root, port, threads):
+    """Runs one server in this process (the ``--serve`` mode of this script)."""
+    app = _make_app(root)
+    if kind == 'asgi':
+        import uvicorn
+        from app.asgi import AsgiApp
+
+        uvicorn.run(AsgiApp(app), host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in {'bind': f'127.0.0.1:{port}', 'workers': 1, 'worker_class': 'gthread',
+                               'threads': threads, 'backlog': 4096, 'loglevel': 'warning',
+                               'worker_connections': 100000}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+async def _fetch(reader, writer, path, delay_per_chunk):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while length > 0:
+        chunk = await reader.read(min(CHUNK, length))
+        if not chunk:
+            raise ConnectionError('connection closed mid-body')
+        length -= len(chunk)
+        if delay_per_chunk:
+            await asyncio.sleep(delay_per_chunk * len(chunk) / CHUNK)
+    return status
+
+
+async def _connection(port, paths, deadline, delay_per_chunk, latencies, errors, offset):
+    reader = writer = None
+    i = offset
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=1024 * 1024)
+            status = await asyncio.wait_for(_fetch(reader, writer, paths[i % len(paths)], delay_per_chunk), 30)
+            if status != 200:
+                raise ConnectionError(f'HTTP {status}')
+            latencies.append(time.monotonic() - start)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            errors.append(1)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.1)
+        i += 1
+    if writer is not None:
+        writer.close()
+
+
+async def _load(port, paths, connections, duration, client_kbps):
+    latencies, errors = [], []
+    delay_per_chunk = CHUNK / (client_kbps * 1024) if client_kbps else 0
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(_connection(port, paths, deadline, delay_per_chunk, latencies, errors, i)
+                           for i in range(connections)))
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--client-kbps', type=int, default=256, help='Per-connection read rate; 0 for unlimited.')
+    parser.add_argument('--defects', type=int, default=20)
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--threads', type=int, default=64, help='gthread threads of the sync worker.')
+    parser.add_argument('--servers', nargs='+', default=['sync', 'asgi'], choices=['sync', 'asgi'])
+    parser.add_argument('--serve', choices=['sync', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        _serve(args.serve, args.root, args.port, args.threads)
+        return
+
+    # Every connection is a file descriptor on both ends.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    root = tempfile.mkdtemp(prefix='wdl-asgi-')
+    try:
+        paths = _seed(root, args.defects, args.image_kb)
+        print(f"1 worker each, {args.client_kbps or 'unlimited'} KiB/s per connection, {args.duration:.0f}s per run")
+        print(f"{'server':<6} {'conns':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for kind in args.servers:
+            port = _free_port()
+            server = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_asgi', '--serve', kind,
+                                       '--root', root, '--port', str(port), '--threads', str(args.threads)])
+            try:
+                _wait_for_port(port)
+                for connections in args.connections:
+                    latencies, errors = asyncio.run(_load(port, paths, connections, args.duration, args.client_kbps))
+                    latencies.sort()
+                    p50 = statistics.median(latencies) * 1000 if latencies else float('nan')
+                    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else float('nan')
+                    print(f"{kind:<6} {connections:>6} {len(latencies) / args.duration:>8.1f} "
+                          f"{p50:>8.1f} {p99:>8.1f} {len(errors):>7}")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
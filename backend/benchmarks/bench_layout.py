@@ -0,0 +1,78 @@
+"""
+Benchmark file lookups in the flat and sharded upload layouts.
+
+Creates N empty files in a temporary directory under each layout and times
+the existence check ``serve_image`` performs for hits and misses. Run from
+the ``backend`` folder:
+
+    python -m benchmarks.bench_layout --files 200000 --lookups 20000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from app.layout import shard_dirs
+
+
+def _path(root, name, layout):
+    if layout == 'sharded':
+        return os.path.join(root, *shard_dirs(name), name)
+    return os.path.join(root, name)
+
+
+def _populate(root, names, layout):
+    for name in names:
+        path = _path(root, name, layout)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb'):
+            pass
+
+
+def _time_lookups(root, names, layout):
+    start = time.perf_counter()
+    for name in names:
+        os.path.isfile(_path(root, name, layout))
+    return (time.perf_counter() - start) / len(names) * 1e6
+
+
+def _time_listing(root):
+    start = time.perf_counter()
+    count = 0
+    for _, _, files in os.walk(root):
+        count += len(files)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--dir', default=None, help='Parent directory for the test trees.')
+    args = parser.parse_args()
+
+    names = [f"{uuid.uuid4().hex}_image.png" for _ in range(args.files)]
+    hits = random.sample(names, min(args.lookups, len(names)))
+    misses = [f"{uuid.uuid4().hex}_missing.png" for _ in range(args.lookups)]
+
+    print(f"{args.files} files, {args.lookups} lookups")
+    print(f"{'layout':<8} {'hit us':>8} {'miss us':>8} {'walk s':>8}")
+    for layout in ('flat', 'sharded'):
+        root = tempfile.mkdtemp(prefix=f"wdl-{layout}-", dir=args.dir)
+        try:
+            _populate(root, names, layout)
+            # Warm the dentry cache so both layouts are measured the same way.
+            _time_lookups(root, hits[:1000], layout)
+            hit = _time_lookups(root, hits, layout)
+            miss = _time_lookups(root, misses, layout)
+            walk = _time_listing(root)
+            print(f"{layout:<8} {hit:>8.2f} {miss:>8.2f} {walk:>8.2f}")
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
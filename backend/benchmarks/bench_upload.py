@@ -0,0 +1,102 @@
+"""
+Benchmark ``/admin/upload`` with 1, 10 and 50 mode images.
+
+Each configuration is run with ``UPLOAD_WORKERS=1`` (sequential file
+processing) and with the pool size given on the command line, against a
+throw-away SQLite database and upload folders. Run from the ``backend``
+folder:
+
+    python -m benchmarks.bench_upload --image-kb 2048 --workers 8
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+PDF_HEADER = b'%PDF-1.4\n'
+
+
+def _payload(image_count, image_bytes, pdf_bytes):
+    images = [(io.BytesIO(PNG_HEADER + image_bytes), f'mode_{i}.png') for i in range(image_count)]
+    return {
+        'defect_name': f'Benchmark defect {image_count}',
+        'defect_modes': json.dumps([f'mode {i}' for i in range(image_count)]),
+        'descriptions': [f'benchmark description {i}' for i in range(image_count)],
+        'images': images,
+        'pdf': (io.BytesIO(PDF_HEADER + pdf_bytes), 'report.pdf'),
+    }
+
+
+def _make_app(root):
+    # Config reads DATABASE_URL at import time, so set it before importing the app.
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(root, 'bench.db')}"
+    from app import create_app, db
+
+    app = create_app()
+    app.config.update(
+        UPLOAD_FOLDER_IMAGES=os.path.join(root, 'images'),
+        UPLOAD_FOLDER_PDFS=os.path.join(root, 'pdfs'),
+        IMAGE_NORMALIZE=False,
+        MAX_CONTENT_LENGTH=1024 * 1024 * 1024,
+    )
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _set_workers(app, workers):
+    from app import staging
+
+    app.config['UPLOAD_WORKERS'] = workers
+    # The pool is sized on first use; drop it so the new size takes effect.
+    if staging._upload_pool is not None:
+        staging._upload_pool.shutdown()
+        staging._upload_pool = None
+
+
+def _run(app, image_count, image_bytes, pdf_bytes, repeat):
+    client = app.test_client()
+    timings = []
+    for _ in range(repeat):
+        data = _payload(image_count, image_bytes, pdf_bytes)
+        start = time.perf_counter()
+        response = client.post('/admin/upload', data=data, content_type='multipart/form-data')
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(response.get_json())
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--image-kb', type=int, default=1024)
+    parser.add_argument('--pdf-kb', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    image_bytes = os.urandom(args.image_kb * 1024)
+    pdf_bytes = os.urandom(args.pdf_kb * 1024)
+
+    print(f"{args.image_kb} KB images, {args.pdf_kb} KB PDF, median of {args.repeat} runs")
+    print(f"{'images':>6} {'1 worker ms':>12} {f'{args.workers} workers ms':>14}")
+    root = tempfile.mkdtemp(prefix='wdl-upload-')
+    try:
+        app = _make_app(root)
+        for image_count in (1, 10, 50):
+            row = []
+            for workers in (1, args.workers):
+                _set_workers(app, workers)
+                row.append(_run(app, image_count, image_bytes, pdf_bytes, args.repeat))
+            print(f"{image_count:>6} {row[0]:>12.1f} {row[1]:>14.1f}")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
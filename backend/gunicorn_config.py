@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 # Bind to localhost:8000 (can be changed)
 bind = "127.0.0.1:8000"
@@ -6,8 +7,16 @@ bind = "127.0.0.1:8000"
 # Number of worker processes (adjust to your CPU cores)
 workers = multiprocessing.cpu_count() * 2 + 1
 
+# Threads per worker. More than 1 runs threaded workers, so open change streams
+# (GET /defect/changes) each hold a thread instead of a whole worker process; 1
+# keeps sync workers, which serve no streams. The app reads the same variable to
+# size CHANGES_MAX_STREAMS and ADMISSION_WRITE_SLOTS. Each thread that is not
+# streaming needs a database connection: keep it within the SQLAlchemy pool
+# (pool_size 5 + max_overflow 10).
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
 # Worker class
-worker_class = "sync"
+worker_class = "gthread" if threads > 1 else "sync"
 
 # Logging
 accesslog = "logs/gunicorn_access.log"
@@ -17,5 +26,18 @@ loglevel = "info"
 # Timeout for workers (seconds)
 timeout = 30
 
+# Seconds a recycled worker gets to finish its in-flight requests
+graceful_timeout = 30
+
+# Restart workers after this many requests (0 disables; jitter spreads the restarts)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+
+def post_request(worker, req, environ, resp):
+    """Recycles the worker gracefully once its RSS exceeds WORKER_MAX_RSS_MB (see app/memory.py)."""
+    from app.memory import recycle_if_over_limit
+    recycle_if_over_limit(worker)
+
 # PID file (optional)
 pidfile = "gunicorn.pid"
@@ -0,0 +1,39 @@
+"""Add related_defect and related_queue
+
+Populate related_defect with `flask defects related --full` after upgrading;
+later runs only recompute the defects queued since.
+
+Revision ID: a8c4e61f2d37
+Revises: f3b6d28a4c15
+Create Date: 2026-10-19 16:41:07.218455
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c4e61f2d37'
+down_revision = 'f3b6d28a4c15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('related_defect',
+    sa.Column('defect_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('related_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('defect_id', 'rank')
+    )
+    op.create_table('related_queue',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('defect_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('related_queue')
+    op.drop_table('related_defect')
@@ -0,0 +1,45 @@
+"""Index the foreign keys and creation times the routes query by
+
+defect_mode.defect_id and pdf_file.defect_id back every load of a defect's
+modes and PDF, the search join and the bulk and purge deletes;
+defect.created_at and defect_mode.created_at back the activity rebuild.
+tests/test_query_plans.py checks the routes' plans against these.
+
+Revision ID: b7e2f9a14c83
+Revises: c5d19e7b3f62
+Create Date: 2026-10-19 19:27:44.803162
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2f9a14c83'
+down_revision = 'c5d19e7b3f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('defect', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_defect_created_at'), ['created_at'], unique=False)
+
+    with op.batch_alter_table('defect_mode', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_defect_mode_defect_id'), ['defect_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_defect_mode_created_at'), ['created_at'], unique=False)
+
+    with op.batch_alter_table('pdf_file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_pdf_file_defect_id'), ['defect_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pdf_file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pdf_file_defect_id'))
+
+    with op.batch_alter_table('defect_mode', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_defect_mode_created_at'))
+        batch_op.drop_index(batch_op.f('ix_defect_mode_defect_id'))
+
+    with op.batch_alter_table('defect', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_defect_created_at'))
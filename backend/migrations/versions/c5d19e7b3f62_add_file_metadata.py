@@ -0,0 +1,52 @@
+"""Add stored image and PDF metadata
+
+Fill in the rows of existing uploads with `flask files metadata` after upgrading.
+
+Revision ID: c5d19e7b3f62
+Revises: a8c4e61f2d37
+Create Date: 2026-10-19 18:42:07.351904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d19e7b3f62'
+down_revision = 'a8c4e61f2d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('defect_mode', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('image_size', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('image_sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('image_mimetype', sa.String(length=100), nullable=True))
+        batch_op.add_column(sa.Column('image_width', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('image_height', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_defect_mode_image_filename'), ['image_filename'], unique=False)
+
+    with op.batch_alter_table('pdf_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('size', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('mimetype', sa.String(length=100), nullable=True))
+        batch_op.add_column(sa.Column('page_count', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_pdf_file_filename'), ['filename'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pdf_file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_pdf_file_filename'))
+        batch_op.drop_column('page_count')
+        batch_op.drop_column('mimetype')
+        batch_op.drop_column('sha256')
+        batch_op.drop_column('size')
+
+    with op.batch_alter_table('defect_mode', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_defect_mode_image_filename'))
+        batch_op.drop_column('image_height')
+        batch_op.drop_column('image_width')
+        batch_op.drop_column('image_mimetype')
+        batch_op.drop_column('image_sha256')
+        batch_op.drop_column('image_size')
@@ -0,0 +1,52 @@
+"""Add statistics rollup tables
+
+Populate them with `flask stats rebuild` after upgrading; from then on they
+are updated on every write.
+
+Revision ID: d41f0c3a9e27
+Revises: c2b1847fd5b2
+Create Date: 2026-10-19 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f0c3a9e27'
+down_revision = 'c2b1847fd5b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('defect_activity_daily',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('defects_created', sa.Integer(), nullable=False),
+    sa.Column('modes_created', sa.Integer(), nullable=False),
+    sa.Column('defects_edited', sa.Integer(), nullable=False),
+    sa.Column('defects_deleted', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day')
+    )
+    op.create_table('defect_rollup',
+    sa.Column('defect_id', sa.Integer(), nullable=False),
+    sa.Column('mode_count', sa.Integer(), nullable=False),
+    sa.Column('edit_count', sa.Integer(), nullable=False),
+    sa.Column('image_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('pdf_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('total_bytes', sa.BigInteger(), nullable=False),
+    sa.Column('last_edited_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('defect_id')
+    )
+    with op.batch_alter_table('defect_rollup', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_defect_rollup_edit_count'), ['edit_count'], unique=False)
+        batch_op.create_index(batch_op.f('ix_defect_rollup_total_bytes'), ['total_bytes'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('defect_rollup', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_defect_rollup_total_bytes'))
+        batch_op.drop_index(batch_op.f('ix_defect_rollup_edit_count'))
+
+    op.drop_table('defect_rollup')
+    op.drop_table('defect_activity_daily')
@@ -0,0 +1,40 @@
+"""Add image_job
+
+Normalization jobs are recorded with their upload and removed when they
+finish; `flask files resume` runs those a worker restart interrupted.
+
+Revision ID: d9a3f5c27e61
+Revises: b7e2f9a14c83
+Create Date: 2026-10-19 21:04:12.530318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9a3f5c27e61'
+down_revision = 'b7e2f9a14c83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('image_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('image_job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_image_job_created_at'), ['created_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_image_job_filename'), ['filename'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('image_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_job_filename'))
+        batch_op.drop_index(batch_op.f('ix_image_job_created_at'))
+
+    op.drop_table('image_job')
@@ -0,0 +1,28 @@
+"""Add defect.deleted_at for soft deletes
+
+Revision ID: e7a93b5c1d08
+Revises: d41f0c3a9e27
+Create Date: 2026-10-19 14:03:52.118730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a93b5c1d08'
+down_revision = 'd41f0c3a9e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('defect', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_defect_deleted_at'), ['deleted_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('defect', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_defect_deleted_at'))
+        batch_op.drop_column('deleted_at')
@@ -0,0 +1,35 @@
+"""Add upload_idempotency_key for resumable uploads
+
+Revision ID: f3b6d28a4c15
+Revises: e7a93b5c1d08
+Create Date: 2026-10-19 16:02:18.550913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b6d28a4c15'
+down_revision = 'e7a93b5c1d08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_idempotency_key',
+    sa.Column('key', sa.String(length=128), nullable=False),
+    sa.Column('upload_id', sa.String(length=32), nullable=False),
+    sa.Column('defect_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('upload_idempotency_key', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_upload_idempotency_key_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('upload_idempotency_key', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_upload_idempotency_key_created_at'))
+
+    op.drop_table('upload_idempotency_key')
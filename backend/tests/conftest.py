@@ -0,0 +1,50 @@
+"""
+Fixtures shared by the behaviour tests: an app on a fresh SQLite database
+created from the models, with every file and state path under ``tmp_path``.
+"""
+import pytest
+
+from app import create_app, db
+from app.config import Config
+
+
+@pytest.fixture
+def config_overrides():
+    """Config values a test module needs set before the app is created."""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, config_overrides):
+    for name, value in {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'defects.db'}",
+        'SQLALCHEMY_BINDS': {},
+        'UPLOAD_FOLDER_IMAGES': str(tmp_path / 'images'),
+        'UPLOAD_FOLDER_PDFS': str(tmp_path / 'pdfs'),
+        'UPLOAD_FOLDER_ORIGINALS': str(tmp_path / 'originals'),
+        'UPLOAD_FOLDER_TILES': str(tmp_path / 'tiles'),
+        'CHANGES_LOG_PATH': str(tmp_path / 'changes.db'),
+        'SEMANTIC_INDEX_DIR': str(tmp_path / 'search-index'),
+        'RELATED_DIR': str(tmp_path / 'related-features'),
+        'PROFILE_DIR': str(tmp_path / 'profiles'),
+        'PROFILE_TOKEN': None,
+        'PROFILE_SAMPLE_RATE': 0,
+        'ADMISSION_CONTROL': False,
+        'IMAGE_NORMALIZE': False,
+        'SLOW_QUERY_LOG': False,
+        'SNAPSHOT_MODE': False,
+        'STATS_ROLLUPS': True,
+        **config_overrides,
+    }.items():
+        monkeypatch.setattr(Config, name, value)
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,76 @@
+"""
+Behaviour tests for the profiling and memory routes: hidden behind
+``PROFILE_TOKEN``, and safe where ``resource`` or ``/proc`` is missing.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import builtins
+
+import pytest
+
+from app import memory
+
+TOKEN = 'secret-token'
+
+ROUTES = [
+    ('get', '/admin/profiles'),
+    ('get', '/admin/profiles/1-1-ab'),
+    ('get', '/admin/memory'),
+    ('post', '/admin/memory/tracemalloc'),
+    ('delete', '/admin/memory/tracemalloc'),
+]
+
+
+@pytest.fixture
+def config_overrides():
+    # Set before the app is created, so the profiling hooks are installed.
+    return {'PROFILE_TOKEN': TOKEN}
+
+
+@pytest.mark.parametrize('method, path', ROUTES)
+def test_routes_are_404_without_a_token_configured(app, client, method, path):
+    app.config['PROFILE_TOKEN'] = None
+    assert getattr(client, method)(path, headers={'X-Profile': 'anything'}).status_code == 404
+
+
+@pytest.mark.parametrize('method, path', ROUTES)
+@pytest.mark.parametrize('supplied', [None, 'wrong-token'])
+def test_routes_are_404_without_the_token(client, method, path, supplied):
+    headers = {'X-Profile': supplied} if supplied else {}
+    assert getattr(client, method)(path, headers=headers).status_code == 404
+
+
+def test_routes_answer_with_the_token(client):
+    headers = {'X-Profile': TOKEN}
+    assert client.get('/admin/memory', headers=headers).get_json()['data']['pid']
+    assert client.post('/admin/memory/tracemalloc', headers=headers).status_code == 200
+    assert client.delete('/admin/memory/tracemalloc', headers=headers).status_code == 200
+    # Reading the profile list is not profiled itself.
+    response = client.get('/admin/profiles', headers=headers)
+    assert response.status_code == 200 and 'X-Profile-Id' not in response.headers
+    assert client.get('/admin/profiles', headers=headers).get_json()['data'] == []
+
+
+class Worker:
+    alive = True
+    pid = 1
+
+    class log:
+        @staticmethod
+        def warning(message):
+            pass
+
+
+def test_rss_unknown_without_proc_psutil_or_resource(monkeypatch):
+    real_open = builtins.open
+
+    def no_proc(path, *args, **kwargs):
+        if str(path).startswith('/proc/'):
+            raise OSError(path)
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr(builtins, 'open', no_proc)
+    monkeypatch.setattr(memory, 'psutil', None)
+    monkeypatch.setattr(memory, 'resource', None)
+    assert memory.current_rss() is None
+    worker = Worker()
+    assert memory.recycle_if_over_limit(worker, limit_mb=1) is False and worker.alive
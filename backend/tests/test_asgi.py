@@ -0,0 +1,52 @@
+"""
+Tests for the ASGI deployment's routing between native read handlers and the
+Flask app (``app/asgi.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``; skipped without a2wsgi
+or aiosqlite.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('a2wsgi')
+pytest.importorskip('aiosqlite')
+
+from app.asgi import AsgiApp  # noqa: E402
+
+
+@pytest.fixture
+def routed(app):
+    """Returns a function that reports which handler a GET request reaches."""
+    asgi_app = AsgiApp(app)
+    handled = []
+
+    async def native_search(scope, send):
+        handled.append('native')
+
+    async def wsgi(scope, receive, send):
+        handled.append('flask')
+
+    asgi_app.search_defect = native_search
+    asgi_app.wsgi = wsgi
+
+    def route(path, query_string):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': []}
+        asyncio.run(asgi_app(scope, None, None))
+        return handled.pop()
+
+    yield route
+    asyncio.run(asgi_app.engine.dispose())
+
+
+@pytest.mark.parametrize('query_string, handler', [
+    (b'query=void', 'native'),
+    (b'query=void&mode=keyword', 'native'),
+    (b'query=void&xmode=semantic', 'native'),
+    (b'query=mode%3Dsemantic', 'native'),
+    (b'query=void&mode=semantic', 'flask'),
+    (b'query=void&mode=other', 'flask'),
+    (b'mode=semantic&mode=keyword', 'flask'),
+])
+def test_search_mode_is_parsed(routed, query_string, handler):
+    assert routed('/defect/search', query_string) == handler
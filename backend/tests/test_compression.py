@@ -0,0 +1,77 @@
+"""
+Tests for negotiated response compression and the precompressed frontend
+assets written by ``flask assets precompress`` (``app/compression.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import gzip
+import json
+
+import pytest
+
+from app import compression, db
+from app.models import Defect, DefectMode
+
+INDEX = b'<!doctype html><html><body>' + b'<p>defect library</p>' * 200 + b'</body></html>'
+
+
+@pytest.fixture
+def config_overrides(tmp_path):
+    build = tmp_path / 'frontend'
+    build.mkdir()
+    (build / 'index.html').write_bytes(INDEX)
+    return {'FRONTEND_BUILD_DIR': str(build), 'COMPRESS_MIN_SIZE': 512}
+
+
+def add_defects(app, count):
+    with app.app_context():
+        db.session.add_all(DefectMode(defect=Defect(title=f"plating defect {i}"), mode='void',
+                                      description='void in the plating') for i in range(count))
+        db.session.commit()
+
+
+def test_large_json_is_gzipped(app, client):
+    add_defects(app, 30)
+    response = client.get('/defect/search?query=plating', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert len(json.loads(gzip.decompress(response.get_data()))) == 30
+
+
+@pytest.mark.skipif(compression.brotli is None, reason='brotli is not installed')
+def test_brotli_is_preferred_when_accepted(app, client):
+    add_defects(app, 30)
+    response = client.get('/defect/search?query=plating', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert len(json.loads(compression.brotli.decompress(response.get_data()))) == 30
+    response = client.get('/defect/search?query=plating', headers={'Accept-Encoding': 'gzip;q=1, br;q=0.5'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_small_or_unaccepted_responses_are_not_compressed(app, client):
+    add_defects(app, 1)
+    small = client.get('/defect/search?query=plating', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers and len(small.get_json()) == 1
+    add_defects(app, 30)
+    identity = client.get('/defect/search?query=plating', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in identity.headers and len(identity.get_json()) == 31
+
+
+def test_precompressed_index_is_served(app, client):
+    plain = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert plain.get_data() == INDEX and 'Content-Encoding' not in plain.headers
+    plain.close()
+
+    result = app.test_cli_runner().invoke(args=['assets', 'precompress'])
+    assert result.exit_code == 0, result.output
+
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/html'
+    assert gzip.decompress(response.get_data()) == INDEX
+    response.close()
+    if compression.brotli is not None:
+        response = client.get('/', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['Content-Encoding'] == 'br'
+        assert compression.brotli.decompress(response.get_data()) == INDEX
+        response.close()
@@ -0,0 +1,155 @@
+"""
+Behaviour tests for the defect routes' error paths: malformed bulk payloads,
+missing ids and purge accounting.
+
+Each test runs against a fresh SQLite database (the ``app`` fixture in
+``conftest.py``). Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+
+import pytest
+
+from app import changes
+from app.storage import LocalStorage
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+def upload(client, name, modes=('void', 'scratch')):
+    """Uploads a defect through /admin/upload and returns it as served by GET /defect/<id>."""
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps(list(modes)),
+        'descriptions': [f"{mode} in the plating" for mode in modes],
+        'images': [(io.BytesIO(PNG), f"{mode}.png") for mode in modes],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    found = client.get(f"/defect/search?query={name}").get_json()
+    return client.get(f"/defect/{found[0]['id']}").get_json()
+
+
+# Bulk update
+
+@pytest.mark.parametrize('modes', [
+    5,
+    'void',
+    {'mode': 'void'},
+    ['void'],
+    [None],
+    [{'id': 'x', 'mode': 'void', 'description': 'bulk edit'}],
+    [{'id': [1], 'mode': 'void', 'description': 'bulk edit'}],
+    [{'mode': 5, 'description': 'bulk edit'}],
+])
+def test_bulk_update_rejects_malformed_modes(client, modes):
+    defect = upload(client, 'plating defect')
+    response = client.patch('/defect/bulk', json={'defects': [{'id': defect['id'], 'modes': modes}]})
+    assert response.status_code == 400, response.get_json()
+
+
+@pytest.mark.parametrize('body', [None, {}, {'defects': []}, {'defects': ['x']}, {'defects': [{'id': '1'}]}])
+def test_bulk_update_rejects_malformed_defects(client, body):
+    upload(client, 'plating defect')
+    assert client.patch('/defect/bulk', json=body).status_code == 400
+
+
+def test_bulk_update_is_all_or_nothing(client):
+    first, second = upload(client, 'first defect'), upload(client, 'second defect')
+    response = client.patch('/defect/bulk', json={'defects': [
+        {'id': first['id'], 'name': 'first renamed'},
+        {'id': second['id'], 'modes': [{'mode': 'new mode', 'description': 'x'}]},
+    ]})
+    assert response.status_code == 400
+    assert client.get(f"/defect/{first['id']}").get_json()['name'] == 'first defect'
+    assert len(client.get(f"/defect/{second['id']}").get_json()['modes']) == 2
+
+
+@pytest.mark.parametrize('modes', [
+    [1],
+    [None],
+    ['void'],
+    [{'id': 'x', 'mode': 'void', 'description': 'detail edit'}],
+    [{'id': True, 'mode': 'void', 'description': 'detail edit'}],
+    [{'mode': 5, 'description': 'detail edit'}],
+    [{'mode': 'void', 'description': ['detail edit']}],
+])
+def test_detail_update_rejects_malformed_modes(client, modes):
+    defect = upload(client, 'plating defect')
+    response = client.post(f"/defect/{defect['id']}", data={
+        'defect_name': 'plating defect', 'defect_modes_json': json.dumps(modes)})
+    assert response.status_code == 400, response.get_json()
+    assert client.get(f"/defect/{defect['id']}").get_json()['modes'] == defect['modes']
+
+
+# Missing ids
+
+@pytest.mark.parametrize('method, path, data', [
+    ('get', '/defect/999999', None),
+    ('get', '/defect/999999/related', None),
+    ('put', '/defect/999999', {'defect_name': 'renamed defect'}),
+    ('post', '/defect/999999', {'defect_name': 'renamed defect'}),
+    ('delete', '/defect/999999', None),
+    ('post', '/defect/999999/restore', None),
+    ('put', '/defect/mode/999999', {'mode': 'void edited'}),
+    ('delete', '/defect/mode/999999', None),
+])
+def test_missing_ids_are_404(client, method, path, data):
+    upload(client, 'plating defect')
+    assert getattr(client, method)(path, data=data).status_code == 404
+
+
+def test_deleted_defect_is_404(client):
+    defect = upload(client, 'plating defect')
+    assert client.delete(f"/defect/{defect['id']}").status_code == 200
+    assert client.put(f"/defect/{defect['id']}", data={'defect_name': 'renamed defect'}).status_code == 404
+    assert client.delete(f"/defect/mode/{defect['modes'][0]['id']}").status_code == 404
+    assert client.post(f"/defect/{defect['id']}/restore").status_code == 200
+    assert client.get(f"/defect/{defect['id']}").status_code == 200
+
+
+# Bulk delete
+
+def deleted_count(client):
+    return sum(row['defects_deleted'] for row in client.get('/defect/stats/activity?bucket=day').get_json()['data'])
+
+
+def test_bulk_purge_counts_each_deletion_once(client, monkeypatch):
+    published = []
+    monkeypatch.setattr(changes, 'publish', lambda kind, defect_id, **fields: published.append((kind, defect_id)))
+    soft, live = upload(client, 'soft deleted defect'), upload(client, 'live defect')
+    assert client.delete(f"/defect/{soft['id']}").status_code == 200
+
+    response = client.post('/defect/bulk/delete', json={'defect_ids': [soft['id'], live['id'], 999999], 'purge': True})
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert data['defects_deleted'] == 2 and data['not_found']['defect_ids'] == [999999]
+    assert [entry for entry in published if entry[0] == 'defect.deleted'] == [
+        ('defect.deleted', soft['id']), ('defect.deleted', live['id'])]
+    assert deleted_count(client) == 2
+    assert client.post(f"/defect/{soft['id']}/restore").status_code == 404
+
+
+def test_bulk_soft_delete_skips_deleted_defects(client):
+    first, second = upload(client, 'first defect'), upload(client, 'second defect')
+    assert client.post('/defect/bulk/delete', json={'defect_ids': [first['id']]}).status_code == 200
+    response = client.post('/defect/bulk/delete', json={
+        'defect_ids': [first['id'], second['id']], 'mode_ids': [first['modes'][0]['id']]})
+    data = response.get_json()['data']
+    assert data['defects_deleted'] == 1 and data['modes_deleted'] == 0
+    assert data['not_found'] == {'defect_ids': [first['id']], 'mode_ids': [first['modes'][0]['id']]}
+    assert deleted_count(client) == 2
+
+
+# Statistics
+
+def test_storage_rollup_uses_recorded_sizes(client, monkeypatch):
+    def size(self, name):
+        raise AssertionError(f"storage asked for the size of {name}")
+    monkeypatch.setattr(LocalStorage, 'size', size)
+    defect = upload(client, 'plating defect', modes=('void',))
+    row = next(row for row in client.get('/defect/stats/storage').get_json()['data'] if row['id'] == defect['id'])
+    assert row['image_bytes'] == len(PNG) and row['pdf_bytes'] == len(PDF)
+    assert row['total_bytes'] == len(PNG) + len(PDF)
@@ -0,0 +1,32 @@
+"""
+Tests for the PDF page count stored with uploads (``filemeta.pdf_page_count``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import zlib
+
+from app import filemeta
+
+
+def pdf(*object_streams, pages=0):
+    """Builds a PDF with ``pages`` plain page objects and the given object streams, compressed."""
+    data = b'%PDF-1.5\n' + b''.join(b'%d 0 obj << /Type /Page >> endobj\n' % i for i in range(pages))
+    for i, content in enumerate(object_streams, pages + 1):
+        compressed = zlib.compress(content)
+        data += (b'%d 0 obj << /Type /ObjStm /Filter /FlateDecode /Length %d >>\nstream\n' % (i, len(compressed))
+                 + compressed + b'\nendstream\nendobj\n')
+    return data + b'%%EOF\n'
+
+
+def test_counts_plain_and_compressed_pages():
+    assert filemeta.pdf_page_count(pdf(pages=3)) == 3
+    assert filemeta.pdf_page_count(pdf(b'<< /Type /Page >> << /Type /Pages >> << /Type /Page >>', pages=1)) == 3
+    assert filemeta.pdf_page_count(pdf(b'<< /Type /Catalog >>')) is None
+
+
+def test_stops_at_the_inflate_budget(monkeypatch):
+    monkeypatch.setattr(filemeta, 'PDF_MAX_INFLATED_BYTES', 1024)
+    assert filemeta.pdf_page_count(pdf(b'<< /Type /Page >>' + b' ' * 1000, pages=1)) == 2
+    # A stream inflating past the budget, alone or together with others
+    assert filemeta.pdf_page_count(pdf(b'<< /Type /Page >>' + b' ' * 2000, pages=1)) is None
+    assert filemeta.pdf_page_count(pdf(*[b'<< /Type /Page >>' + b' ' * 400] * 3)) is None
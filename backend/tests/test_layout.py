@@ -0,0 +1,45 @@
+"""
+Tests for the upload folder layouts and ``flask files migrate-layout``.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import os
+
+from app.layout import resolve_path, shard_dirs, storage_path
+
+
+def write(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'data')
+
+
+def test_flat_is_the_default(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    with app.app_context():
+        assert storage_path(folder, 'a.png') == os.path.join(folder, 'a.png')
+        assert storage_path(folder, 'a.png', 'sharded') == os.path.join(folder, *shard_dirs('a.png'), 'a.png')
+
+
+def test_migration_to_sharded_keeps_files_reachable(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    names = [f"{i}.png" for i in range(5)]
+    with app.app_context():
+        for name in names:
+            write(storage_path(folder, name))
+
+    app.config.update(UPLOAD_LAYOUT='sharded')
+    with app.app_context():
+        # Without the fallback, flat files are not found under the sharded layout.
+        assert resolve_path(folder, names[0]) is None
+    app.config.update(UPLOAD_LAYOUT_FALLBACK=True)
+    with app.app_context():
+        assert resolve_path(folder, names[0]) == os.path.join(folder, names[0])
+
+    result = app.test_cli_runner().invoke(args=['files', 'migrate-layout', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    app.config.update(UPLOAD_LAYOUT_FALLBACK=False)
+    with app.app_context():
+        for name in names:
+            assert resolve_path(folder, name) == storage_path(folder, name, 'sharded')
+    assert sorted(entry for entry in os.listdir(folder) if entry.endswith('.png')) == []
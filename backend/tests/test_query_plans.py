@@ -0,0 +1,239 @@
+"""
+Query-plan regression tests for the API's hot paths.
+
+Every case calls a route against a small seeded library, captures the SQL it
+ran and asks the database for the plan of each statement. A case fails when
+a plan reads a table in full (``slowlog.full_scans``) that the case does not
+expect to, i.e. when a route's access pattern lost the index it needs (see
+``migrations/versions/b7e2f9a14c83_add_hot_path_indexes.py``).
+
+The schema is created from the models, like ``db.create_all()`` does in
+development. SQLite always runs; PostgreSQL runs when
+``QUERY_PLAN_POSTGRES_URL`` points at an empty database. Its plans are taken
+with ``enable_seqscan`` off, because with a handful of rows a sequential
+scan is the cheapest plan even where an index exists; a ``Seq Scan`` left
+then means no index could serve the statement.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+import os
+import re
+
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db, slowlog
+from app.config import Config
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+DEFECTS = 12
+
+_CHECKED = re.compile(r"\s*(SELECT|WITH|UPDATE|DELETE)\b", re.IGNORECASE)
+_ALIAS = re.compile(r"_\d+$")
+
+
+def _databases():
+    yield pytest.param('sqlite', id='sqlite')
+    yield pytest.param('postgresql', id='postgresql', marks=pytest.mark.skipif(
+        not os.environ.get('QUERY_PLAN_POSTGRES_URL'), reason='QUERY_PLAN_POSTGRES_URL is not set'))
+
+
+@pytest.fixture(scope='module', params=list(_databases()))
+def app(request, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp(request.param)
+    url = os.environ.get('QUERY_PLAN_POSTGRES_URL') if request.param == 'postgresql' else f"sqlite:///{tmp / 'defects.db'}"
+    patch = pytest.MonkeyPatch()
+    for name, value in {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_BINDS': {},
+        'UPLOAD_FOLDER_IMAGES': str(tmp / 'images'),
+        'UPLOAD_FOLDER_PDFS': str(tmp / 'pdfs'),
+        'UPLOAD_FOLDER_ORIGINALS': str(tmp / 'originals'),
+        'UPLOAD_FOLDER_TILES': str(tmp / 'tiles'),
+        'CHANGES_LOG_PATH': str(tmp / 'changes.db'),
+        'SEMANTIC_INDEX_DIR': str(tmp / 'search-index'),
+        'ADMISSION_CONTROL': False,
+        'IMAGE_NORMALIZE': False,
+        'SLOW_QUERY_LOG': False,
+        'SNAPSHOT_MODE': False,
+        'STATS_ROLLUPS': True,
+    }.items():
+        patch.setattr(Config, name, value)
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    client = app.test_client()
+    for i in range(DEFECTS):
+        response = client.post('/admin/upload', content_type='multipart/form-data', data={
+            'defect_name': f"defect {i}",
+            'defect_modes': json.dumps([f"void {i}", f"scratch {i}"]),
+            'descriptions': ['cavity in the plating', 'handling damage'],
+            'images': [(io.BytesIO(PNG), f"mode{i}.png")],
+            'pdf': (io.BytesIO(PDF), f"report{i}.pdf"),
+        })
+        assert response.status_code == 200, response.get_json()
+    yield app
+    with app.app_context():
+        db.drop_all()
+    patch.undo()
+
+
+class Statements:
+    """Records the statements an engine runs inside a ``with`` block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.captured = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany and _CHECKED.match(statement):
+            self.captured.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+def assert_indexed(app, call, allowed=()):
+    """Runs ``call(client)`` and fails if a statement it ran fully scans a table outside ``allowed``."""
+    client = app.test_client()
+    with app.app_context():
+        engine = db.engine
+        dialect = engine.dialect.name
+        with Statements(engine) as statements:
+            response = call(client)
+        assert response.status_code < 400, response.get_data(as_text=True)
+        assert statements.captured, 'the route ran no statement'
+
+        connection = engine.raw_connection()
+        try:
+            if dialect == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET enable_seqscan = off')
+            failures = []
+            for statement, parameters in statements.captured:
+                plan = slowlog.explain(connection, dialect, statement, parameters)
+                assert plan is not None, f"cannot explain:\n{statement}"
+                scanned = {_ALIAS.sub('', table) for table in slowlog.full_scans(plan)} - set(allowed)
+                if scanned:
+                    failures.append(f"full scan of {', '.join(sorted(scanned))}:\n{statement}\n-- plan --\n{plan}")
+            assert not failures, '\n\n'.join(failures)
+        finally:
+            connection.rollback()
+            connection.close()
+    return response
+
+
+def _first_defect(client):
+    return client.get('/defect/search?query=defect').get_json()[0]
+
+
+# Reads
+
+def test_search(app):
+    # LIKE '%...%' cannot use an index; the defects are read once, their modes by defect id.
+    assert_indexed(app, lambda c: c.get('/defect/search?query=cavity'), allowed={'defect'})
+
+
+def test_get_defect(app):
+    defect_id = _first_defect(app.test_client())['id']
+    assert_indexed(app, lambda c: c.get(f"/defect/{defect_id}"))
+
+
+def test_related(app):
+    defect_id = _first_defect(app.test_client())['id']
+    assert_indexed(app, lambda c: c.get(f"/defect/{defect_id}/related"))
+
+
+def test_deleted(app):
+    assert_indexed(app, lambda c: c.get('/defect/deleted'))
+
+
+def test_head_files(app):
+    defect = app.test_client().get(f"/defect/{_first_defect(app.test_client())['id']}").get_json()
+    image_url = next(mode['image_url'] for mode in defect['modes'] if mode['image_url'])
+    assert_indexed(app, lambda c: c.head(image_url))
+    assert_indexed(app, lambda c: c.head(defect['pdf_url']))
+
+
+# Edits
+
+def test_rename_defect(app):
+    defect_id = _first_defect(app.test_client())['id']
+    assert_indexed(app, lambda c: c.put(f"/defect/{defect_id}", data={'defect_name': 'renamed defect'}))
+
+
+def test_edit_mode(app):
+    mode_id = _first_defect(app.test_client())['modes'][0]['id']
+    assert_indexed(app, lambda c: c.put(f"/defect/mode/{mode_id}",
+                                        data={'mode': 'void edited', 'description': 'edited'}))
+
+
+def test_update_defect(app):
+    defect = _first_defect(app.test_client())
+    modes = [{'id': mode['id'], 'mode': mode['mode'], 'description': 'updated'} for mode in defect['modes']]
+    assert_indexed(app, lambda c: c.post(f"/defect/{defect['id']}", data={
+        'defect_name': defect['name'], 'defect_modes_json': json.dumps(modes)}))
+
+
+def test_bulk_update(app):
+    defects = app.test_client().get('/defect/search?query=defect').get_json()[:3]
+    body = {'defects': [{'id': defect['id'], 'name': f"{defect['name']} (bulk)",
+                         'modes': [{'id': mode['id'], 'mode': mode['mode'], 'description': 'bulk edit'}
+                                   for mode in defect['modes']]} for defect in defects]}
+    assert_indexed(app, lambda c: c.patch('/defect/bulk', json=body))
+
+
+def test_upload(app):
+    assert_indexed(app, lambda c: c.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': 'uploaded defect',
+        'defect_modes': json.dumps(['pit']),
+        'descriptions': ['pit in the plating'],
+        'images': [(io.BytesIO(PNG), 'pit.png')],
+        'pdf': (io.BytesIO(PDF), 'pit.pdf'),
+    }))
+
+
+# Deletes
+
+def test_delete_mode(app):
+    mode_id = _first_defect(app.test_client())['modes'][-1]['id']
+    assert_indexed(app, lambda c: c.delete(f"/defect/mode/{mode_id}"))
+
+
+def test_delete_and_restore(app):
+    defect_id = _first_defect(app.test_client())['id']
+    assert_indexed(app, lambda c: c.delete(f"/defect/{defect_id}"))
+    assert_indexed(app, lambda c: c.post(f"/defect/{defect_id}/restore"))
+
+
+def test_bulk_delete(app):
+    defects = app.test_client().get('/defect/search?query=defect').get_json()
+    assert_indexed(app, lambda c: c.post('/defect/bulk/delete', json={
+        'defect_ids': [defects[-1]['id']], 'mode_ids': [defects[-2]['modes'][0]['id']]}))
+    assert_indexed(app, lambda c: c.post('/defect/bulk/delete', json={
+        'defect_ids': [defects[-3]['id']], 'purge': True}))
+
+
+# Statistics
+
+def test_stats(app):
+    # Summaries aggregate the whole rollup table by design.
+    assert_indexed(app, lambda c: c.get('/defect/stats'), allowed={'defect_rollup'})
+    assert_indexed(app, lambda c: c.get('/defect/stats/modes'), allowed={'defect_rollup'})
+
+
+def test_stats_edits_storage_activity(app):
+    assert_indexed(app, lambda c: c.get('/defect/stats/edits'))
+    assert_indexed(app, lambda c: c.get('/defect/stats/storage'))
+    # One row per day: the full history is read whole, a date range by primary key.
+    assert_indexed(app, lambda c: c.get('/defect/stats/activity'), allowed={'defect_activity_daily'})
+    assert_indexed(app, lambda c: c.get('/defect/stats/activity?bucket=day&since=2024-01-01&until=2024-12-31'))
@@ -0,0 +1,68 @@
+"""
+Tests for the precomputed related defects: ``flask defects related`` and
+``GET /defect/<id>/related`` (``app/related.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import pytest
+from sqlalchemy import select
+
+from app import db
+from app.models import Defect, DefectMode, RelatedDefect
+
+LIBRARY = [
+    ('plating void', 'void', 'void and pinhole in the plating layer'),
+    ('plating pinhole', 'pinhole', 'pinhole pit in the plating layer'),
+    ('solder bridge', 'bridge', 'bridge short between solder pads'),
+    ('solder short', 'short', 'short circuit across the solder bridge'),
+]
+
+
+@pytest.fixture
+def library(app):
+    with app.app_context():
+        defects = [Defect(title=title) for title, _, _ in LIBRARY]
+        db.session.add_all(DefectMode(defect=defect, mode=mode, description=description)
+                           for defect, (_, mode, description) in zip(defects, LIBRARY))
+        db.session.commit()
+        ids = {defect.title: defect.id for defect in defects}
+    result = app.test_cli_runner().invoke(args=['search', 'build', '--dimensions', '2'])
+    assert result.exit_code == 0, result.output
+    return ids
+
+
+def run(app, *args):
+    result = app.test_cli_runner().invoke(args=['defects', 'related', *args])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def related(client, defect_id):
+    response = client.get(f"/defect/{defect_id}/related")
+    assert response.status_code == 200, response.get_json()
+    return [entry['name'] for entry in response.get_json()]
+
+
+def stored_rows(app):
+    with app.app_context():
+        return set(db.session.execute(select(RelatedDefect.defect_id, RelatedDefect.related_id)).all())
+
+
+def test_related_defects_share_a_topic(app, client, library):
+    assert run(app).startswith('Full run over 4 defects')
+    assert related(client, library['plating void'])[0] == 'plating pinhole'
+    assert related(client, library['solder short'])[0] == 'solder bridge'
+
+
+def test_full_run_removes_rows_of_gone_defects(app, client, library):
+    run(app, '--full')
+    void, pinhole = library['plating void'], library['plating pinhole']
+    with app.app_context():
+        # The list of a defect removed without a queued change event
+        db.session.add(RelatedDefect(defect_id=999, rank=0, related_id=void, score=0.9))
+        db.session.commit()
+
+    assert 'removed 1 stale rows' in run(app, '--full')
+    rows = stored_rows(app)
+    assert (999, void) not in rows and (pinhole, void) in rows
+    assert {defect_id for defect_id, _ in rows} == set(library.values())
@@ -0,0 +1,93 @@
+"""
+Tests for read/write routing to read replicas (``app/replicas.py``), with a
+second SQLite database standing in for the replica.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Defect, DefectMode
+from app.replicas import STICKY_COOKIE
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+@pytest.fixture
+def config_overrides(tmp_path):
+    return {
+        'SQLALCHEMY_BINDS': {'replica_1': f"sqlite:///{tmp_path / 'replica.db'}"},
+        'REPLICA_CHECK_INTERVAL': 3600,
+        'REPLICA_STICKY_SECONDS': 10,
+    }
+
+
+@pytest.fixture
+def replica(app):
+    """Creates the replica's tables and returns its engine; the replica starts empty."""
+    with app.app_context():
+        engine = db.engines['replica_1']
+        db.metadata.create_all(engine)
+    yield engine
+    # init_app registered a metadata for the bind on the shared db; later apps have no such bind.
+    db.metadatas.pop('replica_1', None)
+
+
+def titles(client):
+    return sorted(defect['name'] for defect in client.get('/defect/search?query=defect').get_json())
+
+
+def add_to_replica(replica, title):
+    with Session(replica) as session:
+        session.add(DefectMode(defect=Defect(title=title), mode='void', description='void in the plating'))
+        session.commit()
+
+
+def upload(client, name):
+    return client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps(['void']),
+        'descriptions': ['void in the plating'],
+        'images': [(io.BytesIO(PNG), 'void.png')],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+
+
+def test_reads_go_to_the_replica(client, replica):
+    add_to_replica(replica, 'replica defect')
+    assert titles(client) == ['replica defect']
+
+
+def test_writes_go_to_the_primary_and_stick(app, client, replica):
+    add_to_replica(replica, 'replica defect')
+    response = upload(client, 'primary defect')
+    assert response.status_code == 200, response.get_json()
+    assert STICKY_COOKIE in response.headers.get('Set-Cookie', '')
+
+    # The cookie keeps this client on the primary, so it reads its own write.
+    assert titles(client) == ['primary defect']
+    # A client without the cookie reads from the replica, which has not caught up.
+    assert titles(app.test_client()) == ['replica defect']
+    assert app.extensions['replicas'].sticky_reads == 1
+
+
+def test_failed_replica_falls_back_to_the_primary(app, client, replica):
+    add_to_replica(replica, 'replica defect')
+    assert titles(client) == ['replica defect']
+
+    pool = app.extensions['replicas']
+    pool.mark_failed('replica_1', 'connection reset')
+    assert titles(client) == []
+    assert pool.primary_fallbacks == 1
+
+    status = client.get('/admin/replicas').get_json()['data']
+    # The forced check finds the replica reachable again.
+    assert status['replicas'][0]['name'] == 'replica_1' and status['replicas'][0]['healthy']
+    assert status['replicas'][0]['requests'] == 1
+    assert titles(client) == ['replica defect']
@@ -0,0 +1,112 @@
+"""
+Tests for packed image storage and ``flask files compact-packs``
+(``app/segments.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+import os
+
+import pytest
+
+from app.segments import PackedStorage
+from app.storage import LocalStorage, get_storage
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+@pytest.fixture
+def config_overrides():
+    return {'IMAGE_PACKS': True, 'IMAGE_PACK_MAX_BLOB': 1024 * 1024, 'IMAGE_PACK_SEGMENT_SIZE': 1024}
+
+
+@pytest.fixture
+def storage(app, tmp_path):
+    root = tmp_path / 'packed'
+    root.mkdir()
+    with app.app_context():
+        yield PackedStorage(str(root), LocalStorage(str(root)), max_blob=1000, segment_size=2000)
+
+
+def put(storage, tmp_path, name, data):
+    local = tmp_path / f"staged-{name}"
+    local.write_bytes(data)
+    storage.put_file(str(local), name)
+    assert not local.exists()
+
+
+def blob(i, size=400):
+    return bytes([i]) * size
+
+
+def listed(storage):
+    return sorted(obj.name for batch in storage.iter_objects(100) for obj in batch)
+
+
+def test_small_files_are_packed_and_large_ones_stay_loose(storage, tmp_path):
+    for i in range(12):
+        put(storage, tmp_path, f"{i}.png", blob(i))
+    put(storage, tmp_path, 'large.png', blob(99, 5000))
+
+    assert len(storage.segments()) == 3
+    assert os.path.isfile(os.path.join(storage.root, 'large.png'))
+    assert not os.path.exists(os.path.join(storage.root, '0.png'))
+    assert storage.open('7.png').read() == blob(7) and storage.size('7.png') == 400
+    assert storage.open('large.png').read() == blob(99, 5000)
+    assert listed(storage) == sorted([f"{i}.png" for i in range(12)] + ['large.png'])
+
+    storage.delete_many(['0.png', 'large.png'])
+    assert not storage.exists('0.png') and not storage.exists('large.png')
+    with pytest.raises(FileNotFoundError):
+        storage.open('0.png')
+
+
+def test_compaction_keeps_live_blobs_and_removes_garbage(storage, tmp_path):
+    for i in range(12):
+        put(storage, tmp_path, f"{i}.png", blob(i))
+    first = storage.segments()[0]
+    # Empty most of the first segment and replace one blob, leaving its old copy behind.
+    storage.delete_many(['0.png', '1.png', '2.png'])
+    put(storage, tmp_path, '3.png', blob(33))
+
+    dry = storage.compact(min_garbage=0.5, dry_run=True)
+    assert dry['compacted'] >= 1 and os.path.exists(storage.segment_path(first))
+
+    report = storage.compact(min_garbage=0.5)
+    assert report['compacted'] >= 1 and report['reclaimed_bytes'] >= 4 * 400
+    assert not os.path.exists(storage.segment_path(first))
+    for i in range(3, 12):
+        assert storage.open(f"{i}.png").read() == (blob(33) if i == 3 else blob(i))
+    assert listed(storage) == sorted(f"{i}.png" for i in range(3, 12))
+
+
+def test_compaction_packs_loose_files(storage, tmp_path):
+    with open(os.path.join(storage.root, 'old.png'), 'wb') as f:
+        f.write(blob(1))
+    assert storage.compact(pack_loose=True, dry_run=True)['packed_loose'] == 1
+    assert storage.compact(pack_loose=True)['packed_loose'] == 1
+    assert not os.path.exists(os.path.join(storage.root, 'old.png'))
+    assert storage.open('old.png').read() == blob(1)
+
+
+def test_uploads_are_served_from_packs(app, client):
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': 'plating defect',
+        'defect_modes': json.dumps(['void']),
+        'descriptions': ['void in the plating'],
+        'images': [(io.BytesIO(PNG), 'void.png')],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    defect = client.get('/defect/search?query=plating').get_json()[0]
+    response = client.get(defect['modes'][0]['image_url'])
+    assert response.status_code == 200 and response.get_data() == PNG
+    with app.app_context():
+        assert isinstance(get_storage(app.config['UPLOAD_FOLDER_IMAGES']), PackedStorage)
+    assert not [name for name in os.listdir(app.config['UPLOAD_FOLDER_IMAGES']) if name.endswith('.png')]
+
+    result = app.test_cli_runner().invoke(args=['files', 'compact-packs', '--dry-run'])
+    assert result.exit_code == 0 and '1 segments' in result.output, result.output
@@ -0,0 +1,87 @@
+"""
+Tests for semantic search: ``flask search build`` and
+``/defect/search?mode=semantic`` (``app/semantic.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+import time
+
+import pytest
+
+from app import db
+from app.models import Defect, DefectMode
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+LIBRARY = [
+    ('plating void', 'void', 'void and pinhole in the plating layer'),
+    ('plating pinhole', 'pinhole', 'pinhole pit in the plating layer'),
+    ('solder bridge', 'bridge', 'bridge short between solder pads'),
+    ('solder short', 'short', 'short circuit across the solder bridge'),
+]
+
+
+@pytest.fixture
+def config_overrides():
+    return {'SEMANTIC_SEARCH': True, 'SEMANTIC_RELOAD_INTERVAL': 0, 'SEMANTIC_MIN_SCORE': 0.5}
+
+
+@pytest.fixture
+def library(app):
+    with app.app_context():
+        defects = [Defect(title=title) for title, _, _ in LIBRARY]
+        db.session.add_all(DefectMode(defect=defect, mode=mode, description=description)
+                           for defect, (_, mode, description) in zip(defects, LIBRARY))
+        db.session.commit()
+        return {defect.title: defect.id for defect in defects}
+
+
+def build(app):
+    result = app.test_cli_runner().invoke(args=['search', 'build', '--dimensions', '2'])
+    assert result.exit_code == 0, result.output
+
+
+def search(client, query):
+    response = client.get(f"/defect/search?mode=semantic&query={query}")
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_search_needs_a_built_index(client, library):
+    assert client.get('/defect/search?mode=semantic&query=void').status_code == 503
+
+
+def test_related_words_find_the_same_defects(app, client, library):
+    build(app)
+    found = search(client, 'pit')
+    # Only "plating pinhole" says "pit", but the plating voids share its topic.
+    assert {defect['name'] for defect in found} == {'plating void', 'plating pinhole'}
+    assert [defect['score'] for defect in found] == sorted((defect['score'] for defect in found), reverse=True)
+    assert {defect['name'] for defect in search(client, 'circuit')} == {'solder bridge', 'solder short'}
+    assert search(client, 'unknownword') == []
+
+
+def test_writes_update_the_index(app, client, library):
+    build(app)
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': 'pinhole cluster',
+        'defect_modes': json.dumps(['void']),
+        'descriptions': ['pinholes in the plating'],
+        'images': [(io.BytesIO(PNG), 'void.png')],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    assert client.delete(f"/defect/{library['plating void']}").status_code == 200
+
+    # The index is updated on a background thread.
+    deadline = time.monotonic() + 5
+    while True:
+        names = {defect['name'] for defect in search(client, 'plating')}
+        if 'pinhole cluster' in names or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    assert names == {'plating pinhole', 'pinhole cluster'}
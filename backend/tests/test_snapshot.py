@@ -0,0 +1,94 @@
+"""
+Tests for read-only edge snapshots: ``flask snapshot build`` and an app
+started with ``SNAPSHOT_MODE`` serving the active snapshot
+(``app/snapshot.py``, ``app/routes/snapshot_routes.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+
+import pytest
+
+from app import create_app
+from app.config import Config
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+@pytest.fixture
+def config_overrides(tmp_path):
+    return {'SNAPSHOT_DIR': str(tmp_path / 'snapshots'), 'SNAPSHOT_RELOAD_INTERVAL': 0}
+
+
+@pytest.fixture
+def edge(app, monkeypatch):
+    """A test client of a second app serving the snapshots in SNAPSHOT_MODE."""
+    monkeypatch.setattr(Config, 'SNAPSHOT_MODE', True)
+    return create_app().test_client()
+
+
+def upload(client, name, mode='void'):
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps([mode]),
+        'descriptions': [f"{mode} in the plating"],
+        'images': [(io.BytesIO(PNG), f"{mode}.png")],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    found = client.get(f"/defect/search?query={name}").get_json()
+    return client.get(f"/defect/{found[0]['id']}").get_json()
+
+
+def build(app):
+    result = app.test_cli_runner().invoke(args=['snapshot', 'build'])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_snapshot_serves_the_library(app, client, edge):
+    defect = upload(client, 'plating defect')
+    deleted = upload(client, 'deleted defect')
+    assert client.delete(f"/defect/{deleted['id']}").status_code == 200
+    assert ': 1 defects, 2 files' in build(app)
+
+    response = edge.get(f"/defect/{defect['id']}")
+    assert response.status_code == 200 and response.headers['X-Snapshot']
+    # The snapshot keeps the defect document, without the live related-defects list.
+    assert response.get_json() == {key: value for key, value in defect.items() if key != 'related'}
+    assert [found['id'] for found in edge.get('/defect/search?query=plating').get_json()] == [defect['id']]
+    assert edge.get(f"/defect/{deleted['id']}").status_code == 404
+
+    image = defect['modes'][0]['image_url'].rsplit('/', 1)[-1]
+    response = edge.get(f"/images/{image}")
+    assert response.status_code == 200 and response.get_data() == PNG
+    assert edge.get(f"/images/{image}", headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    partial = edge.get(defect['pdf_url'], headers={'Range': 'bytes=0-3'})
+    assert partial.status_code == 206 and partial.get_data() == PDF[:4]
+    assert edge.get('/images/missing.png').status_code == 404
+
+
+def test_snapshot_mode_has_no_write_routes(app, client, edge):
+    defect = upload(client, 'plating defect')
+    build(app)
+    assert edge.post('/admin/upload', data={'defect_name': 'new defect'}).status_code == 404
+    assert edge.patch('/defect/bulk', json={'defects': [{'id': defect['id'], 'name': 'renamed'}]}).status_code == 404
+    assert edge.post('/defect/bulk/delete', json={'defect_ids': [defect['id']]}).status_code == 404
+    assert edge.delete(f"/defect/mode/{defect['modes'][0]['id']}").status_code == 404
+    assert edge.post('/admin/uploads', json={'files': []}).status_code == 404
+    assert edge.get('/defect/stats/activity').status_code == 404
+    # Read URLs only answer reads.
+    assert edge.delete(f"/defect/{defect['id']}").status_code == 405
+    assert edge.get(f"/defect/{defect['id']}").get_json()['name'] == 'plating defect'
+
+
+def test_new_snapshot_is_picked_up(app, client, edge):
+    upload(client, 'plating defect')
+    build(app)
+    assert len(edge.get('/defect/search?query=defect').get_json()) == 1
+    upload(client, 'second defect')
+    build(app)
+    assert len(edge.get('/defect/search?query=defect').get_json()) == 2
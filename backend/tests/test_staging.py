@@ -0,0 +1,101 @@
+"""
+Tests for transactional file staging and the orphaned file collector
+(``app/staging.py``, ``flask files gc``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import os
+import time
+
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from app.models import Defect, DefectMode
+from app.staging import stage_files, schedule_delete, staging_folder
+from app.storage import get_storage
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+
+
+def stored(folder):
+    return sorted(obj.name for batch in get_storage(folder).iter_objects(100) for obj in batch)
+
+
+def staged(folder):
+    staging = staging_folder(folder)
+    return sorted(os.listdir(staging)) if os.path.isdir(staging) else []
+
+
+def png_files(*names):
+    return [FileStorage(io.BytesIO(PNG), filename=name) for name in names]
+
+
+def add_mode(filename):
+    defect = Defect(title='plating defect')
+    db.session.add(DefectMode(defect=defect, mode='void', description='void in the plating', image_filename=filename))
+
+
+def test_files_are_promoted_on_commit(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    with app.app_context():
+        files = stage_files(png_files('a.png', 'b.png'), folder, {'png'})
+        assert stored(folder) == [] and len(staged(folder)) == 2
+        for staged_file in files:
+            add_mode(staged_file.filename)
+        db.session.commit()
+        assert stored(folder) == sorted(staged_file.filename for staged_file in files)
+        assert staged(folder) == []
+
+
+def test_rollback_discards_staged_files(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    with app.app_context():
+        files = stage_files(png_files('a.png'), folder, {'png'})
+        add_mode(files[0].filename)
+        db.session.flush()
+        db.session.rollback()
+        assert stored(folder) == [] and staged(folder) == []
+
+
+def test_deletes_wait_for_the_commit(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    with app.app_context():
+        name = stage_files(png_files('a.png'), folder, {'png'})[0].filename
+        add_mode(name)
+        db.session.commit()
+
+        DefectMode.query.delete()
+        schedule_delete(folder, name)
+        db.session.rollback()
+        assert stored(folder) == [name]
+
+        DefectMode.query.delete()
+        schedule_delete(folder, name)
+        db.session.commit()
+        assert stored(folder) == []
+
+
+def test_gc_removes_only_old_unreferenced_files(app):
+    folder = app.config['UPLOAD_FOLDER_IMAGES']
+    with app.app_context():
+        names = [staged_file.filename for staged_file in stage_files(png_files('kept.png', 'old.png', 'new.png'),
+                                                                     folder, {'png'})]
+        add_mode(names[0])
+        db.session.commit()
+        storage = get_storage(folder)
+        an_hour_ago = time.time() - 3600
+        for name in names[:2]:
+            os.utime(storage.path(name), (an_hour_ago, an_hour_ago))
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['files', 'gc', '--dry-run', '--grace-seconds', '60'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert stored(folder) == sorted(names)
+
+    result = runner.invoke(args=['files', 'gc', '--grace-seconds', '60'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert stored(folder) == sorted([names[0], names[2]])
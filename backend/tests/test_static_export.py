@@ -0,0 +1,131 @@
+"""
+Tests for ``flask snapshot export-static`` (``app/static_export.py``): the
+exported trigram index answers searches like ``/defect/search``.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+import os
+
+import pytest
+
+from app import db
+from app.models import Defect
+from app.static_export import PADDING, SHARD_PREFIX, TRIGRAM, shard_filename
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+def upload(client, name, modes, descriptions):
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps(modes),
+        'descriptions': descriptions,
+        'images': [(io.BytesIO(PNG), f"{mode}.png") for mode in modes],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+
+
+@pytest.fixture
+def library(app, client):
+    upload(client, 'Plating Void', ['void'], ['void in the plating layer'])
+    upload(client, 'Solder bridge', ['bridge', 'short'], ['bridge between pads', 'short circuit'])
+    upload(client, 'Café stain', ['stain'], ['stain on the lid'])
+    upload(client, 'Deleted defect', ['void'], ['deleted void'])
+    deleted = client.get('/defect/search?query=deleted').get_json()[0]['id']
+    assert client.delete(f"/defect/{deleted}").status_code == 200
+    with app.app_context():
+        db.session.add(Defect(title='Defect without modes'))
+        db.session.commit()
+
+
+def export(app, output, *args):
+    result = app.test_cli_runner().invoke(args=['snapshot', 'export-static', '--output', str(output), *args])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def undelta(deltas):
+    ids, previous = [], 0
+    for delta in deltas:
+        previous += delta
+        ids.append(previous)
+    return ids
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def static_search(root, query):
+    """Searches an export the way the static frontend does."""
+    meta = load(os.path.join(root, 'meta.json'))
+    query = query.lower()
+    if len(query) < TRIGRAM:
+        # Shorter queries read every shard starting with them.
+        candidates = set()
+        for key in meta['shards']:
+            if key.startswith(query[:SHARD_PREFIX]):
+                for trigram, deltas in load(os.path.join(root, 'terms', shard_filename(key))).items():
+                    if trigram.startswith(query):
+                        candidates.update(undelta(deltas))
+    else:
+        candidates = None
+        for i in range(len(query) - TRIGRAM + 1):
+            trigram = query[i:i + TRIGRAM]
+            path = os.path.join(root, 'terms', shard_filename(trigram[:SHARD_PREFIX]))
+            ids = set(undelta(load(path).get(trigram, []))) if os.path.exists(path) else set()
+            candidates = ids if candidates is None else candidates & ids
+    found = []
+    for defect_id in sorted(candidates):
+        document = load(os.path.join(root, 'defects', f"{defect_id // meta['docs_per_shard']}.json"))[str(defect_id)]
+        if query in document['text'].rstrip(PADDING):
+            found.append(document['defect'])
+    return found
+
+
+@pytest.mark.parametrize('query', ['void', 'VOID', 'plating layer', 'bridge', 'circuit', 'café', 'fé', 'vo', 'd',
+                                   'nothing here', 'deleted'])
+def test_export_answers_like_the_live_search(app, client, library, tmp_path, query):
+    export(app, tmp_path / 'search')
+    live = sorted(client.get(f"/defect/search?query={query}").get_json(), key=lambda defect: defect['id'])
+    assert [defect['id'] for defect in static_search(tmp_path / 'search', query)] == [defect['id'] for defect in live]
+
+
+def test_export_contents(app, client, library, tmp_path):
+    output = export(app, tmp_path / 'search')
+    assert output.startswith('Exported 3 of 4 defects')
+    meta = load(tmp_path / 'search' / 'meta.json')
+    assert meta['defects'] == 3 and len(undelta(meta['ids'])) == 3
+    defect = static_search(tmp_path / 'search', 'plating')[0]
+    assert defect['name'] == 'Plating Void'
+    assert defect['pdf_url'].startswith('/pdfs/') and defect['modes'][0]['image_url'].startswith('/images/')
+
+    export(app, tmp_path / 'search', '--files-url', 'https://cdn.example.com/wdl/')
+    defect = static_search(tmp_path / 'search', 'plating')[0]
+    assert defect['pdf_url'].startswith('https://cdn.example.com/wdl/pdfs/')
+
+
+def test_export_with_files(app, client, library, tmp_path):
+    root = tmp_path / 'search'
+    # Four images and three PDFs of the searchable defects
+    assert ', 7 files' in export(app, root, '--with-files')
+    defect = static_search(root, 'bridge')[0]
+    assert (root / defect['modes'][0]['image_url']).read_bytes() == PNG
+    assert (root / defect['pdf_url']).read_bytes() == PDF
+    # Re-exporting replaces the previous export.
+    export(app, root)
+    assert not (root / 'images').exists()
+
+
+def test_export_refuses_foreign_directories(app, tmp_path):
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'docs' / 'index.html').write_text('<html></html>')
+    result = app.test_cli_runner().invoke(args=['snapshot', 'export-static', '--output', str(tmp_path / 'docs')])
+    assert result.exit_code != 0 and 'holds no static export' in result.output
+    assert os.listdir(tmp_path / 'docs') == ['index.html']
@@ -0,0 +1,91 @@
+"""
+Tests for the statistics rollups kept on write and ``flask stats rebuild``
+(``app/stats.py``).
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import db
+from app.models import Defect, DefectMode
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+def upload(client, name, modes=('void', 'scratch')):
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps(list(modes)),
+        'descriptions': [f"{mode} in the plating" for mode in modes],
+        'images': [(io.BytesIO(PNG), f"{mode}.png") for mode in modes],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    found = client.get(f"/defect/search?query={name}").get_json()
+    return client.get(f"/defect/{found[0]['id']}").get_json()
+
+
+def summary(client):
+    return client.get('/defect/stats').get_json()['data']
+
+
+def today(client):
+    rows = client.get('/defect/stats/activity?bucket=day').get_json()['data']
+    assert len(rows) == 1
+    return {key: value for key, value in rows[0].items() if key != 'bucket'}
+
+
+def edit_counts(client):
+    return {row['id']: row['edit_count'] for row in client.get('/defect/stats/edits').get_json()['data']}
+
+
+def rebuild(app):
+    result = app.test_cli_runner().invoke(args=['stats', 'rebuild'])
+    assert result.exit_code == 0, result.output
+
+
+def make_old(app, hours=1):
+    """Moves every creation back, so later edits stand apart from it."""
+    with app.app_context():
+        past = datetime.utcnow() - timedelta(hours=hours)
+        db.session.execute(update(Defect).values(created_at=past, updated_at=past))
+        db.session.execute(update(DefectMode).values(created_at=past, updated_at=past))
+        db.session.commit()
+
+
+def test_counters_follow_writes(client):
+    first, second = upload(client, 'first defect'), upload(client, 'second defect', modes=('void',))
+    assert summary(client) == {'defects': 2, 'modes': 3, 'edits': 0,
+                               'image_bytes': 3 * len(PNG), 'pdf_bytes': 2 * len(PDF)}
+
+    assert client.put(f"/defect/mode/{first['modes'][0]['id']}", data={'mode': 'void edited'}).status_code == 200
+    assert client.put(f"/defect/{first['id']}", data={'defect_name': 'first renamed'}).status_code == 200
+    assert client.delete(f"/defect/mode/{first['modes'][1]['id']}").status_code == 200
+    assert client.delete(f"/defect/{second['id']}").status_code == 200
+
+    assert edit_counts(client) == {first['id']: 3}
+    assert summary(client) == {'defects': 1, 'modes': 1, 'edits': 3,
+                               'image_bytes': len(PNG), 'pdf_bytes': len(PDF)}
+    assert today(client) == {'defects_created': 2, 'modes_created': 3, 'defects_edited': 3, 'defects_deleted': 1}
+
+
+def test_rebuild_recovers_mode_only_edits(app, client):
+    first, second, third = (upload(client, f"{name} defect") for name in ('first', 'second', 'third'))
+    make_old(app)
+    assert client.put(f"/defect/mode/{first['modes'][0]['id']}", data={'mode': 'void edited'}).status_code == 200
+    assert client.delete(f"/defect/mode/{second['modes'][0]['id']}").status_code == 200
+    before = summary(client)
+
+    rebuild(app)
+    assert edit_counts(client) == {first['id']: 1, second['id']: 1}
+    assert summary(client) == before
+    activity = client.get('/defect/stats/activity?bucket=day').get_json()['data']
+    assert sum(row['defects_created'] for row in activity) == 3
+    assert sum(row['modes_created'] for row in activity) == 5
+    assert sum(row['defects_edited'] for row in activity) == 2
@@ -0,0 +1,136 @@
+"""
+Tests for the S3 storage driver (``app/storage.py``) against a moto-mocked
+bucket.
+
+Run from ``backend/`` with ``python -m pytest tests``; skipped when boto3 or
+moto is not installed.
+"""
+import io
+import json
+
+import pytest
+from werkzeug.exceptions import NotFound
+
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from app.storage import S3Storage, get_storage  # noqa: E402
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+BUCKET = 'wdl-test'
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        yield
+
+
+@pytest.fixture
+def config_overrides(s3):
+    return {
+        'STORAGE_BACKEND': 's3',
+        'STORAGE_S3_BUCKET': BUCKET,
+        'STORAGE_S3_PREFIX': 'wdl/',
+        'STORAGE_S3_ENDPOINT_URL': '',
+        'STORAGE_S3_PUBLIC_URL': '',
+        'STORAGE_S3_REGION': 'us-east-1',
+        'STORAGE_S3_ACCESS_KEY': 'testing',
+        'STORAGE_S3_SECRET_KEY': 'testing',
+        'STORAGE_REDIRECTS': True,
+        'IMAGE_PACKS': False,
+    }
+
+
+@pytest.fixture
+def storage(app):
+    with app.app_context():
+        driver = get_storage(app.config['UPLOAD_FOLDER_IMAGES'])
+        driver.client.create_bucket(Bucket=BUCKET)
+        yield driver
+
+
+def put(storage, tmp_path, name, data=PNG):
+    local = tmp_path / f"staged-{name}"
+    local.write_bytes(data)
+    storage.put_file(str(local), name)
+    assert not local.exists()
+
+
+def names(storage, batch_size=100):
+    return [[obj.name for obj in batch] for batch in storage.iter_objects(batch_size)]
+
+
+def test_put_file_uploads_under_the_folder_prefix(storage, tmp_path):
+    assert isinstance(storage, S3Storage) and storage.prefix == 'wdl/images/'
+    put(storage, tmp_path, 'a.png')
+    head = storage.client.head_object(Bucket=BUCKET, Key='wdl/images/a.png')
+    assert head['ContentType'] == 'image/png'
+    assert storage.exists('a.png') and storage.size('a.png') == len(PNG)
+    assert storage.open('a.png').read() == PNG
+
+
+def test_missing_keys(storage):
+    assert not storage.exists('missing.png')
+    with pytest.raises(FileNotFoundError):
+        storage.size('missing.png')
+    with pytest.raises(FileNotFoundError):
+        storage.open('missing.png')
+    storage.delete('missing.png')
+    storage.delete_many(['missing.png'])
+
+
+def test_iter_objects_and_delete_many(storage, tmp_path):
+    for i in range(5):
+        put(storage, tmp_path, f"{i}.png")
+    # Another folder's objects are not listed.
+    storage.client.put_object(Bucket=BUCKET, Key='wdl/pdfs/report.pdf', Body=PDF)
+
+    batches = names(storage, batch_size=2)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sorted(name for batch in batches for name in batch) == [f"{i}.png" for i in range(5)]
+    obj = next(storage.iter_objects(10))[0]
+    assert obj.size == len(PNG) and obj.mtime > 0
+
+    storage.delete_many(['0.png', '1.png', '2.png'])
+    assert names(storage) == [['3.png', '4.png']]
+    storage.delete('3.png')
+    assert names(storage) == [['4.png']]
+
+
+def test_send_redirects_to_a_presigned_url(storage, tmp_path):
+    put(storage, tmp_path, 'a.png')
+    response = storage.send('a.png')
+    assert response.status_code == 302
+    assert '/wdl/images/a.png?' in response.location and 'Signature=' in response.location
+    assert response.headers['Cache-Control'] == f"private, max-age={storage.expires // 2}"
+
+
+def test_send_streams_without_redirects(app, storage, tmp_path):
+    put(storage, tmp_path, 'a.png')
+    storage.redirects = False
+    with app.test_request_context('/images/a.png'):
+        response = storage.send('a.png')
+        assert response.status_code == 200 and response.mimetype == 'image/png'
+        assert response.content_length == len(PNG) and response.get_data() == PNG
+        response.close()
+        with pytest.raises(NotFound):
+            storage.send('missing.png')
+
+
+def test_uploaded_image_is_served_by_redirect(app, client, storage):
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': 'plating defect',
+        'defect_modes': json.dumps(['void']),
+        'descriptions': ['void in the plating'],
+        'images': [(io.BytesIO(PNG), 'void.png')],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    filename = names(storage)[0][0]
+    assert storage.open(filename).read() == PNG
+    response = client.get(f"/images/{filename}")
+    assert response.status_code == 302 and f"/wdl/images/{filename}?" in response.location
@@ -0,0 +1,74 @@
+"""
+Tests for the tile pyramids of normalized images (``app/tiles.py``,
+``app/imaging.py``): the pyramid is cut from the original upload, not from
+the re-encoded copy capped at ``IMAGE_MAX_DIMENSION``.
+
+Normalization jobs are left to ``flask files resume`` so they run in the
+test's process. Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from app import imaging, tiles
+
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+
+@pytest.fixture
+def config_overrides():
+    return {'IMAGE_NORMALIZE': True, 'IMAGE_FORMAT': 'WEBP', 'IMAGE_MAX_DIMENSION': 64,
+            'IMAGE_KEEP_ORIGINAL': False, 'IMAGE_TILES': True, 'IMAGE_TILE_MIN_DIMENSION': 64,
+            'IMAGE_TILE_SIZE': 64, 'IMAGE_TILE_WORKERS': 1}
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    # As if the worker was recycled before it ran the job
+    monkeypatch.setattr(imaging, '_submit_normalization', lambda app, filename: None)
+    return app.test_client()
+
+
+def png(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(out, format='PNG')
+    return out.getvalue()
+
+
+def upload(client, name, image):
+    """Uploads a one-mode defect and returns the URL of its image once normalized."""
+    response = client.post('/admin/upload', content_type='multipart/form-data', data={
+        'defect_name': name,
+        'defect_modes': json.dumps(['void']),
+        'descriptions': ['void in the plating'],
+        'images': [(io.BytesIO(image), 'void.png')],
+        'pdf': (io.BytesIO(PDF), 'report.pdf'),
+    })
+    assert response.status_code == 200, response.get_json()
+    result = client.application.test_cli_runner().invoke(args=['files', 'resume', '--grace-seconds', '0'])
+    assert result.exit_code == 0, result.output
+    found = client.get(f"/defect/search?query={name}").get_json()
+    return client.get(f"/defect/{found[0]['id']}").get_json()['modes'][0]['image_url']
+
+
+def test_normalized_image_is_tiled_from_its_original(client):
+    image_url = upload(client, 'plating defect', png(300, 200))
+    assert image_url.endswith('.webp')
+    with Image.open(io.BytesIO(client.get(image_url).data)) as img:
+        assert img.size == (64, 43)
+
+    response = client.get(f"{image_url}/tiles")
+    assert response.status_code == 200
+    descriptor = tiles.parse_descriptor(response.data)
+    assert (descriptor['width'], descriptor['height']) == (300, 200)
+    top = tiles.max_level(300, 200)
+    assert client.get(f"{image_url}/tiles/{top}/4_3").status_code == 200
+    assert client.get(f"{image_url}/tiles/{top}/5_0").status_code == 404
+
+
+def test_small_original_is_not_tiled(client):
+    image_url = upload(client, 'plating defect', png(60, 40))
+    assert image_url.endswith('.webp')
+    assert client.get(f"{image_url}/tiles").status_code == 404
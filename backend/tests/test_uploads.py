@@ -0,0 +1,111 @@
+"""
+Behaviour tests for resumable uploads: chunk offsets and checksums, and the
+Idempotency-Key replay of ``POST /admin/uploads/<id>/finalize``.
+
+Run from ``backend/`` with ``python -m pytest tests``.
+"""
+import hashlib
+
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       b'\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82')
+PDF = b'%PDF-1.4\n1 0 obj << /Type /Page >> endobj\n%%EOF\n'
+
+DEFECT = {'defect_name': 'plating defect', 'defect_modes': ['void'], 'descriptions': ['void in the plating'],
+          'pdf': 0, 'images': [1]}
+
+
+def put_chunk(client, upload_id, index, offset, data):
+    return client.put(f"/admin/uploads/{upload_id}/files/{index}?offset={offset}", data=data,
+                      headers={'X-Chunk-SHA256': hashlib.sha256(data).hexdigest()})
+
+
+def start_upload(client, complete=True):
+    """Starts an upload of a PDF and an image; sends both unless ``complete`` is false."""
+    response = client.post('/admin/uploads', json={'files': [
+        {'filename': 'report.pdf', 'size': len(PDF), 'sha256': hashlib.sha256(PDF).hexdigest()},
+        {'filename': 'void.png', 'size': len(PNG)},
+    ]})
+    assert response.status_code == 200, response.get_json()
+    upload_id = response.get_json()['data']['upload_id']
+    if complete:
+        # In two chunks, the second resent once
+        assert put_chunk(client, upload_id, 0, 0, PDF[:10]).status_code == 200
+        assert put_chunk(client, upload_id, 0, 10, PDF[10:]).status_code == 200
+        assert put_chunk(client, upload_id, 0, 10, PDF[10:]).get_json()['data']['received'] == len(PDF)
+        assert put_chunk(client, upload_id, 1, 0, PNG).status_code == 200
+    return upload_id
+
+
+def finalize(client, upload_id, key, body=DEFECT):
+    return client.post(f"/admin/uploads/{upload_id}/finalize", json=body,
+                       headers={'Idempotency-Key': key} if key else {})
+
+
+def defect_count(client):
+    return len(client.get('/defect/search?query=plating').get_json())
+
+
+def test_finalize_replays_with_the_same_key(client):
+    upload_id = start_upload(client)
+    first = finalize(client, upload_id, 'key-1')
+    assert first.status_code == 200 and 'Idempotent-Replayed' not in first.headers
+    defect_id = first.get_json()['data']['defect_id']
+
+    # The session is gone after the first finalize; the retry still gets its result.
+    retry = finalize(client, upload_id, 'key-1', body={})
+    assert retry.status_code == 200 and retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json()['data'] == {'upload_id': upload_id, 'defect_id': defect_id}
+    assert defect_count(client) == 1
+    assert client.get(f"/defect/{defect_id}").get_json()['modes'][0]['image_url']
+
+
+def test_key_of_another_upload_is_rejected(client):
+    first, second = start_upload(client), start_upload(client)
+    assert finalize(client, first, 'key-1').status_code == 200
+    assert finalize(client, second, 'key-1').status_code == 422
+    assert finalize(client, second, 'key-2').status_code == 200
+    assert defect_count(client) == 2
+
+
+def test_finalized_upload_without_its_key_is_404(client):
+    upload_id = start_upload(client)
+    assert finalize(client, upload_id, 'key-1').status_code == 200
+    assert finalize(client, upload_id, 'key-2').status_code == 404
+    assert defect_count(client) == 1
+
+
+def test_finalize_requires_a_key_and_complete_files(client):
+    upload_id = start_upload(client, complete=False)
+    assert finalize(client, upload_id, None).status_code == 400
+    assert finalize(client, upload_id, 'k' * 129).status_code == 400
+    assert finalize(client, upload_id, 'key-1').status_code == 409
+    # A failed finalize does not use up the key.
+    assert put_chunk(client, upload_id, 0, 0, PDF).status_code == 200
+    assert put_chunk(client, upload_id, 1, 0, PNG).status_code == 200
+    assert finalize(client, upload_id, 'key-1').status_code == 200
+
+
+def test_chunks_are_checked(client):
+    upload_id = start_upload(client, complete=False)
+    # Past the received bytes: the client is told where to resume.
+    response = put_chunk(client, upload_id, 0, 5, PDF[5:])
+    assert response.status_code == 409 and response.get_json()['data']['received'] == 0
+    bad = client.put(f"/admin/uploads/{upload_id}/files/0?offset=0", data=PDF,
+                     headers={'X-Chunk-SHA256': hashlib.sha256(b'other').hexdigest()})
+    assert bad.status_code == 400
+    assert put_chunk(client, upload_id, 0, 0, PDF + b'extra').status_code == 400
+    assert put_chunk(client, upload_id, 5, 0, PDF).status_code == 404
+
+
+def test_file_failing_its_sha256_must_be_sent_again(client):
+    response = client.post('/admin/uploads', json={'files': [
+        {'filename': 'report.pdf', 'size': len(PDF), 'sha256': hashlib.sha256(b'x' * len(PDF)).hexdigest()},
+        {'filename': 'void.png', 'size': len(PNG)},
+    ]})
+    upload_id = response.get_json()['data']['upload_id']
+    assert put_chunk(client, upload_id, 0, 0, PDF).status_code == 200
+    assert put_chunk(client, upload_id, 1, 0, PNG).status_code == 200
+    assert finalize(client, upload_id, 'key-1').status_code == 409
+    status = client.get(f"/admin/uploads/{upload_id}").get_json()['data']
+    assert status['files'][0]['received'] == 0 and status['files'][1]['complete']
+    assert defect_count(client) == 0
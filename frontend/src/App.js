@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import PropTypes from 'prop-types';
 import './index.css'; // Assuming this contains global styles
 
@@ -13,9 +13,13 @@ function App() {
   const [editingDefect, setEditingDefect] = useState(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
-
+  // Query of the list on screen, read by the change stream handler
+  const activeQuery = useRef('');
+  // Whether the change stream is connected; without it, changes are followed by a refetch
+  const streaming = useRef(false);
 
   const fetchDefects = async (query = '') => {
+    activeQuery.current = query;
     try {
       setLoading(true);
       setError(null);
@@ -37,12 +41,53 @@ function App() {
     fetchDefects();
   }, []);
 
+  // Patch the list from the server's change stream instead of refetching everything
+  useEffect(() => {
+    const source = new EventSource('/defect/changes');
+    source.onopen = () => { streaming.current = true; };
+    source.onerror = () => { streaming.current = false; };
+
+    const refreshDefect = async (defectId, isNew) => {
+      const res = await fetch(`/defect/${defectId}`);
+      if (res.status === 404) {
+        setDefects(prev => prev.filter(d => d.id !== defectId));
+        return;
+      }
+      if (!res.ok) return;
+      const defect = await res.json();
+      setDefects(prev => {
+        if (prev.some(d => d.id === defectId)) {
+          return prev.map(d => (d.id === defectId ? defect : d));
+        }
+        // New defects only join an unfiltered list; a search shows them on its next run
+        return isNew && !activeQuery.current ? [defect, ...prev] : prev;
+      });
+    };
+
+    source.onmessage = (event) => {
+      const change = JSON.parse(event.data);
+      if (change.type === 'defect.deleted') {
+        setDefects(prev => prev.filter(d => d.id !== change.defect_id));
+      } else {
+        refreshDefect(change.defect_id, change.type === 'defect.created').catch(err => console.error(err));
+      }
+    };
+    // Changes were missed (e.g. after a long disconnect): reload the list
+    source.addEventListener('reset', () => fetchDefects(activeQuery.current));
+
+    return () => source.close();
+  }, []);
+
   const handleSearch = () => {
     fetchDefects(searchQuery);
   };
 
+  const refetchUnlessStreaming = () => {
+    if (!streaming.current) fetchDefects(activeQuery.current);
+  };
+
   const handleUpload = () => {
-    fetchDefects();
+    refetchUnlessStreaming();
   };
 
   const handleEdit = (defect) => {
@@ -63,7 +108,7 @@ function App() {
         if (!res.ok) {
           throw new Error("Failed to delete defect");
         }
-        fetchDefects();
+        setDefects(prev => prev.filter(d => d.id !== defectId));
       } catch (error){
         console.error("Error deleting defect", error);
         setError("Failed to delete defect.");
@@ -133,7 +178,7 @@ function App() {
         throw new Error("Failed to update the defect");
       }
       setEditingDefect(null);
-      fetchDefects();
+      refetchUnlessStreaming();
     } catch(error){
       console.error("Error updating defect", error);
       setError("Failed to update defect");